@@ -3,13 +3,14 @@ API Routes pour l'application mobile
 Endpoints REST pour Android et iOS
 """
 import datetime as dt
-from flask import jsonify, request
+from functools import wraps
+from flask import g, jsonify, request
 from flask_jwt_extended import jwt_required, get_jwt_identity, create_access_token
 from sqlalchemy.orm import joinedload
-from sqlalchemy import or_ as sql_or_
-from app import app, db
+from sqlalchemy import func, or_ as sql_or_
+from app import app, db, load_principal, apply_stock_deltas, _lock_stock_products, stock_levels_at, stock_consumption, LowStockItem, PLANT_WIDE_STOCK_ID
 from app import (
-    User, Machine, FollowedMachine, Counter, Product, Stock, StockProduct,
+    User, Machine, FollowedMachine, Counter, Product, Stock, StockProduct, StockSnapshot,
     PreventiveReport, PreventiveComponent, MaintenanceEntry, MaintenanceEntryValue,
     CorrectiveMaintenance, CorrectiveMaintenanceProduct, CounterLog,
     ChecklistTemplate, ChecklistColumn, ChecklistTemplateRow, ChecklistTemplateRowValue, ChecklistInstance, ChecklistInstanceValue, MaintenanceProgress
@@ -18,6 +19,34 @@ from app import (
 
 # ==================== AUTHENTIFICATION ====================
 
+def api_login_required(f):
+    """Jeton JWT valide d'un utilisateur existant, chargé par load_principal (cache) dans g.principal"""
+    @wraps(f)
+    @jwt_required()
+    def decorated_function(*args, **kwargs):
+        try:
+            # Identifiant entier comme pour les sessions web : même entrée du cache, invalidée ensemble
+            principal = load_principal(int(get_jwt_identity()))
+        except (TypeError, ValueError):
+            principal = None
+        if principal is None:
+            return jsonify({'error': 'Utilisateur non trouvé'}), 401
+        g.principal = principal
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def api_admin_or_technician_required(f):
+    """Comme admin_or_technician_required pour les routes de l'API"""
+    @wraps(f)
+    @api_login_required
+    def decorated_function(*args, **kwargs):
+        if not (g.principal.is_admin or g.principal.is_technician):
+            return jsonify({'error': 'Accès réservé aux administrateurs et techniciens'}), 403
+        return f(*args, **kwargs)
+    return decorated_function
+
+
 @app.route('/api/v1/auth/login', methods=['POST'])
 def api_login():
     """Authentification pour l'application mobile"""
@@ -52,14 +81,10 @@ def api_login():
 
 
 @app.route('/api/v1/auth/me', methods=['GET'])
-@jwt_required()
+@api_login_required
 def api_get_current_user():
     """Récupérer les informations de l'utilisateur connecté"""
-    user_id = get_jwt_identity()
-    user = User.query.get(user_id)
-    
-    if not user:
-        return jsonify({'error': 'Utilisateur non trouvé'}), 404
+    user = g.principal
     
     return jsonify({
         'success': True,
@@ -74,10 +99,10 @@ def api_get_current_user():
 # ==================== MACHINES ====================
 
 @app.route('/api/v1/machines', methods=['GET'])
-@jwt_required()
+@api_login_required
 def api_get_machines():
     """Récupérer la liste des machines"""
-    user_id = get_jwt_identity()
+    user_id = g.principal.id
     
     # Récupérer toutes les machines racines avec leurs enfants
     root_machines = Machine.query.filter_by(parent_id=None).options(
@@ -127,7 +152,7 @@ def api_get_machines():
 
 
 @app.route('/api/v1/machines/<int:machine_id>', methods=['GET'])
-@jwt_required()
+@api_login_required
 def api_get_machine(machine_id):
     """Récupérer les détails d'une machine"""
     machine = Machine.query.options(
@@ -237,10 +262,10 @@ def api_get_machine(machine_id):
 
 
 @app.route('/api/v1/machines/<int:machine_id>/follow', methods=['POST'])
-@jwt_required()
+@api_login_required
 def api_follow_machine(machine_id):
     """Suivre une machine"""
-    user_id = get_jwt_identity()
+    user_id = g.principal.id
     machine = Machine.query.get_or_404(machine_id)
     
     # Vérifier si déjà suivie
@@ -264,10 +289,10 @@ def api_follow_machine(machine_id):
 
 
 @app.route('/api/v1/machines/<int:machine_id>/unfollow', methods=['POST'])
-@jwt_required()
+@api_login_required
 def api_unfollow_machine(machine_id):
     """Ne plus suivre une machine"""
-    user_id = get_jwt_identity()
+    user_id = g.principal.id
     
     followed = FollowedMachine.query.filter_by(
         user_id=user_id,
@@ -290,7 +315,7 @@ def api_unfollow_machine(machine_id):
 # ==================== MAINTENANCES PRÉVENTIVES ====================
 
 @app.route('/api/v1/maintenances/preventive', methods=['GET'])
-@jwt_required()
+@api_login_required
 def api_get_preventive_maintenances():
     """Récupérer les maintenances préventives"""
     machine_id = request.args.get('machine_id', type=int)
@@ -331,7 +356,7 @@ def api_get_preventive_maintenances():
 
 
 @app.route('/api/v1/maintenances/preventive/<int:entry_id>', methods=['GET'])
-@jwt_required()
+@api_login_required
 def api_get_preventive_maintenance(entry_id):
     """Récupérer une maintenance préventive spécifique"""
     entry = MaintenanceEntry.query.options(
@@ -371,10 +396,10 @@ def api_get_preventive_maintenance(entry_id):
 
 
 @app.route('/api/v1/maintenances/preventive', methods=['POST'])
-@jwt_required()
+@api_admin_or_technician_required
 def api_create_preventive_maintenance():
     """Créer une maintenance préventive"""
-    user_id = get_jwt_identity()
+    user_id = g.principal.id
     data = request.get_json()
     
     if not data:
@@ -455,7 +480,7 @@ def api_create_preventive_maintenance():
 # ==================== MAINTENANCES CORRECTIVES ====================
 
 @app.route('/api/v1/maintenances/corrective', methods=['GET'])
-@jwt_required()
+@api_login_required
 def api_get_corrective_maintenances():
     """Récupérer les maintenances correctives"""
     machine_id = request.args.get('machine_id', type=int)
@@ -493,7 +518,7 @@ def api_get_corrective_maintenances():
 
 
 @app.route('/api/v1/maintenances/corrective/<int:maintenance_id>', methods=['GET'])
-@jwt_required()
+@api_login_required
 def api_get_corrective_maintenance(maintenance_id):
     """Récupérer une maintenance corrective spécifique"""
     maintenance = CorrectiveMaintenance.query.options(
@@ -523,10 +548,10 @@ def api_get_corrective_maintenance(maintenance_id):
 
 
 @app.route('/api/v1/maintenances/corrective', methods=['POST'])
-@jwt_required()
+@api_admin_or_technician_required
 def api_create_corrective_maintenance():
     """Créer une maintenance corrective"""
-    user_id = get_jwt_identity()
+    user_id = g.principal.id
     data = request.get_json()
     
     if not data:
@@ -560,6 +585,7 @@ def api_create_corrective_maintenance():
     if stock_id:
         maintenance.stock_id = stock_id
     
+    used = {}
     for prod_data in products:
         product_id = prod_data.get('product_id')
         quantity = prod_data.get('quantity', 0)
@@ -567,15 +593,9 @@ def api_create_corrective_maintenance():
         if not product_id or quantity <= 0:
             continue
         
-        # Vérifier et mettre à jour le stock
         if stock_id:
-            stock_product = StockProduct.query.filter_by(
-                stock_id=stock_id,
-                product_id=product_id
-            ).first()
-            
-            if stock_product:
-                stock_product.quantity = max(0.0, stock_product.quantity - quantity)
+            key = (int(stock_id), int(product_id))
+            used[key] = used.get(key, 0) + quantity
         
         # Ajouter le produit à la maintenance
         maint_product = CorrectiveMaintenanceProduct(
@@ -585,6 +605,18 @@ def api_create_corrective_maintenance():
         )
         db.session.add(maint_product)
     
+    if used:
+        # Sortie du stock : quantités lues sous verrou, jamais sous zéro (produits présents dans le stock)
+        locked = _lock_stock_products(set(used))
+        try:
+            apply_stock_deltas(
+                {key: -min(quantity, locked[key][1]) for key, quantity in used.items() if key in locked},
+                source="sortie", user_id=user_id, _locked=locked,
+            )
+        except ValueError as exc:
+            db.session.rollback()
+            return jsonify({'error': str(exc)}), 409
+    
     try:
         db.session.commit()
         return jsonify({
@@ -603,7 +635,7 @@ def api_create_corrective_maintenance():
 # ==================== CHECKLISTS ====================
 
 @app.route('/api/v1/checklists', methods=['GET'])
-@jwt_required()
+@api_login_required
 def api_get_checklists():
     """Récupérer les checklists"""
     machine_id = request.args.get('machine_id', type=int)
@@ -646,10 +678,10 @@ def api_get_checklists():
 
 
 @app.route('/api/v1/checklists/<int:template_id>/fill', methods=['POST'])
-@jwt_required()
+@api_admin_or_technician_required
 def api_fill_checklist(template_id):
     """Remplir une checklist"""
-    user_id = get_jwt_identity()
+    user_id = g.principal.id
     data = request.get_json()
     
     if not data:
@@ -721,7 +753,7 @@ def api_fill_checklist(template_id):
 # ==================== STOCKS ET PRODUITS ====================
 
 @app.route('/api/v1/stocks', methods=['GET'])
-@jwt_required()
+@api_login_required
 def api_get_stocks():
     """Récupérer la liste des stocks"""
     stocks = Stock.query.order_by(Stock.name).all()
@@ -737,7 +769,7 @@ def api_get_stocks():
 
 
 @app.route('/api/v1/stocks/<int:stock_id>', methods=['GET'])
-@jwt_required()
+@api_login_required
 def api_get_stock(stock_id):
     """Récupérer les détails d'un stock avec ses produits"""
     stock = Stock.query.options(
@@ -761,8 +793,114 @@ def api_get_stock(stock_id):
     }), 200
 
 
+def _parse_api_datetime(value, default=None):
+    """Date ISO 8601 d'un paramètre de requête (None si absente, ValueError si invalide)"""
+    if not value:
+        return default
+    return dt.datetime.fromisoformat(value)
+
+
+@app.route('/api/v1/stocks/<int:stock_id>/levels', methods=['GET'])
+@api_login_required
+def api_get_stock_levels(stock_id):
+    """Quantités et valorisation d'un stock à une date donnée (?at=AAAA-MM-JJTHH:MM)"""
+    stock = Stock.query.get_or_404(stock_id)
+    try:
+        at = _parse_api_datetime(request.args.get('at'), dt.datetime.utcnow())
+    except ValueError:
+        return jsonify({'error': 'Date invalide'}), 400
+
+    levels = stock_levels_at(stock.id, at)
+    if levels is None:
+        first_known_at = db.session.query(func.min(StockSnapshot.taken_at)).filter(StockSnapshot.stock_id == stock.id).scalar()
+        return jsonify({
+            'error': 'Quantités inconnues avant la première photographie du stock',
+            'first_known_at': first_known_at.isoformat() if first_known_at else None
+        }), 404
+    products = {p.id: p for p in Product.query.filter(Product.id.in_(list(levels))).all()} if levels else {}
+    items = []
+    total_value = 0.0
+    for product_id, quantity in sorted(levels.items()):
+        product = products.get(product_id)
+        value = quantity * (product.price or 0.0) if product else 0.0
+        total_value += value
+        items.append({
+            'product_id': product_id,
+            'product_name': product.name if product else None,
+            'product_code': product.code if product else None,
+            'quantity': quantity,
+            'value': value
+        })
+
+    return jsonify({
+        'success': True,
+        'stock_id': stock.id,
+        'at': at.isoformat(),
+        'total_value': total_value,
+        'products': items
+    }), 200
+
+
+@app.route('/api/v1/stocks/<int:stock_id>/consumption', methods=['GET'])
+@api_login_required
+def api_get_stock_consumption(stock_id):
+    """Consommation d'un stock sur une période (?start=...&end=..., 30 derniers jours par défaut)"""
+    stock = Stock.query.get_or_404(stock_id)
+    try:
+        end = _parse_api_datetime(request.args.get('end'), dt.datetime.utcnow())
+        start = _parse_api_datetime(request.args.get('start'), end - dt.timedelta(days=30))
+    except ValueError:
+        return jsonify({'error': 'Date invalide'}), 400
+
+    consumption = stock_consumption(stock.id, start, end)
+    products = {p.id: p for p in Product.query.filter(Product.id.in_(list(consumption))).all()} if consumption else {}
+
+    return jsonify({
+        'success': True,
+        'stock_id': stock.id,
+        'start': start.isoformat(),
+        'end': end.isoformat(),
+        'products': [{
+            'product_id': product_id,
+            'product_name': products[product_id].name if product_id in products else None,
+            'product_code': products[product_id].code if product_id in products else None,
+            'quantity': quantity
+        } for product_id, quantity in sorted(consumption.items())]
+    }), 200
+
+
+@app.route('/api/v1/reorder', methods=['GET'])
+@api_login_required
+def api_get_reorder_list():
+    """Produits à réapprovisionner (sous le stock minimum), pour l'usine ou un stock (?stock_id=...)"""
+    stock_id = request.args.get('stock_id', PLANT_WIDE_STOCK_ID, type=int)
+    items = (
+        LowStockItem.query
+        .options(joinedload(LowStockItem.product))
+        .filter_by(stock_id=stock_id)
+        .order_by(LowStockItem.crossed_at)
+        .all()
+    )
+
+    return jsonify({
+        'success': True,
+        'stock_id': stock_id or None,
+        'products': [{
+            'product_id': item.product_id,
+            'product_name': item.product.name,
+            'product_code': item.product.code,
+            'supplier_name': item.product.supplier_name,
+            'supplier_reference': item.product.supplier_reference,
+            'quantity': item.quantity,
+            'minimum_stock': item.minimum_stock,
+            'to_order': item.minimum_stock - item.quantity,
+            'below_minimum_since': item.crossed_at.isoformat()
+        } for item in items]
+    }), 200
+
+
 @app.route('/api/v1/products', methods=['GET'])
-@jwt_required()
+@api_login_required
 def api_get_products():
     """Récupérer la liste des produits"""
     search = request.args.get('search', '')
@@ -798,7 +936,7 @@ def api_get_products():
 # ==================== COMPTEURS ====================
 
 @app.route('/api/v1/machines/<int:machine_id>/counters', methods=['GET'])
-@jwt_required()
+@api_login_required
 def api_get_machine_counters(machine_id):
     """Récupérer les compteurs d'une machine"""
     machine = Machine.query.get_or_404(machine_id)
@@ -824,10 +962,10 @@ def api_get_machine_counters(machine_id):
 
 
 @app.route('/api/v1/machines/<int:machine_id>/counters', methods=['POST'])
-@jwt_required()
+@api_admin_or_technician_required
 def api_update_counter(machine_id):
     """Mettre à jour un compteur"""
-    user_id = get_jwt_identity()
+    user_id = g.principal.id
     data = request.get_json()
     
     if not data:
@@ -912,7 +1050,7 @@ def api_update_counter(machine_id):
 # ==================== RAPPORTS DE MAINTENANCE ====================
 
 @app.route('/api/v1/machines/<int:machine_id>/reports', methods=['GET'])
-@jwt_required()
+@api_login_required
 def api_get_machine_reports(machine_id):
     """Récupérer les rapports de maintenance préventive d'une machine"""
     machine = Machine.query.get_or_404(machine_id)
@@ -946,10 +1084,10 @@ def api_get_machine_reports(machine_id):
 # ==================== DASHBOARD ====================
 
 @app.route('/api/v1/dashboard', methods=['GET'])
-@jwt_required()
+@api_login_required
 def api_get_dashboard():
     """Récupérer les données du dashboard pour l'utilisateur"""
-    user_id = get_jwt_identity()
+    user_id = g.principal.id
     
     # Récupérer les machines suivies
     followed_machines = FollowedMachine.query.filter_by(user_id=user_id).all()
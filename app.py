@@ -1,32 +1,35 @@
 import datetime as dt
+import enum
+import hashlib
 import os
+import socket
+import sqlite3
 import csv
 import json
 import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from urllib.parse import quote
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.security import generate_password_hash, check_password_hash
-from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
+from flask_login import AnonymousUserMixin, LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 
-from flask import Flask, redirect, render_template, request, url_for, flash, Response, make_response, abort, send_from_directory, jsonify, session
+from flask import Flask, Request, redirect, render_template, request, url_for, flash, Response, make_response, abort, send_file, jsonify, session, has_request_context, g
 from werkzeug.utils import secure_filename
-from translations import get_translation, get_language_from_session, TRANSLATIONS
-from openpyxl import Workbook, load_workbook
-import qrcode
-from PIL import Image
-from openpyxl.styles import Font, Alignment
-from openpyxl.utils import get_column_letter
+from translations import get_translation, get_translator, get_language_from_session, TRANSLATIONS
+from template_i18n import LocalizedEnvironment
+from photo_store import (
+    ContentStore, PhotoVariants, PHOTO_VARIANT_SIZES, PHOTO_VARIANT_FORMATS, file_sha256, normalize_image, write_atomic,
+)
 from io import BytesIO, StringIO
-from reportlab.lib.pagesizes import A4
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.lib.units import cm
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
-from reportlab.lib import colors
-from reportlab.lib.enums import TA_CENTER, TA_LEFT
+# openpyxl, reportlab et qrcode sont importés dans les fonctions d'export, d'import,
+# de PDF et de QR code : chaque worker démarre sans les charger (temps et mémoire)
 from flask_sqlalchemy import SQLAlchemy
 from flask_jwt_extended import JWTManager
 from flask_cors import CORS
-from sqlalchemy import CheckConstraint, inspect, text, func
+from sqlalchemy import CheckConstraint, event, func, or_, case
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import joinedload, selectinload
 from sqlalchemy.exc import IntegrityError
 from functools import wraps
@@ -40,11 +43,44 @@ REPORT_PHOTOS_FOLDER = BASE_DIR / "uploads" / "report_photos"
 REPORT_PHOTOS_FOLDER.mkdir(parents=True, exist_ok=True)
 EXCEL_FILES_FOLDER = BASE_DIR / "uploads" / "excel_files"
 EXCEL_FILES_FOLDER.mkdir(parents=True, exist_ok=True)
+JOB_FILES_FOLDER = BASE_DIR / "uploads" / "job_files"
+JOB_FILES_FOLDER.mkdir(parents=True, exist_ok=True)
+# Photos de rapports, stockées sous l'empreinte de leur contenu
+REPORT_PHOTO_STORE = ContentStore(BASE_DIR / "uploads" / "photo_store")
+# Miniatures et tailles moyennes de toutes les photos, par empreinte de l'original
+PHOTO_VARIANTS = PhotoVariants(BASE_DIR / "uploads" / "photo_variants",
+                               workers=int(os.environ.get("PHOTO_VARIANT_WORKERS", "2")))
+# Normalisation des photos reçues : plus grand côté conservé et qualité de recompression
+PHOTO_MAX_EDGE = int(os.environ.get("PHOTO_MAX_EDGE", "2560"))
+PHOTO_JPEG_QUALITY = int(os.environ.get("PHOTO_JPEG_QUALITY", "85"))
+# Budget d'un envoi de photos (taille totale de la requête et nombre de fichiers)
+PHOTO_UPLOAD_BUDGET = int(os.environ.get("PHOTO_UPLOAD_BUDGET_MB", "80")) * 1024 * 1024
+PHOTO_UPLOAD_MAX_FILES = int(os.environ.get("PHOTO_UPLOAD_MAX_FILES", "20"))
+photo_ingest_executor = ThreadPoolExecutor(max_workers=int(os.environ.get("PHOTO_INGEST_WORKERS", "2")),
+                                           thread_name_prefix="photo-ingest")
+# URL versionnées (?v=empreinte) des fichiers servis : leur contenu ne change jamais
+FILE_CACHE_MAX_AGE = 365 * 24 * 3600
+# Envoi des fichiers délégué au proxy frontal : "x-sendfile" (Apache, lighttpd) ou "x-accel-redirect" (nginx)
+FILE_DELIVERY = os.environ.get("FILE_DELIVERY", "").lower()
+# nginx : location interne (internal; alias vers le répertoire de l'application) visée par X-Accel-Redirect
+X_ACCEL_PREFIX = os.environ.get("X_ACCEL_PREFIX", "/_protected/")
 ALLOWED_EXTENSIONS = {'pdf'}
 ALLOWED_IMAGE_EXTENSIONS = {'jpg', 'jpeg', 'png', 'gif', 'webp'}
 ALLOWED_EXCEL_EXTENSIONS = {'xlsx', 'xls'}
 
+class AppRequest(Request):
+    """Requête dont la taille maximale du corps peut être fixée par vue, avant sa lecture"""
+    body_limit = None
+
+    @property
+    def max_content_length(self):
+        return self.body_limit if self.body_limit is not None else super().max_content_length
+
+
 app = Flask(__name__)
+app.request_class = AppRequest
+# Templates compilés une fois par langue, traductions littérales résolues à la compilation
+app.jinja_environment = LocalizedEnvironment
 
 # Configuration de la base de données
 # Sur Render, utiliser PostgreSQL via DATABASE_URL, sinon SQLite en local
@@ -64,6 +100,67 @@ else:
     app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{DB_PATH}"
 
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+
+# Réglages du moteur selon la base (surcharges par variables d'environnement)
+# SQLite : journal WAL (lectures non bloquées par une écriture), attente d'un verrou
+# au lieu d'échouer aussitôt avec "database is locked"
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_JOURNAL_MODE = os.environ.get("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_FOREIGN_KEYS = os.environ.get("SQLITE_FOREIGN_KEYS", "1") == "1"
+SQLITE_MMAP_SIZE = int(os.environ.get("SQLITE_MMAP_SIZE_MB", "128")) * 1024 * 1024
+# PostgreSQL : connexions par worker (pool_size + max_overflow), multipliées par le nombre de workers.
+# Par défaut le pool suit les threads du worker (GUNICORN_THREADS, même défaut que
+# gunicorn.conf.py) plus le planificateur : 5 connexions gardées, les autres ouvertes
+# au besoin, pour qu'aucun thread n'attende une connexion jusqu'à PG_POOL_TIMEOUT
+WORKER_THREADS = int(os.environ.get("GUNICORN_THREADS", "32"))
+PG_POOL_SIZE = int(os.environ.get("PG_POOL_SIZE", "5"))
+PG_MAX_OVERFLOW = int(os.environ.get("PG_MAX_OVERFLOW", max(WORKER_THREADS + 1 - PG_POOL_SIZE, 0)))
+PG_POOL_TIMEOUT = int(os.environ.get("PG_POOL_TIMEOUT_SECONDS", "10"))
+PG_POOL_RECYCLE = int(os.environ.get("PG_POOL_RECYCLE_SECONDS", "1800"))
+PG_STATEMENT_TIMEOUT_MS = int(os.environ.get("PG_STATEMENT_TIMEOUT_MS", "30000"))
+# Requêtes préparées côté serveur après N exécutions ("off" derrière un pgbouncer en mode transaction)
+PG_PREPARE_THRESHOLD = os.environ.get("PG_PREPARE_THRESHOLD", "5")
+
+
+def database_engine_options(uri):
+    """Options de create_engine pour l'URI donnée"""
+    if uri.startswith("sqlite"):
+        # busy_timeout est appliqué par set_sqlite_pragmas ; timeout du module sqlite3 aligné
+        return {"connect_args": {"timeout": SQLITE_BUSY_TIMEOUT_MS / 1000}}
+    connect_args = {}
+    if uri.startswith("postgresql"):
+        connect_args["options"] = f"-c statement_timeout={PG_STATEMENT_TIMEOUT_MS}"
+        if "+psycopg" in uri:
+            connect_args["prepare_threshold"] = None if PG_PREPARE_THRESHOLD == "off" else int(PG_PREPARE_THRESHOLD)
+    return {
+        "pool_size": PG_POOL_SIZE,
+        "max_overflow": PG_MAX_OVERFLOW,
+        "pool_timeout": PG_POOL_TIMEOUT,
+        "pool_recycle": PG_POOL_RECYCLE,
+        # Connexion coupée par le serveur ou un proxy : détectée avant usage plutôt qu'en pleine requête
+        "pool_pre_ping": True,
+        "connect_args": connect_args,
+    }
+
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """Réglages de chaque nouvelle connexion SQLite (sans effet sur les autres bases)"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+    cursor.execute(f"PRAGMA journal_mode = {SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous = {SQLITE_SYNCHRONOUS}")
+    cursor.execute(f"PRAGMA foreign_keys = {'ON' if SQLITE_FOREIGN_KEYS else 'OFF'}")
+    cursor.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+    cursor.close()
+
+
+app.config["SQLALCHEMY_ENGINE_OPTIONS"] = database_engine_options(app.config["SQLALCHEMY_DATABASE_URI"])
+# send_file n'envoie plus les octets lui-même : le proxy lit le fichier désigné par l'en-tête
+app.config["USE_X_SENDFILE"] = FILE_DELIVERY in ("x-sendfile", "x-accel-redirect")
 app.config["SECRET_KEY"] = os.environ.get("SECRET_KEY", "change-me-in-production")
 
 # Configuration JWT pour l'API mobile
@@ -82,122 +179,130 @@ login_manager.login_view = "splash"
 login_manager.login_message = None
 login_manager.login_message_category = "info"
 
-# Fonctions de permissions (doivent être définies avant le context processor)
-def can_view_params():
-    """Vérifie si l'utilisateur peut voir les paramètres"""
-    if not current_user.is_authenticated:
-        return False
-    return current_user.user_type == "admin"
-
-
-def can_edit_machines():
-    """Vérifie si l'utilisateur peut modifier/supprimer des machines"""
-    if not current_user.is_authenticated:
-        return False
-    return current_user.user_type == "admin"
-
-
-def can_create_checklist():
-    """Vérifie si l'utilisateur peut créer une check list"""
-    if not current_user.is_authenticated:
-        return False
-    return current_user.user_type in ["admin"]
-
-
-def can_create_preventive_template():
-    """Vérifie si l'utilisateur peut créer un modèle de maintenance préventive"""
-    if not current_user.is_authenticated:
-        return False
-    return current_user.user_type in ["admin"]
-
-
-def can_create_corrective_maintenance():
-    """Vérifie si l'utilisateur peut créer une maintenance corrective"""
-    if not current_user.is_authenticated:
-        return False
-    return current_user.user_type in ["admin", "technicien"]
-
-
-def can_delete_machines():
-    """Vérifie si l'utilisateur peut supprimer des machines"""
-    if not current_user.is_authenticated:
-        return False
-    return current_user.user_type == "admin"
-
-
-def can_delete_stocks():
-    """Vérifie si l'utilisateur peut supprimer des stocks"""
-    if not current_user.is_authenticated:
-        return False
-    return current_user.user_type == "admin"
-
-
-def can_delete_products():
-    """Vérifie si l'utilisateur peut supprimer des produits"""
-    if not current_user.is_authenticated:
-        return False
-    return current_user.user_type == "admin"
-
-
-def can_edit_stocks_products():
-    """Vérifie si l'utilisateur peut modifier des stocks/produits"""
-    if not current_user.is_authenticated:
-        return False
-    return current_user.user_type in ["admin", "gestionnaire"]
-
-
-def can_edit_machines_maintenances():
-    """Vérifie si l'utilisateur peut modifier des machines/maintenances"""
-    if not current_user.is_authenticated:
-        return False
-    return current_user.user_type in ["admin", "technicien"]
-
-
-def can_add_documentation():
-    """Vérifie si l'utilisateur peut ajouter de la documentation"""
-    if not current_user.is_authenticated:
-        return False
-    return current_user.user_type in ["admin"]
-
-
-def can_view_documentation():
-    """Vérifie si l'utilisateur peut voir la documentation"""
-    return current_user.is_authenticated
-
-
-def can_access_chat():
-    """Vérifie si l'utilisateur peut accéder au chat"""
-    if not current_user.is_authenticated:
-        return False
-    return current_user.user_type in ["admin", "spectateur", "gestionnaire", "technicien"]
-
-
-def can_access_qrcode():
-    """Vérifie si l'utilisateur peut accéder au QR code"""
-    if not current_user.is_authenticated:
-        return False
-    return current_user.user_type in ["admin", "spectateur", "gestionnaire", "technicien"]
-
-
-def is_readonly_machines_maintenances():
-    """Vérifie si l'utilisateur est en mode lecture seule sur machines/maintenances"""
-    if not current_user.is_authenticated:
-        return False
-    return current_user.user_type == "gestionnaire"
-
-
-def is_readonly_stocks_products():
-    """Vérifie si l'utilisateur est en mode lecture seule sur stocks/produits"""
-    if not current_user.is_authenticated:
-        return False
-    return current_user.user_type == "technicien"
+# Droits applicatifs : un bit par droit, calculé une fois par utilisateur à partir de son rôle
+class Capability(enum.IntFlag):
+    VIEW_PARAMS = enum.auto()
+    EDIT_MACHINES = enum.auto()
+    CREATE_CHECKLIST = enum.auto()
+    CREATE_PREVENTIVE_TEMPLATE = enum.auto()
+    CREATE_CORRECTIVE_MAINTENANCE = enum.auto()
+    DELETE_MACHINES = enum.auto()
+    DELETE_STOCKS = enum.auto()
+    DELETE_PRODUCTS = enum.auto()
+    EDIT_STOCKS_PRODUCTS = enum.auto()
+    EDIT_MACHINES_MAINTENANCES = enum.auto()
+    ADD_DOCUMENTATION = enum.auto()
+    VIEW_DOCUMENTATION = enum.auto()
+    ACCESS_CHAT = enum.auto()
+    ACCESS_QRCODE = enum.auto()
+    READONLY_MACHINES_MAINTENANCES = enum.auto()
+    READONLY_STOCKS_PRODUCTS = enum.auto()
+    SPECTATOR = enum.auto()
+
+
+_COMMON_CAPABILITIES = Capability.VIEW_DOCUMENTATION | Capability.ACCESS_CHAT | Capability.ACCESS_QRCODE
+
+ROLE_CAPABILITIES = {
+    "admin": (
+        _COMMON_CAPABILITIES | Capability.VIEW_PARAMS | Capability.EDIT_MACHINES | Capability.CREATE_CHECKLIST
+        | Capability.CREATE_PREVENTIVE_TEMPLATE | Capability.CREATE_CORRECTIVE_MAINTENANCE
+        | Capability.DELETE_MACHINES | Capability.DELETE_STOCKS | Capability.DELETE_PRODUCTS
+        | Capability.EDIT_STOCKS_PRODUCTS | Capability.EDIT_MACHINES_MAINTENANCES | Capability.ADD_DOCUMENTATION
+    ),
+    "technicien": (
+        _COMMON_CAPABILITIES | Capability.CREATE_CORRECTIVE_MAINTENANCE | Capability.EDIT_MACHINES_MAINTENANCES
+        | Capability.READONLY_STOCKS_PRODUCTS
+    ),
+    "gestionnaire": (
+        _COMMON_CAPABILITIES | Capability.EDIT_STOCKS_PRODUCTS | Capability.READONLY_MACHINES_MAINTENANCES
+    ),
+    "spectateur": _COMMON_CAPABILITIES | Capability.SPECTATOR,
+}
+# Rôle inconnu : tout utilisateur connecté peut consulter la documentation
+DEFAULT_CAPABILITIES = Capability.VIEW_DOCUMENTATION
+
+# Attributs exposés par l'utilisateur courant (Python et templates : current_user.can_edit_machines)
+PERMISSION_ATTRIBUTES = {
+    "can_view_params": Capability.VIEW_PARAMS,
+    "can_edit_machines": Capability.EDIT_MACHINES,
+    "can_create_checklist": Capability.CREATE_CHECKLIST,
+    "can_create_preventive_template": Capability.CREATE_PREVENTIVE_TEMPLATE,
+    "can_create_corrective_maintenance": Capability.CREATE_CORRECTIVE_MAINTENANCE,
+    "can_delete_machines": Capability.DELETE_MACHINES,
+    "can_delete_stocks": Capability.DELETE_STOCKS,
+    "can_delete_products": Capability.DELETE_PRODUCTS,
+    "can_edit_stocks_products": Capability.EDIT_STOCKS_PRODUCTS,
+    "can_edit_machines_maintenances": Capability.EDIT_MACHINES_MAINTENANCES,
+    "can_add_documentation": Capability.ADD_DOCUMENTATION,
+    "can_view_documentation": Capability.VIEW_DOCUMENTATION,
+    "can_access_chat": Capability.ACCESS_CHAT,
+    "can_access_qrcode": Capability.ACCESS_QRCODE,
+    "is_readonly_machines_maintenances": Capability.READONLY_MACHINES_MAINTENANCES,
+    "is_readonly_stocks_products": Capability.READONLY_STOCKS_PRODUCTS,
+    "is_spectator": Capability.SPECTATOR,
+}
+
+
+class Principal(UserMixin):
+    """Utilisateur connecté : identité et droits précalculés.
+
+    Objet simple détaché de la session SQLAlchemy, partagé entre requêtes via
+    load_principal ; les vérifications de droits sont des lectures d'attributs.
+    Pour modifier l'utilisateur, recharger le modèle User (db.session.get).
+    """
+
+    def __init__(self, id, username, user_type):
+        self.id = id
+        self.username = username
+        self.user_type = user_type
+        self.capabilities = ROLE_CAPABILITIES.get(user_type, DEFAULT_CAPABILITIES)
+        self.is_admin = user_type == "admin"
+        self.is_technician = user_type == "technicien"
+        self.is_manager = user_type == "gestionnaire"
+        for attribute, capability in PERMISSION_ATTRIBUTES.items():
+            setattr(self, attribute, capability in self.capabilities)
+
+
+class AnonymousPrincipal(AnonymousUserMixin):
+    """Visiteur non connecté : aucun droit"""
+    id = None
+    username = None
+    user_type = None
+    capabilities = Capability(0)
+    is_admin = is_technician = is_manager = False
+
+
+for _attribute in PERMISSION_ATTRIBUTES:
+    setattr(AnonymousPrincipal, _attribute, False)
+
+login_manager.anonymous_user = AnonymousPrincipal
+
+# Utilisateurs chargés : {user_id: (principal, expiration)}. Invalidés localement à la
+# suppression d'un utilisateur ; la durée de vie borne le décalage entre workers.
+PRINCIPAL_CACHE_TTL = int(os.environ.get("PRINCIPAL_CACHE_TTL_SECONDS", "30"))
+_principal_cache = {}
+
+
+def invalidate_principal(user_id=None):
+    """Invalide l'utilisateur mis en cache, ou tous si user_id est None"""
+    if user_id is None:
+        _principal_cache.clear()
+    else:
+        _principal_cache.pop(user_id, None)
 
 
-def is_spectator():
-    """Vérifie si l'utilisateur est un spectateur (lecture seule partout)"""
-    if not current_user.is_authenticated:
-        return False
-    return current_user.user_type == "spectateur"
+def load_principal(user_id):
+    """Utilisateur (Principal) d'identifiant user_id, depuis le cache ou la base ; None s'il n'existe pas"""
+    cached = _principal_cache.get(user_id)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    row = db.session.query(User.id, User.username, User.user_type).filter(User.id == user_id).first()
+    if row is None:
+        _principal_cache.pop(user_id, None)
+        return None
+    principal = Principal(*row)
+    _principal_cache[user_id] = (principal, time.monotonic() + PRINCIPAL_CACHE_TTL)
+    return principal
 
 
 # Context processor pour rendre les traductions disponibles dans tous les templates
@@ -205,38 +310,21 @@ def is_spectator():
 def inject_translations():
     """Injecte les fonctions de traduction dans tous les templates"""
     lang = get_language_from_session(session)
-    def t(key):
-        """Fonction de traduction pour les templates"""
-        return get_translation(key, lang)
-    
-    # Injecter les fonctions de permissions dans les templates
+    # Clés calculées uniquement (t(job.label)) : les clés littérales sont traduites à la compilation
     return dict(
-        t=t, 
+        t=get_translator(lang), 
         current_lang=lang, 
         available_languages=['fr', 'es', 'en', 'it'],
-        can_view_params=can_view_params,
-        can_edit_machines=can_edit_machines,
-        can_create_checklist=can_create_checklist,
-        can_create_preventive_template=can_create_preventive_template,
-        can_create_corrective_maintenance=can_create_corrective_maintenance,
-        can_delete_machines=can_delete_machines,
-        can_delete_stocks=can_delete_stocks,
-        can_delete_products=can_delete_products,
-        can_edit_stocks_products=can_edit_stocks_products,
-        can_edit_machines_maintenances=can_edit_machines_maintenances,
-        can_add_documentation=can_add_documentation,
-        can_view_documentation=can_view_documentation,
-        can_access_chat=can_access_chat,
-        can_access_qrcode=can_access_qrcode,
-        is_readonly_machines_maintenances=is_readonly_machines_maintenances,
-        is_readonly_stocks_products=is_readonly_stocks_products,
-        is_spectator=is_spectator
     )
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # Flask-Login garde le résultat pour la durée de la requête (current_user)
+    try:
+        return load_principal(int(user_id))
+    except (TypeError, ValueError):
+        return None
 
 
 # Décorateurs pour la gestion des rôles
@@ -244,7 +332,7 @@ def admin_required(f):
     @wraps(f)
     @login_required
     def decorated_function(*args, **kwargs):
-        if current_user.user_type != "admin":
+        if not current_user.is_admin:
             flash("Accès refusé : cette fonctionnalité est réservée aux administrateurs.", "danger")
             return redirect(url_for("index"))
         return f(*args, **kwargs)
@@ -255,7 +343,7 @@ def admin_or_technician_required(f):
     @wraps(f)
     @login_required
     def decorated_function(*args, **kwargs):
-        if current_user.user_type not in ["admin", "technicien"]:
+        if not (current_user.is_admin or current_user.is_technician):
             flash("Accès refusé : cette fonctionnalité est réservée aux administrateurs et techniciens.", "danger")
             return redirect(url_for("index"))
         return f(*args, **kwargs)
@@ -266,7 +354,7 @@ def admin_or_manager_required(f):
     @wraps(f)
     @login_required
     def decorated_function(*args, **kwargs):
-        if current_user.user_type not in ["admin", "gestionnaire"]:
+        if not (current_user.is_admin or current_user.is_manager):
             flash("Accès refusé : cette fonctionnalité est réservée aux administrateurs et gestionnaires.", "danger")
             return redirect(url_for("index"))
         return f(*args, **kwargs)
@@ -275,16 +363,13 @@ def admin_or_manager_required(f):
 
 def can_edit_maintenance_entry(entry):
     """Vérifie si l'utilisateur peut modifier/supprimer un rapport de maintenance"""
-    if current_user.user_type == "admin":
+    if current_user.is_admin:
         return True
-    if current_user.user_type == "technicien" and entry.user_id == current_user.id:
+    if current_user.is_technician and entry.user_id == current_user.id:
         return True
     return False
 
 
-# Les fonctions de permissions sont définies au début du fichier (après le context processor)
-
-
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(80), unique=True, nullable=False)
@@ -421,9 +506,39 @@ class Movement(db.Model):
     dest_stock_id = db.Column(db.Integer, db.ForeignKey("stock.id"), index=True)
     created_at = db.Column(db.DateTime, nullable=False, default=dt.datetime.utcnow, index=True)
 
+    # Maintenance à l'origine d'une sortie de stock
+    maintenance_entry_id = db.Column(db.Integer, db.ForeignKey("maintenance_entry.id", ondelete="SET NULL"), nullable=True, index=True)
+    corrective_maintenance_id = db.Column(db.Integer, db.ForeignKey("corrective_maintenance.id", ondelete="SET NULL"), nullable=True, index=True)
+
     source_stock = db.relationship("Stock", foreign_keys=[source_stock_id])
     dest_stock = db.relationship("Stock", foreign_keys=[dest_stock_id])
     items = db.relationship("MovementItem", back_populates="movement", cascade="all, delete-orphan")
+    maintenance_entry = db.relationship("MaintenanceEntry", backref="movements")
+    corrective_maintenance = db.relationship("CorrectiveMaintenance", backref="movements")
+
+    @property
+    def is_maintenance_related(self):
+        return self.maintenance_entry_id is not None or self.corrective_maintenance_id is not None
+
+    @property
+    def maintenance_info(self):
+        if self.maintenance_entry is not None:
+            entry = self.maintenance_entry
+            return {
+                'type': 'préventive',
+                'name': entry.report.name,
+                'machine_name': entry.machine.name,
+                'machine_code': entry.machine.code
+            }
+        if self.corrective_maintenance is not None:
+            maintenance = self.corrective_maintenance
+            return {
+                'type': 'corrective',
+                'name': 'Maintenance corrective',
+                'machine_name': maintenance.machine.name,
+                'machine_code': maintenance.machine.code
+            }
+        return None
 
 
 class MovementItem(db.Model):
@@ -436,6 +551,65 @@ class MovementItem(db.Model):
     product = db.relationship("Product")
 
 
+class StockLedgerEntry(db.Model):
+    """Journal des variations de stock (ajout uniquement, jamais modifié)"""
+    __tablename__ = "stock_ledger"
+
+    id = db.Column(db.Integer, primary_key=True)
+    stock_id = db.Column(db.Integer, db.ForeignKey("stock.id"), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey("product.id"), nullable=False)
+    delta = db.Column(db.Float, nullable=False)
+    balance = db.Column(db.Float, nullable=False)  # Quantité après la variation
+    source = db.Column(db.String(30), nullable=False)  # entree, sortie, transfert, annulation_*, inventaire, produit...
+    movement_id = db.Column(db.Integer, db.ForeignKey("movement.id", ondelete="SET NULL"), nullable=True)
+    inventory_id = db.Column(db.Integer, db.ForeignKey("inventory.id", ondelete="SET NULL"), nullable=True)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False, default=dt.datetime.utcnow, index=True)
+
+    __table_args__ = (
+        db.Index("ix_stock_ledger_stock_product_created", "stock_id", "product_id", "created_at"),
+        db.Index("ix_stock_ledger_stock_id_id", "stock_id", "id"),
+    )
+
+
+class StockSnapshot(db.Model):
+    """Quantités d'un stock figées à une date, jusqu'à l'écriture de journal ledger_entry_id incluse"""
+    __tablename__ = "stock_snapshot"
+
+    id = db.Column(db.Integer, primary_key=True)
+    stock_id = db.Column(db.Integer, db.ForeignKey("stock.id"), nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey("product.id"), nullable=False)
+    quantity = db.Column(db.Float, nullable=False)
+    ledger_entry_id = db.Column(db.Integer, nullable=False, default=0)
+    taken_at = db.Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+
+    __table_args__ = (
+        db.Index("ix_stock_snapshot_stock_taken", "stock_id", "taken_at"),
+    )
+
+
+# stock_id utilisé par LowStockItem pour le niveau usine (total de tous les stocks)
+PLANT_WIDE_STOCK_ID = 0
+
+
+class LowStockItem(db.Model):
+    """Produits actuellement sous leur stock minimum, par stock et pour l'usine (stock_id = 0)"""
+    __tablename__ = "low_stock_item"
+
+    id = db.Column(db.Integer, primary_key=True)
+    stock_id = db.Column(db.Integer, nullable=False)  # Pas de clé étrangère : 0 désigne l'usine
+    product_id = db.Column(db.Integer, db.ForeignKey("product.id"), nullable=False, index=True)
+    quantity = db.Column(db.Float, nullable=False)
+    minimum_stock = db.Column(db.Float, nullable=False)
+    crossed_at = db.Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)  # Passage sous le seuil
+
+    product = db.relationship("Product")
+
+    __table_args__ = (
+        db.UniqueConstraint("stock_id", "product_id", name="uq_low_stock_item"),
+    )
+
+
 class PreventiveReport(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(150), nullable=False)
@@ -596,6 +770,10 @@ class MachineDocument(db.Model):
     machine = db.relationship("Machine", backref="documents")
     user = db.relationship("User")
 
+    @property
+    def version(self):
+        return file_version(self.file_path)
+
 
 class MaintenancePhoto(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -605,11 +783,16 @@ class MaintenancePhoto(db.Model):
     filename = db.Column(db.String(255), nullable=False)
     original_filename = db.Column(db.String(255), nullable=False)
     file_path = db.Column(db.String(500), nullable=False)
+    content_hash = db.Column(db.String(64), nullable=True, index=True)  # Empreinte SHA-256 (clé des variantes)
     uploaded_at = db.Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
 
     maintenance_entry = db.relationship("MaintenanceEntry", backref="photos")
     corrective_maintenance = db.relationship("CorrectiveMaintenance", backref="photos")
+
+    @property
+    def version(self):
+        return self.content_hash[:16] if self.content_hash else file_version(self.file_path)
     user = db.relationship("User")
 
 
@@ -743,6 +926,10 @@ class ChatMessage(db.Model):
     machine = db.relationship("Machine")
     reply_to = db.relationship("ChatMessage", remote_side=[id], backref="replies")
 
+    __table_args__ = (
+        db.Index("ix_chat_message_type_created_at", "message_type", "created_at"),
+    )
+
 
 class ChatReadStatus(db.Model):
     """Suivi des messages lus par chaque utilisateur"""
@@ -753,6 +940,16 @@ class ChatReadStatus(db.Model):
     user = db.relationship("User", backref="chat_read_status")
 
 
+class ChatEvent(db.Model):
+    """Journal des changements du chat relayé aux clients connectés (id = curseur)"""
+    __tablename__ = "chat_event"
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # 'created', 'edited', 'deleted', 'read', 'report'
+    message_id = db.Column(db.Integer, nullable=True)  # Pas de FK : les messages sont purgés
+    user_id = db.Column(db.Integer, nullable=True)  # Utilisateur concerné par un événement 'read'
+    created_at = db.Column(db.DateTime, default=dt.datetime.utcnow, nullable=False, index=True)
+
+
 class Report(db.Model):
     """Rapports de poste/jour créés par les utilisateurs"""
     id = db.Column(db.Integer, primary_key=True)
@@ -777,640 +974,96 @@ class ReportPhoto(db.Model):
     report_id = db.Column(db.Integer, db.ForeignKey("report.id"), nullable=False)
     file_path = db.Column(db.String(500), nullable=True)  # Gardé pour compatibilité, mais optionnel maintenant
     original_filename = db.Column(db.String(255), nullable=False)
-    photo_data = db.Column(db.LargeBinary, nullable=True)  # Stockage BLOB des données de l'image
+    # Ancien stockage BLOB, vidé par migrate_report_photo_blobs ; différé : jamais chargé avec la ligne
+    photo_data = db.deferred(db.Column(db.LargeBinary, nullable=True))
     content_type = db.Column(db.String(50), nullable=True)  # Type MIME (image/jpeg, image/png, etc.)
+    content_hash = db.Column(db.String(64), nullable=True, index=True)  # Empreinte SHA-256 dans REPORT_PHOTO_STORE
+    file_size = db.Column(db.Integer, nullable=True)
 
     report = db.relationship("Report", back_populates="photos")
 
 
 class ExcelFile(db.Model):
     """Fichiers Excel uploadés par les administrateurs"""
-    id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(200), nullable=False)  # Nom personnalisé donné par l'utilisateur
-    filename = db.Column(db.String(255), nullable=False)  # Nom du fichier sur le disque
-    original_filename = db.Column(db.String(255), nullable=False)  # Nom original du fichier uploadé
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
-    created_at = db.Column(db.DateTime, default=dt.datetime.utcnow, nullable=False)
-    
-    user = db.relationship("User", backref="uploaded_excel_files")
-
-with app.app_context():
-    db.create_all()
-    # Ajouter les index manquants pour optimiser les performances
-    try:
-        inspector = inspect(db.engine)
-        # Créer les index si nécessaire (pour les bases existantes)
-        # PostgreSQL supporte "CREATE INDEX IF NOT EXISTS" depuis la version 9.5
-        # Pour SQLite, cette syntaxe est supportée depuis la version 3.9.0
-        with db.engine.connect() as conn:
-            # Index pour Machine
-            try:
-                # Vérifier si l'index existe déjà (compatible avec PostgreSQL et SQLite)
-                indexes = [idx['name'] for idx in inspector.get_indexes('machine')]
-                if 'ix_machine_parent_id' not in indexes:
-                    conn.execute(text("CREATE INDEX ix_machine_parent_id ON machine(parent_id)"))
-                if 'ix_machine_stock_id' not in indexes:
-                    conn.execute(text("CREATE INDEX ix_machine_stock_id ON machine(stock_id)"))
-                conn.commit()
-            except Exception:
-                # Fallback: utiliser CREATE INDEX IF NOT EXISTS si la vérification échoue
-                try:
-                    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_machine_parent_id ON machine(parent_id)"))
-                    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_machine_stock_id ON machine(stock_id)"))
-                    conn.commit()
-                except Exception:
-                    pass
-            
-            # Index pour FollowedMachine
-            try:
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_followed_machine_user_id ON followed_machine(user_id)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_followed_machine_machine_id ON followed_machine(machine_id)"))
-                conn.commit()
-            except Exception:
-                pass
-            
-            # Index pour Counter
-            try:
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_counter_machine_id ON counter(machine_id)"))
-                conn.commit()
-            except Exception:
-                pass
-            
-            # Index pour Movement
-            try:
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_movement_source_stock_id ON movement(source_stock_id)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_movement_dest_stock_id ON movement(dest_stock_id)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_movement_created_at ON movement(created_at)"))
-                conn.commit()
-            except Exception:
-                pass
-            
-            # Index pour MaintenanceEntry
-            try:
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_maintenance_entry_machine_id ON maintenance_entry(machine_id)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_maintenance_entry_report_id ON maintenance_entry(report_id)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_maintenance_entry_stock_id ON maintenance_entry(stock_id)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_maintenance_entry_user_id ON maintenance_entry(user_id)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_maintenance_entry_created_at ON maintenance_entry(created_at)"))
-                conn.commit()
-            except Exception:
-                pass
-            
-            # Index pour MaintenanceProgress
-            try:
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_maintenance_progress_machine_id ON maintenance_progress(machine_id)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_maintenance_progress_counter_id ON maintenance_progress(counter_id)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_maintenance_progress_report_id ON maintenance_progress(report_id)"))
-                conn.commit()
-            except Exception:
-                pass
-            
-            # Index pour CorrectiveMaintenance
-            try:
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_corrective_maintenance_machine_id ON corrective_maintenance(machine_id)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_corrective_maintenance_stock_id ON corrective_maintenance(stock_id)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_corrective_maintenance_user_id ON corrective_maintenance(user_id)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_corrective_maintenance_created_at ON corrective_maintenance(created_at)"))
-                conn.commit()
-            except Exception:
-                pass
-            
-            # Index pour CounterLog
-            try:
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_counter_log_machine_id ON counter_log(machine_id)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_counter_log_counter_id ON counter_log(counter_id)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_counter_log_created_at ON counter_log(created_at)"))
-                conn.commit()
-            except Exception:
-                pass
-            
-            # Index pour ChecklistTemplate
-            try:
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_checklist_template_machine_id ON checklist_template(machine_id)"))
-                conn.commit()
-            except Exception:
-                pass
-            
-            # Index pour ChecklistColumn
-            try:
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_checklist_column_template_id ON checklist_column(template_id)"))
-                conn.commit()
-            except Exception:
-                pass
-            
-            # Index pour ChecklistTemplateRow
-            try:
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_checklist_template_row_template_id ON checklist_template_row(template_id)"))
-                conn.commit()
-            except Exception:
-                pass
-            
-            # Index pour ChecklistTemplateRowValue
-            try:
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_checklist_template_row_value_row_id ON checklist_template_row_value(row_id)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_checklist_template_row_value_column_id ON checklist_template_row_value(column_id)"))
-                conn.commit()
-            except Exception:
-                pass
-            
-            # Index pour ChecklistInstance
-            try:
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_checklist_instance_template_id ON checklist_instance(template_id)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_checklist_instance_machine_id ON checklist_instance(machine_id)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_checklist_instance_user_id ON checklist_instance(user_id)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_checklist_instance_created_at ON checklist_instance(created_at)"))
-                conn.commit()
-            except Exception:
-                pass
-            
-            # Index pour ChecklistInstanceValue
-            try:
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_checklist_instance_value_instance_id ON checklist_instance_value(instance_id)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_checklist_instance_value_template_row_id ON checklist_instance_value(template_row_id)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_checklist_instance_value_column_id ON checklist_instance_value(column_id)"))
-                conn.commit()
-            except Exception:
-                pass
-            
-            # Index pour PreventiveReport
-            try:
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_preventive_report_machine_id ON preventive_report(machine_id)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_preventive_report_counter_id ON preventive_report(counter_id)"))
-                conn.commit()
-            except Exception:
-                pass
-            
-            # Créer la table PreventiveReportCounter si elle n'existe pas
-            try:
-                inspector = inspect(db.engine)
-                if 'preventive_report_counter' not in inspector.get_table_names():
-                    conn.execute(text("""
-                        CREATE TABLE preventive_report_counter (
-                            id INTEGER PRIMARY KEY,
-                            report_id INTEGER NOT NULL,
-                            counter_id INTEGER,
-                            FOREIGN KEY (report_id) REFERENCES preventive_report(id) ON DELETE CASCADE,
-                            FOREIGN KEY (counter_id) REFERENCES counter(id) ON DELETE CASCADE,
-                            UNIQUE (report_id, counter_id)
-                        )
-                    """))
-                    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_preventive_report_counter_report_id ON preventive_report_counter(report_id)"))
-                    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_preventive_report_counter_counter_id ON preventive_report_counter(counter_id)"))
-                    conn.commit()
-            except Exception as e:
-                print(f"Erreur lors de la création de preventive_report_counter: {e}")
-                pass
-            
-            # Index pour ChatMessage
-            try:
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_chat_message_user_id ON chat_message(user_id)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_chat_message_message_type ON chat_message(message_type)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_chat_message_machine_id ON chat_message(machine_id)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_chat_message_reply_to_id ON chat_message(reply_to_id)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_chat_message_deleted_at ON chat_message(deleted_at)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_chat_message_created_at ON chat_message(created_at)"))
-                conn.commit()
-            except Exception:
-                pass
-            
-            # Index pour Report
-            try:
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_report_user_id ON report(user_id)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_report_created_at ON report(created_at)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_report_deleted_at ON report(deleted_at)"))
-                conn.commit()
-            except Exception:
-                pass
-            
-            # Index pour StockProduct
-            try:
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_stock_product_stock_id ON stock_product(stock_id)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_stock_product_product_id ON stock_product(product_id)"))
-                conn.commit()
-            except Exception:
-                pass
-    except Exception:
-        pass
-    
-    try:
-        inspector = inspect(db.engine)
-        columns = {col["name"] for col in inspector.get_columns("maintenance_entry")}
-        if "stock_id" not in columns:
-            with db.engine.connect() as conn:
-                conn.execute(text("ALTER TABLE maintenance_entry ADD COLUMN stock_id INTEGER"))
-        if "performed_hours" not in columns:
-            with db.engine.connect() as conn:
-                conn.execute(text("ALTER TABLE maintenance_entry ADD COLUMN performed_hours FLOAT DEFAULT 0"))
-        if "user_id" not in columns:
-            with db.engine.connect() as conn:
-                conn.execute(text("ALTER TABLE maintenance_entry ADD COLUMN user_id INTEGER"))
-        if "hours_before_maintenance" not in columns:
-            with db.engine.connect() as conn:
-                conn.execute(text("ALTER TABLE maintenance_entry ADD COLUMN hours_before_maintenance FLOAT"))
-                conn.commit()
-        if "triggered_counter_id" not in columns:
-            with db.engine.connect() as conn:
-                conn.execute(text("ALTER TABLE maintenance_entry ADD COLUMN triggered_counter_id INTEGER"))
-                conn.commit()
-    except Exception:
-        pass
-    try:
-        inspector = inspect(db.engine)
-        corrective_columns = {col["name"] for col in inspector.get_columns("corrective_maintenance")}
-        if "user_id" not in corrective_columns:
-            with db.engine.connect() as conn:
-                conn.execute(text("ALTER TABLE corrective_maintenance ADD COLUMN user_id INTEGER"))
-        if "hours" not in corrective_columns:
-            with db.engine.connect() as conn:
-                conn.execute(text("ALTER TABLE corrective_maintenance ADD COLUMN hours FLOAT DEFAULT 0"))
-    except Exception:
-        pass
-    # Migration pour la table chat_message
-    try:
-        inspector = inspect(db.engine)
-        if "chat_message" in inspector.get_table_names():
-            chat_message_columns = {col["name"] for col in inspector.get_columns("chat_message")}
-            if "reply_to_id" not in chat_message_columns:
-                with db.engine.connect() as conn:
-                    conn.execute(text("ALTER TABLE chat_message ADD COLUMN reply_to_id INTEGER"))
-                    conn.commit()
-            if "edited_at" not in chat_message_columns:
-                with db.engine.connect() as conn:
-                    # Utiliser TIMESTAMP pour PostgreSQL, DATETIME pour SQLite
-                    if database_url and "postgresql" in database_url:
-                        conn.execute(text("ALTER TABLE chat_message ADD COLUMN edited_at TIMESTAMP"))
-                    else:
-                        conn.execute(text("ALTER TABLE chat_message ADD COLUMN edited_at DATETIME"))
-                    conn.commit()
-            if "deleted_at" not in chat_message_columns:
-                with db.engine.connect() as conn:
-                    # Utiliser TIMESTAMP pour PostgreSQL, DATETIME pour SQLite
-                    if database_url and "postgresql" in database_url:
-                        conn.execute(text("ALTER TABLE chat_message ADD COLUMN deleted_at TIMESTAMP"))
-                    else:
-                        conn.execute(text("ALTER TABLE chat_message ADD COLUMN deleted_at DATETIME"))
-                    conn.commit()
-    except Exception as exc:
-        print(f"Error migrating chat_message table: {exc}")
-        pass
-    # Migration pour la table maintenance_photo
-    try:
-        inspector = inspect(db.engine)
-        if "maintenance_photo" not in inspector.get_table_names():
-            # La table sera créée automatiquement par db.create_all()
-            pass
-    except Exception:
-        pass
-    try:
-        inspector = inspect(db.engine)
-        machine_columns = {col["name"] for col in inspector.get_columns("machine")}
-        if "counter_unit" not in machine_columns:
-            with db.engine.connect() as conn:
-                conn.execute(text("ALTER TABLE machine ADD COLUMN counter_unit VARCHAR(20)"))
-                # Pour les machines existantes avec compteur horaire, définir l'unité par défaut à "h"
-                # Note: PostgreSQL utilise TRUE/FALSE au lieu de 1/0 pour les booléens
-                if database_url and "postgresql" in database_url:
-                    conn.execute(text("UPDATE machine SET counter_unit = 'h' WHERE hour_counter_enabled = TRUE AND counter_unit IS NULL"))
-                else:
-                    conn.execute(text("UPDATE machine SET counter_unit = 'h' WHERE hour_counter_enabled = 1 AND counter_unit IS NULL"))
-                conn.commit()
-        if "stock_id" not in machine_columns:
-            with db.engine.connect() as conn:
-                conn.execute(text("ALTER TABLE machine ADD COLUMN stock_id INTEGER"))
-                conn.commit()
-    except Exception:
-        pass
-    # Migration pour la table counter
-    try:
-        inspector = inspect(db.engine)
-        if "counter" not in [tbl["name"] for tbl in inspector.get_table_names()]:
-            db.create_all()
-    except Exception:
-        pass
-    # Migration pour ajouter counter_id à preventive_report
-    try:
-        inspector = inspect(db.engine)
-        preventive_report_columns = {col["name"] for col in inspector.get_columns("preventive_report")}
-        if "counter_id" not in preventive_report_columns:
-            with db.engine.connect() as conn:
-                conn.execute(text("ALTER TABLE preventive_report ADD COLUMN counter_id INTEGER"))
-                conn.commit()
-    except Exception:
-        pass
-    # Migration pour ajouter comment à preventive_component
-    try:
-        inspector = inspect(db.engine)
-        if "preventive_component" in inspector.get_table_names():
-            preventive_component_columns = {col["name"] for col in inspector.get_columns("preventive_component")}
-            if "comment" not in preventive_component_columns:
-                with db.engine.connect() as conn:
-                    conn.execute(text("ALTER TABLE preventive_component ADD COLUMN comment VARCHAR(500)"))
-                    conn.commit()
-    except Exception:
-        pass
-    # Migration pour ajouter trigger_type et calendar_start_date à preventive_report
-    try:
-        inspector = inspect(db.engine)
-        preventive_report_columns = {col["name"] for col in inspector.get_columns("preventive_report")}
-        if "trigger_type" not in preventive_report_columns:
-            with db.engine.connect() as conn:
-                conn.execute(text("ALTER TABLE preventive_report ADD COLUMN trigger_type VARCHAR(20) DEFAULT 'counter'"))
-                conn.execute(text("UPDATE preventive_report SET trigger_type = 'counter' WHERE trigger_type IS NULL"))
-                conn.commit()
-        if "calendar_start_date" not in preventive_report_columns:
-            with db.engine.connect() as conn:
-                if database_url and "postgresql" in database_url:
-                    conn.execute(text("ALTER TABLE preventive_report ADD COLUMN calendar_start_date DATE"))
-                else:
-                    conn.execute(text("ALTER TABLE preventive_report ADD COLUMN calendar_start_date DATE"))
-                conn.commit()
-    except Exception as exc:
-        print(f"Error migrating preventive_report table for calendar fields: {exc}")
-        pass
-    # Migration pour créer la table calendar_maintenance_progress
-    try:
-        inspector = inspect(db.engine)
-        tables = {table["name"] for table in inspector.get_table_names()}
-        if "calendar_maintenance_progress" not in tables:
-            with db.engine.connect() as conn:
-                conn.execute(text("""
-                    CREATE TABLE calendar_maintenance_progress (
-                        id INTEGER PRIMARY KEY,
-                        machine_id INTEGER NOT NULL,
-                        report_id INTEGER NOT NULL,
-                        last_performed_date DATE,
-                        missed_count INTEGER NOT NULL DEFAULT 0,
-                        FOREIGN KEY (machine_id) REFERENCES machine(id) ON DELETE CASCADE,
-                        FOREIGN KEY (report_id) REFERENCES preventive_report(id) ON DELETE CASCADE,
-                        UNIQUE (machine_id, report_id)
-                    )
-                """))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_calendar_maintenance_progress_machine_id ON calendar_maintenance_progress(machine_id)"))
-                conn.execute(text("CREATE INDEX IF NOT EXISTS ix_calendar_maintenance_progress_report_id ON calendar_maintenance_progress(report_id)"))
-                conn.commit()
-    except Exception as exc:
-        print(f"Error creating calendar_maintenance_progress table: {exc}")
-        pass
-    # Migration pour ajouter counter_id à maintenance_progress
-    try:
-        inspector = inspect(db.engine)
-        maintenance_progress_columns = {col["name"] for col in inspector.get_columns("maintenance_progress")}
-        if "counter_id" not in maintenance_progress_columns:
-            with db.engine.connect() as conn:
-                conn.execute(text("ALTER TABLE maintenance_progress ADD COLUMN counter_id INTEGER"))
-                conn.commit()
-    except Exception:
-        pass
-    try:
-        inspector = inspect(db.engine)
-        product_columns = {col["name"] for col in inspector.get_columns("product")}
-        if "supplier_name" not in product_columns:
-            with db.engine.connect() as conn:
-                conn.execute(text("ALTER TABLE product ADD COLUMN supplier_name VARCHAR(120)"))
-        if "supplier_reference" not in product_columns:
-            with db.engine.connect() as conn:
-                conn.execute(text("ALTER TABLE product ADD COLUMN supplier_reference VARCHAR(120)"))
-        if "location_code" not in product_columns:
-            with db.engine.connect() as conn:
-                conn.execute(text("ALTER TABLE product ADD COLUMN location_code VARCHAR(120)"))
-        if "minimum_stock" not in product_columns:
-            with db.engine.connect() as conn:
-                conn.execute(text("ALTER TABLE product ADD COLUMN minimum_stock FLOAT DEFAULT 0"))
-    except Exception:
-        pass
-    # Migration pour ajouter counter_id à counter_log
-    try:
-        inspector = inspect(db.engine)
-        counter_log_columns = {col["name"] for col in inspector.get_columns("counter_log")}
-        if "counter_id" not in counter_log_columns:
-            with db.engine.connect() as conn:
-                conn.execute(text("ALTER TABLE counter_log ADD COLUMN counter_id INTEGER"))
-                conn.commit()
-    except Exception:
-        pass
-    # Migration pour créer les tables Report et ReportPhoto
-    try:
-        inspector = inspect(db.engine)
-        tables = {table["name"] for table in inspector.get_table_names()}
-        if "report" not in tables:
-            db.create_all()
-    except Exception:
-        pass
-    
-    # Migration pour ajouter photo_data et content_type à report_photo
-    try:
-        inspector = inspect(db.engine)
-        if "report_photo" in inspector.get_table_names():
-            report_photo_columns = {col["name"] for col in inspector.get_columns("report_photo")}
-            
-            # Ajouter photo_data si elle n'existe pas
-            if "photo_data" not in report_photo_columns:
-                with db.engine.connect() as conn:
-                    # Pour PostgreSQL, utiliser BYTEA pour les BLOB
-                    # Pour SQLite, utiliser BLOB
-                    if db.engine.dialect.name == 'postgresql':
-                        conn.execute(text("ALTER TABLE report_photo ADD COLUMN photo_data BYTEA"))
-                    else:
-                        conn.execute(text("ALTER TABLE report_photo ADD COLUMN photo_data BLOB"))
-                    conn.commit()
-                    print("Colonne photo_data ajoutée à report_photo")
-            
-            # Ajouter content_type si elle n'existe pas
-            if "content_type" not in report_photo_columns:
-                with db.engine.connect() as conn:
-                    conn.execute(text("ALTER TABLE report_photo ADD COLUMN content_type VARCHAR(50)"))
-                    conn.commit()
-                    print("Colonne content_type ajoutée à report_photo")
-            
-            # Rendre file_path nullable si ce n'est pas déjà le cas
-            # (Cette partie peut échouer si la colonne est déjà nullable, c'est normal)
-            try:
-                with db.engine.connect() as conn:
-                    if db.engine.dialect.name == 'postgresql':
-                        conn.execute(text("ALTER TABLE report_photo ALTER COLUMN file_path DROP NOT NULL"))
-                    else:
-                        # SQLite ne supporte pas ALTER COLUMN, on ignore
-                        pass
-                    conn.commit()
-            except Exception:
-                pass
-    except Exception as exc:
-        print(f"Erreur lors de la migration report_photo: {exc}")
-        pass
-    
-    # Migration pour ajouter les colonnes manquantes à checklist_instance_value
-    try:
-        inspector = inspect(db.engine)
-        if "checklist_instance_value" in inspector.get_table_names():
-            instance_value_columns_info = inspector.get_columns("checklist_instance_value")
-            instance_value_columns = {col["name"] for col in instance_value_columns_info}
-            
-            print(f"Colonnes actuelles dans checklist_instance_value: {sorted(instance_value_columns)}")
-            
-            # Toutes les colonnes requises selon le modèle ChecklistInstanceValue
-            required_columns = {
-                "instance_id": "INTEGER",
-                "template_row_id": "INTEGER",
-                "column_id": "INTEGER",
-                "value": "TEXT"
-            }
-            
-            columns_added = []
-            with db.engine.connect() as conn:
-                # Étape 1: Ajouter d'abord toutes les colonnes manquantes
-                for col_name, col_type in required_columns.items():
-                    if col_name not in instance_value_columns:
-                        try:
-                            conn.execute(text(f"ALTER TABLE checklist_instance_value ADD COLUMN {col_name} {col_type}"))
-                            conn.commit()
-                            print(f"✓ Colonne {col_name} ajoutée à checklist_instance_value")
-                            columns_added.append(col_name)
-                            
-                            # Créer l'index si nécessaire (seulement pour les colonnes qui en ont besoin)
-                            if col_name in ["instance_id", "template_row_id", "column_id"]:
-                                try:
-                                    index_name = f"ix_checklist_instance_value_{col_name}"
-                                    conn.execute(text(f"CREATE INDEX IF NOT EXISTS {index_name} ON checklist_instance_value({col_name})"))
-                                    conn.commit()
-                                    print(f"✓ Index créé pour {col_name} dans checklist_instance_value")
-                                except Exception as idx_exc:
-                                    print(f"⚠ Note lors de la création de l'index pour {col_name}: {idx_exc}")
-                        except Exception as col_exc:
-                            print(f"✗ Erreur lors de l'ajout de la colonne {col_name}: {col_exc}")
-                    else:
-                        print(f"✓ Colonne {col_name} existe déjà")
-                
-                # Étape 2: Recréer la table sans item_id si elle existe (SQLite ne supporte pas DROP COLUMN)
-                # On le fait après avoir ajouté les colonnes manquantes pour s'assurer qu'elles existent
-                if "item_id" in instance_value_columns and db.engine.dialect.name == 'sqlite':
-                    try:
-                        print("🔄 Recréation de la table checklist_instance_value sans item_id...")
-                        # Re-vérifier les colonnes après les ajouts
-                        updated_columns_info = inspector.get_columns("checklist_instance_value")
-                        updated_columns = {col["name"] for col in updated_columns_info}
-                        # Vérifier quelles colonnes existent pour la copie
-                        has_template_row_id = "template_row_id" in updated_columns
-                        has_column_id = "column_id" in updated_columns
-                        has_value = "value" in updated_columns
-                        has_instance_id = "instance_id" in updated_columns
-                        
-                        if not has_instance_id:
-                            print("⚠ instance_id manquante, impossible de recréer la table")
-                            raise Exception("instance_id manquante")
-                        
-                        # Sauvegarder les données existantes
-                        conn.execute(text("""
-                            CREATE TABLE checklist_instance_value_new (
-                                id INTEGER PRIMARY KEY,
-                                instance_id INTEGER NOT NULL,
-                                template_row_id INTEGER NOT NULL,
-                                column_id INTEGER NOT NULL,
-                                value TEXT,
-                                FOREIGN KEY (instance_id) REFERENCES checklist_instance(id),
-                                FOREIGN KEY (template_row_id) REFERENCES checklist_template_row(id),
-                                FOREIGN KEY (column_id) REFERENCES checklist_column(id)
-                            )
-                        """))
-                        
-                        # Construire la requête SELECT selon les colonnes disponibles
-                        select_cols = ["id", "instance_id"]
-                        if has_template_row_id:
-                            select_cols.append("template_row_id")
-                        else:
-                            select_cols.append("0 as template_row_id")
-                        if has_column_id:
-                            select_cols.append("column_id")
-                        else:
-                            select_cols.append("0 as column_id")
-                        if has_value:
-                            select_cols.append("value")
-                        else:
-                            select_cols.append("NULL as value")
-                        
-                        # Copier les données (en ignorant item_id)
-                        select_query = f"""
-                            INSERT INTO checklist_instance_value_new (id, instance_id, template_row_id, column_id, value)
-                            SELECT {', '.join(select_cols)}
-                            FROM checklist_instance_value
-                        """
-                        conn.execute(text(select_query))
-                        
-                        # Supprimer l'ancienne table
-                        conn.execute(text("DROP TABLE checklist_instance_value"))
-                        # Renommer la nouvelle table
-                        conn.execute(text("ALTER TABLE checklist_instance_value_new RENAME TO checklist_instance_value"))
-                        # Recréer les index
-                        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_checklist_instance_value_instance_id ON checklist_instance_value(instance_id)"))
-                        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_checklist_instance_value_template_row_id ON checklist_instance_value(template_row_id)"))
-                        conn.execute(text("CREATE INDEX IF NOT EXISTS ix_checklist_instance_value_column_id ON checklist_instance_value(column_id)"))
-                        conn.commit()
-                        print("✓ Table checklist_instance_value recréée sans item_id")
-                    except Exception as recreate_exc:
-                        print(f"⚠ Erreur lors de la recréation de la table: {recreate_exc}")
-                        import traceback
-                        traceback.print_exc()
-                        conn.rollback()
-                
-                if columns_added:
-                    print(f"Migration terminée: {len(columns_added)} colonne(s) ajoutée(s): {', '.join(columns_added)}")
-                else:
-                    print("Aucune colonne à ajouter, la table est à jour")
-        else:
-            # Si la table n'existe pas, la créer avec toutes les colonnes
-            print("Table checklist_instance_value n'existe pas, création...")
-            db.create_all()
-            print("✓ Table checklist_instance_value créée")
-    except Exception as exc:
-        print(f"✗ Erreur lors de la migration checklist_instance_value: {exc}")
-        import traceback
-        traceback.print_exc()
-        pass
-    updated = PreventiveComponent.query.filter_by(field_type="increment").update({"field_type": "number"})
-    if updated:
-        db.session.commit()
-    try:
-        # Migration: rendre machine_id obligatoire pour PreventiveReport
-        inspector = inspect(db.engine)
-        preventive_report_columns = {col["name"]: col for col in inspector.get_columns("preventive_report")}
-        if "machine_id" in preventive_report_columns:
-            # Supprimer les rapports sans machine_id (s'ils existent)
-            reports_without_machine = PreventiveReport.query.filter_by(machine_id=None).all()
-            if reports_without_machine:
-                for report in reports_without_machine:
-                    db.session.delete(report)
-                db.session.commit()
-            # Vérifier si la colonne est nullable et la rendre NOT NULL
-            # Note: SQLite ne supporte pas ALTER COLUMN, donc on ne peut pas changer directement
-            # Mais comme on a supprimé les NULL, le modèle SQLAlchemy avec nullable=False devrait fonctionner
-    except Exception:
-        db.session.rollback()
-    try:
-        machines_with_counter = Machine.query.filter_by(hour_counter_enabled=True).all()
-        created = False
-        for machine in machines_with_counter:
-            reports = PreventiveReport.query.filter_by(machine_id=machine.id).all()
-            existing_ids = {
-                record.report_id for record in MaintenanceProgress.query.filter_by(machine_id=machine.id).all()
-            }
-            for report in reports:
-                if report.id not in existing_ids:
-                    initial_hours = report.periodicity
-                    db.session.add(MaintenanceProgress(machine=machine, report=report, hours_since=initial_hours))
-                    created = True
-        if created:
-            db.session.commit()
-    except Exception:
-        db.session.rollback()
-    # Créer le compte admin par défaut s'il n'existe pas
-    try:
-        admin_user = User.query.filter_by(username="admin123").first()
-        if not admin_user:
-            admin_user = User(username="admin123", user_type="admin")
-            admin_user.set_password("123")
-            db.session.add(admin_user)
-            db.session.commit()
-    except Exception:
-        db.session.rollback()
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(200), nullable=False)  # Nom personnalisé donné par l'utilisateur
+    filename = db.Column(db.String(255), nullable=False)  # Nom du fichier sur le disque
+    original_filename = db.Column(db.String(255), nullable=False)  # Nom original du fichier uploadé
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False)
+    created_at = db.Column(db.DateTime, default=dt.datetime.utcnow, nullable=False)
+    
+    user = db.relationship("User", backref="uploaded_excel_files")
+
+    @property
+    def version(self):
+        return file_version(EXCEL_FILES_FOLDER / self.filename)
+
+
+class BackgroundJob(db.Model):
+    """Tâches longues (exports, imports, PDF) exécutées hors de la requête HTTP"""
+    id = db.Column(db.Integer, primary_key=True)
+    job_type = db.Column(db.String(50), nullable=False, index=True)  # Clé du handler enregistré dans jobs.py
+    label = db.Column(db.String(200), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default="pending", index=True)  # 'pending', 'running', 'done', 'failed', 'cancelled'
+    progress = db.Column(db.Integer, nullable=False, default=0)  # Pourcentage d'avancement (0-100)
+    message = db.Column(db.Text, nullable=True)  # Résumé du résultat ou message d'erreur
+    params = db.Column(db.Text, nullable=True)  # Paramètres JSON du handler
+    input_filename = db.Column(db.String(255), nullable=True)  # Fichier source dans uploads/job_files (imports)
+    excel_file_id = db.Column(db.Integer, db.ForeignKey("excel_file.id"), nullable=True)  # Fichier résultat
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id"), nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=dt.datetime.utcnow, nullable=False, index=True)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, default=dt.datetime.utcnow, nullable=False)  # Dernier signe de vie du worker
+
+    user = db.relationship("User")
+    excel_file = db.relationship("ExcelFile")
+
+    def is_finished(self):
+        return self.status in ("done", "failed", "cancelled")
+
+
+class TaskLease(db.Model):
+    """Bail d'exécution d'une tâche périodique, partagé par tous les workers et instances"""
+    name = db.Column(db.String(50), primary_key=True)
+    holder = db.Column(db.String(120), nullable=True)  # hôte:pid du dernier détenteur
+    expires_at = db.Column(db.DateTime, nullable=True)
+
+
+class ScheduledJobState(db.Model):
+    """État persisté des tâches planifiées déclarées dans scheduler.py"""
+    __tablename__ = "scheduled_job"
+    name = db.Column(db.String(50), primary_key=True)
+    next_run_at = db.Column(db.DateTime, nullable=True)
+    last_started_at = db.Column(db.DateTime, nullable=True)
+    last_finished_at = db.Column(db.DateTime, nullable=True)
+    last_status = db.Column(db.String(20), nullable=True)  # 'running', 'done', 'failed'
+    last_duration_ms = db.Column(db.Integer, nullable=True)
+    last_result = db.Column(db.String(500), nullable=True)  # Valeur retournée par la tâche (JSON)
+    last_error = db.Column(db.Text, nullable=True)
+    run_count = db.Column(db.Integer, nullable=False, default=0)
+    failure_count = db.Column(db.Integer, nullable=False, default=0)
+    holder = db.Column(db.String(120), nullable=True)  # Processus de la dernière exécution
+
+
+class SchemaVersion(db.Model):
+    """Migrations appliquées à la base (voir migrations.py)"""
+    __tablename__ = "schema_version"
+    version = db.Column(db.Integer, primary_key=True)
+    description = db.Column(db.String(200), nullable=False)
+    applied_at = db.Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+
+
+class RetentionRun(db.Model):
+    """Historique des passes du moteur de rétention (voir retention.py)"""
+    id = db.Column(db.Integer, primary_key=True)
+    holder = db.Column(db.String(120), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default="running")  # 'running', 'done', 'failed'
+    stats = db.Column(db.Text, nullable=True)  # Compteurs JSON (lignes et fichiers supprimés)
+    error = db.Column(db.Text, nullable=True)
+    started_at = db.Column(db.DateTime, default=dt.datetime.utcnow, nullable=False, index=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
 
 
 @app.route("/")
@@ -1467,27 +1120,8 @@ def index():
                 }
             )
 
-    # Optimiser le calcul du stock minimum : une seule requête avec jointure
-    first_stock = Stock.query.order_by(Stock.id).first()
-    low_stock_count = 0
-    if first_stock:
-        # Utiliser une requête SQL optimisée au lieu d'une boucle
-        low_stock_products = (
-            db.session.query(Product.id)
-            .outerjoin(StockProduct, db.and_(
-                StockProduct.product_id == Product.id,
-                StockProduct.stock_id == first_stock.id
-            ))
-            .filter(
-                Product.minimum_stock > 0,
-                db.or_(
-                    StockProduct.quantity.is_(None),
-                    StockProduct.quantity < Product.minimum_stock
-                )
-            )
-            .count()
-        )
-        low_stock_count = low_stock_products
+    # Produits sous le stock minimum (total de tous les stocks), ensemble maintenu par les écritures de stock
+    low_stock_count = LowStockItem.query.filter_by(stock_id=PLANT_WIDE_STOCK_ID).count()
 
     # Statistiques supplémentaires
     # Nombre total de maintenances (préventives + correctives)
@@ -1697,7 +1331,7 @@ def login():
             return redirect(request.url)
         user = User.query.filter_by(username=username).first()
         if user and user.check_password(password):
-            login_user(user)
+            login_user(Principal(user.id, user.username, user.user_type))
             next_page = request.args.get("next")
             return redirect(next_page or url_for("index"))
         else:
@@ -1736,8 +1370,11 @@ def change_password():
             flash("Tous les champs sont requis", "danger")
             return redirect(url_for("change_password"))
         
+        # current_user est détaché de la session : recharger l'utilisateur pour le modifier
+        user = db.session.get(User, current_user.id)
+
         # Vérifier que le mot de passe actuel est correct
-        if not current_user.check_password(current_password):
+        if not user.check_password(current_password):
             flash("Mot de passe actuel incorrect", "danger")
             return redirect(url_for("change_password"))
         
@@ -1752,7 +1389,7 @@ def change_password():
             return redirect(url_for("change_password"))
         
         # Modifier le mot de passe
-        current_user.set_password(new_password)
+        user.set_password(new_password)
         
         try:
             db.session.commit()
@@ -1848,6 +1485,7 @@ def delete_user(user_id):
     db.session.delete(user)
     try:
         db.session.commit()
+        invalidate_principal(user_id)
         flash("Utilisateur supprimé", "success")
     except Exception as exc:
         db.session.rollback()
@@ -2191,6 +1829,167 @@ def allowed_image_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_IMAGE_EXTENSIONS
 
 
+def requested_photo_size():
+    """Taille demandée par ?size= (thumb, medium) ; None pour l'original"""
+    size = request.args.get("size")
+    if not size or size == "original":
+        return None
+    if size not in PHOTO_VARIANT_SIZES:
+        abort(400)
+    return size
+
+
+def file_version(path):
+    """Empreinte courte d'un fichier servi (date de modification et taille), pour le paramètre ?v= ; None s'il n'existe pas"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return hashlib.sha1(f"{stat.st_mtime_ns}-{stat.st_size}".encode()).hexdigest()[:16]
+
+
+def send_stored_file(path_or_file, version, etag=None, **kwargs):
+    """Sert un fichier avec ETag, Last-Modified et Range.
+
+    Une URL qui porte la version courante (?v=) est mise en cache un an sans
+    revalidation ; sinon le navigateur revalide à chaque ouverture (304 si inchangé).
+    """
+    response = send_file(path_or_file, conditional=True, etag=etag or version, **kwargs)
+    # Annoncé dès la première réponse : les lecteurs PDF chargent ensuite les gros fichiers par plages
+    response.accept_ranges = "bytes"
+    if version and request.args.get("v") == version:
+        response.cache_control.no_cache = None
+        response.cache_control.max_age = FILE_CACHE_MAX_AGE
+        response.cache_control.immutable = True
+        response.expires = None
+    else:
+        response.cache_control.no_cache = True
+    # Fichiers réservés aux utilisateurs connectés : jamais dans un cache partagé
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+
+@app.after_request
+def offload_file_delivery(response):
+    """Délégation au proxy : adapte la réponse construite par send_file avec X-Sendfile"""
+    path = response.headers.get("X-Sendfile")
+    if not path:
+        return response
+    if response.status_code == 206:
+        # Le proxy applique lui-même l'en-tête Range de la requête au fichier complet
+        response.status_code = 200
+        response.headers.pop("Content-Range", None)
+    if FILE_DELIVERY == "x-accel-redirect":
+        del response.headers["X-Sendfile"]
+        relative = Path(path).resolve().relative_to(BASE_DIR).as_posix()
+        response.headers["X-Accel-Redirect"] = X_ACCEL_PREFIX.rstrip("/") + "/" + quote(relative)
+    return response
+
+
+def send_photo_variant(content_hash, source, size):
+    """Sert une variante réduite (WebP si le navigateur l'accepte, JPEG sinon) ; None si indisponible"""
+    fmt = "webp" if "image/webp" in request.headers.get("Accept", "") else "jpeg"
+    path = PHOTO_VARIANTS.get(content_hash, size, fmt, source)
+    if path is None:
+        return None
+    response = send_stored_file(path, content_hash[:16], etag=f"{content_hash}-{size}-{fmt}",
+                                mimetype=PHOTO_VARIANT_FORMATS[fmt][1])
+    response.vary.add("Accept")
+    return response
+
+
+def photo_upload_error():
+    """Message d'erreur si l'envoi de photos dépasse le budget de la requête, None sinon"""
+    # Taille du corps bornée par limit_photo_upload_size avant la lecture du formulaire
+    photos = [photo for photo in request.files.getlist("photos") if photo and photo.filename]
+    if len(photos) > PHOTO_UPLOAD_MAX_FILES:
+        return f"Trop de photos : {PHOTO_UPLOAD_MAX_FILES} maximum par envoi"
+    return None
+
+
+# Vues recevant des photos : corps limité à PHOTO_UPLOAD_BUDGET
+PHOTO_UPLOAD_ENDPOINTS = {
+    "fill_maintenance", "edit_maintenance_entry", "new_corrective_maintenance",
+    "edit_corrective_maintenance", "create_report", "update_report",
+}
+
+
+@app.before_request
+def limit_photo_upload_size():
+    """Refuse (413) un envoi de photos trop lourd avant la lecture du formulaire, y compris sans Content-Length"""
+    if request.endpoint in PHOTO_UPLOAD_ENDPOINTS:
+        request.body_limit = PHOTO_UPLOAD_BUDGET
+
+
+@app.errorhandler(RequestEntityTooLarge)
+def request_too_large(exc):
+    """Envoi de photos au-delà du budget : JSON pour les appels fetch, retour au formulaire sinon"""
+    message = f"Envoi trop volumineux : {PHOTO_UPLOAD_BUDGET // (1024 * 1024)} Mo maximum par envoi"
+    if request.accept_mimetypes.best_match(["application/json", "text/html"]) == "text/html":
+        flash(message, "danger")
+        return redirect(request.referrer or url_for('index'))
+    return jsonify({"success": False, "error": message}), 413
+
+
+def save_maintenance_photo(upload, prefix_id, **owner):
+    """Enregistre une photo de maintenance sur disque telle que reçue (normalisée ensuite par ingest_maintenance_photos)"""
+    original_filename = upload.filename
+    filename = secure_filename(original_filename)
+    timestamp = dt.datetime.now().strftime("%Y%m%d_%H%M%S_")
+    safe_filename = f"{timestamp}{prefix_id}_{filename}"
+    file_path = MAINTENANCE_PHOTOS_FOLDER / safe_filename
+    upload.save(str(file_path))
+    content_hash = file_sha256(file_path)
+    return MaintenancePhoto(
+        filename=safe_filename,
+        original_filename=original_filename,
+        file_path=str(file_path),
+        content_hash=content_hash,
+        user_id=current_user.id,
+        **owner
+    )
+
+
+def add_maintenance_photos(prefix_id, **owner):
+    """Enregistre les photos envoyées dans le champ photos et les ajoute à la session"""
+    saved = []
+    for photo in request.files.getlist("photos"):
+        if photo and photo.filename and allowed_image_file(photo.filename):
+            maintenance_photo = save_maintenance_photo(photo, prefix_id, **owner)
+            db.session.add(maintenance_photo)
+            saved.append(maintenance_photo)
+    return saved
+
+
+def ingest_maintenance_photos(photos):
+    """Confie les photos validées au pool d'ingestion, hors du thread de la requête"""
+    for photo in photos:
+        photo_ingest_executor.submit(normalize_maintenance_photo, photo.id)
+
+
+def normalize_maintenance_photo(photo_id):
+    """Remplace sur place une photo de maintenance par sa version normalisée, puis génère ses variantes"""
+    try:
+        with app.app_context():
+            photo = db.session.get(MaintenancePhoto, photo_id)
+            if photo is None or not os.path.exists(photo.file_path):
+                return
+            raw_hash = photo.content_hash
+            result = normalize_image(photo.file_path, PHOTO_MAX_EDGE, PHOTO_JPEG_QUALITY)
+            if result is not None:
+                data, _ = result
+                write_atomic(Path(photo.file_path), data)
+                photo.content_hash = hashlib.sha256(data).hexdigest()
+                db.session.commit()
+            PHOTO_VARIANTS.schedule(photo.content_hash, photo.file_path)
+            if raw_hash and raw_hash != photo.content_hash:
+                # Variantes éventuellement générées depuis la photo brute avant la normalisation
+                PHOTO_VARIANTS.delete(raw_hash)
+    except Exception as exc:
+        print(f"Erreur lors de la normalisation de la photo de maintenance {photo_id}: {exc}")
+
+
 @app.route("/machines/<int:machine_id>/documents/upload", methods=["POST"])
 @admin_required
 def upload_machine_document(machine_id):
@@ -2281,9 +2080,9 @@ def download_machine_document(machine_id, document_id):
         flash("Le fichier n'existe plus", "danger")
         return redirect(url_for("machine_detail", machine_id=machine_id))
     
-    return send_from_directory(
-        str(UPLOAD_FOLDER),
-        document.filename,
+    return send_stored_file(
+        document.file_path,
+        document.version,
         as_attachment=False,
         download_name=document.original_filename
     )
@@ -2301,6 +2100,7 @@ def machine_qrcode(machine_id):
 @login_required
 def machine_qrcode_image(machine_id):
     """Génère l'image du QR code pour une machine"""
+    import qrcode
     machine = Machine.query.get_or_404(machine_id)
     
     # Générer le QR code
@@ -3153,7 +2953,7 @@ def delete_counter(machine_id, counter_id):
 def products():
     if request.method == "POST":
         # Seul l'admin peut créer/modifier des produits
-        if current_user.user_type != "admin":
+        if not current_user.is_admin:
             flash("Accès refusé : cette fonctionnalité est réservée aux administrateurs.", "danger")
             return redirect(url_for("products"))
         name = request.form["name"].strip()
@@ -3194,31 +2994,17 @@ def products():
                             try:
                                 initial_quantity = float(initial_quantity_raw) if initial_quantity_raw else 0.0
                                 if initial_quantity > 0:
-                                    # Commit d'abord pour avoir l'ID du produit
+                                    # Flush d'abord pour avoir l'ID du produit
                                     db.session.flush()
-                                    
-                                    # Vérifier si le produit existe déjà dans ce stock
-                                    existing_stock_product = StockProduct.query.filter_by(
-                                        stock_id=stock_id, product_id=product.id
-                                    ).first()
-                                    
-                                    if existing_stock_product:
-                                        # Ajouter à la quantité existante
-                                        existing_stock_product.quantity += initial_quantity
-                                    else:
-                                        # Créer une nouvelle entrée
-                                        stock_product = StockProduct(
-                                            stock_id=stock_id,
-                                            product_id=product.id,
-                                            quantity=initial_quantity
-                                        )
-                                        db.session.add(stock_product)
+                                    apply_stock_deltas({(stock_id, product.id): initial_quantity}, source="produit")
                             except (ValueError, TypeError):
                                 pass  # Ignorer si la quantité n'est pas valide
                     except (ValueError, TypeError):
                         pass  # Ignorer si le stock_id n'est pas valide
                 
                 try:
+                    db.session.flush()
+                    refresh_low_stock([product.id])
                     db.session.commit()
                     flash("Produit créé", "success")
                 except Exception as exc:
@@ -3304,10 +3090,8 @@ def products():
     
     if filter_low_stock:
         # Filtrer les produits dont le stock total est inférieur au stock minimum
-        filtered_products = [
-            p for p in filtered_products
-            if p.minimum_stock > 0 and total_by_product[p.id] < p.minimum_stock
-        ]
+        low_stock_ids = low_stock_product_ids()
+        filtered_products = [p for p in filtered_products if p.id in low_stock_ids]
     
     if filter_stock_id:
         # Filtrer les produits qui ont une quantité > 0 dans le stock sélectionné
@@ -3336,6 +3120,8 @@ def products():
 @login_required
 def export_products():
     # Récupérer les mêmes filtres que la page produits
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, Alignment
     filter_name = request.args.get('filter_name', '').strip().lower()
     filter_code = request.args.get('filter_code', '').strip().lower()
     filter_supplier = request.args.get('filter_supplier', '').strip().lower()
@@ -3381,10 +3167,8 @@ def export_products():
         except (ValueError, TypeError):
             pass
     if filter_low_stock:
-        filtered_products = [
-            p for p in filtered_products
-            if p.minimum_stock > 0 and total_by_product[p.id] < p.minimum_stock
-        ]
+        low_stock_ids = low_stock_product_ids()
+        filtered_products = [p for p in filtered_products if p.id in low_stock_ids]
     if filter_stock_id:
         filtered_products = [
             p for p in filtered_products
@@ -3546,25 +3330,11 @@ def edit_product(product_id):
                             
                             # Si on change de stock, déplacer la quantité
                             if old_stock_product.stock_id != new_stock_id:
-                                # Vérifier si le produit existe déjà dans le nouveau stock
-                                new_stock_product = StockProduct.query.filter_by(
-                                    stock_id=new_stock_id, product_id=product.id
-                                ).first()
-                                
-                                if new_stock_product:
-                                    # Ajouter la quantité à l'existant
-                                    new_stock_product.quantity += old_quantity
-                                else:
-                                    # Créer une nouvelle entrée
-                                    new_stock_product = StockProduct(
-                                        stock_id=new_stock_id,
-                                        product_id=product.id,
-                                        quantity=old_quantity
-                                    )
-                                    db.session.add(new_stock_product)
+                                # Ajouter la quantité au nouveau stock (la ligne est créée si besoin)
+                                apply_stock_deltas({(new_stock_id, product.id): old_quantity}, source="produit")
                                 
                                 # Supprimer l'ancienne entrée
-                                db.session.delete(old_stock_product)
+                                remove_stock_products([old_stock_product], source="produit")
                         else:
                             # Le produit n'est dans aucun stock, créer une entrée dans le nouveau stock avec quantité 0
                             new_stock_product = StockProduct.query.filter_by(
@@ -3582,6 +3352,8 @@ def edit_product(product_id):
                     pass  # Ignorer si le stock_id n'est pas valide
             
             try:
+                # Le stock minimum a pu changer
+                refresh_low_stock([product.id])
                 db.session.commit()
                 flash("Produit modifié", "success")
             except Exception as exc:
@@ -3591,131 +3363,276 @@ def edit_product(product_id):
     return redirect(url_for("products"))
 
 
-@app.route("/products/import", methods=["GET", "POST"])
-@admin_required
-def import_products():
-    if request.method == "POST":
-        if "file" not in request.files:
-            flash("Aucun fichier sélectionné", "danger")
-            return redirect(url_for("products"))
-        
-        file = request.files["file"]
-        if not file or file.filename == "":
-            flash("Aucun fichier sélectionné", "danger")
-            return redirect(url_for("products"))
-        
-        # Vérifier l'extension du fichier
-        filename = file.filename.lower()
-        if not (filename.endswith(".xlsx") or filename.endswith(".xls")):
-            flash("Le fichier doit être au format Excel (.xlsx ou .xls)", "danger")
-            return redirect(url_for("products"))
-        
+# Nombre de lignes validées et écrites ensemble lors d'un import de produits
+PRODUCT_IMPORT_CHUNK_SIZE = 500
+# Champs du produit mis à jour par l'import (dans l'ordre des colonnes du fichier, après nom et code)
+PRODUCT_IMPORT_FIELDS = ("name", "price", "supplier_name", "minimum_stock")
+
+
+def _parse_product_import_row(row):
+    """Extrait (code, valeurs) d'une ligne du fichier d'import produits.
+    
+    Les cellules vides ne figurent pas dans les valeurs : elles ne modifient pas un produit existant.
+    Lève ValueError si le nom ou le code est manquant.
+    """
+    def cell(index):
+        return row[index] if len(row) > index else None
+    
+    name = str(cell(0)).strip() if cell(0) is not None else ""
+    code = str(cell(1)).strip() if cell(1) is not None else ""
+    if not name or not code:
+        raise ValueError("Nom ou code manquant")
+    
+    values = {"name": name}
+    # Prix (colonne 3)
+    if cell(2) is not None:
         try:
-            # Lire le fichier Excel depuis le stream
-            # Convertir le FileStorage en BytesIO pour openpyxl
-            file_content = file.read()
-            if not file_content:
-                flash("Le fichier est vide", "danger")
-                return redirect(url_for("products"))
-            
-            file_stream = BytesIO(file_content)
-            wb = load_workbook(file_stream, data_only=True)
-            ws = wb.active
-            
-            if ws.max_row < 2:
-                flash("Le fichier Excel doit contenir au moins une ligne de données (en plus des en-têtes)", "danger")
-                return redirect(url_for("products"))
-            
-            # Parcourir les lignes (en supposant que la première ligne contient les en-têtes)
-            imported_count = 0
-            skipped_count = 0
-            errors = []
-            
-            # Parcourir à partir de la ligne 2 (en supposant que la ligne 1 contient les en-têtes)
-            for row_idx, row in enumerate(ws.iter_rows(min_row=2, values_only=True), start=2):
-                # Ignorer les lignes vides
-                if not row or not any(row):
-                    continue
-                
-                # Extraire les valeurs (nom, code, prix, fournisseur, stock min)
-                # Gérer les valeurs None et convertir en string
-                name = None
-                code = None
-                if row[0] is not None:
-                    name_str = str(row[0]).strip()
-                    name = name_str if name_str else None
-                if row[1] is not None:
-                    code_str = str(row[1]).strip()
-                    code = code_str if code_str else None
-                
-                price = 0.0
-                supplier_name = None
-                minimum_stock = 0.0
-                
-                # Vérifier que nom et code sont présents
-                if not name or not code:
-                    skipped_count += 1
-                    errors.append(f"Ligne {row_idx}: Nom ou code manquant")
+            values["price"] = float(cell(2))
+        except (ValueError, TypeError):
+            values["price"] = 0.0
+    # Fournisseur (colonne 4)
+    if cell(3) is not None:
+        supplier_str = str(cell(3)).strip()
+        values["supplier_name"] = supplier_str if supplier_str and supplier_str.lower() != "none" else None
+    # Stock minimum (colonne 5)
+    if cell(4) is not None:
+        try:
+            values["minimum_stock"] = float(cell(4))
+        except (ValueError, TypeError):
+            values["minimum_stock"] = 0.0
+    return code, values
+
+
+def _write_product_import_chunk(to_insert, to_update):
+    """Écrit un lot de créations et de mises à jour de produits en requêtes groupées"""
+    if db.engine.dialect.name == "postgresql":
+        # Upsert natif : une seule instruction pour les créations et les mises à jour
+        from sqlalchemy.dialects.postgresql import insert as pg_insert
+        rows = to_insert + [{key: value for key, value in row.items() if key != "id"} for row in to_update]
+        if rows:
+            stmt = pg_insert(Product.__table__).values(rows)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=["code"],
+                set_={field: stmt.excluded[field] for field in PRODUCT_IMPORT_FIELDS},
+            )
+            db.session.execute(stmt)
+        return
+    if to_insert:
+        db.session.execute(db.insert(Product), to_insert)
+    if to_update:
+        # Mise à jour groupée par clé primaire (executemany)
+        db.session.execute(db.update(Product), [
+            {key: value for key, value in row.items() if key != "code"} for row in to_update
+        ])
+
+
+def run_products_import(file_content, progress=None, dry_run=False):
+    """Importe des produits depuis le contenu d'un fichier Excel et retourne le bilan.
+    
+    Le fichier est lu en streaming (openpyxl read_only) et traité par lots : les codes
+    existants du lot sont chargés en une requête, puis les créations et mises à jour sont
+    écrites en requêtes groupées et validées lot par lot : le verrou d'écriture de SQLite
+    n'est détenu que le temps d'un lot, pas de tout l'import. Un import interrompu garde
+    les lots déjà validés ; le relancer ne recrée rien (les produits sont repérés par
+    leur code). En mode simulation (dry_run), rien n'est écrit et le bilan contient le
+    détail des différences.
+    """
+    from openpyxl import load_workbook
+    wb = load_workbook(BytesIO(file_content), read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        total_rows = max((ws.max_row or 0) - 1, 0)
+        
+        report_rows = []
+        counts = {"imported": 0, "updated": 0, "unchanged": 0, "skipped": 0}
+        errors = []
+        seen_codes = set()
+        chunk = []
+        
+        def flush_chunk():
+            codes = [code for _, code, _ in chunk]
+            existing = {
+                row.code: row
+                for row in db.session.query(
+                    Product.id, Product.code, Product.name, Product.price,
+                    Product.supplier_name, Product.minimum_stock,
+                ).filter(Product.code.in_(codes))
+            }
+            to_insert = []
+            to_update = []
+            for row_idx, code, values in chunk:
+                current = existing.get(code)
+                if current is None:
+                    record = {
+                        "code": code,
+                        "name": values["name"],
+                        "price": values.get("price", 0.0),
+                        "supplier_name": values.get("supplier_name"),
+                        "minimum_stock": values.get("minimum_stock", 0.0),
+                    }
+                    to_insert.append(record)
+                    counts["imported"] += 1
+                    report_rows.append({"row": row_idx, "code": code, "action": "create", "changes": {
+                        field: [None, record[field]] for field in PRODUCT_IMPORT_FIELDS
+                    }})
                     continue
-                
-                # Extraire le prix (colonne 2)
-                if len(row) > 2 and row[2] is not None:
-                    try:
-                        price = float(row[2])
-                    except (ValueError, TypeError):
-                        price = 0.0
-                
-                # Extraire le fournisseur (colonne 3)
-                if len(row) > 3 and row[3] is not None:
-                    supplier_str = str(row[3]).strip()
-                    supplier_name = supplier_str if supplier_str and supplier_str.lower() != "none" else None
-                
-                # Extraire le stock minimum (colonne 4)
-                if len(row) > 4 and row[4] is not None:
-                    try:
-                        minimum_stock = float(row[4])
-                    except (ValueError, TypeError):
-                        minimum_stock = 0.0
-                
-                # Vérifier si le code existe déjà
-                existing = Product.query.filter_by(code=code).first()
-                if existing:
-                    skipped_count += 1
-                    errors.append(f"Ligne {row_idx}: Le code '{code}' existe déjà")
+                changes = {
+                    field: [getattr(current, field), value]
+                    for field, value in values.items()
+                    if getattr(current, field) != value
+                }
+                if not changes:
+                    counts["unchanged"] += 1
+                    report_rows.append({"row": row_idx, "code": code, "action": "unchanged", "changes": {}})
                     continue
-                
-                # Créer le produit
-                product = Product(
-                    name=name,
-                    code=code,
-                    price=price,
-                    supplier_name=supplier_name,
-                    minimum_stock=minimum_stock,
-                )
-                db.session.add(product)
-                imported_count += 1
-            
-            # Commit toutes les modifications
-            try:
+                # Les champs non fournis conservent leur valeur actuelle
+                update_row = {"id": current.id, "code": code}
+                update_row.update({field: getattr(current, field) for field in PRODUCT_IMPORT_FIELDS})
+                update_row.update(values)
+                to_update.append(update_row)
+                counts["updated"] += 1
+                report_rows.append({"row": row_idx, "code": code, "action": "update", "changes": changes})
+            if not dry_run:
+                _write_product_import_chunk(to_insert, to_update)
                 db.session.commit()
-                if imported_count > 0:
-                    flash(f"{imported_count} produit(s) importé(s) avec succès", "success")
-                if skipped_count > 0:
-                    flash(f"{skipped_count} produit(s) ignoré(s) (codes existants ou données invalides)", "warning")
-                if errors:
-                    # Afficher les erreurs dans un message plus détaillé si nécessaire
-                    error_summary = "; ".join(errors[:5])  # Limiter à 5 erreurs pour l'affichage
-                    if len(errors) > 5:
-                        error_summary += f" ... et {len(errors) - 5} autre(s)"
-                    flash(f"Détails des erreurs: {error_summary}", "info")
-            except Exception as exc:
-                db.session.rollback()
-                flash(f"Erreur lors de l'import: {exc}", "danger")
-        
-        except Exception as exc:
-            flash(f"Erreur lors de la lecture du fichier: {exc}", "danger")
+            chunk.clear()
         
-        return redirect(url_for("products"))
+        # Parcourir à partir de la ligne 2 (en supposant que la ligne 1 contient les en-têtes)
+        for row_idx, row in enumerate(ws.iter_rows(min_row=2, values_only=True), start=2):
+            _report_progress(progress, row_idx - 1, total_rows)
+            # Ignorer les lignes vides
+            if not row or not any(row):
+                continue
+            try:
+                code, values = _parse_product_import_row(row)
+            except ValueError as exc:
+                error = str(exc)
+            else:
+                error = f"Le code '{code}' apparaît plusieurs fois dans le fichier" if code in seen_codes else None
+            if error:
+                counts["skipped"] += 1
+                errors.append(f"Ligne {row_idx}: {error}")
+                report_rows.append({"row": row_idx, "code": None, "action": "error", "error": error})
+                continue
+            seen_codes.add(code)
+            chunk.append((row_idx, code, values))
+            if len(chunk) >= PRODUCT_IMPORT_CHUNK_SIZE:
+                flush_chunk()
+        if chunk:
+            flush_chunk()
+    finally:
+        wb.close()
+    
+    if not report_rows:
+        raise ValueError("Le fichier Excel doit contenir au moins une ligne de données (en plus des en-têtes)")
+    
+    if dry_run:
+        db.session.rollback()
+    else:
+        # Les stocks minimum ont pu changer : recalcul ensembliste des alertes
+        refresh_low_stock()
+        db.session.commit()
+    return dict(counts, errors=errors, rows=report_rows, dry_run=dry_run)
+
+
+def build_products_import_report(result):
+    """Génère le rapport Excel ligne par ligne d'un import de produits (différences avant/après)"""
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, Alignment
+    action_labels = {"create": "Création", "update": "Mise à jour", "unchanged": "Inchangé", "error": "Erreur"}
+    field_labels = {"name": "Nom", "price": "Prix", "supplier_name": "Fournisseur", "minimum_stock": "Stock minimum"}
+    
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Simulation" if result["dry_run"] else "Import"
+    ws.append(["Ligne", "Code", "Action", "Champ", "Ancienne valeur", "Nouvelle valeur", "Erreur"])
+    for cell in ws[1]:
+        cell.font = Font(bold=True)
+        cell.alignment = Alignment(horizontal='center')
+    
+    for row in result["rows"]:
+        action = action_labels.get(row["action"], row["action"])
+        changes = row.get("changes") or {}
+        if not changes:
+            ws.append([row["row"], row["code"], action, "", "", "", row.get("error", "")])
+            continue
+        for field, (old, new) in changes.items():
+            ws.append([row["row"], row["code"], action, field_labels.get(field, field), old, new, ""])
+    
+    for column_letter, width in zip("ABCDEFG", (8, 20, 14, 16, 30, 30, 50)):
+        ws.column_dimensions[column_letter].width = width
+    
+    prefix = "simulation_import_produits" if result["dry_run"] else "rapport_import_produits"
+    return _workbook_bytes(wb), f'{prefix}_{dt.datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
+
+
+def summarize_import_result(result, imported_label):
+    """Construit le message de bilan d'un import (nombre importé, ignoré, détail des erreurs)"""
+    parts = [f"{result['imported']} {imported_label}"]
+    if result.get("updated"):
+        parts.append(f"{result['updated']} mis à jour")
+    if result.get("unchanged"):
+        parts.append(f"{result['unchanged']} inchangé(s)")
+    if result["skipped"] > 0:
+        parts.append(f"{result['skipped']} ligne(s) ignorée(s)")
+    errors = result["errors"]
+    if errors:
+        # Limiter à 5 erreurs pour l'affichage
+        error_summary = "; ".join(errors[:5])
+        if len(errors) > 5:
+            error_summary += f" ... et {len(errors) - 5} autre(s)"
+        parts.append(f"Détails des erreurs: {error_summary}")
+    return ". ".join(parts)
+
+
+def _read_uploaded_excel(redirect_endpoint, **redirect_kwargs):
+    """Valide le fichier Excel envoyé dans le formulaire.
+    
+    Retourne (contenu, nom du fichier, None) ou (None, None, réponse de redirection) en cas d'erreur.
+    """
+    error_response = redirect(url_for(redirect_endpoint, **redirect_kwargs))
+    if "file" not in request.files:
+        flash("Aucun fichier sélectionné", "danger")
+        return None, None, error_response
+    
+    file = request.files["file"]
+    if not file or file.filename == "":
+        flash("Aucun fichier sélectionné", "danger")
+        return None, None, error_response
+    
+    # Vérifier l'extension du fichier
+    filename = file.filename.lower()
+    if not (filename.endswith(".xlsx") or filename.endswith(".xls")):
+        flash("Le fichier doit être au format Excel (.xlsx ou .xls)", "danger")
+        return None, None, error_response
+    
+    file_content = file.read()
+    if not file_content:
+        flash("Le fichier est vide", "danger")
+        return None, None, error_response
+    return file_content, file.filename, None
+
+
+@app.route("/products/import", methods=["GET", "POST"])
+@admin_required
+def import_products():
+    if request.method == "POST":
+        file_content, filename, error_response = _read_uploaded_excel("products")
+        if error_response is not None:
+            return error_response
+        
+        # L'import est exécuté en arrière-plan pour ne pas bloquer le worker
+        dry_run = request.form.get("dry_run") == "1"
+        job = jobs.submit_job(
+            "import_products",
+            user_id=current_user.id,
+            params={"dry_run": dry_run},
+            input_content=file_content,
+            input_filename=filename,
+            label="Simulation d'import de produits" if dry_run else None,
+        )
+        flash(f"Import lancé en arrière-plan (tâche #{job.id}). Suivez son avancement dans la page des tâches.", "info")
+        return redirect(url_for("jobs_list"))
     
     return redirect(url_for("products"))
 
@@ -3736,8 +3653,7 @@ def delete_product(product_id):
     # Supprimer uniquement les quantités en stock (StockProduct)
     # Cela permet de retirer le produit des stocks sans affecter les rapports de maintenance
     stock_products = StockProduct.query.filter_by(product_id=product_id).all()
-    for sp in stock_products:
-        db.session.delete(sp)
+    remove_stock_products(stock_products)
     
     # Si le produit est référencé dans des maintenances, on ne supprime pas le produit lui-même
     # mais on supprime uniquement les quantités en stock
@@ -3755,6 +3671,7 @@ def delete_product(product_id):
             flash(f"Erreur lors de la suppression des quantités en stock : {exc}", "danger")
     else:
         # Si le produit n'est pas dans des maintenances, on peut le supprimer complètement
+        delete_stock_history(product_id=product_id)
         db.session.delete(product)
         try:
             db.session.commit()
@@ -3819,14 +3736,6 @@ def new_stock():
     return render_template("stock_form.html", can_create=can_create, existing_stocks_count=existing_stocks_count)
 
 
-def _get_or_create_stock_product(stock_id, product_id):
-    record = StockProduct.query.filter_by(stock_id=stock_id, product_id=product_id).one_or_none()
-    if not record:
-        record = StockProduct(stock_id=stock_id, product_id=product_id, quantity=0.0)
-        db.session.add(record)
-    return record
-
-
 @app.route("/stocks/<int:stock_id>", methods=["GET", "POST"])
 @login_required
 def manage_stock(stock_id):
@@ -3834,7 +3743,7 @@ def manage_stock(stock_id):
     products = Product.query.order_by(Product.name).all()
     if request.method == "POST":
         # Vérifier les permissions pour modifier les stocks
-        if not can_edit_stocks_products() or is_readonly_stocks_products():
+        if not current_user.can_edit_stocks_products or current_user.is_readonly_stocks_products:
             flash("Accès refusé : vous n'avez pas les droits pour modifier ce stock.", "danger")
             return redirect(url_for("manage_stock", stock_id=stock_id))
         action = request.form["action"]
@@ -3845,7 +3754,7 @@ def manage_stock(stock_id):
             if not item:
                 flash("Produit introuvable dans le stock", "danger")
                 return redirect(request.url)
-            db.session.delete(item)
+            remove_stock_products([item])
             try:
                 db.session.commit()
                 flash("Produit retiré du stock", "success")
@@ -3897,6 +3806,7 @@ def create_inventory(stock_id):
         comments = request.form.getlist("comment")
         
         has_changes = False
+        new_levels = {}
         
         for product_id_str, new_qty_str, comment in zip(product_ids, new_quantities, comments):
             try:
@@ -3919,15 +3829,7 @@ def create_inventory(stock_id):
                     comment=comment.strip() if comment else None
                 )
                 inventory.items.append(item)
-                
-                # Mettre à jour la quantité dans le stock
-                stock_product = StockProduct.query.filter_by(stock_id=stock_id, product_id=product_id).first()
-                if stock_product:
-                    stock_product.quantity = new_quantity
-                else:
-                    # Créer une nouvelle entrée si le produit n'était pas dans le stock
-                    stock_product = StockProduct(stock_id=stock_id, product_id=product_id, quantity=new_quantity)
-                    db.session.add(stock_product)
+                new_levels[(stock_id, product_id)] = new_quantity
             
             except (ValueError, TypeError):
                 continue
@@ -3938,6 +3840,8 @@ def create_inventory(stock_id):
         
         try:
             db.session.add(inventory)
+            # Mettre à jour les quantités dans le stock
+            set_stock_levels(new_levels, source="inventaire", inventory=inventory)
             db.session.commit()
             # Message automatique pour le chat
             # Récupérer la machine associée au stock si elle existe
@@ -3977,213 +3881,233 @@ def create_inventory(stock_id):
     return render_template("inventory_form.html", stock=stock, products_data=products_data)
 
 
-@app.route("/stocks/<int:stock_id>/inventory/import", methods=["GET", "POST"])
-@login_required
-def import_inventory(stock_id):
-    stock = Stock.query.get_or_404(stock_id)
+def _parse_inventory_import_row(row):
+    """Extrait (code, valeurs du produit, quantité) d'une ligne du fichier d'inventaire.
     
-    if request.method == "POST":
-        if "file" not in request.files:
-            flash("Aucun fichier sélectionné", "danger")
-            return redirect(url_for("stocks"))
-        
-        file = request.files["file"]
-        if not file or file.filename == "":
-            flash("Aucun fichier sélectionné", "danger")
-            return redirect(url_for("stocks"))
-        
-        # Vérifier l'extension du fichier
-        filename = file.filename.lower()
-        if not (filename.endswith(".xlsx") or filename.endswith(".xls")):
-            flash("Le fichier doit être au format Excel (.xlsx ou .xls)", "danger")
-            return redirect(url_for("stocks"))
+    Lève ValueError si le nom, le code ou la quantité est manquant ou invalide.
+    """
+    code, values = _parse_product_import_row(row)
+    # Quantité (colonne 6) - obligatoire pour l'inventaire
+    raw_quantity = row[5] if len(row) > 5 else None
+    if raw_quantity is None:
+        raise ValueError("Quantité manquante")
+    try:
+        quantity = float(raw_quantity)
+    except (ValueError, TypeError):
+        raise ValueError("Quantité invalide")
+    return code, values, quantity
+
+
+def run_inventory_import(stock, user, file_content, progress=None, dry_run=False):
+    """Crée un inventaire du stock à partir du contenu d'un fichier Excel et retourne le bilan.
+    
+    Les lignes sont lues en streaming (openpyxl read_only). Les produits et les quantités
+    actuelles du stock sont résolus en deux requêtes, l'écart est calculé en mémoire puis
+    les produits manquants, les lignes d'inventaire et les quantités du stock sont écrits
+    en requêtes groupées. En mode prévisualisation (dry_run), rien n'est écrit.
+    """
+    from openpyxl import load_workbook
+    wb = load_workbook(BytesIO(file_content), read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        total_rows = max((ws.max_row or 0) - 1, 0)
         
-        try:
-            # Lire le fichier Excel depuis le stream
-            file_content = file.read()
-            if not file_content:
-                flash("Le fichier est vide", "danger")
-                return redirect(url_for("stocks"))
-            
-            file_stream = BytesIO(file_content)
-            wb = load_workbook(file_stream, data_only=True)
-            ws = wb.active
-            
-            if ws.max_row < 2:
-                flash("Le fichier Excel doit contenir au moins une ligne de données (en plus des en-têtes)", "danger")
-                return redirect(url_for("stocks"))
-            
-            # Compter le nombre d'inventaires existants pour ce stock pour générer le nom
-            existing_inventories_count = Inventory.query.filter_by(stock_id=stock_id).count()
-            inventory_number = existing_inventories_count + 1
-            inventory_name = f"{stock.name} #{inventory_number}"
-            
-            # Créer l'inventaire
-            inventory = Inventory(
-                stock_id=stock_id,
-                user_id=current_user.id,
-                name=inventory_name,
-                created_at=dt.datetime.utcnow()
-            )
-            
-            # Récupérer les produits du stock avec leurs quantités actuelles
-            stock_products = StockProduct.query.filter_by(stock_id=stock_id).all()
-            product_quantities = {sp.product_id: sp.quantity for sp in stock_products}
-            
-            imported_count = 0
-            skipped_count = 0
-            errors = []
-            has_changes = False
-            
-            # Parcourir à partir de la ligne 2 (en supposant que la ligne 1 contient les en-têtes)
-            for row_idx, row in enumerate(ws.iter_rows(min_row=2, values_only=True), start=2):
-                # Ignorer les lignes vides
-                if not row or not any(row):
-                    continue
-                
-                # Extraire les valeurs (nom, code, prix, fournisseur, stock min, quantité)
-                name = None
-                code = None
-                if row[0] is not None:
-                    name_str = str(row[0]).strip()
-                    name = name_str if name_str else None
-                if row[1] is not None:
-                    code_str = str(row[1]).strip()
-                    code = code_str if code_str else None
-                
-                price = 0.0
-                supplier_name = None
-                minimum_stock = 0.0
-                quantity = 0.0
-                
-                # Vérifier que nom et code sont présents
-                if not name or not code:
-                    skipped_count += 1
-                    errors.append(f"Ligne {row_idx}: Nom ou code manquant")
-                    continue
-                
-                # Extraire le prix (colonne 3)
-                if len(row) > 2 and row[2] is not None:
-                    try:
-                        price = float(row[2])
-                    except (ValueError, TypeError):
-                        price = 0.0
-                
-                # Extraire le fournisseur (colonne 4)
-                if len(row) > 3 and row[3] is not None:
-                    supplier_str = str(row[3]).strip()
-                    supplier_name = supplier_str if supplier_str and supplier_str.lower() != "none" else None
-                
-                # Extraire le stock minimum (colonne 5)
-                if len(row) > 4 and row[4] is not None:
-                    try:
-                        minimum_stock = float(row[4])
-                    except (ValueError, TypeError):
-                        minimum_stock = 0.0
-                
-                # Extraire la quantité (colonne 6) - obligatoire pour l'inventaire
-                if len(row) > 5 and row[5] is not None:
-                    try:
-                        quantity = float(row[5])
-                    except (ValueError, TypeError):
-                        skipped_count += 1
-                        errors.append(f"Ligne {row_idx}: Quantité invalide")
-                        continue
-                else:
-                    skipped_count += 1
-                    errors.append(f"Ligne {row_idx}: Quantité manquante")
-                    continue
-                
-                # Chercher le produit par code
-                product = Product.query.filter_by(code=code).first()
-                
-                # Si le produit n'existe pas, le créer et l'ajouter à la base de données
-                # Les nouveaux produits seront visibles dans la page produits après le commit
-                if not product:
-                    product = Product(
-                        name=name,
-                        code=code,
-                        price=price,
-                        supplier_name=supplier_name,
-                        minimum_stock=minimum_stock,
-                    )
-                    db.session.add(product)
-                    db.session.flush()  # Pour obtenir l'ID du produit et s'assurer qu'il est dans la session
-                    imported_count += 1
-                
-                # Récupérer la quantité précédente
-                previous_quantity = product_quantities.get(product.id, 0.0)
-                
-                # Ignorer si la quantité n'a pas changé
-                if abs(quantity - previous_quantity) < 0.01:
-                    continue
-                
-                has_changes = True
-                
-                # Créer l'item d'inventaire
-                item = InventoryItem(
-                    inventory=inventory,
-                    product_id=product.id,
-                    previous_quantity=previous_quantity,
-                    new_quantity=quantity,
-                    comment=None
-                )
-                inventory.items.append(item)
-                
-                # Mettre à jour la quantité dans le stock
-                stock_product = StockProduct.query.filter_by(stock_id=stock_id, product_id=product.id).first()
-                if stock_product:
-                    stock_product.quantity = quantity
-                else:
-                    # Créer une nouvelle entrée si le produit n'était pas dans le stock
-                    stock_product = StockProduct(stock_id=stock_id, product_id=product.id, quantity=quantity)
-                    db.session.add(stock_product)
-            
-            if not has_changes:
-                flash("Aucune modification de quantité détectée", "warning")
-                return redirect(url_for("stocks"))
-            
-            # Commit toutes les modifications
+        parsed_rows = []
+        report_rows = []
+        errors = []
+        seen_codes = set()
+        # Parcourir à partir de la ligne 2 (en supposant que la ligne 1 contient les en-têtes)
+        for row_idx, row in enumerate(ws.iter_rows(min_row=2, values_only=True), start=2):
+            # La lecture compte pour la première moitié de l'avancement
+            _report_progress(progress, row_idx - 1, total_rows * 2)
+            # Ignorer les lignes vides
+            if not row or not any(row):
+                continue
             try:
-                db.session.add(inventory)
-                db.session.commit()
-                
-                # Message automatique pour le chat
-                machine_name = ""
-                machine_id_for_msg = None
-                machine_with_stock = Machine.query.filter_by(stock_id=stock.id).first()
-                if machine_with_stock:
-                    machine_name = f" sur la machine '{machine_with_stock.name}'"
-                    machine_id_for_msg = machine_with_stock.id
-                
-                create_chat_message(
-                    message_type="auto",
-                    content=f"{current_user.username} a créé l'inventaire '{inventory.name}'{machine_name}",
-                    link_url=url_for("inventory_detail", inventory_id=inventory.id),
-                    machine_id=machine_id_for_msg
-                )
-                
-                if imported_count > 0:
-                    flash(f"Inventaire créé avec succès. {imported_count} nouveau(x) produit(s) créé(s).", "success")
-                else:
-                    flash("Inventaire créé avec succès", "success")
-                if skipped_count > 0:
-                    flash(f"{skipped_count} ligne(s) ignorée(s) (données invalides)", "warning")
-                if errors:
-                    error_summary = "; ".join(errors[:5])
-                    if len(errors) > 5:
-                        error_summary += f" ... et {len(errors) - 5} autre(s)"
-                    flash(f"Détails des erreurs: {error_summary}", "info")
-                
-                return redirect(url_for("inventories_list"))
-            except Exception as exc:
-                db.session.rollback()
-                flash(f"Erreur lors de l'import: {exc}", "danger")
-        
-        except Exception as exc:
-            flash(f"Erreur lors de la lecture du fichier: {exc}", "danger")
-        
-        return redirect(url_for("stocks"))
+                code, values, quantity = _parse_inventory_import_row(row)
+            except ValueError as exc:
+                error = str(exc)
+            else:
+                error = f"Le code '{code}' apparaît plusieurs fois dans le fichier" if code in seen_codes else None
+            if error:
+                errors.append(f"Ligne {row_idx}: {error}")
+                report_rows.append({"row": row_idx, "code": None, "action": "error", "error": error})
+                continue
+            seen_codes.add(code)
+            parsed_rows.append((row_idx, code, values, quantity))
+    finally:
+        wb.close()
+    
+    if not parsed_rows and not report_rows:
+        raise ValueError("Le fichier Excel doit contenir au moins une ligne de données (en plus des en-têtes)")
+    
+    # Deux requêtes : identifiants des produits par code, quantités actuelles du stock
+    product_ids = dict(db.session.query(Product.code, Product.id))
+    stock_rows = {
+        row.product_id: row
+        for row in db.session.query(StockProduct.id, StockProduct.product_id, StockProduct.quantity)
+        .filter(StockProduct.stock_id == stock.id)
+    }
+    
+    # Produits absents de la base, créés en une fois après le calcul de l'écart : aucune
+    # écriture (verrou SQLite) n'est ouverte pendant que l'avancement est enregistré
+    new_products = [
+        {
+            "code": code,
+            "name": values["name"],
+            "price": values.get("price", 0.0),
+            "supplier_name": values.get("supplier_name"),
+            "minimum_stock": values.get("minimum_stock", 0.0),
+        }
+        for _, code, values, _ in parsed_rows
+        if code not in product_ids
+    ]
+    
+    # Calcul de l'écart en mémoire
+    new_codes = {product["code"] for product in new_products}
+    diff = []
+    for position, (row_idx, code, values, quantity) in enumerate(parsed_rows, start=1):
+        _report_progress(progress, total_rows + position * total_rows / len(parsed_rows), total_rows * 2)
+        product_id = product_ids.get(code)
+        current = stock_rows.get(product_id) if product_id else None
+        previous_quantity = current.quantity if current else 0.0
+        report_row = {
+            "row": row_idx, "code": code, "name": values["name"],
+            "previous_quantity": previous_quantity, "new_quantity": quantity,
+            "new_product": code in new_codes,
+        }
+        # Ignorer si la quantité n'a pas changé
+        if abs(quantity - previous_quantity) < 0.01:
+            report_row["action"] = "unchanged"
+        else:
+            report_row["action"] = "update"
+            diff.append((code, previous_quantity, quantity))
+        report_rows.append(report_row)
+    
+    report_rows.sort(key=lambda row: row["row"])
+    result = {
+        "imported": len(new_products),
+        "skipped": len(errors),
+        "errors": errors,
+        "rows": report_rows,
+        "changed": len(diff),
+        "inventory_id": None,
+        "dry_run": dry_run,
+    }
+    if dry_run or not diff:
+        db.session.rollback()
+        return result
+    
+    if new_products:
+        created = db.session.execute(db.insert(Product).returning(Product.id, Product.code), new_products)
+        product_ids.update({row.code: row.id for row in created})
+    
+    # Compter le nombre d'inventaires existants pour ce stock pour générer le nom
+    existing_inventories_count = Inventory.query.filter_by(stock_id=stock.id).count()
+    inventory = Inventory(
+        stock_id=stock.id,
+        user_id=user.id,
+        name=f"{stock.name} #{existing_inventories_count + 1}",
+        created_at=dt.datetime.utcnow()
+    )
+    db.session.add(inventory)
+    db.session.flush()
+    
+    # Écritures groupées : lignes d'inventaire, quantités existantes, nouvelles lignes de stock
+    db.session.execute(db.insert(InventoryItem), [
+        {
+            "inventory_id": inventory.id,
+            "product_id": product_ids[code],
+            "previous_quantity": previous_quantity,
+            "new_quantity": quantity,
+            "comment": None,
+        }
+        for code, previous_quantity, quantity in diff
+    ])
+    set_stock_levels(
+        {(stock.id, product_ids[code]): quantity for code, _, quantity in diff},
+        source="inventaire", inventory=inventory, user_id=user.id,
+    )
+    # Les produits créés sans quantité peuvent être sous leur stock minimum
+    refresh_low_stock(product_ids[code] for code in new_codes)
+    db.session.commit()
+    result["inventory_id"] = inventory.id
+    
+    # Message automatique pour le chat
+    machine_name = ""
+    machine_id_for_msg = None
+    machine_with_stock = Machine.query.filter_by(stock_id=stock.id).first()
+    if machine_with_stock:
+        machine_name = f" sur la machine '{machine_with_stock.name}'"
+        machine_id_for_msg = machine_with_stock.id
+    
+    create_chat_message(
+        message_type="auto",
+        content=f"{user.username} a créé l'inventaire '{inventory.name}'{machine_name}",
+        link_url=url_for("inventory_detail", inventory_id=inventory.id),
+        machine_id=machine_id_for_msg
+    )
+    return result
+
+
+def build_inventory_import_report(result):
+    """Génère le rapport Excel (écart d'inventaire ligne par ligne) d'un import d'inventaire"""
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, Alignment
+    action_labels = {"update": "Modifié", "unchanged": "Inchangé", "error": "Erreur"}
+    
+    wb = Workbook()
+    ws = wb.active
+    ws.title = "Prévisualisation" if result["dry_run"] else "Inventaire"
+    ws.append(["Ligne", "Code", "Produit", "Ancienne quantité", "Nouvelle quantité", "Écart", "Statut", "Remarque"])
+    for cell in ws[1]:
+        cell.font = Font(bold=True)
+        cell.alignment = Alignment(horizontal='center')
+    
+    for row in result["rows"]:
+        if row["action"] == "error":
+            ws.append([row["row"], "", "", "", "", "", action_labels["error"], row["error"]])
+            continue
+        ws.append([
+            row["row"],
+            row["code"],
+            row["name"],
+            row["previous_quantity"],
+            row["new_quantity"],
+            row["new_quantity"] - row["previous_quantity"],
+            action_labels.get(row["action"], row["action"]),
+            "Nouveau produit" if row["new_product"] else "",
+        ])
+    
+    for column_letter, width in zip("ABCDEFGH", (8, 20, 35, 18, 18, 12, 12, 30)):
+        ws.column_dimensions[column_letter].width = width
+    
+    prefix = "previsualisation_inventaire" if result["dry_run"] else "rapport_import_inventaire"
+    return _workbook_bytes(wb), f'{prefix}_{dt.datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
+
+
+@app.route("/stocks/<int:stock_id>/inventory/import", methods=["GET", "POST"])
+@login_required
+def import_inventory(stock_id):
+    stock = Stock.query.get_or_404(stock_id)
+    
+    if request.method == "POST":
+        file_content, filename, error_response = _read_uploaded_excel("stocks")
+        if error_response is not None:
+            return error_response
+        
+        # L'import est exécuté en arrière-plan pour ne pas bloquer le worker
+        dry_run = request.form.get("dry_run") == "1"
+        job = jobs.submit_job(
+            "import_inventory",
+            user_id=current_user.id,
+            params={"stock_id": stock.id, "dry_run": dry_run},
+            input_content=file_content,
+            input_filename=filename,
+            label=f"Prévisualisation inventaire {stock.name}" if dry_run else f"Import inventaire {stock.name}",
+        )
+        flash(f"Import lancé en arrière-plan (tâche #{job.id}). Suivez son avancement dans la page des tâches.", "info")
+        return redirect(url_for("jobs_list"))
     
     return redirect(url_for("stocks"))
 
@@ -4205,6 +4129,9 @@ def inventory_detail(inventory_id):
 @app.route("/inventories/export")
 @admin_or_manager_required
 def export_inventories():
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, Alignment
+    from openpyxl.utils import get_column_letter
     inventories = Inventory.query.order_by(Inventory.created_at.desc()).all()
     
     wb = Workbook()
@@ -4276,15 +4203,11 @@ def edit_inventory(inventory_id):
     stock = inventory.stock
     
     if request.method == "POST":
-        # Restaurer les quantités précédentes
-        for item in inventory.items:
-            stock_product = StockProduct.query.filter_by(stock_id=stock.id, product_id=item.product_id).first()
-            if stock_product:
-                stock_product.quantity = item.previous_quantity
-            else:
-                # Si le produit n'existe plus dans le stock, on le recrée avec l'ancienne quantité
-                stock_product = StockProduct(stock_id=stock.id, product_id=item.product_id, quantity=item.previous_quantity)
-                db.session.add(stock_product)
+        # Restaurer les quantités précédentes (les lignes disparues du stock sont recréées)
+        set_stock_levels(
+            {(stock.id, item.product_id): item.previous_quantity for item in inventory.items},
+            source="annulation_inventaire", inventory=inventory,
+        )
         
         # Supprimer les anciens items
         for item in inventory.items:
@@ -4301,6 +4224,7 @@ def edit_inventory(inventory_id):
         product_quantities = {sp.product_id: sp.quantity for sp in stock_products}
         
         has_changes = False
+        new_levels = {}
         
         for product_id_str, new_qty_str, comment in zip(product_ids, new_quantities, comments):
             try:
@@ -4323,22 +4247,19 @@ def edit_inventory(inventory_id):
                     comment=comment.strip() if comment else None
                 )
                 inventory.items.append(item)
-                
-                # Mettre à jour la quantité dans le stock
-                stock_product = StockProduct.query.filter_by(stock_id=stock.id, product_id=product_id).first()
-                if stock_product:
-                    stock_product.quantity = new_quantity
-                else:
-                    stock_product = StockProduct(stock_id=stock.id, product_id=product_id, quantity=new_quantity)
-                    db.session.add(stock_product)
+                new_levels[(stock.id, product_id)] = new_quantity
             
             except (ValueError, TypeError):
                 continue
         
         if not has_changes:
             flash("Aucune modification de quantité détectée", "warning")
+            db.session.rollback()
             return redirect(url_for("edit_inventory", inventory_id=inventory_id))
         
+        # Mettre à jour les quantités dans le stock
+        set_stock_levels(new_levels, source="inventaire", inventory=inventory)
+        
         # Mettre à jour la date de modification
         inventory.created_at = dt.datetime.utcnow()
         
@@ -4398,15 +4319,11 @@ def delete_inventory(inventory_id):
     inventory = Inventory.query.get_or_404(inventory_id)
     stock = inventory.stock
     
-    # Restaurer les quantités précédentes pour chaque item
-    for item in inventory.items:
-        stock_product = StockProduct.query.filter_by(stock_id=stock.id, product_id=item.product_id).first()
-        if stock_product:
-            stock_product.quantity = item.previous_quantity
-        else:
-            # Si le produit n'existe plus dans le stock, on le recrée avec l'ancienne quantité
-            stock_product = StockProduct(stock_id=stock.id, product_id=item.product_id, quantity=item.previous_quantity)
-            db.session.add(stock_product)
+    # Restaurer les quantités précédentes pour chaque item (les lignes disparues sont recréées)
+    set_stock_levels(
+        {(stock.id, item.product_id): item.previous_quantity for item in inventory.items},
+        source="annulation_inventaire",
+    )
     
     # Supprimer l'inventaire (les items seront supprimés en cascade)
     db.session.delete(inventory)
@@ -4448,8 +4365,11 @@ def delete_stock(stock_id):
         flash(f"Impossible de supprimer ce stock : il est utilisé dans {corrective_maintenances} maintenance(s) corrective(s).", "danger")
         return redirect(url_for("stocks"))
     
-    # Supprimer tous les produits du stock (cascade)
+    # Supprimer tous les produits du stock (cascade) ainsi que leur historique
+    stocked_product_ids = [sp.product_id for sp in StockProduct.query.filter_by(stock_id=stock_id).all()]
     StockProduct.query.filter_by(stock_id=stock_id).delete()
+    delete_stock_history(stock_id=stock_id)
+    refresh_low_stock(stocked_product_ids)
     
     # Supprimer le stock
     db.session.delete(stock)
@@ -4464,6 +4384,48 @@ def delete_stock(stock_id):
     return redirect(url_for("stocks"))
 
 
+MOVEMENTS_PAGE_SIZE = 20
+
+
+def load_movements_page(cursor=None, page_size=MOVEMENTS_PAGE_SIZE):
+    """Charge une page de mouvements (plus récents d'abord) avec tout ce que la page affiche.
+
+    Une seule requête jointe (stocks, maintenance liée et sa machine) plus un chargement
+    groupé des articles et de leurs produits. La pagination se fait par curseur
+    « date_id » du dernier mouvement affiché : retourne (mouvements, curseur suivant ou None).
+    """
+    query = (
+        Movement.query
+        .options(
+            joinedload(Movement.source_stock),
+            joinedload(Movement.dest_stock),
+            joinedload(Movement.maintenance_entry).joinedload(MaintenanceEntry.machine),
+            joinedload(Movement.maintenance_entry).joinedload(MaintenanceEntry.report),
+            joinedload(Movement.corrective_maintenance).joinedload(CorrectiveMaintenance.machine),
+            selectinload(Movement.items).joinedload(MovementItem.product),
+        )
+        .order_by(Movement.created_at.desc(), Movement.id.desc())
+    )
+    if cursor:
+        try:
+            cursor_date, cursor_id = cursor.rsplit("_", 1)
+            cursor_date = dt.datetime.fromisoformat(cursor_date)
+            cursor_id = int(cursor_id)
+        except ValueError:
+            abort(400)
+        query = query.filter(db.or_(
+            Movement.created_at < cursor_date,
+            db.and_(Movement.created_at == cursor_date, Movement.id < cursor_id),
+        ))
+    page_movements = query.limit(page_size + 1).all()
+    next_cursor = None
+    if len(page_movements) > page_size:
+        page_movements = page_movements[:page_size]
+        last = page_movements[-1]
+        next_cursor = f"{last.created_at.isoformat()}_{last.id}"
+    return page_movements, next_cursor
+
+
 @app.route("/movements", methods=["GET", "POST"])
 @login_required
 def movements():
@@ -4471,7 +4433,7 @@ def movements():
     products = Product.query.order_by(Product.name).all()
     if request.method == "POST":
         # Seul l'admin ou le gestionnaire peut créer/modifier des mouvements
-        if current_user.user_type not in ["admin", "gestionnaire"]:
+        if not (current_user.is_admin or current_user.is_manager):
             flash("Accès refusé : cette fonctionnalité est réservée aux administrateurs et gestionnaires.", "danger")
             return redirect(url_for("movements"))
         move_type = request.form["type"]
@@ -4526,40 +4488,11 @@ def movements():
             if dest_stock:
                 stock_names.append(dest_stock.name)
             stock_info = " → ".join(stock_names) if stock_names else ""
-            # Récupérer la machine associée si le mouvement est lié à une maintenance
-            machine_name = ""
-            machine_id_for_msg = None
-            # Chercher dans une fenêtre de 5 minutes pour trouver une maintenance associée
-            time_window_start = created_at - dt.timedelta(minutes=5)
-            time_window_end = created_at + dt.timedelta(minutes=5)
-            
-            # Vérifier maintenance préventive
-            related_entry = MaintenanceEntry.query.filter(
-                MaintenanceEntry.stock_id == source_id,
-                MaintenanceEntry.created_at >= time_window_start,
-                MaintenanceEntry.created_at <= time_window_end
-            ).first()
-            
-            if related_entry:
-                machine_name = f" sur la machine '{related_entry.machine.name}'"
-                machine_id_for_msg = related_entry.machine_id
-            else:
-                # Vérifier maintenance corrective
-                related_corrective = CorrectiveMaintenance.query.filter(
-                    CorrectiveMaintenance.stock_id == source_id,
-                    CorrectiveMaintenance.created_at >= time_window_start,
-                    CorrectiveMaintenance.created_at <= time_window_end
-                ).first()
-                
-                if related_corrective:
-                    machine_name = f" sur la machine '{related_corrective.machine.name}'"
-                    machine_id_for_msg = related_corrective.machine_id
-            
+            # Un mouvement saisi sur cette page n'est jamais lié à une maintenance
             create_chat_message(
                 message_type="auto",
-                content=f"{current_user.username} a effectué un mouvement ({move_type_label})" + (f" : {stock_info}" if stock_info else "") + machine_name,
-                link_url=url_for("movements"),
-                machine_id=machine_id_for_msg
+                content=f"{current_user.username} a effectué un mouvement ({move_type_label})" + (f" : {stock_info}" if stock_info else ""),
+                link_url=url_for("movements")
             )
             flash("Mouvement enregistré", "success")
         except Exception as exc:
@@ -4567,56 +4500,30 @@ def movements():
             flash(f"Erreur: {exc}", "danger")
         return redirect(request.url)
 
-    recent_movements = Movement.query.order_by(Movement.created_at.desc()).limit(20).all()
-    
-    # Marquer les mouvements liés aux maintenances et récupérer les informations
-    for move in recent_movements:
-        move.is_maintenance_related = False
-        move.maintenance_info = None
-        # Vérifier si le mouvement est lié à une maintenance préventive ou corrective
-        if move.type == "sortie" and move.source_stock_id:
-            # Chercher dans une fenêtre de 5 minutes
-            time_window_start = move.created_at - dt.timedelta(minutes=5)
-            time_window_end = move.created_at + dt.timedelta(minutes=5)
-            
-            # Vérifier maintenance préventive
-            related_entry = MaintenanceEntry.query.filter(
-                MaintenanceEntry.stock_id == move.source_stock_id,
-                MaintenanceEntry.created_at >= time_window_start,
-                MaintenanceEntry.created_at <= time_window_end
-            ).first()
-            
-            if related_entry:
-                move.is_maintenance_related = True
-                move.maintenance_info = {
-                    'type': 'préventive',
-                    'name': related_entry.report.name,
-                    'machine_name': related_entry.machine.name,
-                    'machine_code': related_entry.machine.code
-                }
-            else:
-                # Vérifier maintenance corrective
-                related_corrective = CorrectiveMaintenance.query.filter(
-                    CorrectiveMaintenance.stock_id == move.source_stock_id,
-                    CorrectiveMaintenance.created_at >= time_window_start,
-                    CorrectiveMaintenance.created_at <= time_window_end
-                ).first()
-                
-                if related_corrective:
-                    move.is_maintenance_related = True
-                    move.maintenance_info = {
-                        'type': 'corrective',
-                        'name': 'Maintenance corrective',
-                        'machine_name': related_corrective.machine.name,
-                        'machine_code': related_corrective.machine.code
-                    }
-    
-    return render_template("movements.html", movements=recent_movements, stocks=stocks, products=products)
+    recent_movements, next_cursor = load_movements_page()
+    return render_template(
+        "movements.html",
+        movements=recent_movements,
+        next_cursor=next_cursor,
+        stocks=stocks,
+        products=products,
+    )
+
+
+@app.route("/movements/history")
+@login_required
+def movements_history():
+    """Page suivante de l'historique des mouvements (fragment HTML pour le bouton « Charger plus »)"""
+    page_movements, next_cursor = load_movements_page(request.args.get("before"))
+    html = render_template("_movement_cards.html", movements=page_movements)
+    return jsonify({"html": html, "next_cursor": next_cursor})
 
 
 @app.route("/movements/export")
 @login_required
 def export_movements():
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, Alignment
     movements = Movement.query.order_by(Movement.created_at.desc()).all()
     
     # Créer le workbook Excel
@@ -4683,19 +4590,7 @@ def edit_movement(movement_id):
     movement = Movement.query.get_or_404(movement_id)
     
     # Vérifier si le mouvement est lié à une maintenance
-    is_maintenance_related = False
-    if movement.type == "sortie" and movement.source_stock_id:
-        time_window_start = movement.created_at - dt.timedelta(minutes=5)
-        time_window_end = movement.created_at + dt.timedelta(minutes=5)
-        related_entry = MaintenanceEntry.query.filter(
-            MaintenanceEntry.stock_id == movement.source_stock_id,
-            MaintenanceEntry.created_at >= time_window_start,
-            MaintenanceEntry.created_at <= time_window_end
-        ).first()
-        if related_entry:
-            is_maintenance_related = True
-    
-    if is_maintenance_related:
+    if movement.is_maintenance_related:
         flash("Ce mouvement est lié à une maintenance et ne peut pas être modifié", "danger")
         return redirect(url_for("movements"))
     
@@ -4712,12 +4607,6 @@ def edit_movement(movement_id):
         source_id = request.form.get("source_stock_id") or None
         dest_id = request.form.get("dest_stock_id") or None
         
-        # Sauvegarder les anciens items avant de les supprimer
-        old_items = [(item.product_id, item.quantity) for item in movement.items]
-        old_type = movement.type
-        old_source_id = movement.source_stock_id
-        old_dest_id = movement.dest_stock_id
-        
         # Inverser l'ancien mouvement
         try:
             reverse_movement_rules(movement)
@@ -4742,14 +4631,8 @@ def edit_movement(movement_id):
         
         if not product_ids or not any(pid for pid in product_ids):
             flash("Sélectionnez au moins un produit", "danger")
-            # Restaurer l'ancien mouvement
-            movement.type = old_type
-            movement.source_stock_id = old_source_id
-            movement.dest_stock_id = old_dest_id
-            for pid, qty in old_items:
-                item = MovementItem(product_id=pid, quantity=qty)
-                movement.items.append(item)
-            apply_movement_rules(movement)
+            # Annuler l'inversion : le mouvement et les stocks restent inchangés
+            db.session.rollback()
             return redirect(request.url)
         
         items = []
@@ -4768,36 +4651,16 @@ def edit_movement(movement_id):
         
         if not items:
             flash("Aucune quantité valide fournie", "danger")
-            # Restaurer l'ancien mouvement
-            movement.type = old_type
-            movement.source_stock_id = old_source_id
-            movement.dest_stock_id = old_dest_id
-            for pid, qty in old_items:
-                item = MovementItem(product_id=pid, quantity=qty)
-                movement.items.append(item)
-            apply_movement_rules(movement)
+            # Annuler l'inversion : le mouvement et les stocks restent inchangés
+            db.session.rollback()
             return redirect(request.url)
         
         # Appliquer le nouveau mouvement
         error = apply_movement_rules(movement)
         if error:
             flash(error, "danger")
+            # Le rollback annule aussi l'inversion de l'ancien mouvement
             db.session.rollback()
-            # Restaurer l'ancien mouvement
-            movement.type = old_type
-            movement.source_stock_id = old_source_id
-            movement.dest_stock_id = old_dest_id
-            for item in movement.items:
-                db.session.delete(item)
-            movement.items = []
-            for pid, qty in old_items:
-                item = MovementItem(product_id=pid, quantity=qty)
-                movement.items.append(item)
-            try:
-                apply_movement_rules(movement)
-                db.session.commit()
-            except:
-                db.session.rollback()
             return redirect(request.url)
         
         try:
@@ -4819,19 +4682,7 @@ def delete_movement(movement_id):
     movement = Movement.query.get_or_404(movement_id)
     
     # Vérifier si le mouvement est lié à une maintenance
-    is_maintenance_related = False
-    if movement.type == "sortie" and movement.source_stock_id:
-        time_window_start = movement.created_at - dt.timedelta(minutes=5)
-        time_window_end = movement.created_at + dt.timedelta(minutes=5)
-        related_entry = MaintenanceEntry.query.filter(
-            MaintenanceEntry.stock_id == movement.source_stock_id,
-            MaintenanceEntry.created_at >= time_window_start,
-            MaintenanceEntry.created_at <= time_window_end
-        ).first()
-        if related_entry:
-            is_maintenance_related = True
-    
-    if is_maintenance_related:
+    if movement.is_maintenance_related:
         flash("Ce mouvement est lié à une maintenance et ne peut pas être supprimé", "danger")
         return redirect(url_for("movements"))
     
@@ -5332,11 +5183,14 @@ def maintenance_detail(report_id):
     return render_template("maintenance_detail.html", report=report)
 
 
-@app.route("/maintenance/<int:report_id>/export-pdf")
-@login_required
-def export_maintenance_pdf(report_id):
-    """Exporte un modèle de maintenance préventive en PDF"""
-    report = PreventiveReport.query.get_or_404(report_id)
+def build_maintenance_pdf(report, progress=None):
+    """Génère le PDF d'un modèle de maintenance préventive"""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+    from reportlab.lib.units import cm
+    from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, Table, TableStyle
+    from reportlab.lib import colors
+    from reportlab.lib.enums import TA_CENTER
     machine = report.machine
     
     # Créer le PDF en mémoire
@@ -5437,14 +5291,19 @@ def export_maintenance_pdf(report_id):
                           ParagraphStyle('DateStyle', parent=normal_style, fontSize=9, textColor=colors.grey, alignment=TA_CENTER)))
     
     # Générer le PDF
+    _report_progress(progress, 1, 2)
     doc.build(story)
-    buffer.seek(0)
-    
-    # Créer la réponse
-    response = make_response(buffer.getvalue())
-    response.headers['Content-Type'] = 'application/pdf'
-    response.headers['Content-Disposition'] = f'attachment; filename=maintenance_{report.id}_{report.name.replace(" ", "_")}_{dt.datetime.now().strftime("%Y%m%d")}.pdf'
-    return response
+    _report_progress(progress, 2, 2)
+    return buffer.getvalue(), f'maintenance_{report.id}_{report.name.replace(" ", "_")}_{dt.datetime.now().strftime("%Y%m%d")}.pdf'
+
+
+@app.route("/maintenance/<int:report_id>/export-pdf")
+@login_required
+def export_maintenance_pdf(report_id):
+    """Exporte un modèle de maintenance préventive en PDF"""
+    report = PreventiveReport.query.get_or_404(report_id)
+    content, filename = build_maintenance_pdf(report)
+    return _attachment_response(content, filename, 'application/pdf')
 
 
 @app.route("/maintenance/<int:report_id>/delete", methods=["POST"])
@@ -5620,6 +5479,10 @@ def fill_maintenance(machine_id, report_id):
         return redirect(url_for("machine_detail", machine_id=machine.id))
 
     if request.method == "POST":
+        upload_error = photo_upload_error()
+        if upload_error:
+            flash(upload_error, "danger")
+            return redirect(request.url)
         # Récupérer le nombre d'heures saisi, ou utiliser machine.hours par défaut
         performed_hours_raw = request.form.get("performed_hours")
         try:
@@ -5706,7 +5569,7 @@ def fill_maintenance(machine_id, report_id):
 
         # Créer un mouvement de sortie uniquement si des produits sont fournis
         if removal_items and stock:
-            movement = Movement(type="sortie", source_stock_id=stock.id, created_at=dt.datetime.utcnow())
+            movement = Movement(type="sortie", source_stock_id=stock.id, created_at=dt.datetime.utcnow(), maintenance_entry=entry)
             for pid, qty in removal_items:
                 movement.items.append(MovementItem(product_id=pid, quantity=qty))
 
@@ -5797,27 +5660,9 @@ def fill_maintenance(machine_id, report_id):
             db.session.commit()
             
             # Traiter les photos uploadées
-            if 'photos' in request.files:
-                photos = request.files.getlist('photos')
-                for photo in photos:
-                    if photo and photo.filename and allowed_image_file(photo.filename):
-                        original_filename = photo.filename
-                        filename = secure_filename(original_filename)
-                        timestamp = dt.datetime.now().strftime("%Y%m%d_%H%M%S_")
-                        safe_filename = f"{timestamp}{entry.id}_{filename}"
-                        file_path = MAINTENANCE_PHOTOS_FOLDER / safe_filename
-                        photo.save(str(file_path))
-                        
-                        maintenance_photo = MaintenancePhoto(
-                            maintenance_entry_id=entry.id,
-                            filename=safe_filename,
-                            original_filename=original_filename,
-                            file_path=str(file_path),
-                            user_id=current_user.id
-                        )
-                        db.session.add(maintenance_photo)
-            
+            new_photos = add_maintenance_photos(entry.id, maintenance_entry_id=entry.id)
             db.session.commit()
+            ingest_maintenance_photos(new_photos)
             # Message automatique pour le chat
             create_chat_message(
                 message_type="auto",
@@ -5847,20 +5692,8 @@ def fill_maintenance(machine_id, report_id):
 def maintenance_entry_detail(entry_id):
     entry = MaintenanceEntry.query.get_or_404(entry_id)
     
-    # Récupérer le mouvement de sortie associé à cette maintenance (créé à peu près en même temps)
-    movement = None
-    if entry.stock:
-        time_window_start = entry.created_at - dt.timedelta(minutes=5)
-        time_window_end = entry.created_at + dt.timedelta(minutes=5)
-        movements = Movement.query.filter(
-            Movement.type == "sortie",
-            Movement.source_stock_id == entry.stock.id,
-            Movement.created_at >= time_window_start,
-            Movement.created_at <= time_window_end
-        ).all()
-        # Prendre le premier mouvement trouvé (normalement il n'y en a qu'un)
-        if movements:
-            movement = movements[0]
+    # Mouvement de sortie enregistré avec cette maintenance
+    movement = entry.movements[0] if entry.movements else None
     
     # Récupérer les photos
     photos = MaintenancePhoto.query.filter_by(maintenance_entry_id=entry_id).order_by(MaintenancePhoto.uploaded_at).all()
@@ -5874,27 +5707,16 @@ def delete_maintenance_entry(entry_id):
     entry = MaintenanceEntry.query.get_or_404(entry_id)
     machine_id = entry.machine.id
     
-    # Récupérer le mouvement de sortie associé à cette maintenance (créé à peu près en même temps)
-    movement = None
-    if entry.stock:
-        time_window_start = entry.created_at - dt.timedelta(minutes=5)
-        time_window_end = entry.created_at + dt.timedelta(minutes=5)
-        movements = Movement.query.filter(
-            Movement.type == "sortie",
-            Movement.source_stock_id == entry.stock.id,
-            Movement.created_at >= time_window_start,
-            Movement.created_at <= time_window_end
-        ).all()
-        # Prendre le premier mouvement trouvé (normalement il n'y en a qu'un)
-        if movements:
-            movement = movements[0]
+    # Mouvement de sortie enregistré avec cette maintenance
+    movement = entry.movements[0] if entry.movements else None
     
     # Si un mouvement est associé, inverser ses effets pour remettre les produits en stock
     if movement:
         try:
-            reverse_movement_rules(movement)
-            # Supprimer le mouvement
-            db.session.delete(movement)
+            for linked_movement in list(entry.movements):
+                reverse_movement_rules(linked_movement)
+                # Supprimer le mouvement
+                db.session.delete(linked_movement)
         except ValueError as exc:
             flash(f"Erreur lors de la restauration des stocks : {exc}", "danger")
             db.session.rollback()
@@ -5946,6 +5768,10 @@ def edit_maintenance_entry(entry_id):
         return redirect(url_for("machine_detail", machine_id=machine.id))
 
     if request.method == "POST":
+        upload_error = photo_upload_error()
+        if upload_error:
+            flash(upload_error, "danger")
+            return redirect(request.url)
         errors = []
 
         # Mettre à jour le stock
@@ -5955,35 +5781,13 @@ def edit_maintenance_entry(entry_id):
         except (TypeError, ValueError):
             stock_id = None
 
-        old_stock = entry.stock
         new_stock = Stock.query.get(stock_id) if stock_id else None
         entry.stock = new_stock
 
-        # Récupérer les anciens produits pour annuler le mouvement si nécessaire
-        old_product_quantities = {}
-        if old_stock:
-            # Chercher le mouvement de sortie associé (créé à peu près en même temps que le rapport)
-            # On cherche dans une fenêtre de 5 minutes
-            time_window_start = entry.created_at - dt.timedelta(minutes=5)
-            time_window_end = entry.created_at + dt.timedelta(minutes=5)
-            old_movements = Movement.query.filter(
-                Movement.type == "sortie",
-                Movement.source_stock_id == old_stock.id,
-                Movement.created_at >= time_window_start,
-                Movement.created_at <= time_window_end
-            ).all()
-            
-            # Pour chaque mouvement, vérifier s'il correspond au rapport
-            # (on ne peut pas être sûr à 100% sans lien direct, mais on fait de notre mieux)
-            for mov in old_movements:
-                for item in mov.items:
-                    old_product_quantities[item.product_id] = old_product_quantities.get(item.product_id, 0) + item.quantity
-
-        # Annuler l'ancien mouvement si nécessaire (remettre les produits en stock)
-        if old_product_quantities and old_stock:
-            for product_id, qty in old_product_quantities.items():
-                stock_product = _get_or_create_stock_product(old_stock.id, product_id)
-                stock_product.quantity += qty
+        # Annuler les anciens mouvements de sortie de la maintenance (remettre les produits en stock)
+        for old_movement in list(entry.movements):
+            reverse_movement_rules(old_movement)
+            db.session.delete(old_movement)
 
         # Supprimer les anciennes valeurs
         for value in entry.values:
@@ -6052,7 +5856,7 @@ def edit_maintenance_entry(entry_id):
 
         # Créer un nouveau mouvement de sortie si des produits sont fournis
         if removal_items and new_stock:
-            movement = Movement(type="sortie", source_stock_id=new_stock.id, created_at=dt.datetime.utcnow())
+            movement = Movement(type="sortie", source_stock_id=new_stock.id, created_at=dt.datetime.utcnow(), maintenance_entry=entry)
             for pid, qty in removal_items:
                 movement.items.append(MovementItem(product_id=pid, quantity=qty))
 
@@ -6075,27 +5879,9 @@ def edit_maintenance_entry(entry_id):
             db.session.commit()
             
             # Traiter les photos uploadées
-            if 'photos' in request.files:
-                photos = request.files.getlist('photos')
-                for photo in photos:
-                    if photo and photo.filename and allowed_image_file(photo.filename):
-                        original_filename = photo.filename
-                        filename = secure_filename(original_filename)
-                        timestamp = dt.datetime.now().strftime("%Y%m%d_%H%M%S_")
-                        safe_filename = f"{timestamp}{entry.id}_{filename}"
-                        file_path = MAINTENANCE_PHOTOS_FOLDER / safe_filename
-                        photo.save(str(file_path))
-                        
-                        maintenance_photo = MaintenancePhoto(
-                            maintenance_entry_id=entry.id,
-                            filename=safe_filename,
-                            original_filename=original_filename,
-                            file_path=str(file_path),
-                            user_id=current_user.id
-                        )
-                        db.session.add(maintenance_photo)
-            
+            new_photos = add_maintenance_photos(entry.id, maintenance_entry_id=entry.id)
             db.session.commit()
+            ingest_maintenance_photos(new_photos)
             flash("Rapport de maintenance modifié", "success")
             return redirect(url_for("maintenance_entry_detail", entry_id=entry.id))
         except Exception as exc:
@@ -6141,6 +5927,10 @@ def new_corrective_maintenance(machine_id):
         default_stock_id = stocks[0].id
 
     if request.method == "POST":
+        upload_error = photo_upload_error()
+        if upload_error:
+            flash(upload_error, "danger")
+            return redirect(request.url)
         comment = request.form.get("comment", "").strip()
         stock_id_raw = request.form.get("stock_id")
         created_at_str = request.form.get("created_at")
@@ -6196,7 +5986,7 @@ def new_corrective_maintenance(machine_id):
             )
 
         if removal_items and stock:
-            movement = Movement(type="sortie", source_stock_id=stock.id, created_at=created_at)
+            movement = Movement(type="sortie", source_stock_id=stock.id, created_at=created_at, corrective_maintenance=maintenance)
             for pid, qty in removal_items:
                 movement.items.append(MovementItem(product_id=pid, quantity=qty))
 
@@ -6210,6 +6000,11 @@ def new_corrective_maintenance(machine_id):
         db.session.add(maintenance)
         try:
             db.session.commit()
+            
+            # Traiter les photos uploadées
+            new_photos = add_maintenance_photos(maintenance.id, corrective_maintenance_id=maintenance.id)
+            db.session.commit()
+            ingest_maintenance_photos(new_photos)
             # Message automatique pour le chat
             create_chat_message(
                 message_type="auto",
@@ -6251,7 +6046,7 @@ def edit_corrective_maintenance(maintenance_id):
     maintenance = CorrectiveMaintenance.query.get_or_404(maintenance_id)
     
     # Vérifier les permissions : admin ou technicien qui a créé le rapport
-    if current_user.user_type != "admin" and (current_user.user_type != "technicien" or maintenance.user_id != current_user.id):
+    if not current_user.is_admin and (not current_user.is_technician or maintenance.user_id != current_user.id):
         flash("Accès refusé : vous ne pouvez modifier que les rapports que vous avez créés.", "danger")
         return redirect(url_for("corrective_maintenance_detail", maintenance_id=maintenance.id))
     machine = maintenance.machine
@@ -6259,6 +6054,10 @@ def edit_corrective_maintenance(maintenance_id):
     products = Product.query.order_by(Product.name).all()
 
     if request.method == "POST":
+        upload_error = photo_upload_error()
+        if upload_error:
+            flash(upload_error, "danger")
+            return redirect(request.url)
         comment = request.form.get("comment", "").strip()
         stock_id_raw = request.form.get("stock_id")
         created_at_str = request.form.get("created_at")
@@ -6279,39 +6078,16 @@ def edit_corrective_maintenance(maintenance_id):
         except (TypeError, ValueError):
             hours = 0.0
 
-        old_stock = maintenance.stock
-        old_created_at = maintenance.created_at
         new_stock = Stock.query.get(stock_id) if stock_id else None
         maintenance.stock = new_stock
         maintenance.comment = comment
         maintenance.hours = hours
         maintenance.created_at = created_at
 
-        # Récupérer les anciens produits pour annuler le mouvement si nécessaire
-        old_product_quantities = {}
-        if old_stock:
-            # Chercher le mouvement de sortie associé (créé à peu près en même temps que le rapport)
-            # On cherche dans une fenêtre de 5 minutes en utilisant l'ancienne date
-            time_window_start = old_created_at - dt.timedelta(minutes=5)
-            time_window_end = old_created_at + dt.timedelta(minutes=5)
-            old_movements = Movement.query.filter(
-                Movement.type == "sortie",
-                Movement.source_stock_id == old_stock.id,
-                Movement.created_at >= time_window_start,
-                Movement.created_at <= time_window_end
-            ).all()
-            
-            # Pour chaque mouvement, vérifier s'il correspond au rapport
-            # (on ne peut pas être sûr à 100% sans lien direct, mais on fait de notre mieux)
-            for mov in old_movements:
-                for item in mov.items:
-                    old_product_quantities[item.product_id] = old_product_quantities.get(item.product_id, 0) + item.quantity
-
-        # Annuler l'ancien mouvement si nécessaire (remettre les produits en stock)
-        if old_product_quantities and old_stock:
-            for product_id, qty in old_product_quantities.items():
-                stock_product = _get_or_create_stock_product(old_stock.id, product_id)
-                stock_product.quantity += qty
+        # Annuler les anciens mouvements de sortie de la maintenance (remettre les produits en stock)
+        for old_movement in list(maintenance.movements):
+            reverse_movement_rules(old_movement)
+            db.session.delete(old_movement)
 
         # Supprimer les anciens produits
         for product_item in maintenance.products:
@@ -6345,7 +6121,7 @@ def edit_corrective_maintenance(maintenance_id):
 
         # Créer un nouveau mouvement de sortie si des produits sont fournis
         if removal_items and new_stock:
-            movement = Movement(type="sortie", source_stock_id=new_stock.id, created_at=created_at)
+            movement = Movement(type="sortie", source_stock_id=new_stock.id, created_at=created_at, corrective_maintenance=maintenance)
             for pid, qty in removal_items:
                 movement.items.append(MovementItem(product_id=pid, quantity=qty))
 
@@ -6360,27 +6136,9 @@ def edit_corrective_maintenance(maintenance_id):
             db.session.commit()
             
             # Traiter les photos uploadées
-            if 'photos' in request.files:
-                photos = request.files.getlist('photos')
-                for photo in photos:
-                    if photo and photo.filename and allowed_image_file(photo.filename):
-                        original_filename = photo.filename
-                        filename = secure_filename(original_filename)
-                        timestamp = dt.datetime.now().strftime("%Y%m%d_%H%M%S_")
-                        safe_filename = f"{timestamp}{maintenance.id}_{filename}"
-                        file_path = MAINTENANCE_PHOTOS_FOLDER / safe_filename
-                        photo.save(str(file_path))
-                        
-                        maintenance_photo = MaintenancePhoto(
-                            corrective_maintenance_id=maintenance.id,
-                            filename=safe_filename,
-                            original_filename=original_filename,
-                            file_path=str(file_path),
-                            user_id=current_user.id
-                        )
-                        db.session.add(maintenance_photo)
-            
+            new_photos = add_maintenance_photos(maintenance.id, corrective_maintenance_id=maintenance.id)
             db.session.commit()
+            ingest_maintenance_photos(new_photos)
             flash("Maintenance corrective modifiée", "success")
             return redirect(url_for("corrective_maintenance_detail", maintenance_id=maintenance.id))
         except Exception as exc:
@@ -6517,6 +6275,8 @@ def maintenances_list():
 @login_required
 def export_maintenances():
     # Récupérer les mêmes filtres que la page maintenances
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, Alignment
     filter_type = request.args.get('filter_type', '').strip().lower()
     filter_name = request.args.get('filter_name', '').strip().lower()
     filter_date = request.args.get('filter_date', '').strip()
@@ -6648,6 +6408,47 @@ def export_maintenances():
     return response
 
 
+def calendar_missed_count(last_performed_date, calendar_start_date, periodicity, today):
+    """Nombre d'échéances manquées depuis la dernière maintenance (ou le début du calendrier).
+
+    Retourne None si la maintenance n'est pas encore dépassée.
+    """
+    if not calendar_start_date or not periodicity or periodicity <= 0:
+        return None
+    base_date = last_performed_date or calendar_start_date
+    if (today - base_date).days <= periodicity:
+        return None
+    return (today - base_date).days // periodicity
+
+
+def refresh_calendar_missed_counts():
+    """Met à jour missed_count pour toutes les maintenances calendaires dépassées.
+
+    Exécutée par le planificateur (voir scheduler.py) ; retourne le nombre de lignes modifiées.
+    """
+    today = dt.datetime.utcnow().date()
+    rows = db.session.execute(
+        db.select(
+            CalendarMaintenanceProgress.id,
+            CalendarMaintenanceProgress.last_performed_date,
+            CalendarMaintenanceProgress.missed_count,
+            PreventiveReport.calendar_start_date,
+            PreventiveReport.periodicity,
+        )
+        .join(PreventiveReport, PreventiveReport.id == CalendarMaintenanceProgress.report_id)
+        .where(PreventiveReport.trigger_type == "calendar")
+    ).all()
+    updates = []
+    for row in rows:
+        missed_count = calendar_missed_count(row.last_performed_date, row.calendar_start_date, row.periodicity, today)
+        if missed_count is not None and missed_count != row.missed_count:
+            updates.append({"id": row.id, "missed_count": missed_count})
+    if updates:
+        db.session.execute(db.update(CalendarMaintenanceProgress), updates)
+    db.session.commit()
+    return len(updates)
+
+
 @app.route("/maintenance/manage")
 @login_required
 def maintenance_manage():
@@ -6738,20 +6539,11 @@ def maintenance_manage():
         
         # Si la maintenance est dépassée
         if days_overdue > 0:
-            # Mettre à jour le compteur de retards si nécessaire
-            # Calculer combien d'échéances ont été manquées
-            if calendar_record.last_performed_date:
-                base_date = calendar_record.last_performed_date
-            else:
-                base_date = report.calendar_start_date
-            
-            # Calculer le nombre d'échéances manquées depuis la dernière maintenance ou le début
-            missed_count = (today - base_date).days // report.periodicity
-            
-            # Si le compteur n'est pas à jour, le mettre à jour
-            if missed_count != calendar_record.missed_count:
-                calendar_record.missed_count = missed_count
-                db.session.add(calendar_record)
+            # Compteur calculé pour l'affichage ; la colonne missed_count est tenue
+            # à jour par la tâche planifiée refresh_calendar_missed_counts
+            missed_count = calendar_missed_count(
+                calendar_record.last_performed_date, report.calendar_start_date, report.periodicity, today
+            )
             
             overdue.append(
                 {
@@ -6760,16 +6552,10 @@ def maintenance_manage():
                     "remaining": -days_overdue,  # Négatif pour indiquer le retard
                     "last_performed": calendar_record.last_performed_date,
                     "trigger_type": "calendar",
-                    "missed_count": calendar_record.missed_count,
+                    "missed_count": missed_count,
                     "next_due_date": next_due_date
                 }
             )
-    
-    # Commit les mises à jour du compteur de retards
-    try:
-        db.session.commit()
-    except Exception:
-        db.session.rollback()
 
     overdue.sort(key=lambda item: item["remaining"])
     warning.sort(key=lambda item: item["remaining"])
@@ -7322,13 +7108,38 @@ def stock_tracking():
 def database_export():
     """Page de gestion des exports de base de données"""
     excel_files = ExcelFile.query.order_by(ExcelFile.created_at.desc()).all()
-    return render_template("database_export.html", excel_files=excel_files)
+    recent_jobs = BackgroundJob.query.order_by(BackgroundJob.created_at.desc()).limit(10).all()
+    return render_template("database_export.html", excel_files=excel_files, recent_jobs=recent_jobs)
 
 
-@app.route("/database-export/maintenances/excel")
-@admin_required
-def export_maintenances_excel():
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+def _workbook_bytes(wb):
+    """Sérialise un classeur openpyxl en bytes"""
+    output = BytesIO()
+    wb.save(output)
+    return output.getvalue()
+
+
+def _attachment_response(content, filename, content_type):
+    """Construit une réponse de téléchargement à partir d'un contenu en mémoire"""
+    response = make_response(content)
+    response.headers['Content-Type'] = content_type
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    return response
+
+
+def _report_progress(progress, done, total):
+    """Notifie l'avancement d'un export (utilisé par les tâches en arrière-plan)"""
+    if progress is not None:
+        progress(done, total)
+
+
+def build_maintenances_excel(progress=None):
     """Export Excel complet des maintenances avec tous les détails"""
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, Alignment
     entries = MaintenanceEntry.query.order_by(MaintenanceEntry.created_at.desc()).all()
     corrective = CorrectiveMaintenance.query.order_by(CorrectiveMaintenance.created_at.desc()).all()
     
@@ -7350,7 +7161,9 @@ def export_maintenances_excel():
         cell.alignment = Alignment(horizontal='center')
     
     # Maintenances préventives
-    for entry in entries:
+    total = len(entries) + len(corrective)
+    for idx, entry in enumerate(entries, start=1):
+        _report_progress(progress, idx, total)
         machine_lineage_str = " > ".join([node.name for node in machine_lineage(entry.machine)])
         unit = entry.machine.counter_unit or 'h' if entry.machine.hour_counter_enabled else None
         counter_str = f"{entry.performed_hours} {unit}" if unit else "-"
@@ -7370,18 +7183,9 @@ def export_maintenances_excel():
         
         # Récupérer les produits utilisés via le mouvement associé
         products_list = []
-        if entry.stock:
-            time_window_start = entry.created_at - dt.timedelta(minutes=5)
-            time_window_end = entry.created_at + dt.timedelta(minutes=5)
-            movements = Movement.query.filter(
-                Movement.type == "sortie",
-                Movement.source_stock_id == entry.stock.id,
-                Movement.created_at >= time_window_start,
-                Movement.created_at <= time_window_end
-            ).all()
-            for movement in movements:
-                for item in movement.items:
-                    products_list.append(f"{item.product.name}|{item.product.code}|{item.quantity}")
+        for movement in entry.movements:
+            for item in movement.items:
+                products_list.append(f"{item.product.name}|{item.product.code}|{item.quantity}")
         products_str = " || ".join(products_list) if products_list else ""
         
         ws.append([
@@ -7400,7 +7204,8 @@ def export_maintenances_excel():
         ])
     
     # Maintenances correctives
-    for maintenance in corrective:
+    for idx, maintenance in enumerate(corrective, start=len(entries) + 1):
+        _report_progress(progress, idx, total)
         machine_lineage_str = " > ".join([node.name for node in machine_lineage(maintenance.machine)])
         
         # Récupérer les produits utilisés
@@ -7437,20 +7242,21 @@ def export_maintenances_excel():
         adjusted_width = min(max_length + 2, 50)
         ws.column_dimensions[column_letter].width = adjusted_width
     
-    output = BytesIO()
-    wb.save(output)
-    output.seek(0)
-    
-    response = make_response(output.getvalue())
-    response.headers['Content-Type'] = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-    response.headers['Content-Disposition'] = f'attachment; filename=maintenances_{dt.datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
-    return response
+    return _workbook_bytes(wb), f'maintenances_{dt.datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
 
 
-@app.route("/database-export/modeles/excel")
+@app.route("/database-export/maintenances/excel")
 @admin_required
-def export_modeles_excel():
+def export_maintenances_excel():
+    """Export Excel complet des maintenances avec tous les détails"""
+    content, filename = build_maintenances_excel()
+    return _attachment_response(content, filename, XLSX_MIMETYPE)
+
+
+def build_modeles_excel(progress=None):
     """Export Excel des modèles de maintenance"""
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, Alignment
     reports = PreventiveReport.query.order_by(PreventiveReport.name).all()
     
     wb = Workbook()
@@ -7466,7 +7272,8 @@ def export_modeles_excel():
         cell.font = Font(bold=True)
         cell.alignment = Alignment(horizontal='center')
     
-    for report in reports:
+    for idx, report in enumerate(reports, start=1):
+        _report_progress(progress, idx, len(reports))
         machine_lineage_str = " > ".join([node.name for node in machine_lineage(report.machine)])
         ws.append([
             report.name,
@@ -7489,20 +7296,21 @@ def export_modeles_excel():
         adjusted_width = min(max_length + 2, 50)
         ws.column_dimensions[column_letter].width = adjusted_width
     
-    output = BytesIO()
-    wb.save(output)
-    output.seek(0)
-    
-    response = make_response(output.getvalue())
-    response.headers['Content-Type'] = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-    response.headers['Content-Disposition'] = f'attachment; filename=modeles_{dt.datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
-    return response
+    return _workbook_bytes(wb), f'modeles_{dt.datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
 
 
-@app.route("/database-export/machines/excel")
+@app.route("/database-export/modeles/excel")
 @admin_required
-def export_machines_excel():
+def export_modeles_excel():
+    """Export Excel des modèles de maintenance"""
+    content, filename = build_modeles_excel()
+    return _attachment_response(content, filename, XLSX_MIMETYPE)
+
+
+def build_machines_excel(progress=None):
     """Export Excel de l'arborescence des machines"""
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, Alignment
     machines = Machine.query.order_by(Machine.code).all()
     
     wb = Workbook()
@@ -7518,7 +7326,8 @@ def export_machines_excel():
         cell.font = Font(bold=True)
         cell.alignment = Alignment(horizontal='center')
     
-    for machine in machines:
+    for idx, machine in enumerate(machines, start=1):
+        _report_progress(progress, idx, len(machines))
         parent_name = machine.parent.name if machine.parent else ""
         ws.append([
             machine.name,
@@ -7542,20 +7351,21 @@ def export_machines_excel():
         adjusted_width = min(max_length + 2, 50)
         ws.column_dimensions[column_letter].width = adjusted_width
     
-    output = BytesIO()
-    wb.save(output)
-    output.seek(0)
-    
-    response = make_response(output.getvalue())
-    response.headers['Content-Type'] = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-    response.headers['Content-Disposition'] = f'attachment; filename=arborescence_machines_{dt.datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
-    return response
+    return _workbook_bytes(wb), f'arborescence_machines_{dt.datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
 
 
-@app.route("/database-export/releves/excel")
+@app.route("/database-export/machines/excel")
 @admin_required
-def export_releves_excel():
+def export_machines_excel():
+    """Export Excel de l'arborescence des machines"""
+    content, filename = build_machines_excel()
+    return _attachment_response(content, filename, XLSX_MIMETYPE)
+
+
+def build_releves_excel(progress=None):
     """Export Excel des relevés compteur"""
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, Alignment
     logs = CounterLog.query.order_by(CounterLog.created_at.desc()).all()
     
     wb = Workbook()
@@ -7571,7 +7381,8 @@ def export_releves_excel():
         cell.font = Font(bold=True)
         cell.alignment = Alignment(horizontal='center')
     
-    for log in logs:
+    for idx, log in enumerate(logs, start=1):
+        _report_progress(progress, idx, len(logs))
         unit = log.machine.counter_unit or 'h'
         delta = log.new_hours - log.previous_hours
         ws.append([
@@ -7597,20 +7408,21 @@ def export_releves_excel():
         adjusted_width = min(max_length + 2, 50)
         ws.column_dimensions[column_letter].width = adjusted_width
     
-    output = BytesIO()
-    wb.save(output)
-    output.seek(0)
-    
-    response = make_response(output.getvalue())
-    response.headers['Content-Type'] = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-    response.headers['Content-Disposition'] = f'attachment; filename=releves_{dt.datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
-    return response
+    return _workbook_bytes(wb), f'releves_{dt.datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
 
 
-@app.route("/database-export/produits/excel")
+@app.route("/database-export/releves/excel")
 @admin_required
-def export_produits_excel():
+def export_releves_excel():
+    """Export Excel des relevés compteur"""
+    content, filename = build_releves_excel()
+    return _attachment_response(content, filename, XLSX_MIMETYPE)
+
+
+def build_produits_excel(progress=None):
     """Export Excel des produits"""
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, Alignment
     products = Product.query.order_by(Product.name).all()
     
     wb = Workbook()
@@ -7626,7 +7438,8 @@ def export_produits_excel():
         cell.font = Font(bold=True)
         cell.alignment = Alignment(horizontal='center')
     
-    for product in products:
+    for idx, product in enumerate(products, start=1):
+        _report_progress(progress, idx, len(products))
         ws.append([
             product.name,
             product.code,
@@ -7648,20 +7461,21 @@ def export_produits_excel():
         adjusted_width = min(max_length + 2, 50)
         ws.column_dimensions[column_letter].width = adjusted_width
     
-    output = BytesIO()
-    wb.save(output)
-    output.seek(0)
-    
-    response = make_response(output.getvalue())
-    response.headers['Content-Type'] = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-    response.headers['Content-Disposition'] = f'attachment; filename=produits_{dt.datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
-    return response
+    return _workbook_bytes(wb), f'produits_{dt.datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
 
 
-@app.route("/database-export/mouvements/excel")
+@app.route("/database-export/produits/excel")
 @admin_required
-def export_mouvements_excel():
+def export_produits_excel():
+    """Export Excel des produits"""
+    content, filename = build_produits_excel()
+    return _attachment_response(content, filename, XLSX_MIMETYPE)
+
+
+def build_mouvements_excel(progress=None):
     """Export Excel des mouvements"""
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, Alignment
     movements = Movement.query.order_by(Movement.created_at.desc()).all()
     
     wb = Workbook()
@@ -7677,7 +7491,8 @@ def export_mouvements_excel():
         cell.font = Font(bold=True)
         cell.alignment = Alignment(horizontal='center')
     
-    for movement in movements:
+    for idx, movement in enumerate(movements, start=1):
+        _report_progress(progress, idx, len(movements))
         products_list = []
         quantities_list = []
         for item in movement.items:
@@ -7708,20 +7523,21 @@ def export_mouvements_excel():
         adjusted_width = min(max_length + 2, 50)
         ws.column_dimensions[column_letter].width = adjusted_width
     
-    output = BytesIO()
-    wb.save(output)
-    output.seek(0)
-    
-    response = make_response(output.getvalue())
-    response.headers['Content-Type'] = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-    response.headers['Content-Disposition'] = f'attachment; filename=mouvements_{dt.datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
-    return response
+    return _workbook_bytes(wb), f'mouvements_{dt.datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
 
 
-@app.route("/database-export/inventaires/excel")
+@app.route("/database-export/mouvements/excel")
 @admin_required
-def export_inventaires_excel():
+def export_mouvements_excel():
+    """Export Excel des mouvements"""
+    content, filename = build_mouvements_excel()
+    return _attachment_response(content, filename, XLSX_MIMETYPE)
+
+
+def build_inventaires_excel(progress=None):
     """Export Excel des inventaires"""
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, Alignment
     inventories = Inventory.query.order_by(Inventory.created_at.desc()).all()
     
     wb = Workbook()
@@ -7737,19 +7553,20 @@ def export_inventaires_excel():
         cell.font = Font(bold=True)
         cell.alignment = Alignment(horizontal='center')
     
-    for inventory in inventories:
+    for idx, inventory in enumerate(inventories, start=1):
+        _report_progress(progress, idx, len(inventories))
         for item in inventory.items:
-            diff = item.new_quantity - item.old_quantity
+            diff = item.new_quantity - item.previous_quantity
             ws.append([
                 inventory.created_at.strftime("%d/%m/%Y %H:%M"),
                 inventory.stock.name,
                 inventory.stock.code,
                 item.product.name,
                 item.product.code,
-                item.old_quantity,
+                item.previous_quantity,
                 item.new_quantity,
                 diff,
-                inventory.comment or ""
+                item.comment or ""
             ])
     
     # Ajuster la largeur des colonnes
@@ -7765,19 +7582,18 @@ def export_inventaires_excel():
         adjusted_width = min(max_length + 2, 50)
         ws.column_dimensions[column_letter].width = adjusted_width
     
-    output = BytesIO()
-    wb.save(output)
-    output.seek(0)
-    
-    response = make_response(output.getvalue())
-    response.headers['Content-Type'] = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-    response.headers['Content-Disposition'] = f'attachment; filename=inventaires_{dt.datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
-    return response
+    return _workbook_bytes(wb), f'inventaires_{dt.datetime.now().strftime("%Y%m%d_%H%M%S")}.xlsx'
 
 
-@app.route("/database-export/all/json")
+@app.route("/database-export/inventaires/excel")
 @admin_required
-def export_all_json():
+def export_inventaires_excel():
+    """Export Excel des inventaires"""
+    content, filename = build_inventaires_excel()
+    return _attachment_response(content, filename, XLSX_MIMETYPE)
+
+
+def build_all_json(progress=None):
     """Export JSON complet de toute la base de données"""
     
     # Fonction helper pour convertir datetime en string
@@ -7829,6 +7645,7 @@ def export_all_json():
     }
     
     # Machines avec arborescence
+    _report_progress(progress, 1, 9)
     for machine in Machine.query.all():
         machine_dict = model_to_dict(machine)
         machine_dict["parent_name"] = machine.parent.name if machine.parent else None
@@ -7836,6 +7653,7 @@ def export_all_json():
         data["machines"].append(machine_dict)
     
     # Stocks avec produits
+    _report_progress(progress, 2, 9)
     for stock in Stock.query.all():
         stock_dict = model_to_dict(stock)
         stock_dict["products"] = []
@@ -7851,6 +7669,7 @@ def export_all_json():
         data["stocks"].append(stock_dict)
     
     # Modèles de maintenance avec composants
+    _report_progress(progress, 3, 9)
     for report in PreventiveReport.query.all():
         report_dict = model_to_dict(report)
         report_dict["machine_name"] = report.machine.name if report.machine else None
@@ -7862,6 +7681,7 @@ def export_all_json():
         data["preventive_reports"].append(report_dict)
     
     # Maintenances préventives avec valeurs et produits
+    _report_progress(progress, 4, 9)
     for entry in MaintenanceEntry.query.all():
         entry_dict = model_to_dict(entry)
         entry_dict["machine_name"] = entry.machine.name if entry.machine else None
@@ -7885,26 +7705,18 @@ def export_all_json():
         
         # Produits utilisés
         entry_dict["products"] = []
-        if entry.stock:
-            time_window_start = entry.created_at - dt.timedelta(minutes=5)
-            time_window_end = entry.created_at + dt.timedelta(minutes=5)
-            movements = Movement.query.filter(
-                Movement.type == "sortie",
-                Movement.source_stock_id == entry.stock.id,
-                Movement.created_at >= time_window_start,
-                Movement.created_at <= time_window_end
-            ).all()
-            for movement in movements:
-                for item in movement.items:
-                    entry_dict["products"].append({
-                        "product_name": item.product.name if item.product else None,
-                        "product_code": item.product.code if item.product else None,
-                        "quantity": item.quantity
-                    })
+        for movement in entry.movements:
+            for item in movement.items:
+                entry_dict["products"].append({
+                    "product_name": item.product.name if item.product else None,
+                    "product_code": item.product.code if item.product else None,
+                    "quantity": item.quantity
+                })
         
         data["maintenance_entries"].append(entry_dict)
     
     # Maintenances correctives avec produits
+    _report_progress(progress, 5, 9)
     for maintenance in CorrectiveMaintenance.query.all():
         maint_dict = model_to_dict(maintenance)
         maint_dict["machine_name"] = maintenance.machine.name if maintenance.machine else None
@@ -7925,6 +7737,7 @@ def export_all_json():
         data["corrective_maintenances"].append(maint_dict)
     
     # Relevés compteur
+    _report_progress(progress, 6, 9)
     for log in CounterLog.query.all():
         log_dict = model_to_dict(log)
         log_dict["machine_name"] = log.machine.name if log.machine else None
@@ -7933,6 +7746,7 @@ def export_all_json():
         data["counter_logs"].append(log_dict)
     
     # Mouvements avec items
+    _report_progress(progress, 7, 9)
     for movement in Movement.query.all():
         mov_dict = model_to_dict(movement)
         mov_dict["source_stock_name"] = movement.source_stock.name if movement.source_stock else None
@@ -7949,6 +7763,7 @@ def export_all_json():
         data["movements"].append(mov_dict)
     
     # Inventaires avec items
+    _report_progress(progress, 8, 9)
     for inventory in Inventory.query.all():
         inv_dict = model_to_dict(inventory)
         inv_dict["stock_name"] = inventory.stock.name if inventory.stock else None
@@ -7959,19 +7774,24 @@ def export_all_json():
             inv_dict["items"].append({
                 "product_name": item.product.name if item.product else None,
                 "product_code": item.product.code if item.product else None,
-                "old_quantity": item.old_quantity,
+                "old_quantity": item.previous_quantity,
                 "new_quantity": item.new_quantity
             })
         data["inventories"].append(inv_dict)
     
+    _report_progress(progress, 9, 9)
+    json_output = json.dumps(data, ensure_ascii=False, indent=2, default=str)
+    return json_output.encode("utf-8"), f'database_export_{dt.datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
+
+
+@app.route("/database-export/all/json")
+@admin_required
+def export_all_json():
+    """Export JSON complet de toute la base de données"""
     # Convertir en JSON avec gestion d'erreurs
     try:
-        json_output = json.dumps(data, ensure_ascii=False, indent=2, default=str)
-        
-        response = make_response(json_output)
-        response.headers['Content-Type'] = 'application/json; charset=utf-8'
-        response.headers['Content-Disposition'] = f'attachment; filename=database_export_{dt.datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
-        return response
+        content, filename = build_all_json()
+        return _attachment_response(content, filename, 'application/json; charset=utf-8')
     except Exception as exc:
         flash(f"Erreur lors de l'export JSON : {exc}", "danger")
         return redirect(url_for("database_export"))
@@ -7980,6 +7800,8 @@ def export_all_json():
 @app.route("/counter-logs/export")
 @login_required
 def export_counter_logs():
+    from openpyxl import Workbook
+    from openpyxl.styles import Font, Alignment
     logs = CounterLog.query.order_by(CounterLog.created_at.desc()).all()
     
     # Créer le workbook Excel
@@ -8040,35 +7862,456 @@ def export_counter_logs():
     return response
 
 
-def apply_movement_rules(movement: Movement):
-    def update_stock(stock_id, product_id, delta):
-        record = _get_or_create_stock_product(stock_id, product_id)
-        new_qty = record.quantity + delta
-        if new_qty < 0:
-            raise ValueError("Stock insuffisant pour le produit sélectionné")
-        record.quantity = new_qty
+STOCK_SHORTAGE_MESSAGE = "Stock insuffisant pour le produit sélectionné"
+# Intervalle entre deux photographies des quantités (stock_snapshot)
+STOCK_SNAPSHOT_INTERVAL_HOURS = float(os.environ.get("STOCK_SNAPSHOT_INTERVAL_HOURS", "24"))
+# Écritures du journal plus récentes que ce délai laissées hors des photographies : sous
+# PostgreSQL, un id attribué avant le commit peut devenir visible après un id supérieur
+STOCK_SNAPSHOT_SETTLE = dt.timedelta(minutes=1)
+
+
+def _dialect_insert(table):
+    """INSERT propre au dialecte (PostgreSQL ou SQLite), qui supporte ON CONFLICT"""
+    if db.engine.dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    return dialect_insert(table)
+
+
+def task_lease_holder():
+    """Identifiant du processus courant (calculé à l'appel : les workers gunicorn sont forkés)"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def acquire_task_lease(name, ttl, renew=False):
+    """Prend le bail de la tâche name pour la durée ttl ; True si ce processus l'a obtenu.
+
+    L'UPDATE conditionnel est atomique sur SQLite comme sur PostgreSQL : un seul
+    worker voit sa ligne modifiée. Le bail n'est pas rendu en fin d'exécution, il
+    espace aussi les passes des différents workers. Avec renew, le détenteur
+    actuel prolonge son bail (élection d'un worker qui le garde tant qu'il vit).
+    """
+    now = dt.datetime.utcnow()
+    db.session.execute(
+        _dialect_insert(TaskLease.__table__).values(name=name).on_conflict_do_nothing(index_elements=["name"])
+    )
+    available = or_(TaskLease.expires_at.is_(None), TaskLease.expires_at < now)
+    if renew:
+        available = or_(available, TaskLease.holder == task_lease_holder())
+    result = db.session.execute(
+        db.update(TaskLease)
+        .where(TaskLease.name == name, available)
+        .values(holder=task_lease_holder(), expires_at=now + ttl)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def _lock_stock_products(keys):
+    """Verrouille (SELECT ... FOR UPDATE) les lignes stock_product des couples (stock_id, product_id).
+
+    Les lignes sont verrouillées par id croissant pour éviter les interblocages entre
+    deux mouvements concurrents. Retourne {(stock_id, product_id): (id, quantité)}.
+    """
+    stock_ids = {stock_id for stock_id, _ in keys}
+    product_ids = {product_id for _, product_id in keys}
+    rows = db.session.execute(
+        db.select(StockProduct.id, StockProduct.stock_id, StockProduct.product_id, StockProduct.quantity)
+        .where(StockProduct.stock_id.in_(stock_ids), StockProduct.product_id.in_(product_ids))
+        .order_by(StockProduct.id)
+        .with_for_update()
+    ).all()
+    return {
+        (row.stock_id, row.product_id): (row.id, row.quantity)
+        for row in rows
+        if (row.stock_id, row.product_id) in keys
+    }
+
+
+def _lock_or_create_stock_products(keys):
+    """Comme _lock_stock_products, en créant d'abord en une fois les lignes manquantes (quantité 0)."""
+    locked = _lock_stock_products(keys)
+    missing = keys - set(locked)
+    if missing:
+        rows = [
+            {"stock_id": stock_id, "product_id": product_id, "quantity": 0.0}
+            for stock_id, product_id in sorted(missing)
+        ]
+        db.session.execute(
+            _dialect_insert(StockProduct.__table__)
+            .values(rows)
+            .on_conflict_do_nothing(index_elements=["stock_id", "product_id"])
+        )
+        # Une ligne créée entre-temps par un autre mouvement est simplement verrouillée à son tour
+        locked.update(_lock_stock_products(missing))
+    return locked
+
 
+def _normalize_stock_keys(values):
+    return {
+        (int(stock_id), int(product_id)): value
+        for (stock_id, product_id), value in values.items()
+    }
+
+
+def _ledger_user_id(user_id):
+    if user_id is not None:
+        return user_id
+    if has_request_context() and current_user.is_authenticated:
+        return current_user.id
+    return None
+
+
+def apply_stock_deltas(deltas, source, movement=None, inventory=None, user_id=None, _locked=None):
+    """Applique en une seule opération des variations de quantité {(stock_id, product_id): delta}.
+
+    Toutes les lignes concernées sont verrouillées par un seul SELECT ... FOR UPDATE, les
+    lignes manquantes sont créées en une fois, puis les quantités sont modifiées par des
+    UPDATE atomiques ``quantity = quantity + :delta`` protégés par la contrainte
+    ck_stock_product_positive_qty. Chaque variation est inscrite dans le journal
+    stock_ledger avec la quantité obtenue. Lève ValueError si un stock deviendrait négatif.
+    """
+    deltas = {key: delta for key, delta in _normalize_stock_keys(deltas).items() if delta}
+    if not deltas:
+        return
+
+    locked = _locked if _locked is not None else _lock_or_create_stock_products(set(deltas))
+    for key, delta in deltas.items():
+        if locked[key][1] + delta < 0:
+            raise ValueError(STOCK_SHORTAGE_MESSAGE)
+
+    table = StockProduct.__table__
+    stmt = (
+        db.update(table)
+        .where(table.c.id == db.bindparam("b_id"))
+        .values(quantity=table.c.quantity + db.bindparam("b_delta"))
+    )
+    params = [{"b_id": locked[key][0], "b_delta": delta} for key, delta in deltas.items()]
     try:
+        db.session.execute(stmt, params)
+    except IntegrityError:
+        # L'appelant annule la transaction (rollback) lorsqu'un mouvement est refusé
+        raise ValueError(STOCK_SHORTAGE_MESSAGE)
+
+    # Les objets StockProduct déjà chargés dans la session doivent relire leur quantité
+    updated_ids = {locked[key][0] for key in deltas}
+    for obj in list(db.session.identity_map.values()):
+        if isinstance(obj, StockProduct) and obj.id in updated_ids:
+            db.session.expire(obj, ["quantity"])
+    refresh_low_stock({product_id for _, product_id in deltas})
+
+    # Le mouvement ou l'inventaire doit avoir un id pour être référencé dans le journal
+    for parent in (movement, inventory):
+        if parent is not None and parent.id is None:
+            db.session.add(parent)
+            db.session.flush()
+    now = dt.datetime.utcnow()
+    ledger_user_id = _ledger_user_id(user_id)
+    db.session.execute(db.insert(StockLedgerEntry), [
+        {
+            "stock_id": stock_id,
+            "product_id": product_id,
+            "delta": delta,
+            "balance": locked[(stock_id, product_id)][1] + delta,
+            "source": source,
+            "movement_id": movement.id if movement is not None else None,
+            "inventory_id": inventory.id if inventory is not None else None,
+            "user_id": ledger_user_id,
+            "created_at": now,
+        }
+        for (stock_id, product_id), delta in deltas.items()
+    ])
+
+
+def set_stock_levels(levels, source="inventaire", inventory=None, user_id=None):
+    """Fixe les quantités {(stock_id, product_id): quantité} (inventaires) en passant par apply_stock_deltas."""
+    levels = _normalize_stock_keys(levels)
+    if not levels:
+        return
+    locked = _lock_or_create_stock_products(set(levels))
+    deltas = {key: quantity - locked[key][1] for key, quantity in levels.items()}
+    apply_stock_deltas(deltas, source=source, inventory=inventory, user_id=user_id, _locked=locked)
+
+
+def remove_stock_products(records, source="retrait"):
+    """Retire des lignes StockProduct en inscrivant leur sortie dans le journal."""
+    records = list(records)
+    apply_stock_deltas(
+        {(record.stock_id, record.product_id): -record.quantity for record in records},
+        source=source,
+    )
+    for record in records:
+        db.session.delete(record)
+    db.session.flush()
+    refresh_low_stock({record.product_id for record in records})
+
+
+def delete_stock_history(stock_id=None, product_id=None):
+    """Supprime le journal, les photographies et les alertes d'un stock ou d'un produit supprimé."""
+    for model in (StockLedgerEntry, StockSnapshot, LowStockItem):
+        query = model.query
+        if stock_id is not None:
+            query = query.filter(model.stock_id == stock_id)
+        if product_id is not None:
+            query = query.filter(model.product_id == product_id)
+        query.delete(synchronize_session=False)
+
+
+def refresh_low_stock(product_ids=None):
+    """Met à jour l'ensemble LowStockItem pour les produits donnés (tous si None).
+
+    Appelée par chaque écriture de stock pour les seuls produits touchés, et
+    périodiquement sur l'ensemble des produits pour rattraper les écarts. Une
+    ligne qui reste sous le seuil conserve sa date de passage (crossed_at).
+    """
+    if product_ids is not None:
+        product_ids = {int(product_id) for product_id in product_ids}
+        if not product_ids:
+            return
+
+    def scoped(query, column):
+        return query.where(column.in_(product_ids)) if product_ids is not None else query
+
+    # Par stock : lignes existantes sous le minimum du produit
+    desired = {
+        (row.stock_id, row.product_id): (row.quantity, row.minimum_stock)
+        for row in db.session.execute(scoped(
+            db.select(StockProduct.stock_id, StockProduct.product_id, StockProduct.quantity, Product.minimum_stock)
+            .join(Product, Product.id == StockProduct.product_id)
+            .where(Product.minimum_stock > 0, StockProduct.quantity < Product.minimum_stock),
+            StockProduct.product_id,
+        ))
+    }
+    # Usine : total de tous les stocks (0 si le produit n'est stocké nulle part)
+    total = func.coalesce(func.sum(StockProduct.quantity), 0.0)
+    for row in db.session.execute(scoped(
+        db.select(Product.id, Product.minimum_stock, total.label("total"))
+        .outerjoin(StockProduct, StockProduct.product_id == Product.id)
+        .where(Product.minimum_stock > 0)
+        .group_by(Product.id, Product.minimum_stock)
+        .having(total < Product.minimum_stock),
+        Product.id,
+    )):
+        desired[(PLANT_WIDE_STOCK_ID, row.id)] = (row.total, row.minimum_stock)
+
+    current = {
+        (row.stock_id, row.product_id): row.id
+        for row in db.session.execute(scoped(
+            db.select(LowStockItem.id, LowStockItem.stock_id, LowStockItem.product_id),
+            LowStockItem.product_id,
+        ))
+    }
+    resolved = [item_id for key, item_id in current.items() if key not in desired]
+    if resolved:
+        db.session.execute(db.delete(LowStockItem).where(LowStockItem.id.in_(resolved)))
+    still_low = [
+        {"id": item_id, "quantity": desired[key][0], "minimum_stock": desired[key][1]}
+        for key, item_id in current.items()
+        if key in desired
+    ]
+    if still_low:
+        db.session.execute(db.update(LowStockItem), still_low)
+    crossed = [
+        {
+            "stock_id": stock_id, "product_id": product_id,
+            "quantity": quantity, "minimum_stock": minimum_stock,
+            "crossed_at": dt.datetime.utcnow(),
+        }
+        for (stock_id, product_id), (quantity, minimum_stock) in desired.items()
+        if (stock_id, product_id) not in current
+    ]
+    if crossed:
+        db.session.execute(
+            _dialect_insert(LowStockItem.__table__)
+            .values(crossed)
+            .on_conflict_do_nothing(index_elements=["stock_id", "product_id"])
+        )
+
+
+def low_stock_product_ids(stock_id=PLANT_WIDE_STOCK_ID):
+    """Ids des produits sous le stock minimum dans un stock (l'usine par défaut)."""
+    return set(db.session.execute(
+        db.select(LowStockItem.product_id).where(LowStockItem.stock_id == stock_id)
+    ).scalars())
+
+
+def _latest_snapshot(stock_id, at=None):
+    """Retourne (taken_at, ledger_entry_id, {product_id: quantité}) de la dernière photographie avant `at`."""
+    query = db.select(func.max(StockSnapshot.taken_at)).where(StockSnapshot.stock_id == stock_id)
+    if at is not None:
+        query = query.where(StockSnapshot.taken_at <= at)
+    taken_at = db.session.execute(query).scalar()
+    if taken_at is None:
+        return None, 0, {}
+    rows = db.session.execute(
+        db.select(StockSnapshot.product_id, StockSnapshot.quantity, StockSnapshot.ledger_entry_id)
+        .where(StockSnapshot.stock_id == stock_id, StockSnapshot.taken_at == taken_at)
+    ).all()
+    last_entry_id = max((row.ledger_entry_id for row in rows), default=0)
+    return taken_at, last_entry_id, {row.product_id: row.quantity for row in rows}
+
+
+def stock_levels_at(stock_id, at):
+    """Quantités d'un stock à la date `at` : dernière photographie + tranche du journal qui suit.
+
+    Retourne None si `at` précède la première photographie : le stock existant avant
+    l'ouverture du journal n'y figure pas, la somme des variations serait fausse.
+    """
+    taken_at, last_entry_id, levels = _latest_snapshot(stock_id, at)
+    if taken_at is None:
+        return None
+    rows = db.session.execute(
+        db.select(StockLedgerEntry.product_id, func.sum(StockLedgerEntry.delta))
+        .where(
+            StockLedgerEntry.stock_id == stock_id,
+            StockLedgerEntry.id > last_entry_id,
+            StockLedgerEntry.created_at <= at,
+        )
+        .group_by(StockLedgerEntry.product_id)
+    ).all()
+    for product_id, delta in rows:
+        levels[product_id] = levels.get(product_id, 0.0) + (delta or 0.0)
+    return levels
+
+
+def product_level_at(stock_id, product_id, at):
+    """Quantité d'un produit dans un stock à la date `at` (dernière écriture du journal) ; None si inconnue."""
+    balance = db.session.execute(
+        db.select(StockLedgerEntry.balance)
+        .where(
+            StockLedgerEntry.stock_id == stock_id,
+            StockLedgerEntry.product_id == product_id,
+            StockLedgerEntry.created_at <= at,
+        )
+        .order_by(StockLedgerEntry.created_at.desc(), StockLedgerEntry.id.desc())
+        .limit(1)
+    ).scalar()
+    if balance is not None:
+        return balance
+    levels = stock_levels_at(stock_id, at)
+    return None if levels is None else levels.get(product_id, 0.0)
+
+
+def stock_consumption(stock_id, start, end, sources=("sortie", "annulation_sortie")):
+    """Consommation nette (sorties moins sorties annulées) d'un stock entre `start` (inclus) et `end` (exclu)."""
+    rows = db.session.execute(
+        db.select(StockLedgerEntry.product_id, func.sum(StockLedgerEntry.delta))
+        .where(
+            StockLedgerEntry.stock_id == stock_id,
+            StockLedgerEntry.created_at >= start,
+            StockLedgerEntry.created_at < end,
+            StockLedgerEntry.source.in_(sources),
+        )
+        .group_by(StockLedgerEntry.product_id)
+    ).all()
+    return {product_id: -(total or 0.0) for product_id, total in rows}
+
+
+def take_stock_snapshots(force=False):
+    """Photographie les quantités de chaque stock si la précédente date de plus de STOCK_SNAPSHOT_INTERVAL_HOURS.
+
+    La première photographie reprend StockProduct (solde d'ouverture du journal) ;
+    les suivantes sont calculées à partir de la précédente et du journal. Elles
+    s'arrêtent avant la première écriture de moins de STOCK_SNAPSHOT_SETTLE : les
+    écritures plus récentes, même validées plus tard avec un id inférieur, restent
+    prises en compte à partir du journal. Retourne le nombre de stocks photographiés.
+    """
+    now = dt.datetime.utcnow()
+    due_before = now - dt.timedelta(hours=STOCK_SNAPSHOT_INTERVAL_HOURS)
+    first_recent_id = db.session.execute(
+        db.select(func.min(StockLedgerEntry.id)).where(StockLedgerEntry.created_at >= now - STOCK_SNAPSHOT_SETTLE)
+    ).scalar()
+    if first_recent_id is not None:
+        last_entry_id = first_recent_id - 1
+    else:
+        last_entry_id = db.session.execute(db.select(func.max(StockLedgerEntry.id))).scalar() or 0
+    taken = 0
+    for stock_id in db.session.execute(db.select(Stock.id)).scalars().all():
+        taken_at, previous_entry_id, levels = _latest_snapshot(stock_id)
+        if taken_at is not None and taken_at > due_before and not force:
+            continue
+        if taken_at is None:
+            levels = dict(db.session.execute(
+                db.select(StockProduct.product_id, StockProduct.quantity)
+                .where(StockProduct.stock_id == stock_id)
+            ).all())
+            # Les écritures déjà présentes sont incluses dans les quantités actuelles ;
+            # celles qui suivent la limite de la photographie en sont retirées
+            previous_entry_id = last_entry_id
+            recent = db.session.execute(
+                db.select(StockLedgerEntry.product_id, func.sum(StockLedgerEntry.delta))
+                .where(StockLedgerEntry.stock_id == stock_id, StockLedgerEntry.id > last_entry_id)
+                .group_by(StockLedgerEntry.product_id)
+            ).all()
+            for product_id, delta in recent:
+                levels[product_id] = levels.get(product_id, 0.0) - (delta or 0.0)
+        rows = db.session.execute(
+            db.select(StockLedgerEntry.product_id, func.sum(StockLedgerEntry.delta))
+            .where(
+                StockLedgerEntry.stock_id == stock_id,
+                StockLedgerEntry.id > previous_entry_id,
+                StockLedgerEntry.id <= last_entry_id,
+            )
+            .group_by(StockLedgerEntry.product_id)
+        ).all()
+        for product_id, delta in rows:
+            levels[product_id] = levels.get(product_id, 0.0) + (delta or 0.0)
+        if levels:
+            db.session.execute(db.insert(StockSnapshot), [
+                {
+                    "stock_id": stock_id,
+                    "product_id": product_id,
+                    "quantity": quantity,
+                    "ledger_entry_id": last_entry_id,
+                    "taken_at": now,
+                }
+                for product_id, quantity in levels.items()
+            ])
+            taken += 1
+    db.session.commit()
+    return taken
+
+
+def movement_stock_deltas(movement: Movement, sign=1):
+    """Calcule les variations de stock d'un mouvement (sign=-1 pour l'inverser)."""
+    deltas = {}
+
+    def add(stock_id, product_id, delta):
+        key = (stock_id, product_id)
+        deltas[key] = deltas.get(key, 0) + sign * delta
+
+    for item in movement.items:
         if movement.type == "entree":
-            if not movement.dest_stock_id:
-                return "Sélectionnez un stock de destination"
-            for item in movement.items:
-                update_stock(movement.dest_stock_id, item.product_id, item.quantity)
+            add(movement.dest_stock_id, item.product_id, item.quantity)
         elif movement.type == "sortie":
-            if not movement.source_stock_id:
-                return "Sélectionnez un stock source"
-            for item in movement.items:
-                update_stock(movement.source_stock_id, item.product_id, -item.quantity)
+            add(movement.source_stock_id, item.product_id, -item.quantity)
         elif movement.type == "transfert":
-            if not movement.source_stock_id or not movement.dest_stock_id:
-                return "Sélectionnez les stocks source et destination"
-            if movement.source_stock_id == movement.dest_stock_id:
-                return "Les stocks source et destination doivent être différents"
-            for item in movement.items:
-                update_stock(movement.source_stock_id, item.product_id, -item.quantity)
-                update_stock(movement.dest_stock_id, item.product_id, item.quantity)
-        else:
-            return "Type de mouvement invalide"
+            add(movement.source_stock_id, item.product_id, -item.quantity)
+            add(movement.dest_stock_id, item.product_id, item.quantity)
+    return deltas
+
+
+def apply_movement_rules(movement: Movement):
+    if movement.type == "entree":
+        if not movement.dest_stock_id:
+            return "Sélectionnez un stock de destination"
+    elif movement.type == "sortie":
+        if not movement.source_stock_id:
+            return "Sélectionnez un stock source"
+    elif movement.type == "transfert":
+        if not movement.source_stock_id or not movement.dest_stock_id:
+            return "Sélectionnez les stocks source et destination"
+        if str(movement.source_stock_id) == str(movement.dest_stock_id):
+            return "Les stocks source et destination doivent être différents"
+    else:
+        return "Type de mouvement invalide"
+
+    # Le mouvement rejoint la session avant les requêtes de stock (autoflush) ; l'appelant annule en cas d'erreur
+    db.session.add(movement)
+    try:
+        apply_stock_deltas(movement_stock_deltas(movement), source=movement.type, movement=movement)
     except ValueError as exc:
         return str(exc)
     return None
@@ -8076,24 +8319,12 @@ def apply_movement_rules(movement: Movement):
 
 def reverse_movement_rules(movement: Movement):
     """Inverse les effets d'un mouvement sur les stocks"""
-    def update_stock(stock_id, product_id, delta):
-        record = _get_or_create_stock_product(stock_id, product_id)
-        record.quantity = record.quantity + delta
-
     try:
-        if movement.type == "entree":
-            # Inverser : retirer du stock de destination
-            for item in movement.items:
-                update_stock(movement.dest_stock_id, item.product_id, -item.quantity)
-        elif movement.type == "sortie":
-            # Inverser : remettre dans le stock source
-            for item in movement.items:
-                update_stock(movement.source_stock_id, item.product_id, item.quantity)
-        elif movement.type == "transfert":
-            # Inverser : remettre dans source, retirer de destination
-            for item in movement.items:
-                update_stock(movement.source_stock_id, item.product_id, item.quantity)
-                update_stock(movement.dest_stock_id, item.product_id, -item.quantity)
+        apply_stock_deltas(
+            movement_stock_deltas(movement, sign=-1),
+            source=f"annulation_{movement.type}",
+            movement=movement,
+        )
     except Exception as exc:
         raise ValueError(f"Erreur lors de l'inversion du mouvement : {exc}")
 
@@ -8171,11 +8402,191 @@ def has_counter_in_tree(machine):
     return False
 
 
+def publish_chat_event(kind, message_id=None, user_id=None, at=None):
+    """Ajoute un événement au journal du chat dans la transaction en cours.
+
+    L'événement n'est visible des autres workers qu'au commit de l'appelant.
+    """
+    db.session.add(ChatEvent(kind=kind, message_id=message_id, user_id=user_id,
+                             created_at=at or dt.datetime.utcnow()))
+
+
+# PostgreSQL attribue les ids du journal avant le commit : un id absent de la suite peut
+# appartenir à une transaction encore ouverte. Les événements qui le suivent sont retenus
+# jusqu'à ce qu'il apparaisse, ou jusqu'à ce délai (transaction annulée, id jamais validé)
+CHAT_EVENT_GAP_GRACE = dt.timedelta(seconds=int(os.environ.get("CHAT_EVENT_GAP_GRACE_SECONDS", "10")))
+
+
+def committed_chat_events(cursor=None, limit=None):
+    """Événements du journal postérieurs à cursor, dans l'ordre des ids, jusqu'au premier trou récent.
+
+    Sans curseur, part du dernier événement plus ancien que CHAT_EVENT_GAP_GRACE.
+    Retourne (événements, curseur à renvoyer au prochain appel).
+    """
+    horizon = dt.datetime.utcnow() - CHAT_EVENT_GAP_GRACE
+    if cursor is None:
+        cursor = db.session.query(func.coalesce(func.max(ChatEvent.id), 0)).filter(
+            ChatEvent.created_at < horizon
+        ).scalar()
+    query = ChatEvent.query.filter(ChatEvent.id > cursor).order_by(ChatEvent.id)
+    if limit:
+        query = query.limit(limit)
+    events = []
+    for row in query:
+        if row.id != cursor + 1 and row.created_at >= horizon:
+            break
+        events.append(row)
+        cursor = row.id
+    return events, cursor
+
+
+def chat_message_to_dict(msg, viewer_id=None):
+    """Sérialise un message du chat ; is_own n'est renseigné que si viewer_id est fourni"""
+    reply_to_data = None
+    if msg.reply_to_id and msg.reply_to:
+        reply_to_data = {
+            "id": msg.reply_to.id,
+            "content": msg.reply_to.content[:100] + ("..." if len(msg.reply_to.content) > 100 else ""),
+            "user_name": msg.reply_to.user.username if msg.reply_to.user else "Système"
+        }
+    data = {
+        "id": msg.id,
+        "type": msg.message_type,
+        "content": msg.content,
+        "link_url": msg.link_url,
+        "machine_name": msg.machine.name if msg.machine else None,
+        "user_name": msg.user.username if msg.user else None,
+        "user_id": msg.user_id,
+        "reply_to": reply_to_data,
+        "edited": msg.edited_at is not None,
+        "created_at": msg.created_at.isoformat(),
+        "date": msg.created_at.strftime("%d/%m/%Y"),
+        "time": msg.created_at.strftime("%H:%M")
+    }
+    if viewer_id is not None:
+        data["is_own"] = msg.user_id == viewer_id if msg.user_id else False
+    return data
+
+
+def chat_message_query():
+    """Requête sur les messages du chat avec auteur, machine et message cité chargés en jointure"""
+    return ChatMessage.query.options(
+        joinedload(ChatMessage.user),
+        joinedload(ChatMessage.machine),
+        joinedload(ChatMessage.reply_to).joinedload(ChatMessage.user),
+    )
+
+
+# Compteurs de non-lus par utilisateur : {user_id: (compteurs, last_read_at, expiration)}.
+# Invalidés localement à chaque message créé ou lecture ; le relais du chat invalide aussi
+# sur les écritures des autres workers, et la durée de vie borne le décalage sinon.
+CHAT_UNREAD_CACHE_TTL = 30
+_chat_unread_cache = {}
+
+
+def invalidate_chat_unread(user_id=None):
+    """Invalide les compteurs de non-lus d'un utilisateur, ou de tous si user_id est None"""
+    if user_id is None:
+        _chat_unread_cache.clear()
+    else:
+        _chat_unread_cache.pop(user_id, None)
+
+
+def chat_unread_state(user_id):
+    """Compteurs de messages non lus (1 semaine d'historique) et date de dernière lecture.
+
+    Une seule requête : la date de lecture est une sous-requête et les deux compteurs
+    sont des agrégats conditionnels. Retourne ({"manual_count", "auto_count"}, last_read_at).
+    """
+    cached = _chat_unread_cache.get(user_id)
+    if cached and cached[2] > time.monotonic():
+        return dict(cached[0]), cached[1]
+
+    now = dt.datetime.utcnow()
+    # Si l'utilisateur n'a jamais marqué de messages comme lus, on considère qu'il n'a
+    # rien lu depuis toujours (il verra tous les messages de la semaine)
+    last_read_at = func.coalesce(
+        db.session.query(ChatReadStatus.last_read_at)
+        .filter(ChatReadStatus.user_id == user_id)
+        .scalar_subquery(),
+        now - dt.timedelta(days=365),
+        type_=db.DateTime,
+    )
+    row = db.session.query(
+        last_read_at,
+        func.count(case((ChatMessage.message_type == "manual", ChatMessage.id))),
+        func.count(case((ChatMessage.message_type == "auto", ChatMessage.id))),
+    ).filter(
+        ChatMessage.message_type.in_(("manual", "auto")),
+        ChatMessage.created_at > last_read_at,
+        ChatMessage.created_at >= now - dt.timedelta(days=7),
+    ).one()
+    counts = {"manual_count": row[1], "auto_count": row[2]}
+    _chat_unread_cache[user_id] = (counts, row[0], time.monotonic() + CHAT_UNREAD_CACHE_TTL)
+    return dict(counts), row[0]
+
+
+def chat_unread_counts(user_id):
+    """Nombre de messages manuels et automatiques non lus (1 semaine d'historique)"""
+    return chat_unread_state(user_id)[0]
+
+
+def _write_chat_auto_messages(groups):
+    """Écrit les messages automatiques regroupés {(contenu, lien, machine, auteur): nombre}"""
+    messages = [
+        ChatMessage(
+            message_type="auto",
+            content=content if count == 1 else f"{content} (×{count})",
+            link_url=link_url,
+            machine_id=machine_id,
+            user_id=user_id,
+        )
+        for (content, link_url, machine_id, user_id), count in groups.items()
+    ]
+    db.session.add_all(messages)
+    try:
+        db.session.flush()
+        for message in messages:
+            publish_chat_event("created", message_id=message.id)
+        db.session.commit()
+        invalidate_chat_unread()
+    except Exception as exc:
+        db.session.rollback()
+        print(f"Error creating chat message: {exc}")
+
+
+@app.teardown_request
+def flush_chat_auto_messages(exc):
+    """Écrit en fin de requête les messages automatiques émis par celle-ci.
+
+    Les messages identiques d'une même requête (ex. une sortie sur plusieurs produits)
+    sont fusionnés en une ligne « … (×N) ». L'écriture a lieu avant l'envoi de la
+    réponse, dans la session de la requête : rien n'est conservé en mémoire au-delà.
+    """
+    groups = g.pop("chat_auto_messages", None)
+    if not groups:
+        return
+    if exc is not None:
+        # Abandonner la partie non validée de la requête avant d'écrire les messages
+        db.session.rollback()
+    _write_chat_auto_messages(groups)
+
+
 def create_chat_message(message_type, content, link_url=None, machine_id=None, user_id=None):
-    """Crée un message de chat (automatique ou manuel)"""
-    # Supprimer les messages de plus d'une semaine
-    week_ago = dt.datetime.utcnow() - dt.timedelta(days=7)
-    ChatMessage.query.filter(ChatMessage.created_at < week_ago).delete()
+    """Crée un message de chat (automatique ou manuel).
+
+    Pendant une requête, les messages automatiques sont regroupés et écrits à la fin
+    de celle-ci (flush_chat_auto_messages) ; la rétention est gérée par le moteur de
+    rétention (retention.py).
+    """
+    if message_type == "auto":
+        key = (content, link_url, machine_id, user_id)
+        if has_request_context():
+            groups = g.setdefault("chat_auto_messages", {})
+            groups[key] = groups.get(key, 0) + 1
+        else:
+            _write_chat_auto_messages({key: 1})
+        return
     
     message = ChatMessage(
         message_type=message_type,
@@ -8186,7 +8597,10 @@ def create_chat_message(message_type, content, link_url=None, machine_id=None, u
     )
     db.session.add(message)
     try:
+        db.session.flush()
+        publish_chat_event("created", message_id=message.id)
         db.session.commit()
+        invalidate_chat_unread()
     except Exception as exc:
         db.session.rollback()
         print(f"Error creating chat message: {exc}")
@@ -8219,7 +8633,10 @@ def chat_send():
     )
     db.session.add(message)
     try:
+        db.session.flush()
+        publish_chat_event("created", message_id=message.id)
         db.session.commit()
+        invalidate_chat_unread()
         return json.dumps({"success": True, "message_id": message.id})
     except Exception as exc:
         db.session.rollback()
@@ -8229,55 +8646,98 @@ def chat_send():
 @app.route("/chat/messages")
 @login_required
 def chat_messages():
-    """Récupérer les messages du chat (1 semaine d'historique)"""
+    """Récupérer les messages du chat (1 semaine d'historique).
+
+    Sans paramètre : les 100 derniers messages. ?after_id=N : seulement les messages
+    plus récents que N. ?cursor=N : les messages créés ou modifiés depuis l'événement
+    N du journal chat_event, plus les ids supprimés. La réponse donne le curseur à
+    renvoyer (dernier événement validé sans trou avant lui, voir committed_chat_events).
+    Elle porte un ETag indépendant du curseur : un rafraîchissement sans changement
+    reçoit un 304 sans que les messages soient chargés.
+    """
     week_ago = dt.datetime.utcnow() - dt.timedelta(days=7)
-    messages = ChatMessage.query.filter(
-        ChatMessage.created_at >= week_ago,
-        ChatMessage.deleted_at == None  # Ne pas afficher les messages supprimés
-    ).order_by(ChatMessage.created_at.desc()).limit(100).all()
-    
-    messages_data = []
-    for msg in reversed(messages):  # Inverser pour avoir les plus anciens en premier
-        reply_to_data = None
-        if msg.reply_to_id and msg.reply_to:
-            reply_to_data = {
-                "id": msg.reply_to.id,
-                "content": msg.reply_to.content[:100] + ("..." if len(msg.reply_to.content) > 100 else ""),
-                "user_name": msg.reply_to.user.username if msg.reply_to.user else "Système"
-            }
-        
-        messages_data.append({
-            "id": msg.id,
-            "type": msg.message_type,
-            "content": msg.content,
-            "link_url": msg.link_url,
-            "machine_name": msg.machine.name if msg.machine else None,
-            "user_name": msg.user.username if msg.user else None,
-            "user_id": msg.user_id,
-            "is_own": msg.user_id == current_user.id if msg.user_id else False,
-            "reply_to": reply_to_data,
-            "edited": msg.edited_at is not None,
-            "created_at": msg.created_at.isoformat(),
-            "date": msg.created_at.strftime("%d/%m/%Y"),
-            "time": msg.created_at.strftime("%H:%M")
-        })
-    
-    return json.dumps({"success": True, "messages": messages_data})
+    after_id = request.args.get("after_id", type=int)
+    cursor = request.args.get("cursor")
+    if cursor is not None:
+        try:
+            cursor = int(cursor)
+        except ValueError:
+            return json.dumps({"success": False, "error": "Paramètre cursor invalide"}), 400
+
+    # Empreinte de la fenêtre d'une semaine et du journal : change à chaque création,
+    # modification, suppression ou expiration d'un message
+    last_event_id = db.session.query(func.coalesce(func.max(ChatEvent.id), 0)).scalar_subquery()
+    state = db.session.query(
+        func.count(ChatMessage.id),
+        func.max(ChatMessage.id),
+        func.max(ChatMessage.edited_at),
+        func.max(ChatMessage.deleted_at),
+        last_event_id,
+    ).filter(ChatMessage.created_at >= week_ago).one()
+    etag = hashlib.md5(f"{current_user.id}|{tuple(state)}".encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response
+
+    query = chat_message_query().filter(ChatMessage.created_at >= week_ago)
+    deleted_ids = []
+    if cursor is not None:
+        # Les écritures du chat ajoutent leur événement dans la même transaction :
+        # le journal donne, dans l'ordre des ids, tous les messages touchés depuis le curseur
+        events, next_cursor = committed_chat_events(cursor)
+        message_ids = {
+            event.message_id for event in events
+            if event.kind in ("created", "edited", "deleted") and event.message_id is not None
+        }
+        changed = query.filter(ChatMessage.id.in_(message_ids)).order_by(ChatMessage.id).all() if message_ids else []
+        messages = [msg for msg in changed if msg.deleted_at is None]
+        deleted_ids = [msg.id for msg in changed if msg.deleted_at is not None]
+    else:
+        # Curseur lu avant les messages : un message écrit entre les deux sera renvoyé
+        # au rafraîchissement suivant (fusionné par id côté client)
+        _, next_cursor = committed_chat_events()
+        query = query.filter(ChatMessage.deleted_at == None)  # Ne pas afficher les messages supprimés
+        if after_id:
+            query = query.filter(ChatMessage.id > after_id)
+        # Inverser pour avoir les plus anciens en premier
+        messages = list(reversed(query.order_by(ChatMessage.created_at.desc()).limit(100).all()))
+
+    messages_data = [chat_message_to_dict(msg, current_user.id) for msg in messages]
+    response = make_response(json.dumps({
+        "success": True,
+        "messages": messages_data,
+        "deleted": deleted_ids,
+        # Curseurs à renvoyer au prochain rafraîchissement
+        "after_id": max([after_id or 0] + [msg.id for msg in messages]),
+        "cursor": next_cursor,
+    }))
+    response.mimetype = "application/json"
+    # Événements retenus derrière un trou : pas d'ETag, ils seront livrés sans que l'état change
+    if next_cursor >= state[4]:
+        response.set_etag(etag)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
 
 
 @app.route("/chat/mark-read", methods=["POST"])
 @login_required
 def chat_mark_read():
     """Marquer les messages comme lus pour l'utilisateur actuel"""
+    now = dt.datetime.utcnow()
     read_status = ChatReadStatus.query.filter_by(user_id=current_user.id).first()
     if read_status:
-        read_status.last_read_at = dt.datetime.utcnow()
+        read_status.last_read_at = now
     else:
-        read_status = ChatReadStatus(user_id=current_user.id, last_read_at=dt.datetime.utcnow())
+        read_status = ChatReadStatus(user_id=current_user.id, last_read_at=now)
         db.session.add(read_status)
+    # Remet à zéro les compteurs des autres onglets de l'utilisateur
+    publish_chat_event("read", user_id=current_user.id, at=now)
     
     try:
         db.session.commit()
+        invalidate_chat_unread(current_user.id)
         return json.dumps({"success": True})
     except Exception as exc:
         db.session.rollback()
@@ -8288,38 +8748,7 @@ def chat_mark_read():
 @login_required
 def chat_unread_count():
     """Compter les messages non lus pour l'utilisateur actuel"""
-    read_status = ChatReadStatus.query.filter_by(user_id=current_user.id).first()
-    
-    # Si l'utilisateur n'a jamais marqué de messages comme lus, 
-    # on considère qu'il n'a rien lu depuis toujours (il verra tous les messages de la semaine)
-    # Sinon, on utilise sa dernière date de lecture
-    week_ago = dt.datetime.utcnow() - dt.timedelta(days=7)
-    if read_status:
-        last_read_at = read_status.last_read_at
-    else:
-        # Première connexion : considérer qu'il n'a rien lu depuis toujours
-        # On limite à 1 semaine d'historique comme défini dans le système
-        last_read_at = dt.datetime.utcnow() - dt.timedelta(days=365)
-    
-    # Compter les messages manuels non lus (limité à 1 semaine d'historique)
-    manual_unread = ChatMessage.query.filter(
-        ChatMessage.message_type == "manual",
-        ChatMessage.created_at > last_read_at,
-        ChatMessage.created_at >= week_ago
-    ).count()
-    
-    # Compter les messages automatiques non lus (limité à 1 semaine d'historique)
-    auto_unread = ChatMessage.query.filter(
-        ChatMessage.message_type == "auto",
-        ChatMessage.created_at > last_read_at,
-        ChatMessage.created_at >= week_ago
-    ).count()
-    
-    return json.dumps({
-        "success": True,
-        "manual_count": manual_unread,
-        "auto_count": auto_unread
-    })
+    return json.dumps({"success": True, **chat_unread_counts(current_user.id)})
 
 
 @app.route("/chat/<int:message_id>/edit", methods=["POST"])
@@ -8344,6 +8773,7 @@ def chat_edit_message(message_id):
     
     message.content = new_content
     message.edited_at = dt.datetime.utcnow()
+    publish_chat_event("edited", message_id=message.id)
     
     try:
         db.session.commit()
@@ -8368,6 +8798,7 @@ def chat_delete_message(message_id):
         return json.dumps({"success": False, "error": "Impossible de supprimer ce type de message"}), 403
     
     message.deleted_at = dt.datetime.utcnow()
+    publish_chat_event("deleted", message_id=message.id)
     
     try:
         db.session.commit()
@@ -8382,43 +8813,94 @@ app.jinja_env.globals["machine_lineage"] = machine_lineage
 app.jinja_env.globals["has_counter_in_tree"] = has_counter_in_tree
 
 
+REPORTS_PAGE_SIZE = 50
+
+
 @app.route("/reports", methods=["GET"])
 @login_required
 def get_reports():
-    """Récupérer les rapports (1 semaine d'historique)"""
+    """Récupérer les rapports (1 semaine d'historique), plus récents d'abord.
+
+    Une seule requête ne projetant que les colonnes affichées (rapport, auteur,
+    métadonnées des photos) : le contenu des photos n'est jamais lu. Pagination par
+    curseur « date_id » (?cursor=), taille ?limit= ; ?report_id= retourne un seul rapport.
+    """
     week_ago = dt.datetime.utcnow() - dt.timedelta(days=7)
-    reports = Report.query.filter(
+    page_size = max(1, min(request.args.get("limit", REPORTS_PAGE_SIZE, type=int), REPORTS_PAGE_SIZE))
+    page = db.session.query(Report.id).filter(
         Report.deleted_at.is_(None),
         Report.created_at >= week_ago
-    ).order_by(Report.created_at.desc()).all()
+    )
+    only_report_id = request.args.get("report_id", type=int)
+    if only_report_id:
+        page = page.filter(Report.id == only_report_id)
+    cursor = request.args.get("cursor")
+    if cursor:
+        try:
+            cursor_date, cursor_id = cursor.rsplit("_", 1)
+            cursor_date = dt.datetime.fromisoformat(cursor_date)
+            cursor_id = int(cursor_id)
+        except ValueError:
+            return jsonify({"success": False, "error": "Curseur invalide"}), 400
+        page = page.filter(db.or_(
+            Report.created_at < cursor_date,
+            db.and_(Report.created_at == cursor_date, Report.id < cursor_id),
+        ))
+    # Une ligne de plus que la page pour savoir s'il reste des rapports
+    page = page.order_by(Report.created_at.desc(), Report.id.desc()).limit(page_size + 1).subquery()
+
+    rows = db.session.query(
+        Report.id, Report.user_id, Report.content, Report.created_at, Report.edited_at,
+        User.username, ReportPhoto.id, ReportPhoto.original_filename, ReportPhoto.content_hash,
+    ).join(page, page.c.id == Report.id).join(User, User.id == Report.user_id).outerjoin(
+        ReportPhoto, ReportPhoto.report_id == Report.id
+    ).order_by(Report.created_at.desc(), Report.id.desc(), ReportPhoto.id).all()
     
     reports_data = []
-    for report in reports:
-        photos_data = []
-        for photo in report.photos:
-            photos_data.append({
-                "id": photo.id,
-                "url": url_for("report_photo", photo_id=photo.id),
-                "original_filename": photo.original_filename
+    by_id = {}
+    for report_id, user_id, content, created_at, edited_at, username, photo_id, original_filename, content_hash in rows:
+        report = by_id.get(report_id)
+        if report is None:
+            report = by_id[report_id] = {
+                "id": report_id,
+                "user_name": username,
+                "content": content,
+                "created_at": created_at.isoformat(),
+                "edited_at": edited_at.isoformat() if edited_at else None,
+                "is_own": user_id == current_user.id,
+                "photos": [],
+                "_cursor": f"{created_at.isoformat()}_{report_id}",
+            }
+            reports_data.append(report)
+        if photo_id is not None:
+            # Version dans l'URL : le navigateur garde la photo en cache sans la revalider
+            version = content_hash[:16] if content_hash else None
+            report["photos"].append({
+                "id": photo_id,
+                "url": url_for("report_photo", photo_id=photo_id, v=version),
+                "thumbnail_url": url_for("report_photo", photo_id=photo_id, size="thumb", v=version),
+                "medium_url": url_for("report_photo", photo_id=photo_id, size="medium", v=version),
+                "original_filename": original_filename
             })
-        
-        reports_data.append({
-            "id": report.id,
-            "user_name": report.user.username,
-            "content": report.content,
-            "created_at": report.created_at.isoformat(),
-            "edited_at": report.edited_at.isoformat() if report.edited_at else None,
-            "is_own": report.user_id == current_user.id,
-            "photos": photos_data
-        })
     
-    return jsonify({"success": True, "reports": reports_data})
+    next_cursor = None
+    if len(reports_data) > page_size:
+        reports_data = reports_data[:page_size]
+        next_cursor = reports_data[-1]["_cursor"]
+    for report in reports_data:
+        del report["_cursor"]
+    
+    return jsonify({"success": True, "reports": reports_data, "next_cursor": next_cursor})
 
 
 @app.route("/reports", methods=["POST"])
 @login_required
 def create_report():
     """Créer un nouveau rapport"""
+    upload_error = photo_upload_error()
+    if upload_error:
+        return jsonify({"success": False, "error": upload_error}), 413
+    
     content = request.form.get("content", "").strip()
     photos = request.files.getlist("photos")
     
@@ -8433,25 +8915,14 @@ def create_report():
     db.session.add(report)
     db.session.flush()  # Pour obtenir l'ID du rapport
     
-    # Traiter les photos - stocker en base de données (BLOB)
-    for photo in photos:
-        if photo and photo.filename and allowed_image_file(photo.filename):
-            original_filename = photo.filename
-            # Lire les données binaires de l'image
-            photo_data = photo.read()
-            # Déterminer le type MIME
-            content_type = photo.content_type or 'image/jpeg'
-            
-            report_photo = ReportPhoto(
-                report_id=report.id,
-                original_filename=original_filename,
-                photo_data=photo_data,
-                content_type=content_type
-            )
-            db.session.add(report_photo)
+    # Traiter les photos - stockées sur disque sous l'empreinte du contenu, normalisées après validation
+    new_photos = store_report_photos(report, photos)
+    db.session.add_all(new_photos)
+    publish_chat_event("report", message_id=report.id)
     
     try:
         db.session.commit()
+        ingest_report_photos(new_photos)
         return jsonify({"success": True, "report_id": report.id})
     except Exception as exc:
         db.session.rollback()
@@ -8468,17 +8939,24 @@ def update_report(report_id):
     if report.user_id != current_user.id:
         return jsonify({"success": False, "error": "Vous ne pouvez modifier que vos propres rapports"}), 403
     
+    upload_error = photo_upload_error()
+    if upload_error:
+        return jsonify({"success": False, "error": upload_error}), 413
+    
     content = request.form.get("content", "").strip()
     if not content:
         return jsonify({"success": False, "error": "Le contenu est requis"}), 400
     
     # Supprimer les photos existantes si demandé
     photos_to_delete = request.form.getlist("delete_photos")
+    released_hashes = set()
     for photo_id in photos_to_delete:
         try:
             photo_id_int = int(photo_id)
             photo = ReportPhoto.query.filter_by(id=photo_id_int, report_id=report.id).first()
             if photo:
+                if photo.content_hash:
+                    released_hashes.add(photo.content_hash)
                 # Supprimer le fichier si il existe (migration)
                 if photo.file_path and os.path.exists(photo.file_path):
                     try:
@@ -8489,30 +8967,19 @@ def update_report(report_id):
         except (ValueError, TypeError):
             pass
     
-    # Ajouter de nouvelles photos - stocker en base de données (BLOB)
-    new_photos = request.files.getlist("photos")
-    for photo in new_photos:
-        if photo and photo.filename and allowed_image_file(photo.filename):
-            original_filename = photo.filename
-            # Lire les données binaires de l'image
-            photo_data = photo.read()
-            # Déterminer le type MIME
-            content_type = photo.content_type or 'image/jpeg'
-            
-            report_photo = ReportPhoto(
-                report_id=report.id,
-                original_filename=original_filename,
-                photo_data=photo_data,
-                content_type=content_type
-            )
-            db.session.add(report_photo)
+    # Ajouter de nouvelles photos - stocker sur disque sous l'empreinte du contenu
+    new_photos = store_report_photos(report, request.files.getlist("photos"))
+    db.session.add_all(new_photos)
     
     # Mettre à jour le contenu
     report.content = content
     report.edited_at = dt.datetime.utcnow()
+    publish_chat_event("report", message_id=report.id)
     
     try:
         db.session.commit()
+        release_report_photo_files(released_hashes)
+        ingest_report_photos(new_photos)
         return jsonify({"success": True})
     except Exception as exc:
         db.session.rollback()
@@ -8530,6 +8997,7 @@ def delete_report(report_id):
         return jsonify({"success": False, "error": "Vous ne pouvez supprimer que vos propres rapports"}), 403
     
     report.deleted_at = dt.datetime.utcnow()
+    publish_chat_event("report", message_id=report.id)
     
     try:
         db.session.commit()
@@ -8542,7 +9010,7 @@ def delete_report(report_id):
 @app.route("/reports/photos/<int:photo_id>")
 @login_required
 def report_photo(photo_id):
-    """Servir une photo de rapport depuis la base de données"""
+    """Servir une photo de rapport depuis le stockage sur disque (Range et requêtes conditionnelles)"""
     photo = ReportPhoto.query.get_or_404(photo_id)
     report = photo.report
     
@@ -8550,118 +9018,145 @@ def report_photo(photo_id):
     if report.deleted_at:
         abort(404)
     
-    # Si la photo est stockée en BLOB dans la base de données
-    if photo.photo_data:
-        response = make_response(photo.photo_data)
-        response.headers['Content-Type'] = photo.content_type or 'image/jpeg'
-        return response
+    size = requested_photo_size()
+    mimetype = photo.content_type or 'image/jpeg'
+    if photo.content_hash and REPORT_PHOTO_STORE.exists(photo.content_hash):
+        source = REPORT_PHOTO_STORE.path(photo.content_hash)
+        if size:
+            response = send_photo_variant(photo.content_hash, source, size)
+            if response:
+                return response
+        # Le contenu d'un fichier du stockage ne change jamais : son empreinte sert d'ETag et de version
+        return send_stored_file(source, photo.content_hash[:16], etag=photo.content_hash, mimetype=mimetype)
+    # BLOB pas encore migré vers le stockage sur disque
+    photo_data = db.session.query(ReportPhoto.photo_data).filter_by(id=photo.id).scalar()
+    if photo_data:
+        content_hash = hashlib.sha256(photo_data).hexdigest()
+        if size:
+            response = send_photo_variant(content_hash, photo_data, size)
+            if response:
+                return response
+        return send_stored_file(BytesIO(photo_data), content_hash[:16], etag=content_hash, mimetype=mimetype)
     # Fallback : si la photo est encore sur le système de fichiers (migration)
     elif photo.file_path and os.path.exists(photo.file_path):
-        return send_from_directory(
-            str(REPORT_PHOTOS_FOLDER),
-            os.path.basename(photo.file_path),
-            as_attachment=False
-        )
+        if size:
+            response = send_photo_variant(file_sha256(photo.file_path), photo.file_path, size)
+            if response:
+                return response
+        legacy_path = REPORT_PHOTOS_FOLDER / os.path.basename(photo.file_path)
+        if not legacy_path.is_file():
+            abort(404)
+        return send_stored_file(legacy_path, file_version(legacy_path), as_attachment=False)
     else:
         abort(404)
 
 
-def cleanup_old_reports():
-    """Supprime automatiquement les rapports et leurs photos de plus de 7 jours"""
-    try:
-        week_ago = dt.datetime.utcnow() - dt.timedelta(days=7)
-        
-        # Trouver tous les rapports de plus de 7 jours (y compris ceux soft-deleted)
-        old_reports = Report.query.filter(Report.created_at < week_ago).all()
-        
-        deleted_count = 0
-        for report in old_reports:
-            # Supprimer les fichiers photos si ils existent encore (migration)
-            for photo in report.photos:
-                if photo.file_path and os.path.exists(photo.file_path):
-                    try:
-                        os.remove(photo.file_path)
-                    except Exception:
-                        pass
-            
-            # Supprimer le rapport (cascade supprimera automatiquement les photos)
-            db.session.delete(report)
-            deleted_count += 1
-        
-        if deleted_count > 0:
-            db.session.commit()
-            print(f"Cleanup: {deleted_count} rapports et leurs photos supprimés (plus de 7 jours)")
-        
-        return deleted_count
-    except Exception as exc:
-        db.session.rollback()
-        print(f"Erreur lors du nettoyage des rapports: {exc}")
-        return 0
+# Nombre de BLOB déplacés vers le stockage sur disque par transaction
+REPORT_PHOTO_MIGRATION_BATCH = 20
 
 
-def cleanup_old_chat_messages():
-    """Supprime automatiquement les messages de chat de plus de 7 jours"""
-    try:
-        week_ago = dt.datetime.utcnow() - dt.timedelta(days=7)
-        deleted_count = ChatMessage.query.filter(ChatMessage.created_at < week_ago).count()
-        ChatMessage.query.filter(ChatMessage.created_at < week_ago).delete()
-        db.session.commit()
-        if deleted_count > 0:
-            print(f"Cleanup: {deleted_count} messages de chat supprimés (plus de 7 jours)")
-        return deleted_count
-    except Exception as exc:
-        db.session.rollback()
-        print(f"Erreur lors du nettoyage des messages: {exc}")
-        return 0
+def store_report_photos(report, uploads):
+    """Enregistre les photos envoyées telles que reçues dans REPORT_PHOTO_STORE et retourne leurs lignes ReportPhoto.
+
+    La normalisation est faite ensuite hors du thread de la requête, par ingest_report_photos
+    une fois les lignes validées.
+    """
+    photos = []
+    for upload in uploads:
+        if not (upload and upload.filename and allowed_image_file(upload.filename)):
+            continue
+        data = upload.read()
+        photos.append(ReportPhoto(
+            report_id=report.id,
+            # Chaîne vide plutôt que NULL : les anciennes bases SQLite gardent file_path NOT NULL
+            file_path="",
+            original_filename=upload.filename,
+            content_type=upload.content_type or 'image/jpeg',
+            content_hash=REPORT_PHOTO_STORE.put(data),
+            file_size=len(data),
+        ))
+    return photos
+
+
+def ingest_report_photos(photos):
+    """Confie les photos de rapport validées au pool d'ingestion, hors du thread de la requête"""
+    for photo in photos:
+        photo_ingest_executor.submit(normalize_report_photo, photo.id)
 
 
-def cleanup_old_reports():
-    """Supprime automatiquement les rapports et leurs photos de plus de 7 jours"""
+def normalize_report_photo(photo_id):
+    """Remplace une photo de rapport par sa version normalisée (nouvelle empreinte), puis génère ses variantes"""
     try:
-        week_ago = dt.datetime.utcnow() - dt.timedelta(days=7)
-        
-        # Trouver tous les rapports de plus de 7 jours (y compris ceux soft-deleted)
-        old_reports = Report.query.filter(Report.created_at < week_ago).all()
-        
-        deleted_count = 0
-        for report in old_reports:
-            # Supprimer les fichiers photos si ils existent encore (migration)
-            for photo in report.photos:
-                if photo.file_path and os.path.exists(photo.file_path):
-                    try:
-                        os.remove(photo.file_path)
-                    except Exception:
-                        pass
-            
-            # Supprimer le rapport (cascade supprimera automatiquement les photos)
-            db.session.delete(report)
-            deleted_count += 1
-        
-        if deleted_count > 0:
-            db.session.commit()
-            print(f"Cleanup: {deleted_count} rapports et leurs photos supprimés (plus de 7 jours)")
-        
-        return deleted_count
+        with app.app_context():
+            photo = db.session.get(ReportPhoto, photo_id)
+            if photo is None or not REPORT_PHOTO_STORE.exists(photo.content_hash):
+                return
+            raw_hash = photo.content_hash
+            result = normalize_image(REPORT_PHOTO_STORE.path(raw_hash), PHOTO_MAX_EDGE, PHOTO_JPEG_QUALITY)
+            if result is not None:
+                data, content_type = result
+                photo.content_hash = REPORT_PHOTO_STORE.put(data)
+                photo.content_type = content_type
+                photo.file_size = len(data)
+                db.session.commit()
+            PHOTO_VARIANTS.schedule(photo.content_hash, REPORT_PHOTO_STORE.path(photo.content_hash))
+            if raw_hash != photo.content_hash:
+                # Photo brute : ses variantes éventuelles sont supprimées, son fichier l'est
+                # par la rétention s'il n'est plus référencé
+                PHOTO_VARIANTS.delete(raw_hash)
+                release_report_photo_files({raw_hash})
     except Exception as exc:
-        db.session.rollback()
-        print(f"Erreur lors du nettoyage des rapports: {exc}")
-        return 0
+        print(f"Erreur lors de la normalisation de la photo de rapport {photo_id}: {exc}")
 
 
-def cleanup_old_chat_messages():
-    """Supprime automatiquement les messages de chat de plus de 7 jours"""
-    try:
-        week_ago = dt.datetime.utcnow() - dt.timedelta(days=7)
-        deleted_count = ChatMessage.query.filter(ChatMessage.created_at < week_ago).count()
-        ChatMessage.query.filter(ChatMessage.created_at < week_ago).delete()
-        db.session.commit()
-        if deleted_count > 0:
-            print(f"Cleanup: {deleted_count} messages de chat supprimés (plus de 7 jours)")
-        return deleted_count
-    except Exception as exc:
-        db.session.rollback()
-        print(f"Erreur lors du nettoyage des messages: {exc}")
+def release_report_photo_files(content_hashes):
+    """Supprime du disque les fichiers qui ne sont plus référencés par aucune photo ; retourne leur nombre"""
+    if not content_hashes:
         return 0
+    still_used = {
+        row[0] for row in db.session.query(ReportPhoto.content_hash)
+        .filter(ReportPhoto.content_hash.in_(content_hashes))
+        .distinct()
+    }
+    removed = 0
+    for content_hash in set(content_hashes) - still_used:
+        if REPORT_PHOTO_STORE.delete(content_hash):
+            PHOTO_VARIANTS.delete(content_hash)
+            removed += 1
+    return removed
+
+
+def migrate_report_photo_blobs(max_batches=None):
+    """Déplace les photos encore stockées en BLOB vers REPORT_PHOTO_STORE, par lots.
+
+    Chaque BLOB est lu individuellement pour borner la mémoire, puis le lot est
+    validé en une transaction. Retourne le nombre de photos migrées.
+    """
+    migrated = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        ids = [row[0] for row in db.session.query(ReportPhoto.id)
+               .filter(ReportPhoto.photo_data.isnot(None))
+               .order_by(ReportPhoto.id)
+               .limit(REPORT_PHOTO_MIGRATION_BATCH)]
+        if not ids:
+            break
+        updates = []
+        for photo_id in ids:
+            data = db.session.query(ReportPhoto.photo_data).filter_by(id=photo_id).scalar()
+            updates.append({
+                "id": photo_id,
+                "content_hash": REPORT_PHOTO_STORE.put(data),
+                "file_size": len(data),
+                "photo_data": None,
+            })
+        db.session.execute(db.update(ReportPhoto), updates)
+        db.session.commit()
+        migrated += len(updates)
+        batches += 1
+    if migrated:
+        print(f"Migration: {migrated} photos de rapports déplacées vers le stockage sur disque")
+    return migrated
 
 
 @app.context_processor
@@ -8846,6 +9341,7 @@ def get_report_unit(machine: Machine, report: PreventiveReport):
 @login_required
 def view_maintenance_photo(photo_id):
     photo = MaintenancePhoto.query.get_or_404(photo_id)
+    size = requested_photo_size()
     
     if not os.path.exists(photo.file_path):
         flash("La photo n'existe plus", "danger")
@@ -8854,9 +9350,21 @@ def view_maintenance_photo(photo_id):
         else:
             return redirect(url_for("corrective_maintenance_detail", maintenance_id=photo.corrective_maintenance_id))
     
-    return send_from_directory(
-        str(MAINTENANCE_PHOTOS_FOLDER),
-        photo.filename,
+    if size:
+        if not photo.content_hash:
+            # Photo antérieure aux variantes : empreinte calculée une fois et conservée
+            photo.content_hash = file_sha256(photo.file_path)
+            db.session.commit()
+        response = send_photo_variant(photo.content_hash, photo.file_path, size)
+        if response:
+            return response
+    
+    photo_path = MAINTENANCE_PHOTOS_FOLDER / photo.filename
+    if not photo_path.is_file():
+        abort(404)
+    return send_stored_file(
+        photo_path,
+        photo.version,
         as_attachment=False,
         download_name=photo.original_filename
     )
@@ -8868,7 +9376,7 @@ def delete_maintenance_photo(photo_id):
     photo = MaintenancePhoto.query.get_or_404(photo_id)
     
     # Vérifier les permissions : admin ou technicien qui a créé la photo
-    if current_user.user_type != "admin" and (current_user.user_type != "technicien" or photo.user_id != current_user.id):
+    if not current_user.is_admin and (not current_user.is_technician or photo.user_id != current_user.id):
         flash("Accès refusé : vous ne pouvez supprimer que les photos que vous avez uploadées.", "danger")
         if photo.maintenance_entry_id:
             return redirect(url_for("maintenance_entry_detail", entry_id=photo.maintenance_entry_id))
@@ -8885,11 +9393,14 @@ def delete_maintenance_photo(photo_id):
     # Déterminer où rediriger
     redirect_entry_id = photo.maintenance_entry_id
     redirect_maintenance_id = photo.corrective_maintenance_id
+    content_hash = photo.content_hash
     
     # Supprimer l'enregistrement en base de données
     db.session.delete(photo)
     try:
         db.session.commit()
+        if content_hash and not MaintenancePhoto.query.filter_by(content_hash=content_hash).first():
+            PHOTO_VARIANTS.delete(content_hash)
         flash("Photo supprimée avec succès", "success")
     except Exception as exc:
         db.session.rollback()
@@ -9124,22 +9635,11 @@ def get_dashboard_data():
             preventive_entries = query.all()
             
             for entry in preventive_entries:
-                if entry.stock_id:
-                    # Chercher les mouvements de sortie dans une fenêtre de 5 minutes
-                    time_window_start = entry.created_at - dt.timedelta(minutes=5)
-                    time_window_end = entry.created_at + dt.timedelta(minutes=5)
-                    
-                    movements = Movement.query.filter(
-                        Movement.type == 'sortie',
-                        Movement.source_stock_id == entry.stock_id,
-                        Movement.created_at >= time_window_start,
-                        Movement.created_at <= time_window_end
-                    ).all()
-                    
-                    for movement in movements:
-                        for item in movement.items:
-                            if item.product:
-                                total_cost += item.quantity * (item.product.price or 0.0)
+                # Mouvements de sortie enregistrés avec la maintenance
+                for movement in entry.movements:
+                    for item in movement.items:
+                        if item.product:
+                            total_cost += item.quantity * (item.product.price or 0.0)
             
             # Coût pour les maintenances curatives (via CorrectiveMaintenanceProduct)
             query = CorrectiveMaintenance.query.filter(CorrectiveMaintenance.machine_id.in_(all_machine_ids_in_tree))
@@ -9427,21 +9927,10 @@ def get_dashboard_chart_data():
             ).all()
             
             for entry in preventive_entries:
-                if entry.stock_id:
-                    time_window_start = entry.created_at - dt.timedelta(minutes=5)
-                    time_window_end = entry.created_at + dt.timedelta(minutes=5)
-                    
-                    movements = Movement.query.filter(
-                        Movement.type == 'sortie',
-                        Movement.source_stock_id == entry.stock_id,
-                        Movement.created_at >= time_window_start,
-                        Movement.created_at <= time_window_end
-                    ).all()
-                    
-                    for movement in movements:
-                        for item in movement.items:
-                            if item.product:
-                                total_cost += item.quantity * (item.product.price or 0.0)
+                for movement in entry.movements:
+                    for item in movement.items:
+                        if item.product:
+                            total_cost += item.quantity * (item.product.price or 0.0)
             
             # Coût pour les maintenances curatives
             corrective_maintenances = CorrectiveMaintenance.query.filter(
@@ -9588,9 +10077,9 @@ def download_excel_file(file_id):
         flash("Fichier introuvable", "danger")
         return redirect(url_for("database_export"))
     
-    return send_from_directory(
-        str(EXCEL_FILES_FOLDER),
-        excel_file.filename,
+    return send_stored_file(
+        file_path,
+        excel_file.version,
         as_attachment=True,
         download_name=excel_file.original_filename
     )
@@ -9608,6 +10097,9 @@ def delete_excel_file(file_id):
         if file_path.exists():
             file_path.unlink()
         
+        # Détacher les tâches qui ont produit ce fichier
+        BackgroundJob.query.filter_by(excel_file_id=excel_file.id).update({"excel_file_id": None})
+        
         # Supprimer l'entrée en base de données
         db.session.delete(excel_file)
         db.session.commit()
@@ -9620,42 +10112,78 @@ def delete_excel_file(file_id):
     return redirect(url_for("database_export"))
 
 
-def run_cleanup_scheduler():
-    """Lance le scheduler de nettoyage automatique en arrière-plan"""
-    def cleanup_loop():
-        while True:
-            try:
-                # Exécuter le nettoyage toutes les heures
-                cleanup_old_reports()
-                cleanup_old_chat_messages()
-            except Exception as exc:
-                print(f"Erreur dans le scheduler de nettoyage: {exc}")
-            # Attendre 1 heure avant le prochain nettoyage
-            time.sleep(3600)
-    
-    # Démarrer le thread de nettoyage
-    cleanup_thread = threading.Thread(target=cleanup_loop, daemon=True)
-    cleanup_thread.start()
-    print("Scheduler de nettoyage automatique démarré (nettoyage toutes les heures)")
-
-
 # Importer les routes API pour l'application mobile
 try:
     import api_routes
 except ImportError:
     pass  # Si le fichier n'existe pas, continuer sans erreur
 
+# Importer le gestionnaire de tâches en arrière-plan
+import jobs
+
+# Importer le canal de diffusion du chat (SSE / long-polling)
+import chat_stream
+
+# Importer le moteur de rétention (purges et fichiers orphelins)
+import retention
+
+# Importer le planificateur des tâches périodiques
+import scheduler
+
+# Importer les migrations du schéma (commande flask migrate)
+import migrations
+
+# Importer les lots CSS/JS versionnés (asset_url, commande flask assets-build)
+import static_assets
+
 # Importer la documentation Swagger
 try:
     import swagger_docs
 except ImportError:
     pass  # Si le fichier n'existe pas, continuer sans erreur
 
-if __name__ == "__main__":
-    # Démarrer le scheduler de nettoyage
-    run_cleanup_scheduler()
-    app.run(debug=True)
-else:
-    # Pour Gunicorn et autres serveurs WSGI
-    run_cleanup_scheduler()
 
+def reset_after_fork():
+    """À appeler dans chaque worker juste après le fork (hook post_fork de gunicorn.conf.py).
+
+    Avec --preload, les workers héritent du processus maître : les connexions du pool
+    éventuellement ouvertes par celui-ci sont abandonnées sans être fermées (elles
+    lui appartiennent), chaque worker ouvre ensuite les siennes.
+    """
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+
+def create_app(with_scheduler=False):
+    """Prépare et retourne l'application WSGI du module (app).
+
+    Ce n'est pas une fabrique : chaque appel retourne la même instance globale et ne
+    refait que ce qui manque (templates déjà compilés, manifeste déjà chargé,
+    planificateur déjà démarré), il peut donc être appelé plusieurs fois sans risque.
+
+    Le chargement du module n'ouvre aucune connexion et ne démarre aucun thread :
+    l'application peut être chargée une fois dans le maître de gunicorn puis partagée
+    par les workers (copie à l'écriture). Le planificateur est démarré dans un seul
+    worker par gunicorn.conf.py ; with_scheduler le démarre dans ce processus (serveur
+    de développement, serveurs WSGI sans hook).
+
+    Les templates sont compilés ici dans chaque langue (TEMPLATE_PRECOMPILE=0 pour
+    s'en dispenser) et les lots CSS/JS construits s'ils sont absents ou périmés :
+    sous gunicorn, les workers les reçoivent prêts.
+    """
+    if os.environ.get("TEMPLATE_PRECOMPILE", "1") != "0":
+        app.jinja_env.precompile()
+    static_assets.load_manifest()
+    if with_scheduler:
+        scheduler.start_scheduler()
+    return app
+
+
+if __name__ == "__main__":
+    # Serveur de développement : appliquer les migrations en attente avant de démarrer
+    with app.app_context():
+        migrations.run_migrations()
+    # Avec le rechargement automatique, ce code s'exécute aussi dans le processus qui
+    # surveille les fichiers : le planificateur ne démarre que dans le processus servant
+    create_app(with_scheduler=os.environ.get("WERKZEUG_RUN_MAIN") == "true").run(debug=True)
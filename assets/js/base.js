@@ -0,0 +1,1186 @@
+// Canal de diffusion du chat : un seul flux par onglet, partagé par le widget et la page chat
+// (SSE, ou long-polling si EventSource n'est pas disponible). Le flux est fermé quand
+// l'onglet est masqué et reprend au dernier curseur reçu quand il redevient visible.
+window.chatStream = (function() {
+  const eventNames = ['ready', 'message', 'deleted', 'report', 'unread', 'reset'];
+  const listeners = {};
+  let cursor = null;
+  let source = null;
+  let polling = false;
+  let retryTimer = null;
+
+  function emit(name, data) {
+    (listeners[name] || []).forEach(fn => fn(data));
+  }
+
+  function scheduleRetry(delay) {
+    if (retryTimer) return;
+    retryTimer = setTimeout(function() {
+      retryTimer = null;
+      open();
+    }, delay);
+  }
+
+  function openEventSource() {
+    source = new EventSource('/chat/stream' + (cursor !== null ? '?cursor=' + cursor : ''));
+    eventNames.forEach(name => {
+      source.addEventListener(name, function(e) {
+        if (e.lastEventId) cursor = parseInt(e.lastEventId, 10);
+        emit(name, JSON.parse(e.data));
+      });
+    });
+    source.onerror = function() {
+      // Le navigateur se reconnecte seul, sauf refus du serveur (503, session expirée)
+      if (source && source.readyState === EventSource.CLOSED) {
+        source = null;
+        scheduleRetry(30000);
+      }
+    };
+  }
+
+  function longPoll() {
+    if (!polling) return;
+    fetch('/chat/events' + (cursor !== null ? '?cursor=' + cursor : ''))
+      .then(response => {
+        if (!response.ok) throw new Error(response.status);
+        return response.json();
+      })
+      .then(data => {
+        const first = cursor === null;
+        cursor = data.cursor;
+        if (first) emit('ready', { cursor: cursor });
+        if (data.reset) emit('reset', { cursor: cursor });
+        data.events.forEach(item => emit(item.event, item.data));
+        longPoll();
+      })
+      .catch(() => {
+        polling = false;
+        scheduleRetry(30000);
+      });
+  }
+
+  function open() {
+    if (document.hidden || source || polling) return;
+    if (window.EventSource) {
+      openEventSource();
+    } else {
+      polling = true;
+      longPoll();
+    }
+  }
+
+  function close() {
+    if (retryTimer) {
+      clearTimeout(retryTimer);
+      retryTimer = null;
+    }
+    if (source) {
+      source.close();
+      source = null;
+    }
+    polling = false;
+  }
+
+  document.addEventListener('visibilitychange', function() {
+    if (document.hidden) {
+      close();
+    } else {
+      open();
+    }
+  });
+
+  return {
+    on: function(name, fn) {
+      (listeners[name] = listeners[name] || []).push(fn);
+    },
+    start: open
+  };
+})();
+
+
+// Chat functionality
+(function() {
+  const chatButton = document.getElementById('chat-button');
+  const chatWindow = document.getElementById('chat-window');
+  const chatClose = document.getElementById('chat-close');
+  const chatMessages = document.getElementById('chat-messages');
+  const chatForm = document.getElementById('chat-form');
+  const chatInput = document.getElementById('chat-input');
+  const chatSendBtn = document.getElementById('chat-send-btn');
+  const badgeManual = document.getElementById('chat-badge-manual');
+  const badgeAuto = document.getElementById('chat-badge-auto');
+
+  let isOpen = false;
+  let lastMessageId = 0;
+  let currentFilter = 'all'; // 'all', 'manual', 'auto', 'report'
+  let lastMessagesHash = ''; // Pour éviter le re-rendu inutile
+  let replyingTo = null; // Message auquel on répond
+  let editingMessageId = null; // Message en cours d'édition
+  let editingReportId = null; // Rapport en cours d'édition
+  let cachedMessages = null; // Cache des messages chargés (tous les messages + rapports)
+  let messagesLoaded = false; // Flag pour savoir si les messages ont été chargés une fois
+  let renderedElementsCache = new Map(); // Cache des éléments DOM déjà rendus (id -> element)
+  let currentRenderedFilter = null; // Filtre actuellement affiché
+  const chatReplyPreview = document.getElementById('chat-reply-preview');
+  const chatInputArea = document.getElementById('chat-input-area');
+  const chatAddReportBtn = document.getElementById('chat-add-report-btn');
+  const reportModalEl = document.getElementById('reportModal');
+  const photoModalEl = document.getElementById('photoModal');
+  let reportModal = null;
+  let photoModal = null;
+
+  // Initialiser les modales après le chargement de Bootstrap
+  if (typeof bootstrap !== 'undefined' && reportModalEl) {
+    reportModal = new bootstrap.Modal(reportModalEl);
+  }
+  if (typeof bootstrap !== 'undefined' && photoModalEl) {
+    photoModal = new bootstrap.Modal(photoModalEl);
+  }
+
+  // Filter buttons
+  const filterButtons = document.querySelectorAll('.chat-filter-btn');
+  filterButtons.forEach(btn => {
+    btn.addEventListener('click', function() {
+      filterButtons.forEach(b => b.classList.remove('active'));
+      this.classList.add('active');
+      currentFilter = this.getAttribute('data-filter');
+      // Utiliser le cache si disponible, sinon charger
+      if (cachedMessages) {
+        applyFilter();
+      } else {
+        loadMessages();
+      }
+    });
+  });
+
+  // Add report button
+  if (chatAddReportBtn) {
+    chatAddReportBtn.addEventListener('click', function() {
+      editingReportId = null;
+      compressedPhotos = []; // Réinitialiser les photos compressées
+      const reportModalTitle = document.getElementById('reportModalTitle');
+      const reportForm = document.getElementById('report-form');
+      if (reportModalTitle) reportModalTitle.textContent = chatTranslations['Créer un rapport'];
+      if (reportForm) reportForm.reset();
+      const reportId = document.getElementById('report-id');
+      if (reportId) reportId.value = '';
+      const photosPreview = document.getElementById('report-photos-preview');
+      if (photosPreview) photosPreview.innerHTML = '';
+      const existingPhotos = document.getElementById('report-existing-photos');
+      if (existingPhotos) existingPhotos.innerHTML = '';
+      // Réinitialiser l'input file
+      const reportPhotosInput = document.getElementById('report-photos');
+      if (reportPhotosInput) reportPhotosInput.value = '';
+      if (reportModal) reportModal.show();
+    });
+  }
+
+  // Fonction de compression d'image (comme WhatsApp - 70% de qualité)
+  function compressImage(file, quality = 0.7, maxWidth = 1920, maxHeight = 1920) {
+    return new Promise((resolve, reject) => {
+      const reader = new FileReader();
+      reader.onload = function(e) {
+        const img = new Image();
+        img.onload = function() {
+          // Calculer les nouvelles dimensions en gardant le ratio
+          let width = img.width;
+          let height = img.height;
+
+          if (width > maxWidth || height > maxHeight) {
+            if (width > height) {
+              if (width > maxWidth) {
+                height = (height * maxWidth) / width;
+                width = maxWidth;
+              }
+            } else {
+              if (height > maxHeight) {
+                width = (width * maxHeight) / height;
+                height = maxHeight;
+              }
+            }
+          }
+
+          // Créer un canvas pour redimensionner et compresser
+          const canvas = document.createElement('canvas');
+          canvas.width = width;
+          canvas.height = height;
+          const ctx = canvas.getContext('2d');
+          ctx.drawImage(img, 0, 0, width, height);
+
+          // Convertir en blob avec compression
+          canvas.toBlob(function(blob) {
+            if (blob) {
+              // Créer un nouveau File avec le nom original
+              const compressedFile = new File([blob], file.name, {
+                type: 'image/jpeg',
+                lastModified: Date.now()
+              });
+              resolve(compressedFile);
+            } else {
+              reject(new Error('Erreur lors de la compression'));
+            }
+          }, 'image/jpeg', quality);
+        };
+        img.onerror = reject;
+        img.src = e.target.result;
+      };
+      reader.onerror = reject;
+      reader.readAsDataURL(file);
+    });
+  }
+
+  // Stocker les fichiers compressés
+  let compressedPhotos = [];
+
+  // Photo preview avec compression
+  const reportPhotosInput = document.getElementById('report-photos');
+  if (reportPhotosInput) {
+    reportPhotosInput.addEventListener('change', async function(e) {
+      const preview = document.getElementById('report-photos-preview');
+      preview.innerHTML = '<div style="color: #666; font-size: 12px; margin-bottom: 8px;">Compression des photos...</div>';
+      compressedPhotos = [];
+
+      const files = Array.from(e.target.files);
+      const previewPromises = [];
+
+      for (const file of files) {
+        if (file.type.startsWith('image/')) {
+          try {
+            // Compresser l'image
+            const compressedFile = await compressImage(file, 0.7);
+            compressedPhotos.push(compressedFile);
+
+            // Afficher la preview
+            const reader = new FileReader();
+            reader.onload = function(e) {
+              const img = document.createElement('img');
+              img.src = e.target.result;
+              img.style.width = '120px';
+              img.style.height = '120px';
+              img.style.objectFit = 'cover';
+              img.style.borderRadius = '4px';
+              img.style.marginRight = '8px';
+              img.style.marginBottom = '8px';
+              preview.appendChild(img);
+            };
+            reader.readAsDataURL(compressedFile);
+          } catch (error) {
+            console.error('Erreur lors de la compression:', error);
+            // En cas d'erreur, utiliser le fichier original
+            compressedPhotos.push(file);
+            const reader = new FileReader();
+            reader.onload = function(e) {
+              const img = document.createElement('img');
+              img.src = e.target.result;
+              img.style.width = '120px';
+              img.style.height = '120px';
+              img.style.objectFit = 'cover';
+              img.style.borderRadius = '4px';
+              img.style.marginRight = '8px';
+              img.style.marginBottom = '8px';
+              preview.appendChild(img);
+            };
+            reader.readAsDataURL(file);
+          }
+        }
+      }
+
+      // Supprimer le message de chargement
+      const loadingMsg = preview.querySelector('div');
+      if (loadingMsg && loadingMsg.textContent.includes('Compression')) {
+        loadingMsg.remove();
+      }
+    });
+  }
+
+  // Submit report
+  const reportSubmitBtn = document.getElementById('report-submit-btn');
+  if (reportSubmitBtn) {
+    reportSubmitBtn.addEventListener('click', async function() {
+    const form = document.getElementById('report-form');
+    const formData = new FormData();
+
+    // Ajouter le contenu du rapport
+    const content = document.getElementById('report-content').value;
+    formData.append('content', content);
+
+    // Ajouter les photos compressées au lieu des photos originales
+    if (compressedPhotos.length > 0) {
+      compressedPhotos.forEach((file, index) => {
+        formData.append('photos', file);
+      });
+    }
+
+    // Si on modifie un rapport, ajouter les photos à supprimer et le report_id
+    if (editingReportId) {
+      formData.append('report_id', editingReportId);
+      // Ajouter les photos à supprimer (checkboxes cochées)
+      const deleteCheckboxes = document.querySelectorAll('input[name="delete_photos"]:checked');
+      deleteCheckboxes.forEach(checkbox => {
+        formData.append('delete_photos', checkbox.value);
+      });
+
+      fetch(`/reports/${editingReportId}`, {
+        method: 'PUT',
+        body: formData
+      })
+      .then(response => response.json())
+      .then(data => {
+        if (data.success) {
+          if (reportModal) reportModal.hide();
+          // Réinitialiser les variables
+          compressedPhotos = [];
+          editingReportId = null;
+          const reportForm = document.getElementById('report-form');
+          if (reportForm) reportForm.reset();
+          const photosPreview = document.getElementById('report-photos-preview');
+          if (photosPreview) photosPreview.innerHTML = '';
+          lastMessagesHash = ''; // Réinitialiser le hash pour forcer le re-rendu
+          cachedMessages = null; // Invalider le cache
+          messagesLoaded = false; // Forcer le rechargement
+          loadMessages();
+        } else {
+          alert(chatTranslations['Erreur'] + ' : ' + (data.error || chatTranslations['Impossible de modifier le rapport']));
+        }
+      })
+      .catch(error => {
+        console.error('Erreur:', error);
+        alert('Erreur lors de la modification du rapport');
+      });
+    } else {
+      fetch('/reports', {
+        method: 'POST',
+        body: formData
+      })
+      .then(response => response.json())
+      .then(data => {
+        if (data.success) {
+          if (reportModal) reportModal.hide();
+          // Réinitialiser les variables
+          compressedPhotos = [];
+          editingReportId = null;
+          const reportForm = document.getElementById('report-form');
+          if (reportForm) reportForm.reset();
+          const photosPreview = document.getElementById('report-photos-preview');
+          if (photosPreview) photosPreview.innerHTML = '';
+          lastMessagesHash = ''; // Réinitialiser le hash pour forcer le re-rendu
+          cachedMessages = null; // Invalider le cache
+          messagesLoaded = false; // Forcer le rechargement
+          loadMessages();
+        } else {
+          alert(chatTranslations['Erreur'] + ' : ' + (data.error || chatTranslations['Impossible de modifier le rapport']));
+        }
+      })
+      .catch(error => {
+        console.error('Erreur:', error);
+        alert('Erreur lors de la création du rapport');
+      });
+    }
+    });
+  }
+
+  // Load reports
+  // Edit report function
+  window.editReport = function(reportId) {
+    fetch(`/reports?report_id=${reportId}`)
+      .then(response => response.json())
+      .then(data => {
+        if (data.success) {
+          const report = data.reports.find(r => r.id === reportId);
+          if (report) {
+            editingReportId = report.id;
+            compressedPhotos = []; // Réinitialiser les photos compressées
+            const reportModalTitle = document.getElementById('reportModalTitle');
+            const reportContent = document.getElementById('report-content');
+            const reportIdInput = document.getElementById('report-id');
+            const photosPreview = document.getElementById('report-photos-preview');
+            const existingPhotosDiv = document.getElementById('report-existing-photos');
+
+            if (reportModalTitle) reportModalTitle.textContent = chatTranslations['Modifier le rapport'];
+            if (reportContent) reportContent.value = report.content;
+            if (reportIdInput) reportIdInput.value = report.id;
+            if (photosPreview) photosPreview.innerHTML = '';
+            // Réinitialiser l'input file
+            const reportPhotosInput = document.getElementById('report-photos');
+            if (reportPhotosInput) reportPhotosInput.value = '';
+
+            if (existingPhotosDiv) {
+              existingPhotosDiv.innerHTML = '<label class="form-label">Photos existantes</label>';
+              report.photos.forEach(photo => {
+                const photoDiv = document.createElement('div');
+                photoDiv.style.display = 'flex';
+                photoDiv.style.alignItems = 'center';
+                photoDiv.style.gap = '8px';
+                photoDiv.style.marginBottom = '8px';
+
+                const img = document.createElement('img');
+                img.src = photo.thumbnail_url || photo.url;
+                img.style.width = '60px';
+                img.style.height = '60px';
+                img.style.objectFit = 'cover';
+                img.style.borderRadius = '4px';
+
+                const checkbox = document.createElement('input');
+                checkbox.type = 'checkbox';
+                checkbox.name = 'delete_photos';
+                checkbox.value = photo.id;
+                checkbox.id = `photo-${photo.id}`;
+
+                const label = document.createElement('label');
+                label.htmlFor = `photo-${photo.id}`;
+                label.textContent = chatTranslations['Supprimer'];
+                label.style.cursor = 'pointer';
+
+                photoDiv.appendChild(img);
+                photoDiv.appendChild(checkbox);
+                photoDiv.appendChild(label);
+                existingPhotosDiv.appendChild(photoDiv);
+              });
+            }
+
+            if (reportModal) reportModal.show();
+          }
+        }
+      })
+      .catch(error => {
+        console.error('Erreur:', error);
+        alert('Erreur lors du chargement du rapport');
+      });
+  };
+
+  // Delete report function
+  window.deleteReport = function(reportId) {
+    if (confirm(chatTranslations['Êtes-vous sûr de vouloir supprimer ce rapport ?'])) {
+      fetch(`/reports/${reportId}`, {
+        method: 'DELETE'
+      })
+      .then(response => response.json())
+      .then(data => {
+        if (data.success) {
+          lastMessagesHash = ''; // Réinitialiser le hash pour forcer le re-rendu
+          renderedElementsCache.clear(); // Vider le cache DOM
+          currentRenderedFilter = null; // Réinitialiser le filtre rendu
+          loadMessages();
+        } else {
+          alert(chatTranslations['Erreur'] + ' : ' + (data.error || chatTranslations['Impossible de supprimer le rapport']));
+        }
+      })
+      .catch(error => {
+        console.error('Erreur:', error);
+        alert('Erreur lors de la suppression du rapport');
+      });
+    }
+  };
+
+  // Cancel reply
+  function cancelReply() {
+    replyingTo = null;
+    chatReplyPreview.style.display = 'none';
+    chatInput.placeholder = chatTranslations['Tapez votre message...'];
+  }
+
+  // Cancel edit
+  function cancelEdit() {
+    editingMessageId = null;
+    chatInput.value = '';
+    chatInput.placeholder = chatTranslations['Tapez votre message...'];
+    chatSendBtn.title = chatTranslations['Envoyer'];
+    chatSendBtn.removeAttribute('data-mode');
+  }
+
+  // Toggle chat window
+  function toggleChat() {
+    isOpen = !isOpen;
+    if (isOpen) {
+      chatWindow.classList.add('open');
+      // Charger les messages seulement la première fois, sinon utiliser le cache
+      if (!messagesLoaded) {
+        loadMessages();
+        messagesLoaded = true;
+      } else {
+        // Utiliser le cache et juste filtrer
+        applyFilter();
+      }
+      markAsRead();
+    } else {
+      chatWindow.classList.remove('open');
+    }
+  }
+
+  // Appliquer le filtre sur les messages en cache (version optimisée)
+  function applyFilter() {
+    if (!cachedMessages) {
+      // Si pas de cache, charger les messages
+      loadMessages();
+      return;
+    }
+
+    // Si le filtre n'a pas changé, ne rien faire
+    if (currentFilter === currentRenderedFilter && renderedElementsCache.size > 0) {
+      return;
+    }
+
+    // Filtrer les items selon le filtre actif
+    // 'all' = tout afficher, sinon filtrer par type
+    let filteredItems = cachedMessages;
+    if (currentFilter === 'manual') {
+      filteredItems = cachedMessages.filter(item => item.type === 'manual');
+    } else if (currentFilter === 'auto') {
+      filteredItems = cachedMessages.filter(item => item.type === 'auto');
+    } else if (currentFilter === 'report') {
+      filteredItems = cachedMessages.filter(item => item.type === 'report');
+    }
+    // Si currentFilter === 'all', on garde tous les items
+
+    // Utiliser le rendu optimisé qui cache/affiche au lieu de recréer
+    // Mais seulement si on a déjà des éléments rendus, sinon utiliser renderAllItems
+    if (renderedElementsCache.size > 0) {
+      renderAllItemsOptimized(filteredItems);
+    } else {
+      renderAllItems(filteredItems);
+    }
+    currentRenderedFilter = currentFilter;
+
+    // Forcer le scroll vers le dernier message après changement d'onglet
+    requestAnimationFrame(() => {
+      chatMessages.scrollTop = chatMessages.scrollHeight;
+    });
+  }
+
+  chatButton.addEventListener('click', toggleChat);
+  chatClose.addEventListener('click', toggleChat);
+
+  // Load messages
+  function loadMessages(isRefresh = false) {
+    fetch('/chat/messages')
+      .then(response => response.json())
+      .then(data => {
+        if (data.success) {
+          // Charger aussi les rapports
+          fetch('/reports')
+            .then(response => response.json())
+            .then(reportData => {
+              let allItems = [];
+
+              if (reportData.success) {
+                // Convertir les rapports en format message
+                const reportMessages = reportData.reports.map(report => ({
+                  id: 'report_' + report.id,
+                  type: 'report',
+                  user_name: report.user_name,
+                  content: report.content,
+                  date: new Date(report.created_at).toLocaleDateString('fr-FR'),
+                  time: new Date(report.created_at).toLocaleTimeString('fr-FR', { hour: '2-digit', minute: '2-digit' }),
+                  edited: report.edited_at ? true : false,
+                  is_own: report.is_own,
+                  photos: report.photos || [],
+                  report_id: report.id,
+                  created_at: report.created_at
+                }));
+
+                // Combiner messages et rapports
+                allItems = [...data.messages, ...reportMessages];
+              } else {
+                allItems = data.messages;
+              }
+
+              // Trier par date (plus ancien en premier, comme WhatsApp)
+              allItems.sort((a, b) => {
+                const dateA = a.created_at ? new Date(a.created_at) : new Date(a.date + ' ' + a.time);
+                const dateB = b.created_at ? new Date(b.created_at) : new Date(b.date + ' ' + b.time);
+                return dateA - dateB; // Plus ancien en premier
+              });
+
+              // Mettre en cache TOUS les messages (pas de filtre à ce stade)
+              // Le cache contient TOUT : messages + rapports
+              cachedMessages = allItems;
+              messagesLoaded = true;
+
+              // Appliquer le filtre actuel pour l'affichage
+              applyFilter();
+            })
+            .catch(error => {
+              console.error('Error loading reports:', error);
+              // En cas d'erreur, mettre en cache seulement les messages (sans rapports)
+              cachedMessages = data.messages;
+              messagesLoaded = true;
+              // Appliquer le filtre
+              applyFilter();
+            });
+        }
+      })
+      .catch(error => {
+        console.error('Error loading messages:', error);
+      });
+  }
+
+  // Version optimisée : cache les éléments DOM et cache/affiche selon le filtre
+  function renderAllItemsOptimized(items) {
+    const wasAtBottom = chatMessages.scrollHeight - chatMessages.scrollTop < 150;
+    const scrollPosition = chatMessages.scrollTop;
+
+    // Créer un Set des IDs des items à afficher pour un accès rapide
+    const itemsToShow = new Set(items.map(item => item.id || item.report_id));
+
+    // Si aucun élément n'est à afficher, créer un message vide
+    if (items.length === 0) {
+      const emptyId = 'empty-message';
+      if (!renderedElementsCache.has(emptyId)) {
+        const emptyDiv = document.createElement('div');
+        emptyDiv.className = 'chat-message';
+        emptyDiv.style.textAlign = 'center';
+        emptyDiv.style.color = '#6c757d';
+        emptyDiv.setAttribute('data-item-id', emptyId);
+        emptyDiv.textContent = currentFilter === 'all' 
+          ? chatTranslations['Aucun message'] 
+          : currentFilter === 'manual' 
+            ? chatTranslations['Aucun message écrit'] 
+            : currentFilter === 'auto'
+              ? chatTranslations['Aucun message système']
+              : chatTranslations['Aucun rapport'];
+        chatMessages.appendChild(emptyDiv);
+        renderedElementsCache.set(emptyId, emptyDiv);
+      } else {
+        renderedElementsCache.get(emptyId).style.display = '';
+      }
+      // Cacher tous les autres éléments
+      renderedElementsCache.forEach((element, itemId) => {
+        if (itemId !== emptyId) {
+          element.style.display = 'none';
+        }
+      });
+      return;
+    }
+
+    // Cacher le message vide s'il existe
+    if (renderedElementsCache.has('empty-message')) {
+      renderedElementsCache.get('empty-message').style.display = 'none';
+    }
+
+    // Parcourir tous les éléments rendus et les cacher/afficher
+    let hasChanges = false;
+
+    // D'abord, créer les éléments manquants pour les items à afficher
+    items.forEach(item => {
+      const itemId = item.id || item.report_id;
+      if (!renderedElementsCache.has(itemId)) {
+        // Créer l'élément manquant
+        let element;
+        if (item.type === 'report') {
+          element = renderReportMessage(item);
+        } else {
+          element = renderChatMessage(item);
+        }
+        if (element) {
+          renderedElementsCache.set(itemId, element);
+          hasChanges = true;
+        }
+      }
+    });
+
+    // Ensuite, cacher/afficher selon le filtre
+    renderedElementsCache.forEach((element, itemId) => {
+      if (itemId === 'empty-message') return; // Ignorer le message vide
+
+      if (itemsToShow.has(itemId)) {
+        if (element.style.display === 'none') {
+          element.style.display = '';
+          hasChanges = true;
+        }
+      } else {
+        if (element.style.display !== 'none') {
+          element.style.display = 'none';
+          hasChanges = true;
+        }
+      }
+    });
+
+    // Restaurer la position de scroll seulement si nécessaire
+    if (hasChanges) {
+      requestAnimationFrame(() => {
+        if (wasAtBottom) {
+          chatMessages.scrollTop = chatMessages.scrollHeight;
+        } else {
+          chatMessages.scrollTop = scrollPosition;
+        }
+      });
+    }
+  }
+
+  // Version originale pour le premier rendu ou quand les messages changent
+  function renderAllItems(items) {
+    // Créer un hash plus précis des messages pour éviter le re-rendu inutile
+    const itemsHash = JSON.stringify(items.map(item => ({
+      id: item.id || item.report_id,
+      type: item.type,
+      content: item.content ? item.content.substring(0, 100) : '',
+      date: item.date,
+      time: item.time,
+      edited: item.edited || false,
+      photos_count: item.photos ? item.photos.length : 0
+    })));
+
+    // Ne re-rendre que si les messages ont vraiment changé
+    if (itemsHash === lastMessagesHash && chatMessages.children.length === items.length && currentRenderedFilter === currentFilter) {
+      // Messages identiques, pas besoin de re-rendre
+      return;
+    }
+
+    lastMessagesHash = itemsHash;
+    currentRenderedFilter = currentFilter;
+
+    // Sauvegarder la position de scroll avant le re-rendu
+    const wasAtBottom = chatMessages.scrollHeight - chatMessages.scrollTop < 150;
+    const scrollPosition = chatMessages.scrollTop;
+    const scrollHeight = chatMessages.scrollHeight;
+
+    // Vider le cache DOM et recréer tous les éléments
+    renderedElementsCache.clear();
+
+    // Utiliser requestAnimationFrame pour un rendu plus fluide
+    requestAnimationFrame(() => {
+      chatMessages.innerHTML = '';
+
+      if (items.length === 0) {
+        const emptyDiv = document.createElement('div');
+        emptyDiv.className = 'chat-message';
+        emptyDiv.style.textAlign = 'center';
+        emptyDiv.style.color = '#6c757d';
+        emptyDiv.setAttribute('data-item-id', 'empty-message');
+        emptyDiv.textContent = currentFilter === 'all' 
+          ? chatTranslations['Aucun message'] 
+          : currentFilter === 'manual' 
+            ? chatTranslations['Aucun message écrit'] 
+            : currentFilter === 'auto'
+              ? chatTranslations['Aucun message système']
+              : chatTranslations['Aucun rapport'];
+        chatMessages.appendChild(emptyDiv);
+        renderedElementsCache.set('empty-message', emptyDiv);
+      } else {
+        items.forEach(item => {
+          const itemId = item.id || item.report_id;
+          if (item.type === 'report') {
+            const element = renderReportMessage(item);
+            if (element) {
+              renderedElementsCache.set(itemId, element);
+            }
+          } else {
+            const element = renderChatMessage(item);
+            if (element) {
+              renderedElementsCache.set(itemId, element);
+            }
+          }
+        });
+      }
+
+      // Restaurer la position de scroll ou aller en bas
+      requestAnimationFrame(() => {
+        if (wasAtBottom || chatMessages.scrollTop === 0) {
+          chatMessages.scrollTop = chatMessages.scrollHeight;
+        } else {
+          // Maintenir la position relative si on n'était pas en bas
+          const newScrollHeight = chatMessages.scrollHeight;
+          const heightDiff = newScrollHeight - scrollHeight;
+          chatMessages.scrollTop = scrollPosition + heightDiff;
+        }
+      });
+    });
+  }
+
+  function renderChatMessage(msg) {
+    const messageDiv = document.createElement('div');
+    messageDiv.className = `chat-message ${msg.type} ${msg.is_own ? 'own' : ''}`;
+    messageDiv.setAttribute('data-message-id', msg.id);
+    messageDiv.setAttribute('data-item-id', msg.id);
+
+    // Reply preview if exists
+    if (msg.reply_to) {
+      const replyDiv = document.createElement('div');
+      replyDiv.className = 'chat-message-reply';
+      replyDiv.innerHTML = `
+        <div class="chat-message-reply-user">${msg.reply_to.user_name}</div>
+        <div class="chat-message-reply-content">${msg.reply_to.content}</div>
+      `;
+      replyDiv.addEventListener('click', function() {
+        const originalMsg = chatMessages.querySelector(`[data-message-id="${msg.reply_to.id}"]`);
+        if (originalMsg) {
+          originalMsg.scrollIntoView({ behavior: 'smooth', block: 'center' });
+          originalMsg.style.backgroundColor = '#fff3cd';
+          setTimeout(() => {
+            originalMsg.style.backgroundColor = '';
+          }, 2000);
+        }
+      });
+      messageDiv.appendChild(replyDiv);
+    }
+
+    const header = document.createElement('div');
+    header.className = 'chat-message-header';
+
+    const userSpan = document.createElement('span');
+    userSpan.className = 'chat-message-user';
+    userSpan.textContent = msg.user_name || 'Système';
+
+    const headerRight = document.createElement('div');
+    headerRight.className = 'chat-message-header-right';
+
+    // Actions for manual messages
+    if (msg.type === 'manual') {
+      const actionsDiv = document.createElement('div');
+      actionsDiv.className = 'chat-message-actions';
+
+      if (msg.is_own) {
+        actionsDiv.innerHTML = `
+          <button class="chat-message-action-btn" onclick="replyToMessage(${msg.id})" title="${chatTranslations['Répondre']}">↩</button>
+          <button class="chat-message-action-btn" onclick="editMessage(${msg.id}, '${msg.content.replace(/'/g, "\\'").replace(/"/g, '&quot;')}')" title="${chatTranslations['Modifier']}"><img src="/static/icons/edit.svg" alt="${chatTranslations['Modifier']}" style="width: 14px; height: 14px;"></button>
+          <button class="chat-message-action-btn" onclick="deleteMessage(${msg.id})" title="${chatTranslations['Supprimer']}"><img src="/static/icons/delete.svg" alt="${chatTranslations['Supprimer']}" style="width: 14px; height: 14px;"></button>
+        `;
+      } else {
+        actionsDiv.innerHTML = `
+          <button class="chat-message-action-btn" onclick="replyToMessage(${msg.id})" title="${chatTranslations['Répondre']}">↩</button>
+        `;
+      }
+      headerRight.appendChild(actionsDiv);
+    }
+
+    const dateSpan = document.createElement('span');
+    dateSpan.className = 'chat-message-date';
+    dateSpan.innerHTML = `${msg.date} ${msg.time}${msg.edited ? ' <span class="chat-message-edited">(modifié)</span>' : ''}`;
+    headerRight.appendChild(dateSpan);
+
+    header.appendChild(userSpan);
+    header.appendChild(headerRight);
+
+    const content = document.createElement('div');
+    content.className = 'chat-message-content';
+    content.textContent = msg.content;
+
+    messageDiv.appendChild(header);
+    messageDiv.appendChild(content);
+
+    if (msg.link_url) {
+      const link = document.createElement('a');
+      link.href = msg.link_url;
+      link.className = 'chat-message-link';
+      link.textContent = 'Voir la tâche →';
+      link.target = '_blank';
+      messageDiv.appendChild(link);
+    }
+
+    chatMessages.appendChild(messageDiv);
+
+    if (msg.id > lastMessageId && typeof msg.id === 'number') {
+      lastMessageId = msg.id;
+    }
+
+    return messageDiv;
+  }
+
+  function renderReportMessage(report) {
+    const messageDiv = document.createElement('div');
+    messageDiv.className = `chat-message report ${report.is_own ? 'own' : ''}`;
+    messageDiv.setAttribute('data-report-id', report.report_id);
+    messageDiv.setAttribute('data-item-id', report.report_id);
+
+    const header = document.createElement('div');
+    header.className = 'chat-message-header';
+
+    const userSpan = document.createElement('span');
+    userSpan.className = 'chat-message-user';
+    userSpan.textContent = report.user_name;
+
+    const headerRight = document.createElement('div');
+    headerRight.className = 'chat-message-header-right';
+
+    // Actions pour les rapports (modifier/supprimer si propriétaire)
+    if (report.is_own) {
+      const actionsDiv = document.createElement('div');
+      actionsDiv.className = 'chat-message-actions';
+      actionsDiv.innerHTML = `
+        <button class="chat-message-action-btn" onclick="editReport(${report.report_id})" title="${chatTranslations['Modifier']}"><img src="/static/icons/edit.svg" alt="${chatTranslations['Modifier']}" style="width: 14px; height: 14px;"></button>
+        <button class="chat-message-action-btn" onclick="deleteReport(${report.report_id})" title="${chatTranslations['Supprimer']}"><img src="/static/icons/delete.svg" alt="${chatTranslations['Supprimer']}" style="width: 14px; height: 14px;"></button>
+      `;
+      headerRight.appendChild(actionsDiv);
+    }
+
+    const dateSpan = document.createElement('span');
+    dateSpan.className = 'chat-message-date';
+    dateSpan.innerHTML = `${report.date} ${report.time}${report.edited ? ' <span class="chat-message-edited">(modifié)</span>' : ''}`;
+    headerRight.appendChild(dateSpan);
+
+    header.appendChild(userSpan);
+    header.appendChild(headerRight);
+
+    const content = document.createElement('div');
+    content.className = 'chat-message-content';
+    content.style.whiteSpace = 'pre-wrap';
+    content.textContent = report.content;
+
+    messageDiv.appendChild(header);
+    messageDiv.appendChild(content);
+
+    // Photos
+    if (report.photos && report.photos.length > 0) {
+      const photosDiv = document.createElement('div');
+      photosDiv.style.display = 'grid';
+      photosDiv.style.gridTemplateColumns = 'repeat(auto-fill, minmax(120px, 1fr))';
+      photosDiv.style.gap = '8px';
+      photosDiv.style.marginTop = '12px';
+
+      report.photos.forEach(photo => {
+        const img = document.createElement('img');
+        img.src = photo.thumbnail_url || photo.url;
+        img.style.width = '100%';
+        img.style.height = '120px';
+        img.style.objectFit = 'cover';
+        img.style.borderRadius = '4px';
+        img.style.cursor = 'pointer';
+        img.addEventListener('click', function() {
+          if (photoModalEl) {
+            const photoModalImg = photoModalEl.querySelector('#photoModalImage');
+            if (photoModalImg) {
+              photoModalImg.src = photo.medium_url || photo.url;
+              if (photoModal) photoModal.show();
+            }
+          }
+        });
+        photosDiv.appendChild(img);
+      });
+
+      messageDiv.appendChild(photosDiv);
+    }
+
+    chatMessages.appendChild(messageDiv);
+
+    return messageDiv;
+  }
+
+  // Reply to message
+  window.replyToMessage = function(messageId) {
+    const messageDiv = chatMessages.querySelector(`[data-message-id="${messageId}"]`);
+    if (messageDiv) {
+      const content = messageDiv.querySelector('.chat-message-content').textContent;
+      const userName = messageDiv.querySelector('.chat-message-user').textContent;
+      replyingTo = { id: messageId, content: content, user_name: userName };
+
+      chatReplyPreview.innerHTML = `
+        <div class="chat-reply-preview-content">
+          <div class="chat-reply-preview-user">${userName}</div>
+          <div class="chat-reply-preview-text">${content.length > 50 ? content.substring(0, 50) + '...' : content}</div>
+        </div>
+        <button class="chat-reply-preview-close" onclick="cancelReply()">×</button>
+      `;
+      chatReplyPreview.style.display = 'block';
+      chatInput.placeholder = chatTranslations['Répondre à'] + ' ' + userName + '...';
+      chatInput.focus();
+      cancelEdit(); // Cancel any edit in progress
+    }
+  };
+
+  // Edit message
+  window.editMessage = function(messageId, currentContent) {
+    editingMessageId = messageId;
+    chatInput.value = currentContent;
+    chatInput.placeholder = chatTranslations['Modifier le message...'];
+    chatSendBtn.title = chatTranslations['Modifier'];
+    chatSendBtn.setAttribute('data-mode', 'edit');
+    cancelReply(); // Cancel any reply in progress
+    chatInput.focus();
+  };
+
+  // Delete message
+  window.deleteMessage = function(messageId) {
+    if (!confirm(chatTranslations['Êtes-vous sûr de vouloir supprimer ce message ?'])) return;
+
+    fetch(`/chat/${messageId}/delete`, {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+      }
+    })
+    .then(response => response.json())
+    .then(data => {
+        if (data.success) {
+          lastMessagesHash = ''; // Réinitialiser le hash pour forcer le re-rendu
+          cachedMessages = null; // Invalider le cache
+          messagesLoaded = false; // Forcer le rechargement
+          renderedElementsCache.clear(); // Vider le cache DOM
+          currentRenderedFilter = null; // Réinitialiser le filtre rendu
+          loadMessages();
+        } else {
+        alert(chatTranslations['Erreur'] + ': ' + (data.error || chatTranslations['Impossible de supprimer le message']));
+      }
+    })
+    .catch(error => {
+      console.error('Error deleting message:', error);
+      alert('Erreur lors de la suppression du message');
+    });
+  };
+
+  // Cancel reply (global function)
+  window.cancelReply = cancelReply;
+
+  // Send message
+  chatForm.addEventListener('submit', function(e) {
+    e.preventDefault();
+    const content = chatInput.value.trim();
+    if (!content) return;
+
+    chatSendBtn.disabled = true;
+
+    // Edit or send?
+    if (editingMessageId) {
+      // Edit existing message
+      fetch(`/chat/${editingMessageId}/edit`, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({ content: content })
+      })
+      .then(response => response.json())
+      .then(data => {
+        if (data.success) {
+          cancelEdit();
+          cachedMessages = null; // Invalider le cache
+          messagesLoaded = false; // Forcer le rechargement
+          renderedElementsCache.clear(); // Vider le cache DOM
+          currentRenderedFilter = null; // Réinitialiser le filtre rendu
+          loadMessages();
+        } else {
+          alert(chatTranslations['Erreur'] + ': ' + (data.error || chatTranslations['Impossible de modifier le message']));
+        }
+      })
+      .catch(error => {
+        console.error('Error editing message:', error);
+        alert('Erreur lors de la modification du message');
+      })
+      .finally(() => {
+        chatSendBtn.disabled = false;
+      });
+    } else {
+      // Send new message
+      fetch('/chat/send', {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+        },
+        body: JSON.stringify({ 
+          content: content,
+          reply_to_id: replyingTo ? replyingTo.id : null
+        })
+      })
+      .then(response => response.json())
+      .then(data => {
+        if (data.success) {
+          chatInput.value = '';
+          cancelReply();
+          lastMessagesHash = ''; // Réinitialiser le hash pour forcer le re-rendu
+          cachedMessages = null; // Invalider le cache
+          messagesLoaded = false; // Forcer le rechargement
+          renderedElementsCache.clear(); // Vider le cache DOM
+          currentRenderedFilter = null; // Réinitialiser le filtre rendu
+          loadMessages();
+          markAsRead();
+        } else {
+          alert(chatTranslations['Erreur'] + ': ' + (data.error || chatTranslations['Impossible d\'envoyer le message']));
+        }
+      })
+      .catch(error => {
+        console.error('Error sending message:', error);
+        alert('Erreur lors de l\'envoi du message');
+      })
+      .finally(() => {
+        chatSendBtn.disabled = false;
+      });
+    }
+  });
+
+  // Mark as read
+  function markAsRead() {
+    fetch('/chat/mark-read', {
+      method: 'POST',
+      headers: {
+        'Content-Type': 'application/json',
+      }
+    })
+    .then(response => response.json())
+    .then(data => {
+      if (data.success) {
+        setUnreadCount({ manual_count: 0, auto_count: 0 });
+      }
+    })
+    .catch(error => {
+      console.error('Error marking as read:', error);
+    });
+  }
+
+  // Update unread count (compteurs poussés par le flux à la connexion puis à chaque changement)
+  function setUnreadCount(data) {
+    if (data.manual_count > 0) {
+      badgeManual.textContent = data.manual_count;
+      badgeManual.style.display = 'flex';
+    } else {
+      badgeManual.style.display = 'none';
+    }
+
+    if (data.auto_count > 0) {
+      badgeAuto.textContent = data.auto_count;
+      badgeAuto.style.display = 'flex';
+    } else {
+      badgeAuto.style.display = 'none';
+    }
+  }
+
+  // Forcer un rechargement complet des messages et rapports
+  function invalidateMessages() {
+    lastMessagesHash = '';
+    cachedMessages = null;
+    messagesLoaded = false;
+    renderedElementsCache.clear();
+    currentRenderedFilter = null;
+    if (isOpen) {
+      loadMessages();
+      messagesLoaded = true;
+    }
+  }
+
+  // Insérer ou remplacer un message reçu par le flux
+  function upsertMessage(msg) {
+    if (!cachedMessages) return;
+    const index = cachedMessages.findIndex(item => item.id === msg.id);
+    const existing = renderedElementsCache.get(msg.id);
+    if (index >= 0) {
+      cachedMessages[index] = msg;
+      if (existing) {
+        // Remplacer l'élément sur place pour conserver l'ordre d'affichage
+        const element = renderChatMessage(msg);
+        existing.replaceWith(element);
+        element.style.display = existing.style.display;
+        renderedElementsCache.set(msg.id, element);
+      }
+      return;
+    }
+    cachedMessages.push(msg);
+    currentRenderedFilter = null;
+    applyFilter();
+  }
+
+  function removeMessage(messageId) {
+    if (!cachedMessages) return;
+    cachedMessages = cachedMessages.filter(item => item.id !== messageId);
+    const element = renderedElementsCache.get(messageId);
+    if (element) {
+      element.remove();
+      renderedElementsCache.delete(messageId);
+    }
+  }
+
+  // Mises à jour poussées par le serveur (plus de rafraîchissement périodique)
+  chatStream.on('message', upsertMessage);
+  chatStream.on('deleted', data => removeMessage(data.id));
+  chatStream.on('report', invalidateMessages);
+  chatStream.on('reset', invalidateMessages);
+  chatStream.on('unread', setUnreadCount);
+  chatStream.start();
+})();
@@ -0,0 +1,595 @@
+let showAllMachines = false;
+let dashboardChart = null;
+
+function toggleAllMachines() {
+  showAllMachines = !showAllMachines;
+  const button = document.getElementById('toggle-all-machines');
+  
+  console.log('=== TOGGLE ALL MACHINES ===');
+  console.log('showAllMachines:', showAllMachines);
+  
+  if (showAllMachines) {
+    // ÉTAPE 1: Déplier TOUS les enfants d'abord (même ceux dans des divs collapsed)
+    const allChildren = document.querySelectorAll('.machine-children');
+    console.log('Tous les enfants trouvés:', allChildren.length);
+    
+    allChildren.forEach(childrenDiv => {
+      // Forcer l'affichage en enlevant collapsed et en ajoutant expanded
+      childrenDiv.classList.remove('collapsed');
+      childrenDiv.classList.add('expanded');
+      childrenDiv.style.display = 'block';
+      
+      // Afficher aussi le parent si nécessaire
+      const parentNode = childrenDiv.closest('.machine-node');
+      if (parentNode) {
+        parentNode.style.display = '';
+        const toggleBtn = parentNode.querySelector('.machine-toggle:not(.no-children)');
+        if (toggleBtn) {
+          toggleBtn.textContent = '−';
+        }
+      }
+    });
+    
+    // ÉTAPE 2: Afficher toutes les machines non suivies
+    const allNotFollowed = document.querySelectorAll('.machine-not-followed');
+    console.log('Machines non suivies trouvées:', allNotFollowed.length);
+    
+    allNotFollowed.forEach(node => {
+      node.style.display = '';
+      // S'assurer que tous les parents sont aussi affichés
+      let current = node;
+      while (current && current !== document.body) {
+        if (current.classList && current.classList.contains('machine-node')) {
+          current.style.display = '';
+        }
+        if (current.classList && current.classList.contains('machine-children')) {
+          current.classList.remove('collapsed');
+          current.classList.add('expanded');
+          current.style.display = 'block';
+        }
+        current = current.parentElement;
+      }
+    });
+    
+    const eyeIcon = button.querySelector('#eye-icon');
+    if (eyeIcon) {
+      eyeIcon.src = indexIcons.eyeSlash;
+    }
+    button.title = indexTranslations['Masquer les machines non suivies'];
+  } else {
+    // Masquer toutes les machines non suivies
+    const allNotFollowed = document.querySelectorAll('.machine-not-followed');
+    allNotFollowed.forEach(node => {
+      node.style.display = 'none';
+    });
+    
+    // Replier seulement ceux qui ne sont pas suivis
+    const allChildren = document.querySelectorAll('.machine-children');
+    allChildren.forEach(childrenDiv => {
+      const parentNode = childrenDiv.closest('.machine-node');
+      if (parentNode && parentNode.classList.contains('machine-not-followed')) {
+        childrenDiv.classList.remove('expanded');
+        childrenDiv.classList.add('collapsed');
+        const toggleBtn = parentNode.querySelector('.machine-toggle:not(.no-children)');
+        if (toggleBtn) {
+          toggleBtn.textContent = '+';
+        }
+      }
+    });
+    
+    const eyeIcon = button.querySelector('#eye-icon');
+    if (eyeIcon) {
+      eyeIcon.src = indexIcons.eye;
+    }
+    button.title = indexTranslations['Afficher toutes les machines'];
+  }
+  
+  console.log('=== FIN TOGGLE ===');
+}
+
+function toggleMachine(button, machineId) {
+  const childrenDiv = document.getElementById('children-' + machineId);
+  if (!childrenDiv) return;
+  
+  const isCollapsed = childrenDiv.classList.contains('collapsed');
+  
+  if (isCollapsed) {
+    childrenDiv.classList.remove('collapsed');
+    childrenDiv.classList.add('expanded');
+    button.textContent = '−';
+    // Sauvegarder l'état dans localStorage
+    localStorage.setItem('machine-' + machineId + '-expanded', 'true');
+  } else {
+    childrenDiv.classList.remove('expanded');
+    childrenDiv.classList.add('collapsed');
+    button.textContent = '+';
+    // Sauvegarder l'état dans localStorage
+    localStorage.setItem('machine-' + machineId + '-expanded', 'false');
+  }
+}
+
+document.addEventListener('DOMContentLoaded', function() {
+  // Debug: vérifier combien de machines sont dans le HTML
+  const allMachines = document.querySelectorAll('.machine-node');
+  const allNotFollowedMachines = document.querySelectorAll('.machine-not-followed');
+  console.log('=== DEBUG PAGE ACCUEIL ===');
+  console.log('Total machines dans le HTML:', allMachines.length);
+  console.log('Machines non suivies dans le HTML:', allNotFollowedMachines.length);
+  console.log('=======================');
+  
+  // Restaurer l'état de dépliage/repliage depuis localStorage
+  function restoreMachineStates() {
+    document.querySelectorAll('.machine-children').forEach(childrenDiv => {
+      const machineId = childrenDiv.id.replace('children-', '');
+      const savedState = localStorage.getItem('machine-' + machineId + '-expanded');
+      
+      if (savedState === 'true') {
+        childrenDiv.classList.remove('collapsed');
+        childrenDiv.classList.add('expanded');
+        const button = document.querySelector('.machine-toggle[data-target="' + machineId + '"], .machine-toggle[data-machine-id="' + machineId + '"]');
+        if (button && !button.classList.contains('no-children')) {
+          button.textContent = '−';
+        }
+      } else if (savedState === 'false') {
+        childrenDiv.classList.remove('expanded');
+        childrenDiv.classList.add('collapsed');
+        const button = document.querySelector('.machine-toggle[data-target="' + machineId + '"], .machine-toggle[data-machine-id="' + machineId + '"]');
+        if (button && !button.classList.contains('no-children')) {
+          button.textContent = '+';
+        }
+      }
+      // Si pas d'état sauvegardé, on garde l'état initial du HTML
+    });
+  }
+  
+  // Restaurer les états avant d'attacher les listeners
+  restoreMachineStates();
+  
+  // Attacher les listeners aux boutons toggle
+  function attachToggleListeners() {
+    document.querySelectorAll('.machine-toggle:not(.no-children)').forEach(button => {
+      if (!button.dataset.listenerAttached) {
+        button.dataset.listenerAttached = 'true';
+        const machineId = button.getAttribute('data-target') || button.getAttribute('data-machine-id');
+        button.addEventListener('click', function(e) {
+          e.preventDefault();
+          e.stopPropagation();
+          toggleMachine(this, machineId);
+        });
+      }
+    });
+  }
+  
+  attachToggleListeners();
+  
+  // Initialiser les boutons de suivi
+  const followButtons = document.querySelectorAll('.follow-btn');
+  
+  followButtons.forEach(button => {
+    button.addEventListener('click', function(e) {
+      e.stopPropagation();
+      const machineId = this.getAttribute('data-machine-id');
+      
+      this.disabled = true;
+      
+      fetch(`/machines/${machineId}/toggle-follow`, {
+        method: 'POST',
+        headers: {
+          'Content-Type': 'application/json',
+        }
+      })
+      .then(response => response.json())
+      .then(data => {
+        if (data.success) {
+          if (data.is_followed) {
+            this.innerHTML = '<img src="/static/icons/star.svg" alt="Suivi" style="width: 16px; height: 16px; display: inline-block;">';
+            this.classList.add('followed');
+            this.title = 'Ne plus suivre';
+          } else {
+            this.innerHTML = '<img src="/static/icons/star-outline.svg" alt="Non suivi" style="width: 16px; height: 16px; display: inline-block;">';
+            this.classList.remove('followed');
+            this.title = 'Suivre cette machine';
+          }
+          // Recharger la page pour mettre à jour l'affichage
+          location.reload();
+        } else {
+          alert('Erreur : ' + (data.error || 'Impossible de modifier le suivi'));
+        }
+      })
+      .catch(error => {
+        console.error('Erreur:', error);
+        alert('Erreur lors de la modification du suivi');
+      })
+      .finally(() => {
+        this.disabled = false;
+      });
+    });
+  });
+});
+
+// Tableau de bord
+document.addEventListener('DOMContentLoaded', function() {
+  const translations = indexTranslations;
+  
+  const updateBtn = document.getElementById('dashboard-update');
+  const viewSelect = document.getElementById('dashboard-view');
+  const dateStartInput = document.getElementById('dashboard-date-start');
+  const dateEndInput = document.getElementById('dashboard-date-end');
+  const machinesSelect = document.getElementById('dashboard-machines');
+  const metricsSelect = document.getElementById('dashboard-metrics');
+  const loadingDiv = document.getElementById('dashboard-loading');
+  const tableContainer = document.getElementById('dashboard-table-container');
+  const chartContainer = document.getElementById('dashboard-chart-container');
+  const chartCanvas = document.getElementById('dashboard-chart');
+  
+  // Initialiser les dates par défaut (depuis le début jusqu'à aujourd'hui)
+  const today = new Date().toISOString().split('T')[0];
+  dateEndInput.value = today;
+  // Laisser date de début vide pour "depuis le début"
+  
+  // Gérer le changement de vue
+  viewSelect.addEventListener('change', function() {
+    const view = this.value;
+    if (view === 'table') {
+      tableContainer.style.display = 'block';
+      chartContainer.style.display = 'none';
+    } else {
+      tableContainer.style.display = 'none';
+      chartContainer.style.display = 'block';
+    }
+  });
+  
+  // Initialiser l'affichage selon la vue par défaut
+  if (viewSelect.value === 'table') {
+    tableContainer.style.display = 'block';
+    chartContainer.style.display = 'none';
+  } else {
+    tableContainer.style.display = 'none';
+    chartContainer.style.display = 'block';
+  }
+  
+  function updateDashboard() {
+    // Récupérer les machines sélectionnées
+    const selectedMachines = Array.from(machinesSelect.selectedOptions).map(opt => opt.value);
+    if (selectedMachines.length === 0) {
+      tableContainer.innerHTML = '<p class="text-muted">' + translations['Veuillez sélectionner au moins une machine.'] + '</p>';
+      return;
+    }
+    
+    // Récupérer les métriques sélectionnées
+    const selectedMetrics = Array.from(metricsSelect.selectedOptions).map(opt => opt.value);
+    
+    if (selectedMetrics.length === 0) {
+      tableContainer.innerHTML = '<p class="text-muted">' + translations['Veuillez sélectionner au moins une métrique.'] + '</p>';
+      return;
+    }
+    
+    // Récupérer les dates
+    const dateStart = dateStartInput.value || '';
+    const dateEnd = dateEndInput.value || '';
+    
+    // Afficher le chargement
+    loadingDiv.style.display = 'block';
+    tableContainer.innerHTML = '';
+    chartContainer.innerHTML = '<canvas id="dashboard-chart"></canvas>';
+    const currentChartCanvas = document.getElementById('dashboard-chart');
+    
+    const metricLabels = {
+      'maintenances_preventives': translations['Maintenances préventives'],
+      'maintenances_curatives': translations['Maintenances curatives'],
+      'cout_produits': translations['Coût produits (€)'],
+      'checklists': translations['Checklists'],
+      'maintenances_retard': translations['En retard'],
+      'maintenances_a_heure': translations['À l\'heure'],
+      'mises_a_jour_compteur': translations['Mises à jour compteur']
+    };
+    
+    const currentView = viewSelect.value;
+    const machineIds = selectedMachines.join(',');
+    const metrics = selectedMetrics.join(',');
+    
+    if (currentView === 'table') {
+      // Afficher le tableau
+      const url = `/api/dashboard?date_start=${encodeURIComponent(dateStart)}&date_end=${encodeURIComponent(dateEnd)}&machine_ids=${encodeURIComponent(machineIds)}&metrics=${encodeURIComponent(metrics)}`;
+      
+      fetch(url)
+        .then(response => response.json())
+        .then(data => {
+          loadingDiv.style.display = 'none';
+          
+          if (!data.success || !data.data || data.data.length === 0) {
+            tableContainer.innerHTML = '<p class="text-muted">' + translations['Aucune donnée disponible pour les critères sélectionnés.'] + '</p>';
+            return;
+          }
+          
+          // Créer le tableau
+          const table = document.createElement('table');
+          table.className = 'table table-striped';
+          
+          // En-têtes
+          const thead = document.createElement('thead');
+          const headerRow = document.createElement('tr');
+          const machineHeader = document.createElement('th');
+          machineHeader.textContent = translations['Machine'];
+          headerRow.appendChild(machineHeader);
+          
+          selectedMetrics.forEach(metric => {
+            const th = document.createElement('th');
+            th.textContent = metricLabels[metric] || metric;
+            headerRow.appendChild(th);
+          });
+          
+          thead.appendChild(headerRow);
+          table.appendChild(thead);
+          
+          // Corps du tableau
+          const tbody = document.createElement('tbody');
+          data.data.forEach(machineData => {
+            const row = document.createElement('tr');
+            
+            // Nom de la machine
+            const machineCell = document.createElement('td');
+            machineCell.innerHTML = `<strong>${machineData.machine_name}</strong><br><small class="text-muted">${machineData.machine_code}</small>`;
+            row.appendChild(machineCell);
+            
+            // Valeurs des métriques
+            selectedMetrics.forEach(metric => {
+              const cell = document.createElement('td');
+              const value = machineData.metrics[metric];
+              if (value !== undefined) {
+                if (metric === 'cout_produits') {
+                  cell.className = 'metric-value metric-cost';
+                  cell.textContent = value.toLocaleString('fr-FR', { minimumFractionDigits: 2, maximumFractionDigits: 2 }) + ' €';
+                } else {
+                  cell.className = 'metric-value';
+                  cell.textContent = value;
+                }
+              } else {
+                cell.textContent = '-';
+              }
+              row.appendChild(cell);
+            });
+            
+            tbody.appendChild(row);
+          });
+          
+          table.appendChild(tbody);
+          tableContainer.innerHTML = '';
+          tableContainer.appendChild(table);
+        })
+        .catch(error => {
+          loadingDiv.style.display = 'none';
+          tableContainer.innerHTML = '<p class="text-danger">' + translations['Erreur lors du chargement des données :'] + ' ' + error.message + '</p>';
+          console.error('Erreur:', error);
+        });
+    } else {
+      // Afficher le graphique
+      updateChart(dateStart, dateEnd, selectedMachines, selectedMetrics, metricLabels);
+    }
+  }
+  
+  function updateChart(dateStart, dateEnd, selectedMachines, selectedMetrics, metricLabels) {
+    // Détruire le graphique existant s'il existe
+    if (dashboardChart) {
+      dashboardChart.destroy();
+      dashboardChart = null;
+    }
+    
+    if (!selectedMachines || selectedMachines.length === 0 || !selectedMetrics || selectedMetrics.length === 0) {
+      chartContainer.innerHTML = '<p class="text-muted text-center">' + translations['Aucune donnée disponible pour les critères sélectionnés.'] + '</p>';
+      return;
+    }
+    
+    // Construire l'URL de l'API pour le graphique temporel
+    const machineIds = selectedMachines.join(',');
+    const metrics = selectedMetrics.join(',');
+    const url = `/api/dashboard-chart?date_start=${encodeURIComponent(dateStart || '')}&date_end=${encodeURIComponent(dateEnd || '')}&machine_ids=${encodeURIComponent(machineIds)}&metrics=${encodeURIComponent(metrics)}`;
+    
+    // Appel API pour les données temporelles
+    fetch(url)
+      .then(response => {
+        if (!response.ok) {
+          throw new Error('HTTP error! status: ' + response.status);
+        }
+        return response.json();
+      })
+      .then(data => {
+        loadingDiv.style.display = 'none';
+        console.log('Chart data received:', data);
+        
+        if (!data || !data.success || !data.data || data.data.length === 0) {
+          console.log('No chart data available:', data);
+          chartContainer.innerHTML = '<p class="text-muted text-center">' + translations['Aucune donnée disponible pour les critères sélectionnés.'] + '</p>';
+          return;
+        }
+        
+        // Préparer les données pour le graphique temporel
+        const labels = data.data.map(d => d.period_label);
+        const datasets = [];
+        
+        // Couleurs pour les différentes métriques
+        const colors = [
+          { border: 'rgb(26, 59, 80)', background: 'rgba(26, 59, 80, 0.1)' },
+          { border: 'rgb(40, 167, 69)', background: 'rgba(40, 167, 69, 0.1)' },
+          { border: 'rgb(220, 53, 69)', background: 'rgba(220, 53, 69, 0.1)' },
+          { border: 'rgb(255, 193, 7)', background: 'rgba(255, 193, 7, 0.1)' },
+          { border: 'rgb(23, 162, 184)', background: 'rgba(23, 162, 184, 0.1)' },
+          { border: 'rgb(108, 117, 125)', background: 'rgba(108, 117, 125, 0.1)' },
+          { border: 'rgb(111, 66, 193)', background: 'rgba(111, 66, 193, 0.1)' }
+        ];
+        
+        selectedMetrics.forEach((metric, index) => {
+          const values = data.data.map(d => {
+            if (!d || !d.metrics) {
+              console.warn('Invalid data point:', d);
+              return 0;
+            }
+            const value = d.metrics[metric];
+            return value !== undefined ? value : 0;
+          });
+          
+          datasets.push({
+            label: metricLabels[metric] || metric,
+            data: values,
+            borderColor: colors[index % colors.length].border,
+            backgroundColor: colors[index % colors.length].background,
+            tension: 0.4,
+            fill: false
+          });
+        });
+        
+        // Créer le graphique
+        const currentChartCanvas = document.getElementById('dashboard-chart');
+        if (!currentChartCanvas) {
+          console.error('Chart canvas not found');
+          return;
+        }
+        
+        const ctx = currentChartCanvas.getContext('2d');
+        if (!ctx) {
+          console.error('Could not get 2d context');
+          return;
+        }
+        
+        dashboardChart = new Chart(ctx, {
+          type: 'line',
+          data: {
+            labels: labels,
+            datasets: datasets
+          },
+          options: {
+            responsive: true,
+            maintainAspectRatio: true,
+            plugins: {
+              legend: {
+                position: 'top',
+                labels: {
+                  font: {
+                    family: 'Montserrat',
+                    size: 12
+                  }
+                }
+              },
+              tooltip: {
+                mode: 'index',
+                intersect: false,
+                callbacks: {
+                  label: function(context) {
+                    const label = context.dataset.label || '';
+                    const value = context.parsed.y;
+                    if (context.dataset.label.includes(translations['Coût']) || context.dataset.label.includes('Coût')) {
+                      return label + ': ' + value.toLocaleString('fr-FR', { minimumFractionDigits: 2, maximumFractionDigits: 2 }) + ' €';
+                    }
+                    return label + ': ' + value;
+                  }
+                }
+              }
+            },
+            scales: {
+              y: {
+                beginAtZero: true,
+                ticks: {
+                  font: {
+                    family: 'Montserrat'
+                  }
+                },
+                grid: {
+                  color: 'rgba(0, 0, 0, 0.1)'
+                }
+              },
+              x: {
+                ticks: {
+                  font: {
+                    family: 'Montserrat'
+                  },
+                  maxRotation: 45,
+                  minRotation: 45
+                },
+                grid: {
+                  color: 'rgba(0, 0, 0, 0.1)'
+                }
+              }
+            },
+            interaction: {
+              mode: 'nearest',
+              axis: 'x',
+              intersect: false
+            }
+          }
+        });
+      })
+      .catch(error => {
+        loadingDiv.style.display = 'none';
+        console.error('Erreur lors du chargement du graphique:', error);
+        chartContainer.innerHTML = '<p class="text-danger text-center">' + translations['Erreur lors du chargement des données :'] + ' ' + error.message + '</p>';
+      });
+  }
+  
+  // Événements
+  updateBtn.addEventListener('click', updateDashboard);
+  
+  // Charger les données au chargement de la page
+  updateDashboard();
+  
+  // Gestion des tooltips de compteurs
+  const counterBadges = document.querySelectorAll('.btn-counter-badge');
+  
+  counterBadges.forEach(function(badge) {
+    const machineId = badge.getAttribute('data-machine-id');
+    const tooltip = document.getElementById('counter-tooltip-' + machineId);
+    
+    if (!tooltip) return;
+    
+    // Détecter si on est sur mobile
+    const isMobile = window.matchMedia('(max-width: 768px)').matches;
+    
+    if (isMobile) {
+      // Sur mobile : afficher au clic
+      let isOpen = false;
+      badge.addEventListener('click', function(e) {
+        e.stopPropagation();
+        if (isOpen) {
+          tooltip.style.display = 'none';
+          isOpen = false;
+        } else {
+          // Fermer tous les autres tooltips
+          document.querySelectorAll('.counter-tooltip').forEach(function(t) {
+            t.style.display = 'none';
+          });
+          tooltip.style.display = 'block';
+          isOpen = true;
+        }
+      });
+      
+      // Fermer au clic ailleurs
+      document.addEventListener('click', function(e) {
+        if (!badge.contains(e.target) && !tooltip.contains(e.target)) {
+          tooltip.style.display = 'none';
+          isOpen = false;
+        }
+      });
+    } else {
+      // Sur desktop : afficher au survol
+      badge.addEventListener('mouseenter', function() {
+        const rect = badge.getBoundingClientRect();
+        tooltip.style.display = 'block';
+        tooltip.style.bottom = (window.innerHeight - rect.top + 8) + 'px';
+        tooltip.style.left = (rect.left + rect.width / 2) + 'px';
+        tooltip.style.transform = 'translateX(-50%)';
+      });
+      
+      badge.addEventListener('mouseleave', function() {
+        tooltip.style.display = 'none';
+      });
+      
+      // Garder le tooltip ouvert si on survole le tooltip lui-même
+      tooltip.addEventListener('mouseenter', function() {
+        tooltip.style.display = 'block';
+      });
+      
+      tooltip.addEventListener('mouseleave', function() {
+        tooltip.style.display = 'none';
+      });
+    }
+  });
+});
@@ -0,0 +1,287 @@
+"""
+Canal de diffusion du chat (Server-Sent Events, long-polling en repli)
+
+Les écritures du chat ajoutent une ligne dans la table chat_event (voir
+publish_chat_event) dans la même transaction que le message. Dans chaque worker,
+un unique thread relais lit les nouvelles lignes de cette table et réveille les
+connexions ouvertes : le coût en base est d'une requête par intervalle et par
+worker, quel que soit le nombre d'onglets connectés, et nul lorsqu'aucun client
+n'est connecté. Les clients gardent un curseur (id du dernier événement reçu) et
+reprennent à partir de celui-ci après une reconnexion ; le relais n'avance qu'à
+travers une suite d'ids sans trou (committed_chat_events), pour ne pas sauter un
+événement validé après un autre d'id supérieur.
+
+Chaque connexion occupe un thread du worker pendant son attente : le serveur doit
+tourner avec des workers à threads (gunicorn --worker-class gthread --threads N).
+"""
+import datetime as dt
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from flask import Response, jsonify, request
+from flask_login import current_user, login_required
+
+from app import app, db
+from app import (
+    ChatMessage, chat_message_query, chat_message_to_dict, chat_unread_state, committed_chat_events,
+    invalidate_chat_unread,
+)
+
+# Intervalle entre deux lectures de chat_event par le thread relais
+CHAT_POLL_INTERVAL = float(os.environ.get("CHAT_POLL_INTERVAL_SECONDS", "1"))
+# Nombre d'événements gardés en mémoire pour rejouer les reconnexions
+CHAT_EVENT_BUFFER = 500
+# Commentaire SSE envoyé périodiquement pour garder la connexion ouverte derrière un proxy
+CHAT_STREAM_HEARTBEAT = 20
+# Durée de vie d'un flux : le navigateur se reconnecte ensuite avec Last-Event-ID
+CHAT_STREAM_MAX_AGE = int(os.environ.get("CHAT_STREAM_MAX_AGE_SECONDS", "300"))
+# Délai sans client après lequel le relais cesse de suivre le journal (resynchronisation ensuite)
+CHAT_IDLE_GRACE = 60
+# Nombre maximal de connexions en attente par worker (au-delà : 503, le client réessaie plus tard)
+CHAT_STREAM_MAX_CLIENTS = int(os.environ.get("CHAT_STREAM_MAX_CLIENTS", "24"))
+# Attente maximale d'une requête de long-polling
+CHAT_LONGPOLL_TIMEOUT = 25
+
+
+class ChatEventBus:
+    """Relais des événements du chat pour toutes les connexions d'un worker"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._events = deque(maxlen=CHAT_EVENT_BUFFER)
+        self._last_id = None
+        # Curseurs inférieurs à ce plancher : événements plus disponibles en mémoire
+        self._floor = None
+        self._subscribers = 0
+        self._thread = None
+
+    def subscribe(self):
+        """Enregistre une connexion ; retourne le curseur courant, ou None si le worker est saturé"""
+        with self._cond:
+            if self._subscribers >= CHAT_STREAM_MAX_CLIENTS:
+                return None
+            self._subscribers += 1
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+            self._cond.wait_for(lambda: self._last_id is not None, timeout=5)
+            return self._last_id or 0
+
+    def unsubscribe(self):
+        with self._cond:
+            self._subscribers -= 1
+
+    def cursor(self):
+        with self._cond:
+            return self._last_id or 0
+
+    def wait(self, cursor, timeout):
+        """Attend des événements postérieurs au curseur.
+
+        Retourne la liste des événements (vide après le délai), ou None si le curseur
+        est trop ancien pour être rejoué et que le client doit tout recharger.
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: self._last_id is not None and self._last_id > cursor, timeout)
+            if self._last_id is None or self._last_id <= cursor:
+                return []
+            if cursor < self._floor:
+                return None
+            return [event for event in self._events if event["id"] > cursor]
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._subscribers == 0:
+                    # Aucun client connecté : le thread dort sans interroger la base
+                    if not self._cond.wait_for(lambda: self._subscribers > 0, timeout=CHAT_IDLE_GRACE):
+                        self._last_id = None
+                        self._events.clear()
+                        self._cond.wait_for(lambda: self._subscribers > 0)
+            try:
+                with app.app_context():
+                    self._poll()
+            except Exception as exc:
+                print(f"Erreur dans le relais du chat: {exc}")
+            time.sleep(CHAT_POLL_INTERVAL)
+
+    def _poll(self):
+        if self._last_id is None:
+            # Premier démarrage ou reprise après une longue période sans client :
+            # on repart de la fin du journal, les curseurs plus anciens seront rechargés
+            _, last_id = committed_chat_events()
+            with self._cond:
+                self._last_id = self._floor = last_id
+                self._cond.notify_all()
+            return
+
+        # Les événements qui suivent un id pas encore validé attendent le tour suivant
+        rows, last_id = committed_chat_events(self._last_id, limit=CHAT_EVENT_BUFFER)
+        if not rows:
+            return
+
+        # Compteurs de non-lus mis en cache par ce worker : invalider selon les écritures observées
+        for row in rows:
+            if row.kind == "created":
+                invalidate_chat_unread()
+                break
+            if row.kind == "read":
+                invalidate_chat_unread(row.user_id)
+
+        message_ids = {row.message_id for row in rows if row.kind in ("created", "edited") and row.message_id}
+        payloads = {}
+        if message_ids:
+            messages = chat_message_query().filter(ChatMessage.id.in_(message_ids)).all()
+            payloads = {msg.id: chat_message_to_dict(msg) for msg in messages}
+
+        events = []
+        for row in rows:
+            event = {
+                "id": row.id,
+                "kind": row.kind,
+                "message_id": row.message_id,
+                "user_id": row.user_id,
+                "created_at": row.created_at,
+                "message": payloads.get(row.message_id) if row.kind in ("created", "edited") else None,
+            }
+            if event["kind"] in ("created", "edited") and event["message"] is None:
+                continue  # Message purgé entre-temps
+            events.append(event)
+
+        with self._cond:
+            for event in events:
+                if len(self._events) == self._events.maxlen:
+                    self._floor = self._events[0]["id"]
+                self._events.append(event)
+            self._last_id = last_id
+            self._cond.notify_all()
+
+
+chat_event_bus = ChatEventBus()
+
+
+class ChatSubscriber:
+    """État d'une connexion : filtre les événements et tient à jour les compteurs de non-lus"""
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.counted_at = dt.datetime.utcnow()
+        self.counts, self.last_read_at = chat_unread_state(user_id)
+
+    def translate(self, event):
+        """Convertit un événement du relais en (nom, données) à envoyer au client"""
+        kind = event["kind"]
+        out = []
+        if kind in ("created", "edited"):
+            message = event["message"]
+            is_own = message["user_id"] == self.user_id if message["user_id"] else False
+            out.append(("message", dict(message, is_own=is_own)))
+            created_at = dt.datetime.fromisoformat(message["created_at"])
+            # Les messages antérieurs à la connexion sont déjà inclus dans les compteurs initiaux
+            if kind == "created" and created_at > self.last_read_at and created_at >= self.counted_at:
+                self.counts[f"{message['type']}_count"] += 1
+                out.append(("unread", dict(self.counts)))
+        elif kind == "deleted":
+            out.append(("deleted", {"id": event["message_id"]}))
+        elif kind == "report":
+            out.append(("report", {"id": event["message_id"]}))
+        elif kind == "read" and event["user_id"] == self.user_id:
+            self.last_read_at = max(self.last_read_at, event["created_at"])
+            self.counts = {"manual_count": 0, "auto_count": 0}
+            out.append(("unread", dict(self.counts)))
+        return out
+
+
+def _request_cursor():
+    """Curseur transmis par le navigateur (reconnexion SSE) ou en paramètre"""
+    value = request.headers.get("Last-Event-ID") or request.args.get("cursor")
+    try:
+        return int(value) if value not in (None, "") else None
+    except ValueError:
+        return None
+
+
+def _sse(name, data, event_id=None):
+    lines = []
+    if event_id is not None:
+        lines.append(f"id: {event_id}")
+    lines.append(f"event: {name}")
+    lines.append(f"data: {json.dumps(data)}")
+    return "\n".join(lines) + "\n\n"
+
+
+@app.route("/chat/stream")
+@login_required
+def chat_stream():
+    """Flux SSE des messages, modifications, suppressions et compteurs de non-lus"""
+    cursor = _request_cursor()
+    current = chat_event_bus.subscribe()
+    if current is None:
+        return Response("Trop de connexions", status=503, headers={"Retry-After": "30"})
+    try:
+        subscriber = ChatSubscriber(current_user.id)
+    except Exception:
+        chat_event_bus.unsubscribe()
+        raise
+    # Rendre la connexion à la base avant l'attente : un client inactif ne la garde pas
+    db.session.remove()
+
+    def generate():
+        nonlocal cursor
+        try:
+            yield "retry: 5000\n\n"
+            if cursor is None or cursor > current:
+                cursor = current
+                yield _sse("ready", {"cursor": cursor}, cursor)
+            yield _sse("unread", subscriber.counts)
+            deadline = time.monotonic() + CHAT_STREAM_MAX_AGE
+            while time.monotonic() < deadline:
+                events = chat_event_bus.wait(cursor, CHAT_STREAM_HEARTBEAT)
+                if events is None:
+                    # Curseur trop ancien : le client recharge tout et repart du curseur courant
+                    cursor = chat_event_bus.cursor()
+                    yield _sse("reset", {"cursor": cursor}, cursor)
+                    continue
+                if not events:
+                    yield ": ping\n\n"
+                    continue
+                for event in events:
+                    cursor = event["id"]
+                    for name, data in subscriber.translate(event):
+                        yield _sse(name, data, cursor)
+        finally:
+            chat_event_bus.unsubscribe()
+
+    return Response(generate(), mimetype="text/event-stream", headers={
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no",
+    })
+
+
+@app.route("/chat/events")
+@login_required
+def chat_events():
+    """Repli en long-polling : attend les événements postérieurs à ?cursor="""
+    cursor = _request_cursor()
+    current = chat_event_bus.subscribe()
+    if current is None:
+        return jsonify({"success": False, "error": "Trop de connexions"}), 503
+    try:
+        subscriber = ChatSubscriber(current_user.id)
+        db.session.remove()
+        out = [{"event": "unread", "data": dict(subscriber.counts)}]
+        if cursor is None or cursor > current:
+            return jsonify({"success": True, "cursor": current, "events": out})
+        events = chat_event_bus.wait(cursor, CHAT_LONGPOLL_TIMEOUT)
+        if events is None:
+            return jsonify({"success": True, "cursor": chat_event_bus.cursor(), "reset": True, "events": out})
+        for event in events:
+            cursor = event["id"]
+            out.extend({"event": name, "data": data} for name, data in subscriber.translate(event))
+        return jsonify({"success": True, "cursor": cursor, "events": out})
+    finally:
+        chat_event_bus.unsubscribe()
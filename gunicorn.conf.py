@@ -0,0 +1,78 @@
+"""
+Configuration gunicorn (lue automatiquement depuis le répertoire courant)
+
+L'application est chargée une seule fois dans le processus maître (preload) : les
+workers la reçoivent par fork et partagent ses pages de code en copie à l'écriture,
+ils démarrent donc sans réimporter app.py. Après le fork, chaque worker abandonne
+les connexions héritées du maître et le planificateur des tâches périodiques n'est
+démarré que dans un seul worker, remplacé par le suivant s'il s'arrête.
+
+Variables d'environnement :
+    WEB_CONCURRENCY     nombre de workers (par défaut : processeurs disponibles + 1)
+    GUNICORN_THREADS    threads par worker (par défaut 32 ; le flux du chat garde un
+                        thread par onglet ouvert). Lu aussi par app.py : le pool de
+                        connexions PostgreSQL de chaque worker est dimensionné d'après
+    GUNICORN_MAX_REQUESTS
+                        recycler chaque worker après ce nombre de requêtes (par défaut 0 :
+                        jamais ; un recyclage interrompt les tâches en arrière-plan du worker)
+    PORT                port d'écoute (fourni par Render)
+"""
+import os
+
+wsgi_app = "app:create_app()"
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+preload_app = True
+
+worker_class = "gthread"
+
+
+def _available_cpus():
+    try:
+        # Processeurs réellement attribués au conteneur, pas ceux de l'hôte
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+workers = int(os.environ.get("WEB_CONCURRENCY", _available_cpus() + 1))
+threads = int(os.environ.get("GUNICORN_THREADS", "32"))
+
+# Recyclage périodique des workers (fuites mémoire des bibliothèques d'export), sur demande :
+# les exports et imports en cours dans le worker (jobs.py) s'arrêtent avec lui ;
+# la gigue évite que les workers redémarrent tous en même temps
+max_requests = int(os.environ.get("GUNICORN_MAX_REQUESTS", "0"))
+max_requests_jitter = max_requests // 10
+
+
+def pre_fork(server, worker):
+    # Désigner le worker qui exécutera le planificateur : le premier lancé, puis le
+    # remplaçant du worker désigné lorsqu'il s'arrête
+    current = getattr(server, "scheduler_worker", None)
+    if current is None or current not in server.WORKERS.values():
+        server.scheduler_worker = worker
+    worker.run_scheduler = server.scheduler_worker is worker
+
+
+def post_fork(server, worker):
+    from app import reset_after_fork
+
+    reset_after_fork()
+    if worker.run_scheduler:
+        import scheduler
+
+        scheduler.start_scheduler()
+        server.log.info("Planificateur démarré dans le worker %s", worker.pid)
+
+
+def worker_exit(server, worker):
+    from jobs import drain_jobs
+
+    # Laisser finir les tâches en cours dans le délai accordé au worker (il ne signale plus
+    # sa présence à l'arbitre), puis marquer les autres comme interrompues au lieu
+    # d'attendre JOB_STALE_AFTER
+    drain_jobs(timeout=max(min(server.cfg.graceful_timeout, server.cfg.timeout) - 5, 0))
+
+
+def child_exit(server, worker):
+    if getattr(server, "scheduler_worker", None) is worker:
+        server.scheduler_worker = None
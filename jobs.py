@@ -0,0 +1,483 @@
+"""
+Tâches en arrière-plan (exports, imports, génération de PDF)
+
+Les traitements longs sont exécutés dans un pool de threads du worker au lieu de
+bloquer la requête HTTP. Chaque tâche est persistée dans la table background_job :
+le navigateur interroge son avancement, peut l'annuler et télécharger le résultat,
+qui est enregistré dans uploads/excel_files et listé dans la page "Base de données".
+"""
+import datetime as dt
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import flash, jsonify, redirect, render_template, request, send_from_directory, url_for, abort
+from flask_login import current_user, login_required
+from werkzeug.utils import secure_filename
+
+from app import app, db
+from app import (
+    BackgroundJob, ExcelFile, PreventiveReport, Stock, User,
+    EXCEL_FILES_FOLDER, JOB_FILES_FOLDER, XLSX_MIMETYPE,
+    build_maintenances_excel, build_modeles_excel, build_machines_excel, build_releves_excel,
+    build_produits_excel, build_mouvements_excel, build_inventaires_excel, build_all_json,
+    build_maintenance_pdf, run_products_import, build_products_import_report,
+    run_inventory_import, build_inventory_import_report, summarize_import_result,
+)
+
+# Nombre de tâches exécutées simultanément par worker
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+# Une tâche sans signe de vie depuis ce délai est considérée comme interrompue (redémarrage du worker)
+JOB_STALE_AFTER = dt.timedelta(seconds=int(os.environ.get("JOB_STALE_AFTER_SECONDS", "900")))
+# Intervalle minimal entre deux écritures de l'avancement en base
+PROGRESS_WRITE_INTERVAL = 1.0
+
+JOB_HANDLERS = {}
+
+_executor = None
+_executor_lock = threading.Lock()
+# Tâches confiées au pool de ce processus et pas encore terminées
+_active_jobs = set()
+_active_jobs_cond = threading.Condition()
+
+
+class JobCancelled(Exception):
+    """Levée dans un handler lorsque l'utilisateur a demandé l'annulation"""
+
+
+class JobHandler:
+    def __init__(self, job_type, label, func, permission=None):
+        self.job_type = job_type
+        self.label = label
+        self.func = func
+        # Fonction de permission pour la soumission via /jobs/submit ; None = soumission interne uniquement
+        self.permission = permission
+
+
+def job_handler(job_type, label, permission=None):
+    """Enregistre une fonction comme handler de tâche en arrière-plan"""
+    def decorator(func):
+        JOB_HANDLERS[job_type] = JobHandler(job_type, label, func, permission)
+        return func
+    return decorator
+
+
+class JobContext:
+    """Interface donnée aux handlers : avancement, annulation et stockage du résultat"""
+
+    def __init__(self, job):
+        self.job_id = job.id
+        self.user_id = job.user_id
+        self.label = job.label
+        self.params = json.loads(job.params) if job.params else {}
+        self.input_filename = job.input_filename
+        self.message = None
+        self.excel_file_id = None
+        # Conserver le fichier source après exécution (simulation pouvant être confirmée)
+        self.keep_input = False
+        self._last_percent = -1
+        self._last_write = 0.0
+
+    def read_input(self):
+        """Retourne le contenu du fichier source envoyé lors de la soumission"""
+        if not self.input_filename:
+            return None
+        return (JOB_FILES_FOLDER / self.input_filename).read_bytes()
+
+    def progress(self, done, total):
+        """Met à jour le pourcentage d'avancement et vérifie une demande d'annulation.
+
+        L'écriture passe par une connexion dédiée pour ne pas valider la transaction
+        en cours du handler ; elle est limitée à une par seconde. Tant que cette
+        transaction a commencé à écrire (SQLite : verrou d'écriture détenu), l'avancement
+        est seulement gardé en mémoire et enregistré au premier appel qui suit son commit.
+        """
+        percent = min(99, int(done * 100 / total)) if total else 0
+        now = time.monotonic()
+        if percent == self._last_percent or now - self._last_write < PROGRESS_WRITE_INTERVAL:
+            return
+        if _session_holds_write_lock():
+            return
+        self._last_percent = percent
+        self._last_write = now
+        cancel_requested = False
+        try:
+            with db.engine.begin() as conn:
+                table = BackgroundJob.__table__
+                conn.execute(
+                    table.update()
+                    .where(table.c.id == self.job_id)
+                    .values(progress=percent, updated_at=dt.datetime.utcnow())
+                )
+                cancel_requested = bool(conn.execute(
+                    db.select(table.c.cancel_requested).where(table.c.id == self.job_id)
+                ).scalar())
+        except Exception as exc:
+            print(f"Avancement de la tâche {self.job_id} non enregistré: {exc}")
+        if cancel_requested:
+            raise JobCancelled()
+
+    def save_result(self, content, filename, name=None):
+        """Enregistre le fichier produit dans uploads/excel_files et le référence dans ExcelFile"""
+        timestamp = dt.datetime.now().strftime("%Y%m%d_%H%M%S")
+        unique_filename = f"{timestamp}_job{self.job_id}_{secure_filename(filename)}"
+        (EXCEL_FILES_FOLDER / unique_filename).write_bytes(content)
+        excel_file = ExcelFile(
+            name=name or f"{self.label} ({dt.datetime.now().strftime('%d/%m/%Y %H:%M')})",
+            filename=unique_filename,
+            original_filename=filename,
+            user_id=self.user_id,
+        )
+        db.session.add(excel_file)
+        db.session.flush()
+        self.excel_file_id = excel_file.id
+        return excel_file
+
+
+def _session_holds_write_lock():
+    """True si la transaction de db.session a écrit dans une base SQLite.
+
+    Une seconde connexion attendrait alors busy_timeout puis échouerait ("database is
+    locked") ; PostgreSQL verrouille par ligne et n'est pas concerné.
+    """
+    session = db.session()
+    if not session.in_transaction():
+        return False
+    dbapi_connection = session.connection().connection.dbapi_connection
+    # pysqlite n'ouvre la transaction qu'à la première écriture
+    return isinstance(dbapi_connection, sqlite3.Connection) and dbapi_connection.in_transaction
+
+
+def _get_executor():
+    """Crée le pool de threads à la première utilisation (jamais avant un fork du serveur)"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="gmao-job")
+        return _executor
+
+
+def _enqueue(job_id):
+    with _active_jobs_cond:
+        _active_jobs.add(job_id)
+    _get_executor().submit(_run_job, job_id)
+
+
+def drain_jobs(timeout):
+    """Arrêt du worker : attend au plus timeout secondes les tâches en cours, puis marque
+    comme interrompues celles qui ne sont pas terminées (en attente ou en cours)"""
+    if _executor is not None:
+        # Les tâches pas encore démarrées ne le seront plus
+        _executor.shutdown(wait=False, cancel_futures=True)
+    with _active_jobs_cond:
+        _active_jobs_cond.wait_for(lambda: not _active_jobs, timeout)
+        unfinished = list(_active_jobs)
+    if not unfinished:
+        return
+    with app.app_context():
+        now = dt.datetime.utcnow()
+        db.session.execute(
+            db.update(BackgroundJob)
+            .where(BackgroundJob.id.in_(unfinished), BackgroundJob.status.in_(("pending", "running")))
+            .values(status="failed", message="Tâche interrompue (arrêt du worker)", finished_at=now, updated_at=now)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+    print(f"{len(unfinished)} tâche(s) interrompue(s) par l'arrêt du worker")
+
+
+def submit_job(job_type, user_id, params=None, input_content=None, input_filename=None, label=None):
+    """Persiste une tâche et la confie au pool de threads"""
+    handler = JOB_HANDLERS[job_type]
+    stored_input = None
+    if input_content is not None:
+        stored_input = f"{uuid.uuid4().hex}_{secure_filename(input_filename or 'input')}"
+        (JOB_FILES_FOLDER / stored_input).write_bytes(input_content)
+
+    job = BackgroundJob(
+        job_type=job_type,
+        label=label or handler.label,
+        status="pending",
+        params=json.dumps(params) if params else None,
+        input_filename=stored_input,
+        user_id=user_id,
+    )
+    db.session.add(job)
+    db.session.commit()
+    _enqueue(job.id)
+    return job
+
+
+def _finish_job(job_id, status, message=None, excel_file_id=None):
+    job = db.session.get(BackgroundJob, job_id)
+    job.status = status
+    job.finished_at = dt.datetime.utcnow()
+    job.updated_at = job.finished_at
+    if status == "done":
+        job.progress = 100
+    if message is not None:
+        job.message = message
+    if excel_file_id is not None:
+        job.excel_file_id = excel_file_id
+    db.session.commit()
+    return job
+
+
+def _run_job(job_id):
+    """Point d'entrée exécuté dans le pool de threads"""
+    try:
+        _execute_job(job_id)
+    finally:
+        with _active_jobs_cond:
+            _active_jobs.discard(job_id)
+            _active_jobs_cond.notify_all()
+
+
+def _execute_job(job_id):
+    # Un contexte de requête factice permet aux handlers d'utiliser url_for (liens des messages de chat)
+    with app.test_request_context():
+        job = db.session.get(BackgroundJob, job_id)
+        if job is None:
+            return
+        if job.cancel_requested:
+            _finish_job(job_id, "cancelled", "Tâche annulée avant son démarrage")
+            return
+
+        job.status = "running"
+        job.started_at = dt.datetime.utcnow()
+        job.updated_at = job.started_at
+        db.session.commit()
+
+        handler = JOB_HANDLERS.get(job.job_type)
+        context = JobContext(job)
+        try:
+            if handler is None:
+                raise ValueError(f"Type de tâche inconnu: {job.job_type}")
+            handler.func(context)
+            _finish_job(job_id, "done", context.message, context.excel_file_id)
+        except JobCancelled:
+            db.session.rollback()
+            _finish_job(job_id, "cancelled", "Tâche annulée par l'utilisateur")
+        except Exception as exc:
+            db.session.rollback()
+            print(f"Erreur dans la tâche {job_id} ({job.job_type}): {exc}")
+            _finish_job(job_id, "failed", f"Erreur: {exc}")
+        finally:
+            if context.input_filename and not context.keep_input:
+                try:
+                    (JOB_FILES_FOLDER / context.input_filename).unlink()
+                except OSError:
+                    pass
+
+
+def _mark_if_stale(job):
+    """Marque comme échouée une tâche dont le worker a disparu (redémarrage, crash)"""
+    if job.is_finished():
+        return
+    if job.updated_at and dt.datetime.utcnow() - job.updated_at > JOB_STALE_AFTER:
+        job.status = "failed"
+        job.message = "Tâche interrompue (redémarrage du serveur)"
+        job.finished_at = dt.datetime.utcnow()
+        db.session.commit()
+
+
+def _get_job_for_current_user(job_id):
+    job = BackgroundJob.query.get_or_404(job_id)
+    if job.user_id != current_user.id and not current_user.is_admin:
+        abort(403)
+    return job
+
+
+def job_to_dict(job):
+    return {
+        "id": job.id,
+        "type": job.job_type,
+        "label": job.label,
+        "status": job.status,
+        "progress": job.progress,
+        "message": job.message,
+        "created_at": job.created_at.strftime("%d/%m/%Y %H:%M"),
+        "finished_at": job.finished_at.strftime("%d/%m/%Y %H:%M") if job.finished_at else None,
+        "download_url": url_for("job_download", job_id=job.id) if job.excel_file_id else None,
+        "can_confirm": can_confirm(job),
+    }
+
+
+def can_confirm(job):
+    """Une simulation d'import terminée peut être confirmée tant que son fichier source est conservé"""
+    params = json.loads(job.params) if job.params else {}
+    return (
+        job.status == "done"
+        and bool(params.get("dry_run"))
+        and bool(job.input_filename)
+        and (JOB_FILES_FOLDER / job.input_filename).exists()
+    )
+
+
+# ==================== HANDLERS ====================
+
+def _register_export(job_type, label, builder, mimetype=XLSX_MIMETYPE):
+    @job_handler(job_type, label, permission=lambda: current_user.can_view_params)
+    def handler(ctx):
+        content, filename = builder(progress=ctx.progress)
+        ctx.save_result(content, filename)
+        ctx.message = f"Fichier {filename} généré"
+    return handler
+
+
+_register_export("export_maintenances", "Export des maintenances", build_maintenances_excel)
+_register_export("export_modeles", "Export des modèles", build_modeles_excel)
+_register_export("export_machines", "Export de l'arborescence machines", build_machines_excel)
+_register_export("export_releves", "Export des relevés", build_releves_excel)
+_register_export("export_produits", "Export des produits", build_produits_excel)
+_register_export("export_mouvements", "Export des mouvements", build_mouvements_excel)
+_register_export("export_inventaires", "Export des inventaires", build_inventaires_excel)
+_register_export("export_all_json", "Export complet de la base (JSON)", build_all_json)
+
+
+@job_handler("maintenance_pdf", "Export PDF d'un modèle de maintenance",
+             permission=lambda: current_user.is_authenticated)
+def _maintenance_pdf_job(ctx):
+    report = db.session.get(PreventiveReport, int(ctx.params["report_id"]))
+    if report is None:
+        raise ValueError("Modèle de maintenance introuvable")
+    content, filename = build_maintenance_pdf(report, progress=ctx.progress)
+    ctx.save_result(content, filename, name=f"PDF {report.name}")
+    ctx.message = f"Fichier {filename} généré"
+
+
+@job_handler("import_products", "Import de produits")
+def _import_products_job(ctx):
+    dry_run = bool(ctx.params.get("dry_run"))
+    result = run_products_import(ctx.read_input(), progress=ctx.progress, dry_run=dry_run)
+    ctx.keep_input = dry_run
+    # Le rapport ligne par ligne (différences avant/après) est téléchargeable depuis la tâche
+    content, filename = build_products_import_report(result)
+    ctx.save_result(content, filename)
+    summary = summarize_import_result(result, "produit(s) à créer" if dry_run else "produit(s) créé(s)")
+    ctx.message = f"Simulation (aucune modification enregistrée) : {summary}" if dry_run else summary
+
+
+@job_handler("import_inventory", "Import d'inventaire")
+def _import_inventory_job(ctx):
+    stock = db.session.get(Stock, int(ctx.params["stock_id"]))
+    user = db.session.get(User, ctx.user_id)
+    if stock is None:
+        raise ValueError("Stock introuvable")
+    dry_run = bool(ctx.params.get("dry_run"))
+    result = run_inventory_import(stock, user, ctx.read_input(), progress=ctx.progress, dry_run=dry_run)
+    ctx.keep_input = dry_run
+    content, filename = build_inventory_import_report(result)
+    ctx.save_result(content, filename)
+    summary = summarize_import_result(result, "nouveau(x) produit(s)")
+    if dry_run:
+        ctx.message = f"Prévisualisation : {result['changed']} quantité(s) modifiée(s). {summary}"
+    elif result["inventory_id"] is None:
+        ctx.message = "Aucune modification de quantité détectée"
+    else:
+        ctx.message = f"Inventaire créé : {result['changed']} quantité(s) modifiée(s). {summary}"
+
+
+# ==================== ROUTES ====================
+
+@app.route("/jobs")
+@login_required
+def jobs_list():
+    """Liste des tâches en arrière-plan de l'utilisateur (toutes pour un administrateur)"""
+    query = BackgroundJob.query
+    if not current_user.is_admin:
+        query = query.filter_by(user_id=current_user.id)
+    job_rows = query.order_by(BackgroundJob.created_at.desc()).limit(50).all()
+    for job in job_rows:
+        _mark_if_stale(job)
+    return render_template("jobs.html", jobs=job_rows, can_confirm=can_confirm)
+
+
+@app.route("/jobs/submit/<job_type>", methods=["POST"])
+@login_required
+def job_submit(job_type):
+    """Lance une tâche enregistrée (exports de la page Base de données, PDF)"""
+    handler = JOB_HANDLERS.get(job_type)
+    if handler is None:
+        abort(404)
+    if handler.permission is None or not handler.permission():
+        flash("Accès refusé : vous n'avez pas les droits pour lancer cette tâche.", "danger")
+        return redirect(url_for("index"))
+    params = {key: value for key, value in request.form.items() if key != "next"}
+    job = submit_job(job_type, user_id=current_user.id, params=params)
+    flash(f"Tâche #{job.id} lancée : {job.label}", "info")
+    next_url = request.form.get("next", "")
+    if not next_url.startswith("/") or next_url.startswith("//"):
+        next_url = url_for("jobs_list")
+    return redirect(next_url)
+
+
+@app.route("/jobs/<int:job_id>/status")
+@login_required
+def job_status(job_id):
+    """Avancement d'une tâche (interrogé périodiquement par la page des tâches)"""
+    job = _get_job_for_current_user(job_id)
+    _mark_if_stale(job)
+    return jsonify(job_to_dict(job))
+
+
+@app.route("/jobs/<int:job_id>/cancel", methods=["POST"])
+@login_required
+def job_cancel(job_id):
+    """Demande l'annulation d'une tâche ; le handler s'arrête au prochain point d'avancement"""
+    job = _get_job_for_current_user(job_id)
+    if not job.is_finished():
+        job.cancel_requested = True
+        db.session.commit()
+    if request.is_json:
+        return jsonify(job_to_dict(job))
+    flash(f"Annulation de la tâche #{job.id} demandée", "info")
+    return redirect(url_for("jobs_list"))
+
+
+@app.route("/jobs/<int:job_id>/confirm", methods=["POST"])
+@login_required
+def job_confirm(job_id):
+    """Lance l'import réel à partir du fichier d'une simulation (prévisualisation validée)"""
+    preview = _get_job_for_current_user(job_id)
+    if not can_confirm(preview):
+        flash("Cette prévisualisation ne peut plus être confirmée, veuillez relancer l'import.", "danger")
+        return redirect(url_for("jobs_list"))
+    params = json.loads(preview.params)
+    params["dry_run"] = False
+    job = BackgroundJob(
+        job_type=preview.job_type,
+        label=JOB_HANDLERS[preview.job_type].label,
+        status="pending",
+        params=json.dumps(params),
+        input_filename=preview.input_filename,
+        user_id=current_user.id,
+    )
+    # Le fichier source est transféré à la nouvelle tâche
+    preview.input_filename = None
+    db.session.add(job)
+    db.session.commit()
+    _enqueue(job.id)
+    flash(f"Import confirmé (tâche #{job.id})", "info")
+    return redirect(url_for("jobs_list"))
+
+
+@app.route("/jobs/<int:job_id>/download")
+@login_required
+def job_download(job_id):
+    """Télécharge le fichier produit par une tâche terminée"""
+    job = _get_job_for_current_user(job_id)
+    excel_file = job.excel_file
+    if job.status != "done" or excel_file is None or not (EXCEL_FILES_FOLDER / excel_file.filename).exists():
+        flash("Fichier introuvable", "danger")
+        return redirect(url_for("jobs_list"))
+    return send_from_directory(
+        str(EXCEL_FILES_FOLDER),
+        excel_file.filename,
+        as_attachment=True,
+        download_name=excel_file.original_filename
+    )
@@ -0,0 +1,520 @@
+"""
+Migrations versionnées du schéma de la base de données
+
+Les étapes sont numérotées et appliquées dans l'ordre ; chaque étape appliquée est
+enregistrée dans la table schema_version et n'est plus jamais rejouée. Les tables
+nouvelles sont créées par db.create_all() au début de chaque exécution ; les
+étapes ne portent que sur ce que create_all ne sait pas faire (colonnes ajoutées
+à une table existante, reprises de données, reconstruction de table).
+
+Les migrations sont exécutées une seule fois, avant le démarrage des workers :
+
+    flask --app app migrate            # applique les étapes en attente
+    flask --app app migrate --status   # liste les étapes et leur état
+
+Les premières étapes reprennent les vérifications qui étaient faites à chaque
+import de app.py ; elles inspectent le schéma et peuvent donc s'appliquer à une
+base dans n'importe quel état antérieur. Une nouvelle étape s'ajoute à la fin
+avec le numéro suivant et n'a pas besoin d'être idempotente.
+"""
+import bisect
+import datetime as dt
+
+import click
+from sqlalchemy import Column, DateTime, ForeignKey, Integer, MetaData, Table, UniqueConstraint, inspect, text
+
+from app import app, db
+from app import (
+    CorrectiveMaintenance, Machine, MaintenanceEntry, MaintenanceProgress, Movement, PreventiveComponent,
+    PreventiveReport, SchemaVersion, User, migrate_report_photo_blobs,
+)
+
+MIGRATIONS = []
+
+
+class Migration:
+    def __init__(self, version, description, func):
+        self.version = version
+        self.description = description
+        self.func = func
+
+
+def migration(version, description):
+    """Enregistre une étape de migration ; les numéros doivent être croissants"""
+    def decorator(func):
+        if MIGRATIONS and version <= MIGRATIONS[-1].version:
+            raise ValueError(f"Migration {version} déclarée après la migration {MIGRATIONS[-1].version}")
+        MIGRATIONS.append(Migration(version, description, func))
+        return func
+    return decorator
+
+
+# ==================== OUTILS ====================
+
+def _is_postgresql():
+    return db.engine.dialect.name == "postgresql"
+
+
+def _datetime_type():
+    return "TIMESTAMP" if _is_postgresql() else "DATETIME"
+
+
+def _columns(table):
+    """Colonnes existantes d'une table, ou None si la table n'existe pas"""
+    inspector = inspect(db.session.connection())
+    if table not in inspector.get_table_names():
+        return None
+    return {col["name"] for col in inspector.get_columns(table)}
+
+
+def _add_columns(table, columns):
+    """Ajoute les colonnes absentes d'une table ({nom: définition SQL}) ; retourne les colonnes ajoutées"""
+    existing = _columns(table)
+    if existing is None:
+        return []
+    added = []
+    for name, definition in columns.items():
+        if name not in existing:
+            db.session.execute(text(f"ALTER TABLE {table} ADD COLUMN {name} {definition}"))
+            added.append(name)
+    if added:
+        print(f"  {table} : colonne(s) {', '.join(added)} ajoutée(s)")
+    return added
+
+
+def _create_indexes(table, *indexes):
+    """Crée les index absents ; chaque index est un tuple (nom, colonnes)"""
+    if _columns(table) is None:
+        return
+    for name, columns in indexes:
+        db.session.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table}({columns})"))
+
+
+# ==================== ÉTAPES ====================
+
+@migration(1, "Colonnes ajoutées aux tables d'origine")
+def add_legacy_columns():
+    datetime_type = _datetime_type()
+    _add_columns("maintenance_entry", {
+        "stock_id": "INTEGER",
+        "performed_hours": "FLOAT DEFAULT 0",
+        "user_id": "INTEGER",
+        "hours_before_maintenance": "FLOAT",
+        "triggered_counter_id": "INTEGER",
+    })
+    _add_columns("corrective_maintenance", {"user_id": "INTEGER", "hours": "FLOAT DEFAULT 0"})
+    _add_columns("chat_message", {
+        "reply_to_id": "INTEGER",
+        "edited_at": datetime_type,
+        "deleted_at": datetime_type,
+    })
+    if "counter_unit" in _add_columns("machine", {"counter_unit": "VARCHAR(20)", "stock_id": "INTEGER"}):
+        # Machines existantes avec compteur horaire : unité "h" par défaut
+        db.session.execute(
+            db.update(Machine)
+            .where(Machine.hour_counter_enabled.is_(True), Machine.counter_unit.is_(None))
+            .values(counter_unit="h")
+        )
+    added = _add_columns("preventive_report", {
+        "counter_id": "INTEGER",
+        "trigger_type": "VARCHAR(20) DEFAULT 'counter'",
+        "calendar_start_date": "DATE",
+    })
+    if "trigger_type" in added:
+        db.session.execute(text("UPDATE preventive_report SET trigger_type = 'counter' WHERE trigger_type IS NULL"))
+    _add_columns("preventive_component", {"comment": "VARCHAR(500)"})
+    _add_columns("maintenance_progress", {"counter_id": "INTEGER"})
+    _add_columns("product", {
+        "supplier_name": "VARCHAR(120)",
+        "supplier_reference": "VARCHAR(120)",
+        "location_code": "VARCHAR(120)",
+        "minimum_stock": "FLOAT DEFAULT 0",
+    })
+    _add_columns("counter_log", {"counter_id": "INTEGER"})
+
+
+@migration(2, "Photos : contenu en base, empreinte et taille")
+def add_photo_columns():
+    added = _add_columns("report_photo", {
+        "photo_data": "BYTEA" if _is_postgresql() else "BLOB",
+        "content_type": "VARCHAR(50)",
+        "content_hash": "VARCHAR(64)",
+        "file_size": "INTEGER",
+    })
+    if added and _is_postgresql():
+        # Les photos en BLOB n'ont pas de chemin (SQLite ne sait pas modifier une colonne)
+        db.session.execute(text("ALTER TABLE report_photo ALTER COLUMN file_path DROP NOT NULL"))
+    _create_indexes("report_photo", ("ix_report_photo_content_hash", "content_hash"))
+    _add_columns("maintenance_photo", {"content_hash": "VARCHAR(64)"})
+    _create_indexes("maintenance_photo", ("ix_maintenance_photo_content_hash", "content_hash"))
+
+
+def backfill_movement_maintenance_links():
+    """Relie les anciens mouvements de sortie à leur maintenance (même stock, à 5 minutes près).
+
+    Reprise unique de l'ancienne recherche par fenêtre de temps : les maintenances de
+    chaque stock sont chargées une fois et triées, puis chaque mouvement est rapproché
+    par recherche dichotomique. Les nouveaux mouvements sont liés à leur création.
+    """
+    window = dt.timedelta(minutes=5)
+
+    def by_stock(model):
+        grouped = {}
+        rows = db.session.query(model.id, model.stock_id, model.created_at).filter(model.stock_id.isnot(None))
+        for row in rows.order_by(model.created_at):
+            grouped.setdefault(row.stock_id, ([], []))
+            grouped[row.stock_id][0].append(row.created_at)
+            grouped[row.stock_id][1].append(row.id)
+        return grouped
+
+    def find(grouped, stock_id, created_at):
+        dates, ids = grouped.get(stock_id, ([], []))
+        index = bisect.bisect_left(dates, created_at - window)
+        if index < len(dates) and dates[index] <= created_at + window:
+            return ids[index]
+        return None
+
+    preventive = by_stock(MaintenanceEntry)
+    corrective = by_stock(CorrectiveMaintenance)
+    updates = []
+    movements = db.session.query(Movement.id, Movement.source_stock_id, Movement.created_at).filter(
+        Movement.type == "sortie",
+        Movement.source_stock_id.isnot(None),
+        Movement.maintenance_entry_id.is_(None),
+        Movement.corrective_maintenance_id.is_(None),
+    )
+    for move in movements:
+        entry_id = find(preventive, move.source_stock_id, move.created_at)
+        if entry_id is not None:
+            updates.append({"id": move.id, "maintenance_entry_id": entry_id})
+            continue
+        corrective_id = find(corrective, move.source_stock_id, move.created_at)
+        if corrective_id is not None:
+            updates.append({"id": move.id, "corrective_maintenance_id": corrective_id})
+    # Une mise à jour groupée par colonne (les lignes d'un même lot doivent avoir les mêmes clés)
+    for column in ("maintenance_entry_id", "corrective_maintenance_id"):
+        batch = [update for update in updates if column in update]
+        if batch:
+            db.session.execute(db.update(Movement), batch)
+    return len(updates)
+
+
+@migration(3, "Liens des mouvements de sortie vers leur maintenance")
+def link_movements_to_maintenances():
+    added = _add_columns("movement", {
+        "maintenance_entry_id": "INTEGER REFERENCES maintenance_entry(id) ON DELETE SET NULL",
+        "corrective_maintenance_id": "INTEGER REFERENCES corrective_maintenance(id) ON DELETE SET NULL",
+    })
+    _create_indexes(
+        "movement",
+        ("ix_movement_maintenance_entry_id", "maintenance_entry_id"),
+        ("ix_movement_corrective_maintenance_id", "corrective_maintenance_id"),
+    )
+    if added:
+        linked = backfill_movement_maintenance_links()
+        print(f"  {linked} mouvement(s) relié(s) à leur maintenance")
+
+
+@migration(4, "checklist_instance_value : valeurs par ligne et colonne du modèle")
+def rebuild_checklist_instance_value():
+    _add_columns("checklist_instance_value", {
+        "instance_id": "INTEGER",
+        "template_row_id": "INTEGER",
+        "column_id": "INTEGER",
+        "value": "TEXT",
+    })
+    columns = _columns("checklist_instance_value")
+    if columns is None or "item_id" not in columns:
+        return
+    if _is_postgresql():
+        db.session.execute(text("ALTER TABLE checklist_instance_value DROP COLUMN item_id"))
+        return
+    # SQLite ne sait pas supprimer une colonne : recréer la table sans item_id
+    db.session.execute(text("""
+        CREATE TABLE checklist_instance_value_new (
+            id INTEGER PRIMARY KEY,
+            instance_id INTEGER NOT NULL,
+            template_row_id INTEGER NOT NULL,
+            column_id INTEGER NOT NULL,
+            value TEXT,
+            FOREIGN KEY (instance_id) REFERENCES checklist_instance(id),
+            FOREIGN KEY (template_row_id) REFERENCES checklist_template_row(id),
+            FOREIGN KEY (column_id) REFERENCES checklist_column(id)
+        )
+    """))
+    db.session.execute(text("""
+        INSERT INTO checklist_instance_value_new (id, instance_id, template_row_id, column_id, value)
+        SELECT id, instance_id, COALESCE(template_row_id, 0), COALESCE(column_id, 0), value
+        FROM checklist_instance_value
+    """))
+    db.session.execute(text("DROP TABLE checklist_instance_value"))
+    db.session.execute(text("ALTER TABLE checklist_instance_value_new RENAME TO checklist_instance_value"))
+    print("  checklist_instance_value recréée sans item_id")
+
+
+@migration(5, "Index des clés étrangères et des colonnes filtrées")
+def create_foreign_key_indexes():
+    # Les tables créées par create_all ont déjà ces index ; les bases plus anciennes non
+    _create_indexes("machine", ("ix_machine_parent_id", "parent_id"), ("ix_machine_stock_id", "stock_id"))
+    _create_indexes(
+        "followed_machine",
+        ("ix_followed_machine_user_id", "user_id"),
+        ("ix_followed_machine_machine_id", "machine_id"),
+    )
+    _create_indexes("counter", ("ix_counter_machine_id", "machine_id"))
+    _create_indexes(
+        "movement",
+        ("ix_movement_source_stock_id", "source_stock_id"),
+        ("ix_movement_dest_stock_id", "dest_stock_id"),
+        ("ix_movement_created_at", "created_at"),
+    )
+    _create_indexes(
+        "maintenance_entry",
+        ("ix_maintenance_entry_machine_id", "machine_id"),
+        ("ix_maintenance_entry_report_id", "report_id"),
+        ("ix_maintenance_entry_stock_id", "stock_id"),
+        ("ix_maintenance_entry_user_id", "user_id"),
+        ("ix_maintenance_entry_created_at", "created_at"),
+    )
+    _create_indexes(
+        "maintenance_progress",
+        ("ix_maintenance_progress_machine_id", "machine_id"),
+        ("ix_maintenance_progress_counter_id", "counter_id"),
+        ("ix_maintenance_progress_report_id", "report_id"),
+    )
+    _create_indexes(
+        "corrective_maintenance",
+        ("ix_corrective_maintenance_machine_id", "machine_id"),
+        ("ix_corrective_maintenance_stock_id", "stock_id"),
+        ("ix_corrective_maintenance_user_id", "user_id"),
+        ("ix_corrective_maintenance_created_at", "created_at"),
+    )
+    _create_indexes(
+        "counter_log",
+        ("ix_counter_log_machine_id", "machine_id"),
+        ("ix_counter_log_counter_id", "counter_id"),
+        ("ix_counter_log_created_at", "created_at"),
+    )
+    _create_indexes("checklist_template", ("ix_checklist_template_machine_id", "machine_id"))
+    _create_indexes("checklist_column", ("ix_checklist_column_template_id", "template_id"))
+    _create_indexes("checklist_template_row", ("ix_checklist_template_row_template_id", "template_id"))
+    _create_indexes(
+        "checklist_template_row_value",
+        ("ix_checklist_template_row_value_row_id", "row_id"),
+        ("ix_checklist_template_row_value_column_id", "column_id"),
+    )
+    _create_indexes(
+        "checklist_instance",
+        ("ix_checklist_instance_template_id", "template_id"),
+        ("ix_checklist_instance_machine_id", "machine_id"),
+        ("ix_checklist_instance_user_id", "user_id"),
+        ("ix_checklist_instance_created_at", "created_at"),
+    )
+    _create_indexes(
+        "checklist_instance_value",
+        ("ix_checklist_instance_value_instance_id", "instance_id"),
+        ("ix_checklist_instance_value_template_row_id", "template_row_id"),
+        ("ix_checklist_instance_value_column_id", "column_id"),
+    )
+    _create_indexes(
+        "preventive_report",
+        ("ix_preventive_report_machine_id", "machine_id"),
+        ("ix_preventive_report_counter_id", "counter_id"),
+    )
+    _create_indexes(
+        "preventive_report_counter",
+        ("ix_preventive_report_counter_report_id", "report_id"),
+        ("ix_preventive_report_counter_counter_id", "counter_id"),
+    )
+    _create_indexes(
+        "chat_message",
+        ("ix_chat_message_user_id", "user_id"),
+        ("ix_chat_message_message_type", "message_type"),
+        ("ix_chat_message_machine_id", "machine_id"),
+        ("ix_chat_message_reply_to_id", "reply_to_id"),
+        ("ix_chat_message_deleted_at", "deleted_at"),
+        ("ix_chat_message_created_at", "created_at"),
+        # Compteurs de messages non lus (type + date)
+        ("ix_chat_message_type_created_at", "message_type, created_at"),
+    )
+    _create_indexes(
+        "report",
+        ("ix_report_user_id", "user_id"),
+        ("ix_report_created_at", "created_at"),
+        ("ix_report_deleted_at", "deleted_at"),
+    )
+    _create_indexes(
+        "stock_product",
+        ("ix_stock_product_stock_id", "stock_id"),
+        ("ix_stock_product_product_id", "product_id"),
+    )
+
+
+@migration(6, "machine.color_index (ancien script migrate_add_color_index.py)")
+def add_machine_color_index():
+    if not _add_columns("machine", {"color_index": "INTEGER DEFAULT 0"}):
+        return
+    # Une couleur par machine racine (ordre alphabétique), héritée par ses sous-machines
+    machines = db.session.execute(db.select(Machine.id, Machine.parent_id, Machine.name)).all()
+    children = {}
+    for machine in machines:
+        children.setdefault(machine.parent_id, []).append(machine.id)
+    roots = sorted((m for m in machines if m.parent_id is None), key=lambda m: m.name or "")
+    updates = []
+    for position, root in enumerate(roots):
+        pending = [root.id]
+        while pending:
+            machine_id = pending.pop()
+            updates.append({"id": machine_id, "color_index": position % 10})
+            pending.extend(children.get(machine_id, []))
+    if updates:
+        db.session.execute(db.update(Machine), updates)
+    print(f"  {len(roots)} machine(s) racine(s) colorée(s)")
+
+
+@migration(7, "inventory.name (ancien script migrate_add_inventory_name.py)")
+def add_inventory_name():
+    _add_columns("inventory", {"name": "VARCHAR(200)"})
+    # Inventaires sans nom : "<stock> #<numéro>", à la suite des inventaires déjà nommés du stock
+    rows = db.session.execute(text("""
+        SELECT i.id, i.stock_id, s.name AS stock_name
+        FROM inventory i
+        JOIN stock s ON i.stock_id = s.id
+        WHERE i.name IS NULL OR i.name = ''
+        ORDER BY i.stock_id, i.created_at
+    """)).all()
+    if not rows:
+        return
+    counts = dict(db.session.execute(text("""
+        SELECT stock_id, COUNT(*) FROM inventory
+        WHERE name IS NOT NULL AND name != ''
+        GROUP BY stock_id
+    """)).all())
+    for row in rows:
+        counts[row.stock_id] = counts.get(row.stock_id, 0) + 1
+        db.session.execute(
+            text("UPDATE inventory SET name = :name WHERE id = :id"),
+            {"name": f"{row.stock_name} #{counts[row.stock_id]}", "id": row.id},
+        )
+    print(f"  {len(rows)} inventaire(s) nommé(s)")
+
+
+@migration(8, "Table user_machine_permission (ancien script migrate_add_user_machine_permissions.py)")
+def create_user_machine_permission():
+    metadata = MetaData()
+    Table("user", metadata, Column("id", Integer, primary_key=True))
+    Table("machine", metadata, Column("id", Integer, primary_key=True))
+    table = Table(
+        "user_machine_permission", metadata,
+        Column("id", Integer, primary_key=True),
+        Column("user_id", Integer, ForeignKey("user.id", ondelete="CASCADE"), nullable=False, index=True),
+        Column("machine_id", Integer, ForeignKey("machine.id", ondelete="CASCADE"), nullable=False, index=True),
+        Column("created_at", DateTime, default=dt.datetime.utcnow),
+        UniqueConstraint("user_id", "machine_id"),
+    )
+    table.create(db.session.connection(), checkfirst=True)
+
+
+@migration(9, "Reprise des données : types de champ, plans sans machine, suivi des compteurs")
+def fix_legacy_data():
+    db.session.execute(
+        db.update(PreventiveComponent).where(PreventiveComponent.field_type == "increment").values(field_type="number")
+    )
+    # machine_id est obligatoire pour un plan de maintenance
+    for report in PreventiveReport.query.filter(PreventiveReport.machine_id.is_(None)).all():
+        db.session.delete(report)
+    db.session.flush()
+    # Suivi des heures manquant pour les plans des machines à compteur
+    existing = set(db.session.execute(db.select(MaintenanceProgress.machine_id, MaintenanceProgress.report_id)).all())
+    missing = db.session.execute(
+        db.select(PreventiveReport.machine_id, PreventiveReport.id, PreventiveReport.periodicity)
+        .join(Machine, Machine.id == PreventiveReport.machine_id)
+        .where(Machine.hour_counter_enabled.is_(True))
+    ).all()
+    rows = [
+        {"machine_id": machine_id, "report_id": report_id, "hours_since": periodicity}
+        for machine_id, report_id, periodicity in missing
+        if (machine_id, report_id) not in existing
+    ]
+    if rows:
+        db.session.execute(db.insert(MaintenanceProgress), rows)
+        print(f"  {len(rows)} suivi(s) de maintenance créé(s)")
+
+
+@migration(10, "Compte administrateur par défaut")
+def create_default_admin():
+    if User.query.filter_by(username="admin123").first() is None:
+        admin_user = User(username="admin123", user_type="admin")
+        admin_user.set_password("123")
+        db.session.add(admin_user)
+
+
+@migration(11, "Index de calendar_maintenance_progress (ancienne création en SQL brut)")
+def create_calendar_progress_indexes():
+    _create_indexes(
+        "calendar_maintenance_progress",
+        ("ix_calendar_maintenance_progress_machine_id", "machine_id"),
+        ("ix_calendar_maintenance_progress_report_id", "report_id"),
+    )
+
+
+# ==================== EXÉCUTION ====================
+
+def applied_versions():
+    return set(db.session.execute(db.select(SchemaVersion.version)).scalars())
+
+
+def pending_migrations():
+    applied = applied_versions()
+    return [step for step in MIGRATIONS if step.version not in applied]
+
+
+def run_migrations():
+    """Crée les tables manquantes puis applique les étapes en attente, dans l'ordre.
+
+    Chaque étape est validée avec sa ligne schema_version dans une même transaction ;
+    une étape en échec est annulée et interrompt la suite. Retourne les versions appliquées.
+    """
+    db.create_all()
+    applied = []
+    for step in pending_migrations():
+        print(f"Migration {step.version} : {step.description}")
+        try:
+            step.func()
+            db.session.add(SchemaVersion(version=step.version, description=step.description))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            print(f"Échec de la migration {step.version}")
+            raise
+        applied.append(step.version)
+    return applied
+
+
+@app.cli.command("migrate")
+@click.option("--status", is_flag=True, help="Affiche l'état des migrations sans rien appliquer")
+def migrate_command(status):
+    """Met à jour le schéma de la base (à lancer avant le démarrage des workers)"""
+    if status:
+        # Lecture seule : une base sans table schema_version a toutes ses étapes en attente
+        rows = {}
+        if inspect(db.engine).has_table(SchemaVersion.__tablename__):
+            rows = {row.version: row for row in SchemaVersion.query.all()}
+        for step in MIGRATIONS:
+            row = rows.get(step.version)
+            state = row.applied_at.strftime("%d/%m/%Y %H:%M") if row else "en attente"
+            print(f"{step.version:>4}  {state:<16}  {step.description}")
+        return
+    applied = run_migrations()
+    print(f"{len(applied)} migration(s) appliquée(s)" if applied else "Base à jour")
+
+
+@app.cli.command("migrate-report-photos")
+def migrate_report_photos_command():
+    """Déplace en une fois les photos de rapports encore stockées en BLOB vers le disque.
+
+    La migration se fait aussi progressivement dans le planificateur ; cette commande
+    permet de la terminer (par exemple avant une sauvegarde).
+    """
+    migrated = migrate_report_photo_blobs()
+    print(f"Migration terminée : {migrated} photo(s) déplacée(s).")
@@ -0,0 +1,223 @@
+"""
+Stockage des fichiers adressé par contenu
+
+Chaque fichier est enregistré sous le SHA-256 de son contenu
+(<racine>/<2 premiers caractères>/<empreinte>) : deux envois identiques ne
+prennent qu'une place sur le disque, et un fichier n'est jamais modifié après
+écriture, ce qui permet de l'utiliser directement comme ETag.
+
+Les versions réduites des photos (miniature, taille moyenne) sont rangées à part
+par PhotoVariants, sous la même empreinte que l'original. normalize_image prépare
+les photos reçues avant leur enregistrement définitif.
+
+Pillow n'est importé qu'au premier traitement d'image, pas au chargement du module.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from io import BytesIO
+from pathlib import Path
+
+# Tailles dérivées : plus grand côté en pixels
+PHOTO_VARIANT_SIZES = {"thumb": 400, "medium": 1280}
+# Formats générés : (format Pillow, type MIME, options d'encodage)
+PHOTO_VARIANT_FORMATS = {
+    "webp": ("WEBP", "image/webp", {"quality": 80, "method": 4}),
+    "jpeg": ("JPEG", "image/jpeg", {"quality": 82, "optimize": True, "progressive": True}),
+}
+
+
+def write_atomic(target, data):
+    """Écrit dans un fichier temporaire puis renomme : un lecteur ne voit jamais de fichier partiel"""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=target.parent, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as tmp:
+            tmp.write(data)
+        os.replace(tmp_path, target)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def normalize_image(source, max_edge, quality=85):
+    """Redresse une photo selon son orientation EXIF, supprime ses métadonnées,
+    la réduit à max_edge pixels de côté et la recompresse.
+
+    Retourne (octets, type MIME), ou None si la photo doit être gardée telle
+    quelle (image animée ou illisible par Pillow).
+    """
+    from PIL import Image, ImageOps
+    try:
+        with Image.open(BytesIO(source) if isinstance(source, bytes) else source) as original:
+            if getattr(original, "is_animated", False):
+                return None
+            # JPEG (et MPO des iPhone) réencodés en JPEG ; PNG et WebP gardent leur format
+            pil_format = original.format if original.format in ("PNG", "WEBP") else "JPEG"
+            icc_profile = original.info.get("icc_profile")
+            original.draft("RGB", (max_edge, max_edge))
+            img = ImageOps.exif_transpose(original)
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError):
+        return None
+    img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    if pil_format == "JPEG":
+        img = img.convert("RGB") if img.mode != "RGB" else img
+        options = {"quality": quality, "optimize": True, "progressive": True}
+    else:
+        img = img.convert("RGBA" if img.has_transparency_data else "RGB") if img.mode not in ("RGB", "RGBA") else img
+        options = {"quality": quality} if pil_format == "WEBP" else {"optimize": True}
+    if icc_profile:
+        # Seul le profil de couleur est conservé (EXIF, GPS et miniatures intégrées sont retirés)
+        options["icc_profile"] = icc_profile
+    buffer = BytesIO()
+    img.save(buffer, pil_format, **options)
+    return buffer.getvalue(), Image.MIME[pil_format]
+
+
+def file_sha256(path):
+    """Empreinte SHA-256 d'un fichier, mémorisée tant qu'il n'est pas modifié"""
+    stat = os.stat(path)
+    return _file_sha256(str(path), stat.st_mtime_ns, stat.st_size)
+
+
+@lru_cache(maxsize=4096)
+def _file_sha256(path, mtime_ns, size):
+    digest = hashlib.sha256()
+    with open(path, "rb") as handle:
+        for chunk in iter(lambda: handle.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ContentStore:
+    """Fichiers adressés par leur empreinte SHA-256 sous un répertoire racine"""
+
+    def __init__(self, root):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+
+    def path(self, content_hash):
+        return self.root / content_hash[:2] / content_hash
+
+    def exists(self, content_hash):
+        return bool(content_hash) and self.path(content_hash).is_file()
+
+    def put(self, data):
+        """Enregistre des octets ; retourne leur empreinte (aucune écriture si déjà présents)"""
+        content_hash = hashlib.sha256(data).hexdigest()
+        target = self.path(content_hash)
+        if target.is_file():
+            # Rafraîchir la date : delete() épargne les fichiers récemment réutilisés
+            os.utime(target)
+            return content_hash
+        # Deux écritures concurrentes du même contenu produisent le même fichier
+        write_atomic(target, data)
+        return content_hash
+
+    def delete(self, content_hash, min_age=3600):
+        """Supprime un fichier qui n'est plus référencé.
+
+        Les fichiers écrits ou réutilisés depuis moins de min_age secondes sont
+        conservés : un envoi identique peut être en cours de transaction.
+        """
+        target = self.path(content_hash)
+        try:
+            if time.time() - target.stat().st_mtime < min_age:
+                return False
+            target.unlink()
+            return True
+        except FileNotFoundError:
+            return False
+
+
+class PhotoVariants:
+    """Versions réduites des photos, en cache sur disque sous l'empreinte de l'original.
+
+    Les variantes d'une photo envoyée sont générées en arrière-plan par un pool de
+    threads (schedule) ; celles des photos plus anciennes sont générées à la
+    première demande (get).
+    """
+
+    def __init__(self, root, workers=2):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="photo-variants")
+        self._lock = threading.Lock()
+        self._pending = {}
+
+    def path(self, content_hash, size, fmt):
+        return self.root / content_hash[:2] / f"{content_hash}-{size}.{fmt}"
+
+    def get(self, content_hash, size, fmt, source):
+        """Chemin de la variante demandée, générée si besoin ; None si la source n'est pas une image lisible.
+
+        source est le chemin de l'original ou son contenu en octets.
+        """
+        target = self.path(content_hash, size, fmt)
+        if target.is_file():
+            return target
+        with self._lock:
+            future = self._pending.get(content_hash)
+        if future is not None:
+            # Génération déjà en cours pour cette photo : l'attendre plutôt que décoder deux fois
+            future.result()
+            if target.is_file():
+                return target
+        try:
+            self._render(content_hash, source, [size], [fmt])
+        except Exception as exc:
+            print(f"Erreur lors de la génération de la variante {size} de {content_hash}: {exc}")
+            return None
+        return target
+
+    def schedule(self, content_hash, source):
+        """Génère en arrière-plan toutes les variantes d'une photo qui vient d'être envoyée"""
+        with self._lock:
+            if content_hash in self._pending:
+                return
+            self._pending[content_hash] = self._executor.submit(self._render_all, content_hash, source)
+
+    def delete(self, content_hash):
+        """Supprime toutes les variantes d'une photo"""
+        for variant in (self.root / content_hash[:2]).glob(f"{content_hash}-*"):
+            try:
+                variant.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _render_all(self, content_hash, source):
+        try:
+            missing = [
+                size for size in PHOTO_VARIANT_SIZES
+                if not all(self.path(content_hash, size, fmt).is_file() for fmt in PHOTO_VARIANT_FORMATS)
+            ]
+            if missing:
+                self._render(content_hash, source, missing, list(PHOTO_VARIANT_FORMATS))
+        except Exception as exc:
+            print(f"Erreur lors de la génération des variantes de {content_hash}: {exc}")
+        finally:
+            with self._lock:
+                self._pending.pop(content_hash, None)
+
+    def _render(self, content_hash, source, sizes, formats):
+        """Décode l'original une seule fois puis réduit de la plus grande taille à la plus petite"""
+        from PIL import Image, ImageOps
+        edges = sorted(((PHOTO_VARIANT_SIZES[size], size) for size in sizes), reverse=True)
+        with Image.open(BytesIO(source) if isinstance(source, bytes) else source) as original:
+            # JPEG : décodage directement à une résolution réduite (bien plus rapide)
+            original.draft("RGB", (edges[0][0], edges[0][0]))
+            img = ImageOps.exif_transpose(original)
+            img = img.convert("RGBA" if img.has_transparency_data else "RGB")
+        for edge, size in edges:
+            img.thumbnail((edge, edge), Image.LANCZOS)
+            for fmt in formats:
+                pil_format, _, options = PHOTO_VARIANT_FORMATS[fmt]
+                frame = img.convert("RGB") if pil_format == "JPEG" and img.mode != "RGB" else img
+                buffer = BytesIO()
+                frame.save(buffer, pil_format, **options)
+                write_atomic(self.path(content_hash, size, fmt), buffer.getvalue())
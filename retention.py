@@ -0,0 +1,222 @@
+"""
+Moteur de rétention : purge des rapports, des messages et événements du chat
+expirés, et des fichiers qui ne sont plus référencés par aucune ligne
+
+Une seule passe s'exécute à la fois pour l'ensemble des workers (et des instances
+qui partagent la base) : elle commence par prendre le bail "retention" de la table
+task_lease, qui n'est rendu qu'après RETENTION_INTERVAL. Les suppressions se font
+par lots d'identifiants, en instructions ensemblistes et avec une transaction
+courte par lot, sans jamais charger les lignes ni les BLOB en mémoire. Chaque
+passe est enregistrée dans retention_run avec ses compteurs.
+"""
+import datetime as dt
+import json
+import os
+import time
+from pathlib import Path, PureWindowsPath
+
+from app import app, db
+from app import (
+    ChatEvent, ChatMessage, MaintenancePhoto, Report, ReportPhoto, RetentionRun, TaskLease,
+    MAINTENANCE_PHOTOS_FOLDER, PHOTO_VARIANTS, REPORT_PHOTO_STORE, REPORT_PHOTOS_FOLDER,
+    acquire_task_lease, release_report_photo_files, task_lease_holder,
+)
+
+# Durées de conservation
+REPORT_RETENTION_DAYS = int(os.environ.get("REPORT_RETENTION_DAYS", "7"))
+CHAT_RETENTION_DAYS = int(os.environ.get("CHAT_RETENTION_DAYS", "7"))
+# Journal chat_event : les clients déconnectés plus longtemps rechargent tout
+CHAT_EVENT_RETENTION = dt.timedelta(hours=int(os.environ.get("CHAT_EVENT_RETENTION_HOURS", "24")))
+# Historique des passes
+RETENTION_RUN_HISTORY = dt.timedelta(days=90)
+# Lignes supprimées par transaction
+RETENTION_BATCH_SIZE = int(os.environ.get("RETENTION_BATCH_SIZE", "1000"))
+# Intervalle minimal entre deux passes, tous workers confondus
+RETENTION_INTERVAL = dt.timedelta(minutes=int(os.environ.get("RETENTION_INTERVAL_MINUTES", "55")))
+# Un fichier sans référence plus récent que ce délai peut appartenir à un envoi en cours
+ORPHAN_MIN_AGE = 24 * 3600
+
+RETENTION_STATS = (
+    "reports", "report_photos", "chat_messages", "chat_events", "runs",
+    "photo_files", "orphan_files",
+)
+
+
+def _id_batches(query):
+    """Lots successifs d'identifiants ; la requête doit exclure les lignes déjà supprimées"""
+    while True:
+        ids = [row[0] for row in query.limit(RETENTION_BATCH_SIZE)]
+        if not ids:
+            return
+        yield ids
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def purge_reports(stats):
+    """Rapports (y compris supprimés) de plus de REPORT_RETENTION_DAYS, avec leurs photos"""
+    cutoff = dt.datetime.utcnow() - dt.timedelta(days=REPORT_RETENTION_DAYS)
+    query = db.session.query(Report.id).filter(Report.created_at < cutoff).order_by(Report.id)
+    for ids in _id_batches(query):
+        photos = (
+            db.session.query(ReportPhoto.content_hash, ReportPhoto.file_path)
+            .filter(ReportPhoto.report_id.in_(ids))
+            .all()
+        )
+        stats["report_photos"] += ReportPhoto.query.filter(ReportPhoto.report_id.in_(ids)).delete(synchronize_session=False)
+        stats["reports"] += Report.query.filter(Report.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+        # Fichiers retirés après le commit : une annulation ne laisse pas de ligne sans fichier
+        stats["photo_files"] += release_report_photo_files({content_hash for content_hash, _ in photos if content_hash})
+        for _, file_path in photos:
+            if file_path and _remove_file(file_path):
+                stats["photo_files"] += 1
+
+
+def purge_chat_messages(stats):
+    """Messages du chat de plus de CHAT_RETENTION_DAYS"""
+    cutoff = dt.datetime.utcnow() - dt.timedelta(days=CHAT_RETENTION_DAYS)
+    query = db.session.query(ChatMessage.id).filter(ChatMessage.created_at < cutoff).order_by(ChatMessage.id)
+    for ids in _id_batches(query):
+        # Détacher les réponses plus récentes qui citent un message purgé
+        ChatMessage.query.filter(ChatMessage.reply_to_id.in_(ids)).update(
+            {ChatMessage.reply_to_id: None}, synchronize_session=False
+        )
+        stats["chat_messages"] += ChatMessage.query.filter(ChatMessage.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+
+
+def purge_chat_events(stats):
+    """Événements du journal chat_event plus anciens que CHAT_EVENT_RETENTION"""
+    cutoff = dt.datetime.utcnow() - CHAT_EVENT_RETENTION
+    query = db.session.query(ChatEvent.id).filter(ChatEvent.created_at < cutoff).order_by(ChatEvent.id)
+    for ids in _id_batches(query):
+        stats["chat_events"] += ChatEvent.query.filter(ChatEvent.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+
+
+def purge_retention_runs(stats):
+    """Passes de rétention plus anciennes que RETENTION_RUN_HISTORY"""
+    cutoff = dt.datetime.utcnow() - RETENTION_RUN_HISTORY
+    stats["runs"] += RetentionRun.query.filter(RetentionRun.started_at < cutoff).delete(synchronize_session=False)
+    db.session.commit()
+
+
+def _referenced(names, *columns):
+    """Sous-ensemble de names présent dans au moins une des colonnes (requêtes IN par lots)"""
+    names = list(names)
+    found = set()
+    for start in range(0, len(names), RETENTION_BATCH_SIZE):
+        chunk = names[start:start + RETENTION_BATCH_SIZE]
+        for column in columns:
+            found.update(row[0] for row in db.session.query(column).filter(column.in_(chunk)).distinct())
+    return found
+
+
+def _old_files(directory, now):
+    """Fichiers d'un répertoire modifiés depuis plus de ORPHAN_MIN_AGE (nom -> chemin)"""
+    files = {}
+    if not directory.is_dir():
+        return files
+    for entry in os.scandir(directory):
+        if entry.is_file() and now - entry.stat().st_mtime >= ORPHAN_MIN_AGE:
+            files[entry.name] = Path(entry.path)
+    return files
+
+
+def sweep_orphan_files(stats):
+    """Fichiers de photos qui ne sont plus référencés par aucune ligne.
+
+    Couvre le stockage adressé par contenu, les variantes réduites et les dossiers
+    maintenance_photos et report_photos (envois interrompus, lignes supprimées).
+    """
+    now = time.time()
+
+    for prefix_dir in (p for p in REPORT_PHOTO_STORE.root.iterdir() if p.is_dir()):
+        files = _old_files(prefix_dir, now)
+        # Fichiers temporaires d'une écriture interrompue
+        for name in [name for name in files if name.startswith(".tmp-")]:
+            stats["orphan_files"] += _remove_file(files.pop(name))
+        used = _referenced(files, ReportPhoto.content_hash)
+        for content_hash in files.keys() - used:
+            stats["orphan_files"] += REPORT_PHOTO_STORE.delete(content_hash, min_age=ORPHAN_MIN_AGE)
+
+    for prefix_dir in (p for p in PHOTO_VARIANTS.root.iterdir() if p.is_dir()):
+        files = _old_files(prefix_dir, now)
+        by_hash = {}
+        for name, path in files.items():
+            by_hash.setdefault(name.split("-", 1)[0], []).append(path)
+        used = _referenced(by_hash, ReportPhoto.content_hash, MaintenancePhoto.content_hash)
+        for content_hash in by_hash.keys() - used:
+            for path in by_hash[content_hash]:
+                stats["orphan_files"] += _remove_file(path)
+
+    files = _old_files(MAINTENANCE_PHOTOS_FOLDER, now)
+    for name in files.keys() - _referenced(files, MaintenancePhoto.filename):
+        stats["orphan_files"] += _remove_file(files[name])
+
+    # Ancien stockage des photos de rapports : file_path contient le chemin complet,
+    # parfois enregistré sous Windows (PureWindowsPath comprend les deux séparateurs)
+    files = _old_files(REPORT_PHOTOS_FOLDER, now)
+    if files:
+        used = {
+            PureWindowsPath(row[0]).name for row in
+            db.session.query(ReportPhoto.file_path).filter(ReportPhoto.file_path.isnot(None), ReportPhoto.file_path != "")
+        }
+        for name in files.keys() - used:
+            stats["orphan_files"] += _remove_file(files[name])
+
+
+RETENTION_STEPS = (purge_reports, purge_chat_messages, purge_chat_events, purge_retention_runs, sweep_orphan_files)
+
+
+def run_retention():
+    """Exécute une passe si aucun autre worker n'en a fait une depuis RETENTION_INTERVAL.
+
+    Retourne les compteurs de la passe, ou None si le bail est détenu ailleurs.
+    """
+    if not acquire_task_lease("retention", RETENTION_INTERVAL):
+        return None
+    run = RetentionRun(holder=task_lease_holder(), started_at=dt.datetime.utcnow())
+    db.session.add(run)
+    db.session.commit()
+    run_id = run.id
+
+    stats = dict.fromkeys(RETENTION_STATS, 0)
+    status, error = "done", None
+    for step in RETENTION_STEPS:
+        try:
+            step(stats)
+        except Exception as exc:
+            # Une étape en échec n'empêche pas les suivantes ; les lots déjà validés restent acquis
+            db.session.rollback()
+            status = "failed"
+            error = f"{error}\n" if error else ""
+            error += f"{step.__name__}: {exc}"
+            print(f"Erreur dans le moteur de rétention ({step.__name__}): {exc}")
+
+    run = db.session.get(RetentionRun, run_id)
+    run.status = status
+    run.error = error
+    run.stats = json.dumps(stats)
+    run.finished_at = dt.datetime.utcnow()
+    db.session.commit()
+    if any(stats.values()):
+        summary = ", ".join(f"{key}={value}" for key, value in stats.items() if value)
+        print(f"Rétention: {summary}")
+    return stats
+
+
+@app.cli.command("retention")
+def retention_command():
+    """Exécute immédiatement une passe de rétention (ignore le bail en cours)"""
+    TaskLease.query.filter_by(name="retention").update({"expires_at": None})
+    db.session.commit()
+    stats = run_retention()
+    print(json.dumps(stats, indent=2))
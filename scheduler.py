@@ -0,0 +1,228 @@
+"""
+Planificateur des tâches périodiques (rétention, migration des photos, stocks, échéances calendaires)
+
+Les tâches sont déclarées dans un registre (register_job) avec leur intervalle et,
+au besoin, l'heure (UTC) à laquelle leurs échéances sont calées : une tâche toutes
+les 24 h à 03:00 tourne chaque nuit à 03:00, quelle que soit la durée de ses passes.
+Le thread planificateur ne tourne que dans un processus par instance (un worker
+désigné par gunicorn.conf.py, ou le serveur de développement). Entre instances, un
+seul thread est élu : celui qui détient le bail "scheduler" de la table
+task_lease, prolongé à chaque tour tant que son processus vit et repris par un
+autre après SCHEDULER_LEASE_TTL sinon. L'état de chaque tâche (dernière exécution, prochaine échéance, résultat,
+erreur) est persisté dans la table scheduled_job : une tâche n'est lancée qu'après
+avoir réservé son échéance par un UPDATE conditionnel, ce qui empêche aussi deux
+exécutions simultanées pendant une bascule du bail.
+"""
+import datetime as dt
+import functools
+import json
+import os
+import threading
+import time
+import traceback
+
+from flask import flash, redirect, render_template, url_for
+from sqlalchemy import or_
+
+from app import app, db
+from app import (
+    RetentionRun, ScheduledJobState, TaskLease,
+    acquire_task_lease, admin_required, migrate_report_photo_blobs, refresh_calendar_missed_counts,
+    refresh_low_stock, take_stock_snapshots, task_lease_holder, _dialect_insert,
+)
+import retention
+
+# Intervalle entre deux tours du planificateur
+SCHEDULER_TICK = int(os.environ.get("SCHEDULER_TICK_SECONDS", "30"))
+# Un worker élu qui ne renouvelle plus son bail est remplacé après ce délai
+SCHEDULER_LEASE_TTL = dt.timedelta(seconds=SCHEDULER_TICK * 3)
+# Taille maximale du résultat enregistré
+RESULT_MAX_LENGTH = 500
+
+SCHEDULED_JOBS = {}
+
+_thread = None
+_thread_lock = threading.Lock()
+
+
+class ScheduledJob:
+    def __init__(self, name, label, every, func, at=None):
+        self.name = name
+        self.label = label
+        self.every = every
+        self.func = func
+        self.at = at
+        # Origine de la grille des échéances : origine + k * every
+        self.anchor = dt.datetime.combine(dt.date(2000, 1, 1), at or dt.time())
+
+    def next_run_after(self, moment):
+        """Première échéance de la grille strictement après moment (les échéances manquées sont sautées)"""
+        return self.anchor + ((moment - self.anchor) // self.every + 1) * self.every
+
+
+def register_job(name, label, every, func, at=None):
+    """Déclare une tâche périodique ; every est un timedelta, at un datetime.time (UTC) qui cale les échéances"""
+    SCHEDULED_JOBS[name] = ScheduledJob(name, label, every, func, at)
+
+
+register_job("retention", "Rétention des données", dt.timedelta(hours=1), retention.run_retention)
+register_job(
+    "report_photo_migration", "Migration des photos de rapports vers le disque", dt.timedelta(hours=1),
+    functools.partial(migrate_report_photo_blobs, max_batches=50),
+)
+register_job("stock_snapshots", "Photographies des stocks", dt.timedelta(hours=1), take_stock_snapshots)
+register_job("low_stock_refresh", "Recalcul des stocks bas", dt.timedelta(hours=1), refresh_low_stock)
+register_job(
+    "calendar_missed_counts", "Échéances calendaires manquées", dt.timedelta(hours=1), refresh_calendar_missed_counts,
+)
+
+
+def _ensure_rows():
+    """Crée les lignes d'état des tâches nouvellement déclarées"""
+    for name in SCHEDULED_JOBS:
+        db.session.execute(
+            _dialect_insert(ScheduledJobState.__table__).values(name=name, run_count=0, failure_count=0)
+            .on_conflict_do_nothing(index_elements=["name"])
+        )
+    db.session.commit()
+
+
+def _claim(job, now):
+    """Réserve l'échéance d'une tâche ; True si ce processus doit l'exécuter"""
+    result = db.session.execute(
+        db.update(ScheduledJobState)
+        .where(
+            ScheduledJobState.name == job.name,
+            or_(ScheduledJobState.next_run_at.is_(None), ScheduledJobState.next_run_at <= now),
+        )
+        .values(
+            # Échéance suivante prise sur la grille de la tâche, pas à partir de l'heure de
+            # passage : la durée des exécutions ne décale pas les suivantes
+            next_run_at=job.next_run_after(now),
+            last_started_at=now,
+            last_status="running",
+            holder=task_lease_holder(),
+        )
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return result.rowcount == 1
+
+
+def _result_text(value):
+    if value is None:
+        return None
+    try:
+        text = json.dumps(value, default=str)
+    except (TypeError, ValueError):
+        text = repr(value)
+    return text[:RESULT_MAX_LENGTH]
+
+
+def run_job(job):
+    """Exécute une tâche déjà réservée et enregistre son résultat"""
+    started = time.monotonic()
+    status, result, error = "done", None, None
+    try:
+        result = job.func()
+        db.session.commit()
+    except Exception as exc:
+        db.session.rollback()
+        status, error = "failed", traceback.format_exc(limit=5)
+        print(f"Erreur dans la tâche planifiée {job.name}: {exc}")
+    values = {
+        "last_finished_at": dt.datetime.utcnow(),
+        "last_status": status,
+        "last_duration_ms": int((time.monotonic() - started) * 1000),
+        "last_result": _result_text(result),
+        "last_error": error,
+        "run_count": ScheduledJobState.run_count + 1,
+    }
+    if status == "failed":
+        values["failure_count"] = ScheduledJobState.failure_count + 1
+    db.session.execute(
+        db.update(ScheduledJobState).where(ScheduledJobState.name == job.name).values(**values)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return status
+
+
+def run_due_jobs():
+    """Un tour du planificateur : exécute les tâches échues si ce worker est élu.
+
+    Retourne les noms des tâches exécutées.
+    """
+    if not acquire_task_lease("scheduler", SCHEDULER_LEASE_TTL, renew=True):
+        return []
+    _ensure_rows()
+    executed = []
+    for job in SCHEDULED_JOBS.values():
+        if _claim(job, dt.datetime.utcnow()):
+            run_job(job)
+            executed.append(job.name)
+            # Une tâche longue ne doit pas faire perdre le bail aux autres workers
+            acquire_task_lease("scheduler", SCHEDULER_LEASE_TTL, renew=True)
+    return executed
+
+
+def _loop():
+    while True:
+        try:
+            with app.app_context():
+                run_due_jobs()
+        except Exception as exc:
+            print(f"Erreur dans le planificateur: {exc}")
+        time.sleep(SCHEDULER_TICK)
+
+
+def start_scheduler():
+    """Démarre le thread planificateur de ce worker (une seule fois)"""
+    global _thread
+    with _thread_lock:
+        if _thread is not None and _thread.is_alive():
+            return
+        _thread = threading.Thread(target=_loop, daemon=True, name="scheduler")
+        _thread.start()
+    print(f"Planificateur démarré ({len(SCHEDULED_JOBS)} tâches, tour toutes les {SCHEDULER_TICK} s)")
+
+
+# ==================== ROUTES ====================
+
+@app.route("/admin/scheduler")
+@admin_required
+def scheduler_status():
+    """État des tâches planifiées, du bail du planificateur et des dernières passes de rétention"""
+    _ensure_rows()
+    states = {state.name: state for state in ScheduledJobState.query.all()}
+    rows = [(job, states.get(job.name)) for job in SCHEDULED_JOBS.values()]
+    lease = db.session.get(TaskLease, "scheduler")
+    retention_runs = RetentionRun.query.order_by(RetentionRun.started_at.desc()).limit(10).all()
+    for run in retention_runs:
+        run.stats_dict = json.loads(run.stats) if run.stats else {}
+    return render_template(
+        "scheduler.html",
+        rows=rows,
+        lease=lease,
+        retention_runs=retention_runs,
+        now=dt.datetime.utcnow(),
+        tick=SCHEDULER_TICK,
+    )
+
+
+@app.route("/admin/scheduler/<name>/run", methods=["POST"])
+@admin_required
+def scheduler_run_now(name):
+    """Avance l'échéance d'une tâche : elle est exécutée au prochain tour du worker élu"""
+    if name not in SCHEDULED_JOBS:
+        flash("Tâche inconnue", "danger")
+        return redirect(url_for("scheduler_status"))
+    _ensure_rows()
+    ScheduledJobState.query.filter_by(name=name).update(
+        {"next_run_at": dt.datetime.utcnow()}, synchronize_session=False
+    )
+    # Bail propre à la tâche (rétention) : lever l'intervalle minimal pour cette demande
+    TaskLease.query.filter_by(name=name).update({"expires_at": None}, synchronize_session=False)
+    db.session.commit()
+    flash(f"Tâche « {SCHEDULED_JOBS[name].label} » programmée pour le prochain tour", "success")
+    return redirect(url_for("scheduler_status"))
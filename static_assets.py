@@ -0,0 +1,181 @@
+"""
+Feuilles de style et scripts communs des pages, servis en fichiers versionnés
+
+Le CSS et le JavaScript de base.html et index.html sont dans assets/ ; les
+templates ne gardent en ligne que ce qui dépend de la requête (textes traduits,
+URL). La construction concatène chaque lot, le nomme d'après l'empreinte de son
+contenu (base.3f2a9c1e7b4d.js), le précompresse en gzip et en brotli et écrit le
+manifeste qui associe chaque lot à son fichier :
+
+    flask --app app assets-build
+
+Elle est aussi lancée au démarrage (create_app) si les sources sont plus récentes
+que le manifeste, et à chaque page en mode debug. Les templates référencent les
+lots par asset_url('base.js') ; le nom du fichier changeant avec son contenu, il
+est servi avec un cache d'un an sans revalidation, dans la variante compressée
+acceptée par le navigateur.
+
+Variables d'environnement :
+    ASSETS_DIST_DIR     répertoire des lots construits (par défaut assets/dist)
+"""
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import threading
+from pathlib import Path
+
+from flask import abort, request, url_for
+
+from app import app, BASE_DIR, FILE_CACHE_MAX_AGE
+
+ASSETS_DIR = BASE_DIR / "assets"
+DIST_DIR = Path(os.environ.get("ASSETS_DIST_DIR", ASSETS_DIR / "dist"))
+MANIFEST_PATH = DIST_DIR / "manifest.json"
+
+# Lots servis : nom logique -> fichiers sources concaténés (relatifs à assets/)
+BUNDLES = {
+    "base.css": ["css/base.css"],
+    "base.js": ["js/base.js"],
+    "index.css": ["css/index.css"],
+    "index.js": ["js/index.js"],
+}
+
+# Variantes précompressées (Content-Encoding, suffixe du fichier), par ordre de préférence
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+_manifest = None
+_manifest_lock = threading.Lock()
+# Contenu des fichiers servis (lots du manifeste et variantes) : {nom du fichier: octets}
+_file_cache = {}
+
+
+def _compress(data, encoding):
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=9, mtime=0)
+    try:
+        import brotli
+    except ImportError:
+        return None  # Brotli absent : gzip seulement
+    return brotli.compress(data, quality=11)
+
+
+def _write(path, data):
+    # Écriture atomique : un autre processus ne lit jamais un fichier partiel
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+def build_assets():
+    """Construit les lots et leurs variantes compressées ; retourne le manifeste {lot: fichier}"""
+    DIST_DIR.mkdir(parents=True, exist_ok=True)
+    manifest = {}
+    for name, sources in BUNDLES.items():
+        data = b"\n".join((ASSETS_DIR / source).read_bytes() for source in sources)
+        stem, extension = name.rsplit(".", 1)
+        filename = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}.{extension}"
+        # Les fichiers existants ne sont pas réécrits : leur nom garantit leur contenu ;
+        # les versions précédentes restent servies aux pages déjà chargées
+        if not (DIST_DIR / filename).exists():
+            _write(DIST_DIR / filename, data)
+        for encoding, suffix in ENCODINGS:
+            if (DIST_DIR / (filename + suffix)).exists():
+                continue
+            compressed = _compress(data, encoding)
+            if compressed is not None and len(compressed) < len(data):
+                _write(DIST_DIR / (filename + suffix), compressed)
+        manifest[name] = filename
+    _write(MANIFEST_PATH, json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8"))
+    return manifest
+
+
+def _is_stale():
+    try:
+        built = MANIFEST_PATH.stat().st_mtime
+    except OSError:
+        return True
+    return any(
+        (ASSETS_DIR / source).stat().st_mtime > built
+        for sources in BUNDLES.values() for source in sources
+    )
+
+
+def load_manifest():
+    """Manifeste des lots, construits d'abord s'ils manquent ou sont périmés"""
+    global _manifest
+    if _manifest is not None and not app.debug:
+        return _manifest
+    with _manifest_lock:
+        if _is_stale():
+            _manifest = build_assets()
+        elif _manifest is None:
+            _manifest = json.loads(MANIFEST_PATH.read_text(encoding="utf-8"))
+    return _manifest
+
+
+@app.template_global()
+def asset_url(name):
+    """URL du fichier construit d'un lot (base.css, index.js...)"""
+    return url_for("asset_file", filename=load_manifest()[name])
+
+
+def _read(filename):
+    """Contenu d'un fichier construit ou d'une de ses variantes compressées ; None sinon.
+
+    Seuls les fichiers du manifeste chargé sont lus et gardés en mémoire : le nom vient
+    de l'URL et ne doit ni faire grossir le cache, ni y figer une absence.
+    """
+    cached = _file_cache.get(filename)
+    if cached is not None:
+        return cached
+    allowed = {
+        output + suffix
+        for output in load_manifest().values()
+        for suffix in ("", *(suffix for _, suffix in ENCODINGS))
+    }
+    if filename not in allowed:
+        return None
+    path = DIST_DIR / filename
+    if not path.is_file():
+        return None
+    data = _file_cache[filename] = path.read_bytes()
+    return data
+
+
+@app.route("/assets/<filename>")
+def asset_file(filename):
+    """Sert un lot construit, précompressé selon Accept-Encoding et mis en cache un an"""
+    data = _read(filename)
+    if data is None:
+        abort(404)
+    encoding = None
+    for candidate, suffix in ENCODINGS:
+        if request.accept_encodings.quality(candidate) > 0:
+            compressed = _read(filename + suffix)
+            if compressed is not None:
+                data, encoding = compressed, candidate
+                break
+    response = app.response_class(data, mimetype=mimetypes.guess_type(filename)[0] or "application/octet-stream")
+    if encoding:
+        response.content_encoding = encoding
+    response.vary.add("Accept-Encoding")
+    response.set_etag(f"{filename}-{encoding or 'identity'}")
+    response.cache_control.public = True
+    response.cache_control.max_age = FILE_CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    return response.make_conditional(request)
+
+
+@app.cli.command("assets-build")
+def assets_build_command():
+    """Construit les lots CSS/JS versionnés et précompressés (assets/ -> assets/dist)"""
+    manifest = build_assets()
+    for name, filename in sorted(manifest.items()):
+        sizes = [f"{(DIST_DIR / filename).stat().st_size // 1024} Ko"]
+        for encoding, suffix in ENCODINGS:
+            path = DIST_DIR / (filename + suffix)
+            if path.exists():
+                sizes.append(f"{encoding} {path.stat().st_size // 1024} Ko")
+        print(f"{name:<10} {filename:<28} {', '.join(sizes)}")
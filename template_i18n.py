@@ -0,0 +1,131 @@
+"""
+Templates compilés par langue
+
+Les appels t('clé') dont la clé est une chaîne littérale sont remplacés par leur
+traduction au moment de la compilation : chaque template est compilé une fois par
+langue, dans un environnement Jinja dérivé (overlay) de celui de Flask, et le rendu
+n'appelle plus t() que pour les clés calculées (t(job.label)). Le bytecode compilé
+est conservé sur disque, un cache par langue et par version du catalogue, pour que
+les workers redémarrés ne recompilent pas les templates.
+
+Variables d'environnement :
+    TEMPLATE_CACHE_DIR      répertoire du cache de bytecode (par défaut : répertoire
+                            temporaire de l'utilisateur ; "off" pour le désactiver)
+"""
+import os
+
+from flask import has_request_context, session
+from flask.templating import Environment
+from jinja2 import FileSystemBytecodeCache, TemplateSyntaxError
+from jinja2.ext import Extension
+from jinja2.lexer import Token
+
+from translations import CATALOGS, CATALOG_VERSIONS, get_language_from_session
+
+TEMPLATE_CACHE_DIR = os.environ.get("TEMPLATE_CACHE_DIR", "")
+DEFAULT_LANGUAGE = "fr"
+# À incrémenter si la transformation faite par StaticTranslationExtension change
+COMPILER_VERSION = 1
+
+
+class StaticTranslationExtension(Extension):
+    """Remplace t('clé littérale') par sa traduction dans la langue de l'environnement"""
+
+    def filter_stream(self, stream):
+        catalog = CATALOGS.get(getattr(self.environment, "language", None))
+        if catalog is None:
+            # Environnement de base (from_string...) : t() reste résolu au rendu
+            return stream
+        return self._translate(list(stream), catalog)
+
+    @staticmethod
+    def _translate(tokens, catalog):
+        i = 0
+        while i < len(tokens):
+            token = tokens[i]
+            if (
+                token.type == "name" and token.value == "t"
+                and (i == 0 or tokens[i - 1].type != "dot")
+                and i + 3 < len(tokens)
+                and tokens[i + 1].type == "lparen"
+                and tokens[i + 2].type == "string"
+                and tokens[i + 3].type == "rparen"
+            ):
+                key = tokens[i + 2].value
+                yield Token(token.lineno, "string", catalog.get(key, key))
+                i += 4
+                continue
+            yield token
+            i += 1
+
+
+def _bytecode_cache(lang):
+    if TEMPLATE_CACHE_DIR.lower() == "off":
+        return None
+    pattern = f"__jinja2_{lang}_{CATALOG_VERSIONS[lang]}_{COMPILER_VERSION}_%s.cache"
+    return FileSystemBytecodeCache(TEMPLATE_CACHE_DIR or None, pattern)
+
+
+class LocalizedEnvironment(Environment):
+    """Environnement Jinja de Flask qui compile chaque template une fois par langue.
+
+    app.jinja_env choisit l'environnement de la langue de la requête en cours ;
+    les extends/include d'un template restent dans l'environnement qui l'a chargé.
+    """
+
+    language = None
+
+    def __init__(self, app, **options):
+        options.setdefault("extensions", [])
+        options["extensions"] = [*options["extensions"], StaticTranslationExtension]
+        super().__init__(app, **options)
+        self._language_environments = {}
+
+    @property
+    def auto_reload(self):
+        # Les environnements par langue suivent app.jinja_env (rechargement en mode debug)
+        if self.language is not None:
+            return self.linked_to.auto_reload
+        return self._auto_reload
+
+    @auto_reload.setter
+    def auto_reload(self, value):
+        self._auto_reload = value
+
+    def for_language(self, lang):
+        """Environnement compilant les templates dans la langue lang (français si inconnue)"""
+        if lang not in CATALOGS:
+            lang = DEFAULT_LANGUAGE
+        env = self._language_environments.get(lang)
+        if env is None:
+            env = self.overlay(bytecode_cache=_bytecode_cache(lang))
+            env.language = lang
+            env = self._language_environments.setdefault(lang, env)
+        return env
+
+    def _current(self):
+        lang = get_language_from_session(session) if has_request_context() else DEFAULT_LANGUAGE
+        return self.for_language(lang)
+
+    def get_template(self, name, parent=None, globals=None):
+        if self.language is None:
+            return self._current().get_template(name, parent, globals)
+        return super().get_template(name, parent, globals)
+
+    def select_template(self, names, parent=None, globals=None):
+        if self.language is None:
+            return self._current().select_template(names, parent, globals)
+        return super().select_template(names, parent, globals)
+
+    def precompile(self):
+        """Compile tous les templates .html dans chaque langue (avant le fork des workers)"""
+        compiled = 0
+        for lang in CATALOGS:
+            env = self.for_language(lang)
+            for name in self.list_templates(extensions=["html"]):
+                try:
+                    env.get_template(name)
+                    compiled += 1
+                except TemplateSyntaxError as exc:
+                    print(f"Template {name} non compilé ({lang}): {exc}")
+        return compiled
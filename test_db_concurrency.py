@@ -0,0 +1,143 @@
+"""Script de test : relevés de compteur et lectures concurrents sur la base configurée.
+
+Crée des machines temporaires, puis plusieurs threads enchaînent pendant une durée
+fixe des lectures (machine et historique de ses relevés) et des relevés de
+compteur (mise à jour des heures + ligne counter_log), sans nouvelle tentative en
+cas d'erreur. Affiche le débit, les latences et le nombre d'erreurs de verrou
+("database is locked") avec les réglages du moteur (voir database_engine_options).
+
+Pour comparer avec les réglages par défaut de SQLite :
+    SQLITE_JOURNAL_MODE=DELETE SQLITE_SYNCHRONOUS=FULL SQLITE_BUSY_TIMEOUT_MS=0 python test_db_concurrency.py
+
+Usage : python test_db_concurrency.py [threads] [duree_secondes] [part_ecritures_pct]
+"""
+import random
+import statistics
+import sys
+import threading
+import time
+import uuid
+
+from sqlalchemy import func
+from sqlalchemy.exc import OperationalError
+
+from app import app, db, CounterLog, Machine
+
+MACHINES = 4
+
+
+def read(machine_id):
+    machine = db.session.get(Machine, machine_id)
+    db.session.query(func.count(CounterLog.id), func.max(CounterLog.created_at)).filter(
+        CounterLog.machine_id == machine.id
+    ).one()
+    db.session.rollback()
+
+
+def report_counter(machine_id):
+    machine = db.session.get(Machine, machine_id)
+    old_hours = machine.hours or 0.0
+    # Incrément calculé par la base : aucune mise à jour perdue entre threads
+    machine.hours = Machine.hours + 1
+    db.session.add(CounterLog(machine_id=machine.id, previous_hours=old_hours, new_hours=old_hours + 1))
+    db.session.commit()
+
+
+def worker(machine_ids, deadline, write_percent, stats, lock):
+    latencies = {"read": [], "write": []}
+    locked = errors = 0
+    rng = random.Random()
+    while time.monotonic() < deadline:
+        kind = "write" if rng.randrange(100) < write_percent else "read"
+        machine_id = rng.choice(machine_ids)
+        started = time.perf_counter()
+        with app.app_context():
+            try:
+                (report_counter if kind == "write" else read)(machine_id)
+                latencies[kind].append(time.perf_counter() - started)
+            except OperationalError as exc:
+                db.session.rollback()
+                if "locked" in str(exc) or "busy" in str(exc):
+                    locked += 1
+                else:
+                    errors += 1
+    with lock:
+        for kind, values in latencies.items():
+            stats[kind].extend(values)
+        stats["locked"] += locked
+        stats["errors"] += errors
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))] * 1000
+
+
+def main(thread_count=16, duration=10.0, write_percent=20):
+    suffix = uuid.uuid4().hex[:8]
+    with app.app_context():
+        engine = db.engine
+        profile = f"{engine.dialect.name}"
+        if engine.dialect.name == "sqlite":
+            with engine.connect() as conn:
+                journal = conn.exec_driver_sql("PRAGMA journal_mode").scalar()
+                timeout = conn.exec_driver_sql("PRAGMA busy_timeout").scalar()
+                synchronous = conn.exec_driver_sql("PRAGMA synchronous").scalar()
+            profile += f" (journal_mode={journal}, busy_timeout={timeout} ms, synchronous={synchronous})"
+        else:
+            profile += f" ({engine.pool.status()})"
+        machines = [
+            Machine(name=f"Test concurrence {suffix} {i}", code=f"TDB{suffix}{i}", hour_counter_enabled=True, hours=0.0)
+            for i in range(MACHINES)
+        ]
+        db.session.add_all(machines)
+        db.session.commit()
+        machine_ids = [machine.id for machine in machines]
+
+    print(f"Base : {profile}")
+    print(f"{thread_count} threads pendant {duration:.0f} s, {write_percent} % de relevés de compteur...")
+    stats = {"read": [], "write": [], "locked": 0, "errors": 0}
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+    try:
+        threads = [threading.Thread(target=worker, args=(machine_ids, deadline, write_percent, stats, lock)) for _ in range(thread_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        with app.app_context():
+            hours = db.session.query(func.sum(Machine.hours)).filter(Machine.id.in_(machine_ids)).scalar() or 0
+            logs = CounterLog.query.filter(CounterLog.machine_id.in_(machine_ids)).count()
+    finally:
+        with app.app_context():
+            CounterLog.query.filter(CounterLog.machine_id.in_(machine_ids)).delete(synchronize_session=False)
+            Machine.query.filter(Machine.id.in_(machine_ids)).delete(synchronize_session=False)
+            db.session.commit()
+
+    for kind, label in (("read", "Lectures"), ("write", "Relevés")):
+        values = stats[kind]
+        print(
+            f"{label} : {len(values) / duration:.0f}/s, médiane {statistics.median(values) * 1000 if values else 0:.1f} ms, "
+            f"p95 {percentile(values, 95):.1f} ms, p99 {percentile(values, 99):.1f} ms"
+        )
+    print(f"Erreurs de verrou : {stats['locked']}, autres erreurs : {stats['errors']}")
+    if logs != len(stats["write"]) or hours != logs:
+        print(f"ERREUR: {len(stats['write'])} relevés validés mais {logs} lignes counter_log et {hours:.0f} heures.")
+        return 1
+    if stats["locked"] or stats["errors"]:
+        print("ERREUR: Des opérations ont échoué.")
+        return 1
+    print("OK: Aucune opération refusée, les compteurs sont cohérents.")
+    return 0
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    sys.exit(main(
+        int(args[0]) if len(args) > 0 else 16,
+        float(args[1]) if len(args) > 1 else 10.0,
+        int(args[2]) if len(args) > 2 else 20,
+    ))
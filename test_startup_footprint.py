@@ -0,0 +1,97 @@
+"""Script de test : temps d'import de l'application et mémoire d'un worker après démarrage.
+
+Chaque mesure est faite dans un processus neuf (comme un worker gunicorn) sur une
+base SQLite temporaire vide : l'import ne doit ni toucher au schéma, ni démarrer de
+thread (chargement dans le maître de gunicorn avant le fork), ni charger les
+bibliothèques réservées aux exports, imports, PDF et QR codes (openpyxl,
+reportlab, qrcode, Pillow). Le script échoue dans ces cas ou si les médianes
+dépassent les seuils donnés.
+
+Usage : python test_startup_footprint.py [mesures] [import_max_ms] [rss_max_mo]
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+
+BASE_DIR = Path(__file__).resolve().parent
+HEAVY_MODULES = ("openpyxl", "reportlab", "qrcode", "PIL")
+
+CHILD = """
+import json, os, sys, threading, time
+
+def rss_mb():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+baseline = rss_mb()
+started = time.perf_counter()
+import app
+elapsed = (time.perf_counter() - started) * 1000
+print(json.dumps({
+    "import_ms": elapsed,
+    "rss_mb": rss_mb(),
+    "interpreter_mb": baseline,
+    "heavy": [name for name in %r if name in sys.modules],
+    "threads": threading.active_count(),
+}))
+sys.stdout.flush()
+os._exit(0)
+""" % (HEAVY_MODULES,)
+
+
+def measure(database_url):
+    env = dict(os.environ, DATABASE_URL=database_url, PYTHONDONTWRITEBYTECODE="1")
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD], cwd=BASE_DIR, env=env, capture_output=True, text=True, check=True,
+    ).stdout
+    # Dernière ligne : les messages de démarrage de l'application la précèdent
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(runs=5, max_import_ms=1500, max_rss_mb=150):
+    with tempfile.TemporaryDirectory() as tmp:
+        database_url = f"sqlite:///{Path(tmp) / 'startup.db'}"
+        measure(database_url)  # Premier lancement : compilation des .pyc, non compté
+        results = [measure(database_url) for _ in range(runs)]
+
+    import_ms = statistics.median(result["import_ms"] for result in results)
+    rss_mb = statistics.median(result["rss_mb"] for result in results)
+    interpreter_mb = statistics.median(result["interpreter_mb"] for result in results)
+    heavy = sorted({name for result in results for name in result["heavy"]})
+    threads = max(result["threads"] for result in results)
+
+    print(f"Import de app.py : {import_ms:.0f} ms (médiane sur {runs} processus)")
+    print(f"Mémoire résidente après démarrage : {rss_mb:.1f} Mo (interpréteur seul : {interpreter_mb:.1f} Mo)")
+    errors = []
+    if heavy:
+        errors.append(f"Bibliothèques chargées au démarrage : {', '.join(heavy)}")
+    if threads > 1:
+        errors.append(f"{threads - 1} thread(s) démarré(s) à l'import")
+    if import_ms > max_import_ms:
+        errors.append(f"Import plus long que {max_import_ms:.0f} ms")
+    if rss_mb > max_rss_mb:
+        errors.append(f"Mémoire supérieure à {max_rss_mb:.0f} Mo")
+    for error in errors:
+        print(f"ERREUR: {error}")
+    if errors:
+        return 1
+    print("OK: Démarrage dans les limites.")
+    return 0
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    sys.exit(main(
+        int(args[0]) if len(args) > 0 else 5,
+        float(args[1]) if len(args) > 1 else 1500,
+        float(args[2]) if len(args) > 2 else 150,
+    ))
@@ -0,0 +1,91 @@
+"""Script de test : sorties de stock concurrentes depuis plusieurs threads.
+
+Crée un stock et un produit temporaires avec une quantité initiale, lance de
+nombreuses sorties simultanées et vérifie que la quantité ne devient jamais
+négative et que le nombre de sorties acceptées correspond au stock initial.
+
+Usage : python test_stock_concurrency.py [threads] [quantite_initiale]
+"""
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy.exc import OperationalError
+
+from app import (
+    app, db, LowStockItem, Movement, MovementItem, Product, Stock, StockLedgerEntry, StockProduct, StockSnapshot,
+    apply_movement_rules,
+)
+
+MAX_RETRIES = 20
+
+
+def sortie(stock_id, product_id):
+    """Tente une sortie d'une unité. Retourne True si elle a été enregistrée."""
+    for attempt in range(MAX_RETRIES):
+        with app.app_context():
+            movement = Movement(type="sortie", source_stock_id=stock_id)
+            movement.items.append(MovementItem(product_id=product_id, quantity=1))
+            try:
+                error = apply_movement_rules(movement)
+                if error:
+                    db.session.rollback()
+                    return False
+                db.session.add(movement)
+                db.session.commit()
+                return True
+            except OperationalError:
+                # SQLite : base verrouillée par un autre thread, on réessaie
+                db.session.rollback()
+                time.sleep(0.05 * (attempt + 1))
+    raise RuntimeError("Trop de tentatives sur une base verrouillée")
+
+
+def main(threads=50, initial_quantity=20):
+    suffix = uuid.uuid4().hex[:8]
+    with app.app_context():
+        stock = Stock(name=f"Test concurrence {suffix}", code=f"TC{suffix}")
+        product = Product(name=f"Produit concurrence {suffix}", code=f"PC{suffix}", price=0.0)
+        db.session.add_all([stock, product])
+        db.session.flush()
+        db.session.add(StockProduct(stock_id=stock.id, product_id=product.id, quantity=initial_quantity))
+        db.session.commit()
+        stock_id, product_id = stock.id, product.id
+
+    print(f"Lancement de {threads} sorties concurrentes sur un stock de {initial_quantity}...")
+    try:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            results = list(executor.map(lambda _: sortie(stock_id, product_id), range(threads)))
+
+        with app.app_context():
+            record = StockProduct.query.filter_by(stock_id=stock_id, product_id=product_id).one()
+            accepted = sum(results)
+            expected = min(threads, initial_quantity)
+            print(f"Sorties acceptées : {accepted}, quantité finale : {record.quantity}")
+            if record.quantity < 0:
+                print("ERREUR: La quantité est devenue négative.")
+                return 1
+            if accepted != expected or record.quantity != initial_quantity - accepted:
+                print(f"ERREUR: {expected} sorties attendues, quantité finale attendue {initial_quantity - expected}.")
+                return 1
+            print("OK: Aucune sortie en trop, le stock est cohérent.")
+            return 0
+    finally:
+        with app.app_context():
+            movement_ids = [m.id for m in Movement.query.filter_by(source_stock_id=stock_id).all()]
+            if movement_ids:
+                MovementItem.query.filter(MovementItem.movement_id.in_(movement_ids)).delete(synchronize_session=False)
+                Movement.query.filter(Movement.id.in_(movement_ids)).delete(synchronize_session=False)
+            StockProduct.query.filter_by(stock_id=stock_id).delete()
+            # Journal et photographies du stock de test (clés étrangères vérifiées, y compris sous SQLite)
+            StockLedgerEntry.query.filter_by(stock_id=stock_id).delete()
+            StockSnapshot.query.filter_by(stock_id=stock_id).delete()
+            LowStockItem.query.filter_by(product_id=product_id).delete()
+            db.session.delete(db.session.get(Stock, stock_id))
+            db.session.delete(db.session.get(Product, product_id))
+            db.session.commit()
+
+
+if __name__ == "__main__":
+    sys.exit(main(*(int(arg) for arg in sys.argv[1:3])))
@@ -0,0 +1,75 @@
+"""Script de test : traductions résolues à la compilation des templates.
+
+Compare, pour chaque langue, le rendu d'expressions t(...) par l'environnement de la
+langue (clés littérales traduites à la compilation) et par l'environnement de base
+(t() appelé au rendu), puis compile tous les templates de l'application dans chaque
+langue et mesure le temps de compilation avec le cache de bytecode vide puis rempli.
+
+Usage : python test_template_translations.py
+"""
+import shutil
+import sys
+import tempfile
+import time
+
+import template_i18n
+from app import app
+from template_i18n import LocalizedEnvironment
+from translations import CATALOGS, get_translator
+
+SAMPLES = [
+    "{{ t('Enregistrer') }}",
+    "{{ t(\"Modifier l'inventaire\") }}",
+    "<a title=\"{{ t('Supprimer') }}\">{{ t('Supprimer')|upper }}</a>",
+    "{{ t('Clé absente du catalogue <b>') }}",
+    "{{ t(label) }} {{ t('Stock' ~ suffix) }} {{ obj.t('Enregistrer') }}",
+    "{% if t('Oui') %}{{ [t('Oui'), t('Non')]|join(', ') }}{% endif %}",
+    "{% autoescape false %}{{ t('Clé <i>brute</i>') }}{% endautoescape %}",
+]
+
+
+class Obj:
+    @staticmethod
+    def t(key):
+        return f"[{key}]"
+
+
+def main(cache_dir):
+    # Cache de bytecode vide, propre à ce test
+    template_i18n.TEMPLATE_CACHE_DIR = cache_dir
+    errors = []
+    with app.test_request_context():
+        base = app.jinja_env
+        for lang in CATALOGS:
+            env = base.for_language(lang)
+            context = {"t": get_translator(lang), "label": "Supprimer", "suffix": "s", "obj": Obj()}
+            for source in SAMPLES:
+                expected = base.from_string(source).render(context)
+                compiled = env.from_string(source).render(context)
+                if compiled != expected:
+                    errors.append(f"{lang} {source!r} : {compiled!r} au lieu de {expected!r}")
+
+    timings = []
+    for _ in range(2):
+        env = LocalizedEnvironment(app, **app.jinja_options)
+        started = time.perf_counter()
+        compiled = env.precompile()
+        timings.append((time.perf_counter() - started) * 1000)
+    print(f"{compiled} templates compilés : {timings[0]:.0f} ms sans cache, {timings[1]:.0f} ms avec le cache de bytecode")
+    if timings[1] >= timings[0]:
+        errors.append("Le cache de bytecode n'accélère pas la compilation")
+
+    for error in errors:
+        print(f"ERREUR: {error}")
+    if errors:
+        return 1
+    print("OK: Traductions compilées identiques aux traductions au rendu.")
+    return 0
+
+
+if __name__ == "__main__":
+    cache_dir = tempfile.mkdtemp(prefix="jinja-cache-test-")
+    try:
+        sys.exit(main(cache_dir))
+    finally:
+        shutil.rmtree(cache_dir, ignore_errors=True)
@@ -1,6 +1,9 @@
 # Fichier de traductions pour l'interface utilisateur
 # Les données métier (noms de machines, produits, etc.) ne sont PAS traduites
 
+import hashlib
+from types import MappingProxyType
+
 TRANSLATIONS = {
     'fr': {
         # Navigation
@@ -1555,13 +1558,35 @@ TRANSLATIONS = {
     }
 }
 
+# Catalogues figés (lecture seule), construits une fois au chargement du module
+CATALOGS = {lang: MappingProxyType(dict(entries)) for lang, entries in TRANSLATIONS.items()}
+
+# Empreinte de chaque catalogue : invalide les templates compilés quand une traduction change
+CATALOG_VERSIONS = {
+    lang: hashlib.sha1(repr(sorted(catalog.items())).encode("utf-8")).hexdigest()[:12]
+    for lang, catalog in CATALOGS.items()
+}
+
+
+def _make_translator(catalog):
+    def t(key):
+        """Fonction de traduction pour les templates"""
+        return catalog.get(key, key)  # Retourne la clé si pas de traduction
+    return t
+
+
+TRANSLATORS = {lang: _make_translator(catalog) for lang, catalog in CATALOGS.items()}
+
+
+def get_translator(lang):
+    """Retourne la fonction t(key) d'une langue (français si la langue est inconnue)"""
+    return TRANSLATORS.get(lang) or TRANSLATORS['fr']
+
+
 def get_translation(key, lang='fr'):
     """Retourne la traduction d'une clé pour une langue donnée"""
-    if lang not in TRANSLATIONS:
-        lang = 'fr'  # Fallback sur français
-    return TRANSLATIONS[lang].get(key, key)  # Retourne la clé si pas de traduction
+    return get_translator(lang)(key)
 
 def get_language_from_session(session):
     """Récupère la langue depuis la session, défaut: français"""
     return session.get('language', 'fr')
-